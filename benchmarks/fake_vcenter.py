@@ -0,0 +1,459 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-process stand-in for vCenter, for benchmarking the worker.
+
+pyVmomi sends every method call and property read on a managed object through
+``stub.InvokeMethod`` or ``stub.InvokeAccessor``; that's where a real stub
+turns them into SOAP requests. ``Simulator`` plugs in at that same point, so the
+worker, ``vlab_inf_common`` and pyVmomi all run unmodified, and every call the
+simulator answers is one round-trip a real vCenter would have served.
+
+The simulator keeps a small object model (folders, VMs, networks and tasks),
+counts every call by type and name, and can add a fixed latency to each call
+and a duration to each task.
+"""
+import time
+import itertools
+import threading
+from datetime import datetime, timezone
+from collections import Counter
+
+from pyVmomi import vim, vmodl
+from vlab_inf_common.vmware.vcenter import vCenter
+
+
+DATACENTER = 'datacenter-1'
+TEMPLATE_SNAPSHOT = 'snapshot-base'
+
+
+class SimulatedVCenter(vCenter):
+    """A ``vlab_inf_common`` vCenter object, connected to a Simulator instead of a server
+
+    :param simulator: The simulated vCenter to talk to
+    :type simulator: Simulator
+    """
+    def __init__(self, simulator, base_dir):
+        self._conn = vim.ServiceInstance('ServiceInstance', simulator.stub)
+        self._base_dir = base_dir
+        self._net_cache = None
+
+    def close(self):
+        """Nothing to logout of"""
+        pass
+
+    def get_by_type(self, vimtype, root=None):
+        """Same calls as the parent class; its type check uses ``collections.Iterable``,
+        which Python 3.10 removed"""
+        if not isinstance(vimtype, (list, tuple)):
+            vimtype = [vimtype]
+        if root is None:
+            folder = self.content.rootFolder
+        else:
+            folder = self.get_vm_folder(path=self._base_dir)
+        entity = self.content.viewManager.CreateContainerView(container=folder, type=vimtype, recursive=True)
+        answer = entity.view
+        entity.DestroyView()
+        return answer
+
+
+def _typed(owner, name, value):
+    """Give a list the array type pyVmomi would have deserialized it as"""
+    if isinstance(value, list):
+        return owner._GetPropertyInfo(name).type(value)
+    return value
+
+
+class FakeStub(object):
+    """Hands pyVmomi calls to the Simulator
+
+    :param simulator: The simulated vCenter
+    :type simulator: Simulator
+    """
+    def __init__(self, simulator):
+        self._simulator = simulator
+        # vlab_inf_common.vCenter.cookie reads this
+        self.cookie = 'vmware_soap_session="simulated"'
+
+    def InvokeMethod(self, mo, info, args):
+        params = {x.name: y for x, y in zip(info.params, args)}
+        return self._simulator.invoke(mo, info.wsdlName, params)
+
+    def InvokeAccessor(self, mo, info):
+        return self._simulator.read(mo, info.name)
+
+
+class _Task(object):
+    """A vCenter task that finishes after a delay"""
+    def __init__(self, done_at, effect):
+        self.done_at = done_at
+        self.effect = effect
+        self.info = None
+
+
+class Simulator(object):
+    """A simulated vCenter, with one datacenter
+
+    :param latency: Seconds added to every call, like a network round-trip
+    :type latency: Float
+
+    :param task_seconds: How long every task takes to finish
+    :type task_seconds: Float
+
+    :param top_dir: The name of the folder vLab keeps user folders in
+    :type top_dir: String
+    """
+    def __init__(self, latency=0.0, task_seconds=0.0, top_dir='vlab'):
+        self.latency = latency
+        self.task_seconds = task_seconds
+        self.top_dir = top_dir
+        self.stub = FakeStub(self)
+        self.calls = Counter()
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._types = {}
+        self._props = {}
+        self._tasks = {}
+        self._pages = {}
+        self.root = self._add(vim.Folder, 'group-d1', name='Datacenters', childEntity=[])
+        self.datacenter = self._add(vim.Datacenter, DATACENTER, name='Datacenter', parent=self.root)
+        self._props['group-d1']['childEntity'].append(self.datacenter)
+        for attr, name in (('vmFolder', 'vm'), ('networkFolder', 'network'), ('hostFolder', 'host'),
+                           ('datastoreFolder', 'datastore')):
+            folder = self._add(vim.Folder, None, name=name, parent=self.datacenter, childEntity=[])
+            self._props[DATACENTER][attr] = folder
+        self.switch = self._add(vim.dvs.VmwareDistributedVirtualSwitch, None, name='vLabSwitch', uuid='dvs-uuid-1')
+        self.resource_pool = self._add(vim.ResourcePool, None, name='Resources')
+        self.top_folder = self.add_folder(self._props[DATACENTER]['vmFolder'], top_dir)
+        self.content = vim.ServiceInstanceContent(
+            rootFolder=self.root,
+            propertyCollector=self._add(vmodl.query.PropertyCollector, 'propertyCollector'),
+            viewManager=self._add(vim.view.ViewManager, 'ViewManager'),
+            searchIndex=self._add(vim.SearchIndex, 'SearchIndex'),
+            sessionManager=self._add(vim.SessionManager, 'SessionManager',
+                                     currentSession=vim.UserSession(key='simulated', userName='bench')),
+            setting=self._add(vim.option.OptionManager, 'VpxSettings',
+                              setting=[vim.option.OptionValue(key='VirtualCenter.FQDN', value='vcenter.simulated')]),
+            about=vim.AboutInfo(name='Simulated vCenter', instanceUuid='simulated-uuid'))
+        self._types['ServiceInstance'] = vim.ServiceInstance
+        self._props['ServiceInstance'] = {'content': self.content}
+
+    def connect(self):
+        """Log into the simulated vCenter
+
+        :Returns: SimulatedVCenter
+        """
+        return SimulatedVCenter(self, self.top_dir)
+
+    # -- the object model --
+
+    def _add(self, vimtype, moid, **props):
+        """Create a managed object"""
+        with self._lock:
+            if moid is None:
+                moid = '{}-{}'.format(vimtype.__name__.split('.')[-1].lower(), next(self._ids))
+            self._types[moid] = vimtype
+            self._props[moid] = props
+            return vimtype(moid, self.stub)
+
+    def _remove(self, mo):
+        """Delete a managed object"""
+        with self._lock:
+            self._types.pop(mo._moId, None)
+            self._props.pop(mo._moId, None)
+
+    def _check(self, mo):
+        """Raise the same fault vCenter does for an object that doesn't exist"""
+        if mo._moId not in self._props:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+
+    def add_folder(self, parent, name):
+        """Create a VM folder
+
+        :Returns: vim.Folder
+        """
+        folder = self._add(vim.Folder, None, name=name, parent=parent, childEntity=[])
+        self._props[parent._moId]['childEntity'].append(folder)
+        return folder
+
+    def add_network(self, name):
+        """Create a distributed port group
+
+        :Returns: vim.dvs.DistributedVirtualPortgroup
+        """
+        key = 'dvportgroup-{}'.format(next(self._ids))
+        config = vim.dvs.DistributedVirtualPortgroup.ConfigInfo(key=key, name=name,
+                                                                distributedVirtualSwitch=self.switch)
+        network = self._add(vim.dvs.DistributedVirtualPortgroup, key, name=name, key=key, config=config, vm=[])
+        self._props[self._props[DATACENTER]['networkFolder']._moId]['childEntity'].append(network)
+        return network
+
+    def add_vm(self, folder, name, annotation=None, network=None, powered_on=True):
+        """Create a VM with one NIC
+
+        :Returns: vim.VirtualMachine
+        """
+        nic = vim.vm.device.VirtualVmxnet3(key=4000,
+                                           deviceInfo=vim.Description(label='Network adapter 1', summary=''))
+        config = vim.vm.ConfigInfo(name=name, annotation=annotation, nestedHVEnabled=False,
+                                   hardware=vim.vm.VirtualHardware(device=[nic]))
+        the_vm = self._add(vim.VirtualMachine, None, name=name, parent=folder, config=config,
+                           runtime=vim.vm.RuntimeInfo(), guest=vim.vm.GuestInfo(net=[]), network=[],
+                           resourcePool=self.resource_pool, snapshot=None)
+        self._props[folder._moId]['childEntity'].append(the_vm)
+        self._power(the_vm, powered_on)
+        if network is not None:
+            self._connect(the_vm, network)
+        return the_vm
+
+    def add_template(self, folder, name):
+        """Create a base VM with a snapshot, for linked clones
+
+        :Returns: vim.VirtualMachine
+        """
+        template = self.add_vm(folder, name, powered_on=False)
+        snapshot = self._add(vim.vm.Snapshot, TEMPLATE_SNAPSHOT + '-' + template._moId)
+        self._props[template._moId]['snapshot'] = vim.vm.SnapshotInfo(
+            currentSnapshot=snapshot,
+            rootSnapshotList=[vim.vm.SnapshotTree(snapshot=snapshot, vm=template, name=TEMPLATE_SNAPSHOT, id=1,
+                                                  createTime=datetime.now(timezone.utc),
+                                                  state=vim.VirtualMachinePowerState.poweredOff,
+                                                  quiesced=False, replaySupported=False,
+                                                  description='')])
+        return template
+
+    def _power(self, the_vm, on):
+        """Change the power state of a VM; a running VM has an IP"""
+        props = self._props[the_vm._moId]
+        if on:
+            props['runtime'] = vim.vm.RuntimeInfo(powerState=vim.VirtualMachinePowerState.poweredOn)
+            ip = '10.{}.{}.{}'.format(*(int(the_vm._moId.split('-')[-1]) >> x & 255 for x in (16, 8, 0)))
+            props['guest'] = vim.vm.GuestInfo(net=[vim.vm.GuestInfo.NicInfo(ipAddress=[ip])])
+        else:
+            props['runtime'] = vim.vm.RuntimeInfo(powerState=vim.VirtualMachinePowerState.poweredOff)
+            props['guest'] = vim.vm.GuestInfo(net=[])
+
+    def _connect(self, the_vm, network):
+        """Move a VM onto a network"""
+        props = self._props[the_vm._moId]
+        for old in props['network']:
+            if old._moId in self._props:
+                self._props[old._moId]['vm'].remove(the_vm)
+        props['network'] = [network]
+        self._props[network._moId]['vm'].append(the_vm)
+
+    def _destroy(self, the_vm):
+        """Delete a VM"""
+        props = self._props[the_vm._moId]
+        self._props[props['parent']._moId]['childEntity'].remove(the_vm)
+        for network in props['network']:
+            self._props[network._moId]['vm'].remove(the_vm)
+        self._remove(the_vm)
+
+    # -- what pyVmomi calls --
+
+    def _count(self, mo, name):
+        """Record one call, and take as long as a real one would"""
+        with self._lock:
+            self.calls['{}.{}'.format(type(mo).__name__.split('.')[-1], name)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, mo, path):
+        """Read a property, or a path into one, i.e. ``runtime.powerState``"""
+        with self._lock:
+            self._check(mo)
+            if mo._moId in self._tasks:
+                self._finish(mo)
+            first, _, rest = path.partition('.')
+            value = _typed(type(mo), first, self._props[mo._moId].get(first, None))
+        for attr in rest.split('.') if rest else []:
+            if value is None:
+                break
+            value = _typed(type(value), attr, getattr(value, attr))
+        return value
+
+    def read(self, mo, name):
+        """Answer a property read
+
+        :Returns: The value of the property
+        """
+        self._count(mo, name)
+        return self._get(mo, name)
+
+    def invoke(self, mo, method, params):
+        """Answer a method call
+
+        :Returns: Whatever the method returns
+        """
+        self._count(mo, method)
+        handler = getattr(self, 'do_{}'.format(method), None)
+        if handler is None:
+            raise NotImplementedError('The simulator does not implement {}.{}'.format(type(mo).__name__, method))
+        with self._lock:
+            self._check(mo)
+            return handler(mo, **params)
+
+    # -- tasks --
+
+    def _task(self, effect):
+        """Start a task, that runs ``effect`` when it finishes"""
+        the_task = self._add(vim.Task, None)
+        self._tasks[the_task._moId] = _Task(time.time() + self.task_seconds, effect)
+        return the_task
+
+    def _finish(self, the_task):
+        """Update the info of a task, finishing it if its time is up"""
+        record = self._tasks[the_task._moId]
+        if record.info is not None and record.info.completeTime:
+            pass
+        elif time.time() < record.done_at:
+            record.info = vim.TaskInfo(key=the_task._moId, task=the_task, state=vim.TaskInfo.State.running)
+        else:
+            now = datetime.now(timezone.utc)
+            try:
+                result = record.effect()
+            except vmodl.MethodFault as doh:
+                record.info = vim.TaskInfo(key=the_task._moId, task=the_task, state=vim.TaskInfo.State.error,
+                                           error=doh, completeTime=now)
+            else:
+                record.info = vim.TaskInfo(key=the_task._moId, task=the_task, state=vim.TaskInfo.State.success,
+                                           result=result, completeTime=now)
+        self._props[the_task._moId]['info'] = record.info
+
+    def do_PowerOnVM_Task(self, mo, host=None):
+        return self._task(lambda: self._power(mo, True))
+
+    def do_PowerOffVM_Task(self, mo):
+        return self._task(lambda: self._power(mo, False))
+
+    def do_ResetVM_Task(self, mo):
+        return self._task(lambda: self._power(mo, True))
+
+    def do_Destroy_Task(self, mo):
+        return self._task(lambda: self._destroy(mo))
+
+    def _configure(self, mo, spec):
+        config = self._props[mo._moId]['config']
+        if spec.annotation is not None:
+            config.annotation = spec.annotation
+        if spec.nestedHVEnabled is not None:
+            config.nestedHVEnabled = spec.nestedHVEnabled
+        for change in spec.deviceChange or []:
+            backing = change.device.backing
+            if isinstance(backing, vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo):
+                self._connect(mo, vim.dvs.DistributedVirtualPortgroup(backing.port.portgroupKey, self.stub))
+
+    def do_ReconfigVM_Task(self, mo, spec):
+        return self._task(lambda: self._configure(mo, spec))
+
+    def do_CloneVM_Task(self, mo, folder, name, spec):
+        def effect():
+            for child in self._props[folder._moId]['childEntity']:
+                if self._props[child._moId]['name'] == name:
+                    raise vim.fault.DuplicateName(name=name, object=child,
+                                                  msg="The name '{}' already exists.".format(name))
+            new_vm = self.add_vm(folder, name, annotation=self._props[mo._moId]['config'].annotation,
+                                 powered_on=spec.powerOn)
+            if spec.config:
+                self._configure(new_vm, spec.config)
+            return new_vm
+        return self._task(effect)
+
+    # -- the service instance --
+
+    def do_RetrieveServiceContent(self, mo):
+        return self.content
+
+    def do_AcquireCloneTicket(self, mo):
+        return 'cst-simulated-{}'.format(next(self._ids))
+
+    def do_FindChild(self, mo, entity, name):
+        self._check(entity)
+        for child in self._props[entity._moId].get('childEntity', []):
+            if self._props[child._moId]['name'] == name:
+                return child
+        return None
+
+    def _children(self, mo):
+        """Everything directly below a folder or datacenter"""
+        props = self._props[mo._moId]
+        if isinstance(mo, vim.Datacenter):
+            return [props[x] for x in ('vmFolder', 'hostFolder', 'datastoreFolder', 'networkFolder')]
+        return list(props.get('childEntity', []))
+
+    def do_CreateContainerView(self, mo, container, type, recursive):
+        found = []
+        pending = self._children(container)
+        while pending:
+            item = pending.pop(0)
+            if any(isinstance(item, x) for x in type):
+                found.append(item)
+            if recursive:
+                pending.extend(self._children(item))
+        return self._add(vim.view.ContainerView, None, view=found)
+
+    def do_DestroyView(self, mo):
+        self._remove(mo)
+
+    # -- the property collector --
+
+    def _select(self, obj, skip, select_set, traversals, found):
+        """Walk the object graph like the PropertyCollector does"""
+        if obj is None or obj._moId not in self._props:
+            return
+        if not skip and obj._moId not in found:
+            found[obj._moId] = obj
+        for selection in select_set or []:
+            if isinstance(selection, vmodl.query.PropertyCollector.TraversalSpec):
+                spec = selection
+            else:
+                spec = traversals.get(selection.name, None)
+            if spec is None or not isinstance(obj, spec.type):
+                continue
+            value = self._props[obj._moId].get(spec.path, None)
+            for child in value if isinstance(value, list) else [value]:
+                self._select(child, spec.skip, spec.selectSet, traversals, found)
+
+    def _traversals(self, select_set, traversals):
+        """Index every named TraversalSpec, so a SelectionSpec can refer to it"""
+        for selection in select_set or []:
+            if isinstance(selection, vmodl.query.PropertyCollector.TraversalSpec):
+                if selection.name and selection.name not in traversals:
+                    traversals[selection.name] = selection
+                    self._traversals(selection.selectSet, traversals)
+
+    def do_RetrievePropertiesEx(self, mo, specSet, options):
+        objects = []
+        for filter_spec in specSet:
+            found = {}
+            for object_spec in filter_spec.objectSet:
+                self._check(object_spec.obj)
+                traversals = {}
+                self._traversals(object_spec.selectSet, traversals)
+                self._select(object_spec.obj, object_spec.skip, object_spec.selectSet, traversals, found)
+            for obj in found.values():
+                paths = [y for x in filter_spec.propSet if isinstance(obj, x.type) for y in x.pathSet]
+                if not paths:
+                    continue
+                prop_set = []
+                for path in paths:
+                    value = self._get(obj, path)
+                    if value is not None:
+                        prop_set.append(vmodl.DynamicProperty(name=path, val=value))
+                objects.append(vmodl.query.PropertyCollector.ObjectContent(obj=obj, propSet=prop_set))
+        return self._page(objects, options.maxObjects if options else None)
+
+    def do_ContinueRetrievePropertiesEx(self, mo, token):
+        objects, page_size = self._pages.pop(token)
+        return self._page(objects, page_size)
+
+    def _page(self, objects, page_size):
+        """Split a result into pages of at most ``page_size`` objects"""
+        if not objects:
+            return None
+        token = None
+        if page_size and len(objects) > page_size:
+            token = 'page-{}'.format(next(self._ids))
+            self._pages[token] = (objects[page_size:], page_size)
+            objects = objects[:page_size]
+        return vmodl.query.PropertyCollector.RetrieveResult(objects=objects, token=token)
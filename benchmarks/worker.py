@@ -0,0 +1,270 @@
+# -*- coding: UTF-8 -*-
+"""
+Benchmark how the worker's vCenter operations scale with the size of a user's
+inventory, against the simulated vCenter in ``fake_vcenter.py``.
+
+For every inventory size, each iteration runs ``show_esxi``, then creates a new
+instance with ``create_esxi``, moves it with ``update_network`` and removes it
+with ``delete_esxi``, so the folder stays the same size. Each operation reports
+its latency percentiles and how many calls it made to vCenter.
+
+Usage::
+
+    python -m benchmarks.worker --sizes 1,10,100,1000 --latency 0.002
+
+Use ``--max-calls show=20`` (repeatable) to fail, with exit code 1, when an
+operation makes more calls than that at any size; i.e. in CI.
+
+Creates use linked clones; uploading an OVA streams the disks to an ESXi host
+over HTTP, which the simulator does not do. The inventory cache and the task
+waiter are turned off, because they hold a ``WaitForUpdatesEx`` session of
+their own open.
+"""
+import sys
+import ssl
+import math
+import time
+import logging
+import argparse
+import datetime
+from contextlib import ExitStack, contextmanager
+from collections import Counter, OrderedDict
+from unittest.mock import patch
+
+import ujson
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from vlab_esxi_api.lib import const
+from vlab_esxi_api.lib.worker import deploy, inventory, session, vmware, waiter
+from benchmarks.fake_vcenter import Simulator
+
+
+USERNAME = 'bench'
+IMAGE = '6.7.0'
+OPERATIONS = ('show', 'create', 'update_network', 'delete')
+ESXI_META = ujson.dumps({'component': 'ESXi', 'created': 0, 'version': IMAGE, 'configured': False, 'generation': 1})
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def make_certificate():
+    """Create a self-signed certificate, for the console URLs to take a thumbprint of
+
+    :Returns: String
+    """
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'vcenter.simulated')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(1).not_valid_before(now).not_valid_after(now + datetime.timedelta(hours=1)) \
+        .sign(key, hashes.SHA256())
+    return cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+def build(size, latency, task_seconds):
+    """Make a simulated vCenter where the user already has some ESXi instances
+
+    :Returns: Simulator
+
+    :param size: How many ESXi instances the user has
+    :type size: Integer
+
+    :param latency: Seconds added to every call to vCenter
+    :type latency: Float
+
+    :param task_seconds: How long every vCenter task takes
+    :type task_seconds: Float
+    """
+    simulator = Simulator(latency=latency, task_seconds=task_seconds, top_dir=const.INF_VCENTER_TOP_LVL_DIR)
+    folder = simulator.add_folder(simulator.top_folder, USERNAME)
+    frontend = simulator.add_network('{}_frontend'.format(USERNAME))
+    simulator.add_network('{}_backend'.format(USERNAME))
+    for index in range(size):
+        simulator.add_vm(folder, 'esxi{}'.format(index), annotation=ESXI_META, network=frontend)
+    # i.e. vlab/templates/esxi
+    parent = simulator.top_folder
+    for name in const.VLAB_ESXI_TEMPLATE_DIR.strip('/').split('/')[1:]:
+        parent = simulator.add_folder(parent, name)
+    simulator.add_template(parent, deploy.template_name(IMAGE))
+    return simulator
+
+
+@contextmanager
+def simulated(simulator, certificate):
+    """Point the worker at a simulated vCenter for the duration of a ``with`` block
+
+    :Returns: None
+
+    :param simulator: The simulated vCenter
+    :type simulator: Simulator
+
+    :param certificate: The PEM certificate vCenter presents
+    :type certificate: String
+    """
+    with ExitStack() as stack:
+        session.POOL.close()
+        stack.callback(session.POOL.close)
+        stack.enter_context(patch.object(session.POOL, '_factory', simulator.connect))
+        stack.enter_context(patch.object(vmware, 'const', vmware.const._replace(VLAB_ESXI_INVENTORY_CACHE=False)))
+        stack.enter_context(patch.object(deploy, 'const', deploy.const._replace(VLAB_ESXI_DEPLOY_MODES='*=clone')))
+        stack.enter_context(patch.object(waiter.WAITER, '_enabled', False))
+        stack.enter_context(patch.object(inventory, 'INDEX', inventory.VMIndex(max_size=const.VLAB_ESXI_INDEX_SIZE)))
+        # Fetching the certificate is a TLS handshake, not a vCenter API call
+        stack.enter_context(patch.object(ssl, 'get_server_certificate', return_value=certificate))
+        yield
+
+
+def percentile(samples, percent):
+    """Obtain a percentile of some samples, by the nearest-rank method
+
+    :Returns: Float
+
+    :param samples: The samples, in any order
+    :type samples: List
+
+    :param percent: Which percentile, from 0 to 100
+    :type percent: Integer
+    """
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def measure(simulator, operation, *args):
+    """Run one operation, timing it and counting its calls to vCenter
+
+    :Returns: Tuple - (seconds, Counter of calls)
+    """
+    before = Counter(simulator.calls)
+    start = time.perf_counter()
+    operation(*args)
+    elapsed = time.perf_counter() - start
+    return elapsed, simulator.calls - before
+
+
+def run(size, iterations, latency=0.0, task_seconds=0.0, certificate=None):
+    """Benchmark every operation at one inventory size
+
+    :Returns: Dictionary - operation name to {'seconds': List, 'calls': List of Counter}
+
+    :param size: How many ESXi instances the user has
+    :type size: Integer
+
+    :param iterations: How many times to run each operation
+    :type iterations: Integer
+
+    :param latency: Seconds added to every call to vCenter
+    :type latency: Float
+
+    :param task_seconds: How long every vCenter task takes
+    :type task_seconds: Float
+
+    :param certificate: The PEM certificate vCenter presents; one is made if not supplied
+    :type certificate: String
+    """
+    if certificate is None:
+        certificate = make_certificate()
+    simulator = build(size, latency, task_seconds)
+    samples = OrderedDict((x, {'seconds': [], 'calls': []}) for x in OPERATIONS)
+    network = '{}_frontend'.format(USERNAME)
+    new_network = '{}_backend'.format(USERNAME)
+    with simulated(simulator, certificate):
+        for index in range(iterations):
+            machine_name = 'bench-new-{}'.format(index)
+            steps = (('show', vmware.show_esxi, USERNAME),
+                     ('create', vmware.create_esxi, USERNAME, machine_name, IMAGE, network, logger),
+                     ('update_network', vmware.update_network, USERNAME, machine_name, new_network),
+                     ('delete', vmware.delete_esxi, USERNAME, machine_name, logger))
+            for name, operation, *args in steps:
+                seconds, calls = measure(simulator, operation, *args)
+                samples[name]['seconds'].append(seconds)
+                samples[name]['calls'].append(calls)
+    return samples
+
+
+def summarize(size, samples):
+    """Reduce the samples of one size to percentiles and call counts
+
+    :Returns: List of Dictionaries
+    """
+    rows = []
+    for name, sample in samples.items():
+        total = sum(sample['calls'], Counter())
+        count = len(sample['seconds'])
+        rows.append({'size': size,
+                     'operation': name,
+                     'p50_ms': percentile(sample['seconds'], 50) * 1000,
+                     'p95_ms': percentile(sample['seconds'], 95) * 1000,
+                     'p99_ms': percentile(sample['seconds'], 99) * 1000,
+                     'max_ms': max(sample['seconds']) * 1000,
+                     'calls': sum(total.values()) / count,
+                     'by_call': {x: y / count for x, y in total.most_common()}})
+    return rows
+
+
+def parse_limits(values):
+    """Convert ``--max-calls`` values, i.e. ``show=20``, into a dictionary
+
+    :Returns: Dictionary
+
+    :Raises: ValueError
+
+    :param values: The ``<operation>=<calls>`` values
+    :type values: List
+    """
+    limits = {}
+    for value in values or []:
+        name, _, count = value.partition('=')
+        if name not in OPERATIONS or not count.isdigit():
+            raise ValueError('Expected <operation>=<calls>, got {}'.format(value))
+        limits[name] = int(count)
+    return limits
+
+
+def main(argv=None):
+    """Run the benchmark, and print the results
+
+    :Returns: Integer - the exit code
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1,10,100,1000',
+                        help='Comma separated inventory sizes to test. Default 1,10,100,1000')
+    parser.add_argument('--iterations', type=int, default=20, help='Runs of each operation per size. Default 20')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every vCenter call. Default 0')
+    parser.add_argument('--task-seconds', type=float, default=0.0, help='How long every vCenter task takes. Default 0')
+    parser.add_argument('--calls', action='store_true', help='Also show a breakdown of the calls each operation makes')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--max-calls', action='append', metavar='OPERATION=CALLS',
+                        help='Fail if an operation makes more calls than this, at any size')
+    args = parser.parse_args(argv)
+    try:
+        limits = parse_limits(args.max_calls)
+    except ValueError as doh:
+        parser.error(str(doh))
+    certificate = make_certificate()
+    rows = []
+    for size in [int(x) for x in args.sizes.split(',') if x.strip()]:
+        samples = run(size, args.iterations, latency=args.latency, task_seconds=args.task_seconds,
+                      certificate=certificate)
+        rows.extend(summarize(size, samples))
+        if not args.json:
+            for row in rows[-len(OPERATIONS):]:
+                print('{size:>6} {operation:<15} p50 {p50_ms:>9.2f}ms  p95 {p95_ms:>9.2f}ms  '
+                      'p99 {p99_ms:>9.2f}ms  {calls:>8.1f} calls'.format(**row))
+                if args.calls:
+                    for call, count in row['by_call'].items():
+                        print('{:>30} {:>8.1f}'.format(call, count))
+    if args.json:
+        print(ujson.dumps(rows, indent=2))
+    failed = [x for x in rows if x['calls'] > limits.get(x['operation'], float('inf'))]
+    for row in failed:
+        print('{operation} made {calls:.1f} calls with {size} VMs'.format(**row), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
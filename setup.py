@@ -10,10 +10,11 @@ setup(name="vlab-esxi-api",
       author="Nicholas Willhite,",
       author_email='willnx84@gmail.com',
       version='2019.06.25',
-      packages=find_packages(),
+      packages=find_packages(exclude=['benchmarks']),
       include_package_data=True,
       package_files={'vlab_esxi_api' : ['app.ini']},
       description="esxi",
       install_requires=['flask', 'ldap3', 'pyjwt', 'uwsgi', 'vlab-api-common',
-                        'ujson', 'cryptography', 'vlab-inf-common', 'celery']
+                        'ujson', 'cryptography', 'vlab-inf-common', 'celery',
+                        'gevent']
       )
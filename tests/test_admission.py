@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in admission.py
+"""
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import admission
+
+
+def make_ticket(username, queued, started=None, slots=1):
+    """Create the record of a ticket"""
+    return {'username': username, 'slots': slots, 'queued': queued, 'started': started, 'renewed': time.time()}
+
+
+class TestSchedule(unittest.TestCase):
+    """A set of test cases for the ``schedule`` function"""
+    def test_fits(self):
+        """``schedule`` starts waiting tickets while there's room"""
+        tickets = {'a': make_ticket('bob', 1), 'b': make_ticket('sam', 2)}
+
+        start, waiting = admission.schedule(tickets, global_max=2, user_max=2)
+
+        self.assertEqual(start, ['a', 'b'])
+        self.assertEqual(waiting, [])
+
+    def test_global_max(self):
+        """``schedule`` never uses more than the global number of slots"""
+        tickets = {'a': make_ticket('bob', 1, started=1), 'b': make_ticket('sam', 2)}
+
+        start, waiting = admission.schedule(tickets, global_max=1, user_max=2)
+
+        self.assertEqual(start, [])
+        self.assertEqual(waiting, ['b'])
+
+    def test_user_max(self):
+        """``schedule`` skips a user at their cap, and starts someone else"""
+        tickets = {'a': make_ticket('bob', 1, started=1), 'b': make_ticket('bob', 2), 'c': make_ticket('sam', 3)}
+
+        start, waiting = admission.schedule(tickets, global_max=4, user_max=1)
+
+        self.assertEqual(start, ['c'])
+        self.assertEqual(waiting, ['b'])
+
+    def test_fair(self):
+        """``schedule`` has users take turns, instead of first come first served"""
+        tickets = {'a': make_ticket('bob', 1), 'b': make_ticket('bob', 2), 'c': make_ticket('bob', 3),
+                   'd': make_ticket('sam', 4)}
+
+        start, waiting = admission.schedule(tickets, global_max=2, user_max=4)
+
+        self.assertEqual(start, ['a', 'd'])
+        self.assertEqual(waiting, ['b', 'c'])
+
+    def test_big_ticket(self):
+        """``schedule`` starts a ticket bigger than the cap once nothing else runs"""
+        tickets = {'a': make_ticket('bob', 1, slots=10)}
+
+        start, _ = admission.schedule(tickets, global_max=2, user_max=2)
+
+        self.assertEqual(start, ['a'])
+
+    def test_no_limit(self):
+        """``schedule`` treats a cap of zero as no limit"""
+        tickets = {x: make_ticket('bob', x) for x in range(10)}
+
+        start, _ = admission.schedule(tickets, global_max=0, user_max=0)
+
+        self.assertEqual(len(start), 10)
+
+    def test_estimate_wait(self):
+        """``estimate_wait`` is based on how many slots are ahead in line"""
+        tickets = {'a': make_ticket('bob', 1), 'b': make_ticket('sam', 2), 'c': make_ticket('ann', 3)}
+
+        eta = admission.estimate_wait(tickets, ['a', 'b', 'c'], 'c', global_max=2, average=300)
+
+        self.assertEqual(eta, 600)
+
+    def test_estimate_wait_unknown(self):
+        """``estimate_wait`` returns None until a create has finished"""
+        tickets = {'a': make_ticket('bob', 1)}
+
+        self.assertEqual(admission.estimate_wait(tickets, ['a'], 'a', global_max=2, average=None), None)
+
+
+class TestAdmitted(unittest.TestCase):
+    """A set of test cases for the ``admitted`` function"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(admission, 'const')
+        self.fake_const = self.patcher.start()
+        self.fake_const.VLAB_ESXI_STATE_DIR = self.state_dir
+        self.fake_const.VLAB_ESXI_CREATE_MAX = 1
+        self.fake_const.VLAB_ESXI_CREATE_MAX_PER_USER = 1
+        self.fake_const.VLAB_ESXI_ADMISSION_POLL = 0
+        self.fake_const.VLAB_ESXI_ADMISSION_LEASE = 60
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.state_dir)
+
+    def test_admitted(self):
+        """``admitted`` holds a slot until the block exits"""
+        with admission.admitted('bob'):
+            tickets = admission._read()['tickets']
+            self.assertEqual(len(tickets), 1)
+            self.assertTrue(list(tickets.values())[0]['started'])
+
+        self.assertEqual(admission._read()['tickets'], {})
+
+    def test_average(self):
+        """``admitted`` records how long slots are held"""
+        with admission.admitted('bob'):
+            pass
+
+        self.assertTrue(admission._read()['average'] is not None)
+
+    def test_released_on_error(self):
+        """``admitted`` releases the slot if the create fails"""
+        with self.assertRaises(RuntimeError):
+            with admission.admitted('bob'):
+                raise RuntimeError('testing')
+
+        self.assertEqual(admission._read()['tickets'], {})
+
+    @patch.object(admission.time, 'sleep')
+    def test_waits(self, fake_sleep):
+        """``admitted`` waits for a free slot, and reports its place in line"""
+        holder = admission.Ticket('sam')
+        holder.check()
+        fake_sleep.side_effect = lambda x: holder.release()
+        on_wait = MagicMock()
+
+        with admission.admitted('bob', on_wait=on_wait):
+            pass
+
+        on_wait.assert_called_with(1, None)
+
+    def test_expired(self):
+        """``admitted`` drops the tickets of workers that died"""
+        holder = admission.Ticket('sam')
+        holder.check()
+        state = admission._read()
+        state['tickets'][holder.id]['renewed'] = 0
+        admission._write(state)
+
+        with admission.admitted('bob'):
+            self.assertNotIn(holder.id, admission._read()['tickets'])
+
+    @patch.object(admission, '_locked')
+    def test_state_error(self, fake_locked):
+        """``admitted`` runs the create anyway if the tickets can't be read"""
+        fake_locked.side_effect = OSError('testing')
+        ran = False
+
+        with admission.admitted('bob'):
+            ran = True
+
+        self.assertTrue(ran)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,6 +22,26 @@ class TestESXiViewSchema(unittest.TestCase):
         self.assertTrue(schema_valid)
 
 
+    def test_batch_post_schema(self):
+        """The schema defined for POST on /batch is valid"""
+        try:
+            Draft4Validator.check_schema(esxi.ESXiView.BATCH_POST_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_batch_delete_schema(self):
+        """The schema defined for DELETE on /batch is valid"""
+        try:
+            Draft4Validator.check_schema(esxi.ESXiView.BATCH_DELETE_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
     def test_get_schema(self):
         """The schema defined for GET on is valid"""
         try:
@@ -32,6 +52,16 @@ class TestESXiViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_get_args_schema(self):
+        """The schema defined for the args of GET on is valid"""
+        try:
+            Draft4Validator.check_schema(esxi.ESXiView.GET_ARGS_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
     def test_delete_schema(self):
         """The schema defined for DELETE on is valid"""
         try:
@@ -52,6 +82,26 @@ class TestESXiViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_images_args_schema(self):
+        """The schema defined for the args of GET on /images is valid"""
+        try:
+            Draft4Validator.check_schema(esxi.ESXiView.IMAGES_ARGS_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+    def test_task_args_schema(self):
+        """The schema defined for the args of GET on /task is valid"""
+        try:
+            Draft4Validator.check_schema(esxi.ESXiView.TASK_ARGS_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the worker benchmarks, and the simulated vCenter they use
+"""
+import unittest
+from unittest.mock import patch
+
+from vlab_esxi_api.lib.worker import vmware
+from benchmarks import worker
+from benchmarks.fake_vcenter import Simulator
+
+
+class TestSimulator(unittest.TestCase):
+    """A set of test cases for the simulated vCenter"""
+    @classmethod
+    def setUpClass(cls):
+        """Runs once before the test cases"""
+        cls.certificate = worker.make_certificate()
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.simulator = worker.build(3, latency=0, task_seconds=0)
+
+    def test_show(self):
+        """The worker can list the ESXi instances in the simulated vCenter"""
+        with worker.simulated(self.simulator, self.certificate):
+            output = vmware.show_esxi(worker.USERNAME)
+
+        self.assertEqual(sorted(output.keys()), ['esxi0', 'esxi1', 'esxi2'])
+        self.assertEqual(output['esxi0']['networks'], ['frontend'])
+
+    def test_lifecycle(self):
+        """The worker can create, move and delete an ESXi instance in the simulated vCenter"""
+        with worker.simulated(self.simulator, self.certificate):
+            vmware.create_esxi(worker.USERNAME, 'new', worker.IMAGE, 'bench_frontend', worker.logger)
+            vmware.update_network(worker.USERNAME, 'new', 'bench_backend')
+            moved = vmware.show_esxi(worker.USERNAME)['new']['networks']
+            vmware.delete_esxi(worker.USERNAME, 'new', worker.logger)
+            output = vmware.show_esxi(worker.USERNAME)
+
+        self.assertEqual(moved, ['backend'])
+        self.assertTrue('new' not in output)
+
+    def test_duplicate(self):
+        """The simulated vCenter refuses a VM with the same name as another in the folder"""
+        with worker.simulated(self.simulator, self.certificate):
+            with self.assertRaises(RuntimeError):
+                vmware.create_esxi(worker.USERNAME, 'esxi0', worker.IMAGE, 'bench_frontend', worker.logger)
+
+    def test_latency(self):
+        """Every call to the simulated vCenter takes ``latency`` seconds"""
+        simulator = Simulator(latency=0.5)
+        vcenter = simulator.connect()
+
+        with patch('benchmarks.fake_vcenter.time.sleep') as fake_sleep:
+            vcenter.content.rootFolder.childEntity
+
+        self.assertEqual(fake_sleep.call_count, 2)
+        fake_sleep.assert_called_with(0.5)
+        self.assertEqual(sum(simulator.calls.values()), 2)
+
+
+class TestWorkerBenchmark(unittest.TestCase):
+    """A set of test cases for benchmarks/worker.py"""
+    @classmethod
+    def setUpClass(cls):
+        """Runs once before the test cases"""
+        cls.certificate = worker.make_certificate()
+
+    def calls(self, size):
+        """Count the calls each operation makes, with a given inventory size"""
+        samples = worker.run(size, iterations=2, certificate=self.certificate)
+        return {x['operation']: x['calls'] for x in worker.summarize(size, samples)}
+
+    def test_constant_calls(self):
+        """Deleting or moving an instance makes the same calls no matter how many the user has"""
+        small = self.calls(1)
+        large = self.calls(50)
+
+        self.assertEqual(small['delete'], large['delete'])
+        self.assertEqual(small['update_network'], large['update_network'])
+
+    def test_percentile(self):
+        """``percentile`` uses the nearest rank"""
+        samples = list(range(1, 101))
+
+        self.assertEqual(worker.percentile(samples, 50), 50)
+        self.assertEqual(worker.percentile(samples, 99), 99)
+        self.assertEqual(worker.percentile([3, 1, 2], 100), 3)
+        self.assertEqual(worker.percentile([3], 50), 3)
+
+    def test_parse_limits(self):
+        """``parse_limits`` converts ``--max-calls`` values into a dictionary"""
+        limits = worker.parse_limits(['show=20', 'delete=7'])
+
+        self.assertEqual(limits, {'show': 20, 'delete': 7})
+
+    def test_parse_limits_bad(self):
+        """``parse_limits`` rejects an unknown operation"""
+        with self.assertRaises(ValueError):
+            worker.parse_limits(['power=3'])
+
+    @patch('builtins.print')
+    def test_main_limits(self, fake_print):
+        """``main`` exits non-zero when an operation makes more calls than allowed"""
+        ok = worker.main(['--sizes', '1', '--iterations', '1', '--max-calls', 'delete=100'])
+        too_many = worker.main(['--sizes', '1', '--iterations', '1', '--max-calls', 'delete=1'])
+
+        self.assertEqual(ok, 0)
+        self.assertEqual(too_many, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
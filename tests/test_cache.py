@@ -0,0 +1,205 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in cache.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import cache
+
+
+def make_change(name, val, op='assign'):
+    """Create a stand-in for a vmodl.query.PropertyCollector.Change"""
+    change = MagicMock()
+    change.name = name
+    change.val = val
+    change.op = op
+    return change
+
+
+def make_update(obj, kind='enter', **changes):
+    """Create a stand-in for a vmodl.query.PropertyCollector.UpdateSet with one object"""
+    object_update = MagicMock()
+    object_update.obj = obj
+    object_update.kind = kind
+    object_update.changeSet = [make_change(x.replace('__', '.'), y) for x, y in changes.items()]
+    update_set = MagicMock()
+    update_set.filterSet = [MagicMock(objectSet=[object_update])]
+    update_set.truncated = False
+    return update_set
+
+
+class TestInventoryCache(unittest.TestCase):
+    """A set of test cases for the InventoryCache object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache = cache.InventoryCache(factory=MagicMock(),
+                                          max_objects=10,
+                                          max_staleness=60,
+                                          wait_seconds=1,
+                                          retry_seconds=1)
+        self.cache._top_folder = 'group-v0'
+        self.cache.apply(make_update(cache.vim.Folder('group-v1'), name='bob', parent=cache.vim.Folder('group-v0')))
+        self.cache.apply(make_update(cache.vim.VirtualMachine('vm-1'),
+                                     name='myESXi',
+                                     parent=cache.vim.Folder('group-v1'),
+                                     config__annotation='{"component": "ESXi"}'))
+        self.cache.apply(make_update(cache.vim.VirtualMachine('vm-2'),
+                                     name='notMine',
+                                     parent=cache.vim.Folder('group-v9')))
+        self.cache._ready = True
+        self.cache._last_sync = cache.time.time()
+
+    def test_esxi_records(self):
+        """``InventoryCache`` - ``esxi_records`` only returns VMs in the user's folder"""
+        vms, _ = self.cache.esxi_records('bob')
+
+        self.assertEqual(list(vms.keys()), ['vm-1'])
+        self.assertEqual(vms['vm-1'][1]['config.annotation'], '{"component": "ESXi"}')
+
+    def test_esxi_records_no_folder(self):
+        """``InventoryCache`` - ``esxi_records`` returns None for an unknown user"""
+        self.assertTrue(self.cache.esxi_records('alice') is None)
+
+    def test_esxi_records_stale(self):
+        """``InventoryCache`` - ``esxi_records`` returns None when the stream has not confirmed recently"""
+        self.cache._last_sync = cache.time.time() - 600
+
+        self.assertTrue(self.cache.esxi_records('bob') is None)
+
+    def test_esxi_records_not_ready(self):
+        """``InventoryCache`` - ``esxi_records`` returns None before the initial load completes"""
+        self.cache._ready = False
+
+        self.assertTrue(self.cache.esxi_records('bob') is None)
+
+    def test_modify(self):
+        """``InventoryCache`` - a change to a VM is applied"""
+        self.cache.apply(make_update(cache.vim.VirtualMachine('vm-1'), kind='modify', runtime__powerState='poweredOff'))
+        vms, _ = self.cache.esxi_records('bob')
+
+        self.assertEqual(vms['vm-1'][1]['runtime.powerState'], 'poweredOff')
+        self.assertEqual(vms['vm-1'][1]['name'], 'myESXi')
+
+    def test_remove_property(self):
+        """``InventoryCache`` - a removed property is dropped"""
+        update = make_update(cache.vim.VirtualMachine('vm-1'), kind='modify')
+        update.filterSet[0].objectSet[0].changeSet = [make_change('config.annotation', None, op='remove')]
+        self.cache.apply(update)
+        vms, _ = self.cache.esxi_records('bob')
+
+        self.assertFalse('config.annotation' in vms['vm-1'][1])
+
+    def test_moved(self):
+        """``InventoryCache`` - a VM moved into the user's folder shows up"""
+        self.cache.apply(make_update(cache.vim.VirtualMachine('vm-2'), kind='modify', parent=cache.vim.Folder('group-v1')))
+        vms, _ = self.cache.esxi_records('bob')
+
+        self.assertEqual(set(vms.keys()), {'vm-1', 'vm-2'})
+
+    def test_leave(self):
+        """``InventoryCache`` - a destroyed VM is removed"""
+        self.cache.apply(make_update(cache.vim.VirtualMachine('vm-1'), kind='leave'))
+        vms, _ = self.cache.esxi_records('bob')
+
+        self.assertEqual(vms, {})
+
+    def test_networks(self):
+        """``InventoryCache`` - network names are cached"""
+        self.cache.apply(make_update(cache.vim.Network('network-1'), name='bob_lan'))
+        _, networks = self.cache.esxi_records('bob')
+
+        self.assertEqual(networks, {'network-1': 'bob_lan'})
+
+    def test_esxi_records_by_path(self):
+        """``InventoryCache`` - ``esxi_records`` ignores folders named after the user outside the vLab root"""
+        self.cache.apply(make_update(cache.vim.Folder('group-v7'), name='bob', parent=cache.vim.Folder('group-v1')))
+        self.cache.apply(make_update(cache.vim.VirtualMachine('vm-7'),
+                                     name='nested',
+                                     parent=cache.vim.Folder('group-v7')))
+
+        vms, _ = self.cache.esxi_records('bob')
+
+        self.assertEqual(list(vms.keys()), ['vm-1'])
+
+    def test_max_objects(self):
+        """``InventoryCache`` - raises RuntimeError when the tree is too big to cache"""
+        with self.assertRaises(RuntimeError):
+            for idx in range(10):
+                self.cache.apply(make_update(cache.vim.VirtualMachine('vm-1{}'.format(idx)), name='a'))
+
+    def test_max_objects_disables(self):
+        """``InventoryCache`` - a tree too big to cache turns the cache off, instead of reloading it"""
+        with self.assertRaises(RuntimeError):
+            for idx in range(10):
+                self.cache.apply(make_update(cache.vim.VirtualMachine('vm-1{}'.format(idx)), name='a'))
+
+        self.assertTrue(self.cache.esxi_records('bob') is None)
+        self.assertEqual(self.cache._count, 0)
+
+    @patch.object(cache.threading, 'Thread')
+    def test_start_disabled(self, fake_Thread):
+        """``InventoryCache`` - ``start`` does nothing once the cache is disabled"""
+        self.cache._disabled = True
+
+        self.cache.start()
+
+        self.assertFalse(fake_Thread.called)
+
+    @patch.object(cache.time, 'sleep')
+    def test_run_disabled(self, fake_sleep):
+        """``InventoryCache`` - the update stream stops, and does not reconnect, once the cache is disabled"""
+        def watch(vcenter):
+            self.cache._disabled = True
+            raise RuntimeError('testing')
+        self.cache._watch = watch
+
+        self.cache._run()
+
+        self.assertFalse(fake_sleep.called)
+
+    def test_leave_counted(self):
+        """``InventoryCache`` - a destroyed VM no longer counts toward the max"""
+        self.cache.apply(make_update(cache.vim.VirtualMachine('vm-1'), kind='leave'))
+
+        self.assertEqual(self.cache._count, 2)
+
+    @patch.object(cache, 'tree_spec')
+    def test_watch(self, fake_tree_spec):
+        """``InventoryCache`` - a timed out wait still confirms the cache is current"""
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        collector.WaitForUpdatesEx.side_effect = [None, RuntimeError('testing')]
+        self.cache._reset()
+
+        with self.assertRaises(RuntimeError):
+            self.cache._watch(fake_vcenter)
+
+        self.assertTrue(self.cache._ready)
+        self.assertTrue(collector.DestroyPropertyCollector.called)
+
+    @patch.object(cache, 'tree_spec')
+    def test_watch_truncated(self, fake_tree_spec):
+        """``InventoryCache`` - not ready until the initial load is completely applied"""
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        update = make_update(cache.vim.Folder('group-v1'), name='bob')
+        update.truncated = True
+        collector.WaitForUpdatesEx.side_effect = [update, RuntimeError('testing')]
+        self.cache._reset()
+
+        with self.assertRaises(RuntimeError):
+            self.cache._watch(fake_vcenter)
+
+        self.assertFalse(self.cache._ready)
+
+    def test_tree_spec(self):
+        """``tree_spec`` recursively selects the vLab folder tree"""
+        spec = cache.tree_spec(cache.vim.Folder('group-v1'))
+        traversal = spec.objectSet[0].selectSet[0]
+
+        self.assertEqual(traversal.selectSet[0].name, traversal.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,346 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in deploy.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import deploy
+
+
+class TestDeploy(unittest.TestCase):
+    """A set of test cases for deploy.py"""
+
+    @patch.object(deploy, 'const')
+    def test_deploy_mode(self, fake_const):
+        """``deploy_mode`` returns the mode configured for a specific image"""
+        fake_const.VLAB_ESXI_DEPLOY_MODES = '*=ova, 6.7u1=clone'
+
+        self.assertEqual(deploy.deploy_mode('6.7u1'), 'clone')
+
+    @patch.object(deploy, 'const')
+    def test_deploy_mode_default(self, fake_const):
+        """``deploy_mode`` returns the '*' mode for images without a specific mode"""
+        fake_const.VLAB_ESXI_DEPLOY_MODES = '*=clone,6.5=ova'
+
+        self.assertEqual(deploy.deploy_mode('6.7u1'), 'clone')
+
+    @patch.object(deploy, 'const')
+    def test_deploy_mode_unset(self, fake_const):
+        """``deploy_mode`` defaults to uploading the OVA"""
+        fake_const.VLAB_ESXI_DEPLOY_MODES = ''
+
+        self.assertEqual(deploy.deploy_mode('6.7u1'), 'ova')
+
+    def test_template_name(self):
+        """``template_name`` includes the version of ESXi"""
+        self.assertEqual(deploy.template_name('6.7u1'), 'esxi-6.7u1-base')
+
+    @patch.object(deploy, 'import_template')
+    @patch.object(deploy, 'template_folder')
+    def test_get_template(self, fake_template_folder, fake_import_template):
+        """``get_template`` returns the existing base VM"""
+        fake_vcenter = MagicMock()
+        base_vm = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = base_vm
+
+        output = deploy.get_template(fake_vcenter, '6.7u1', MagicMock(), MagicMock())
+
+        self.assertTrue(output is base_vm)
+        self.assertFalse(fake_import_template.called)
+
+    @patch.object(deploy, 'import_template')
+    @patch.object(deploy, 'template_folder')
+    def test_get_template_import(self, fake_template_folder, fake_import_template):
+        """``get_template`` imports the base VM the first time it's needed"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = None
+
+        output = deploy.get_template(fake_vcenter, '6.7u1', MagicMock(), MagicMock())
+
+        self.assertTrue(output is fake_import_template.return_value)
+
+    @patch.object(deploy, 'import_template')
+    @patch.object(deploy, 'template_folder')
+    def test_get_template_import_fails(self, fake_template_folder, fake_import_template):
+        """``get_template`` returns None if the base VM cannot be imported"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = None
+        fake_import_template.side_effect = RuntimeError('testing')
+
+        output = deploy.get_template(fake_vcenter, '6.7u1', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+
+    @patch.object(deploy, 'import_template')
+    @patch.object(deploy, 'template_folder')
+    def test_get_template_no_snapshot(self, fake_template_folder, fake_import_template):
+        """``get_template`` returns None if the base VM is still being imported"""
+        fake_vcenter = MagicMock()
+        base_vm = fake_vcenter.content.searchIndex.FindChild.return_value
+        base_vm.snapshot = None
+        base_vm.disabledMethod = ['CreateSnapshot_Task', 'PowerOnVM_Task']
+
+        output = deploy.get_template(fake_vcenter, '6.7u1', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertFalse(base_vm.CreateSnapshot_Task.called)
+
+    @patch.object(deploy, 'consume_task')
+    @patch.object(deploy, 'template_folder')
+    def test_get_template_repair(self, fake_template_folder, fake_consume_task):
+        """``get_template`` snapshots a base VM whose import stopped before the snapshot"""
+        fake_vcenter = MagicMock()
+        base_vm = fake_vcenter.content.searchIndex.FindChild.return_value
+        base_vm.snapshot = None
+        base_vm.disabledMethod = []
+        fake_logger = MagicMock()
+
+        output = deploy.get_template(fake_vcenter, '6.7u1', MagicMock(), fake_logger)
+
+        self.assertTrue(output is base_vm)
+        self.assertEqual(base_vm.CreateSnapshot_Task.call_args[1]['name'], deploy.BASE_SNAPSHOT)
+        self.assertTrue(fake_logger.warning.called)
+
+    @patch.object(deploy, 'consume_task')
+    @patch.object(deploy, 'template_folder')
+    def test_get_template_repair_fails(self, fake_template_folder, fake_consume_task):
+        """``get_template`` returns None if the base VM cannot be snapshot"""
+        fake_vcenter = MagicMock()
+        base_vm = fake_vcenter.content.searchIndex.FindChild.return_value
+        base_vm.snapshot = None
+        base_vm.disabledMethod = []
+        fake_consume_task.side_effect = RuntimeError('testing')
+
+        output = deploy.get_template(fake_vcenter, '6.7u1', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertFalse(deploy._IMPORT_LOCK.locked())
+
+    @patch.object(deploy, 'template_folder')
+    def test_get_template_repair_importing(self, fake_template_folder):
+        """``get_template`` leaves a base VM alone while this process is importing one"""
+        fake_vcenter = MagicMock()
+        base_vm = fake_vcenter.content.searchIndex.FindChild.return_value
+        base_vm.snapshot = None
+        base_vm.disabledMethod = []
+        with deploy._IMPORT_LOCK:
+            output = deploy.get_template(fake_vcenter, '6.7u1', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertFalse(base_vm.CreateSnapshot_Task.called)
+
+    @patch.object(deploy, 'import_template')
+    @patch.object(deploy, 'template_folder')
+    def test_get_template_importing(self, fake_template_folder, fake_import_template):
+        """``get_template`` does not import the same base VM twice at the same time"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.searchIndex.FindChild.return_value = None
+        with deploy._IMPORT_LOCK:
+            output = deploy.get_template(fake_vcenter, '6.7u1', MagicMock(), MagicMock())
+
+        self.assertTrue(output is None)
+        self.assertFalse(fake_import_template.called)
+
+    @patch.object(deploy, 'deploy_ova')
+    @patch.object(deploy, 'consume_task')
+    @patch.object(deploy, 'open_ova')
+    def test_import_template(self, fake_Ova, fake_consume_task, fake_deploy_ova):
+        """``import_template`` imports with nested virtualization enabled, and takes the base snapshot"""
+        fake_Ova.return_value.networks = ['VM Network']
+        base_vm = fake_deploy_ova.return_value
+        deploy.import_template(MagicMock(), '6.7u1', deploy.vim.Network('network-1'), MagicMock(), MagicMock())
+
+        spec = fake_deploy_ova.call_args[1]['config']
+        _, kwargs = base_vm.CreateSnapshot_Task.call_args
+
+        self.assertTrue(spec.nestedHVEnabled)
+        self.assertFalse(base_vm.ReconfigVM_Task.called)
+        self.assertEqual(kwargs['name'], deploy.BASE_SNAPSHOT)
+
+    def test_config_spec(self):
+        """``config_spec`` enables nested virtualization, and stores the meta data in the notes"""
+        meta_data = {'component': 'ESXi', 'created': 1, 'version': '6.7u1', 'configured': False, 'generation': 1}
+
+        spec = deploy.config_spec(meta_data)
+
+        self.assertTrue(spec.nestedHVEnabled)
+        self.assertEqual(deploy.ujson.loads(spec.annotation), meta_data)
+
+    def test_config_spec_no_nested_hv(self):
+        """``config_spec`` can leave nested virtualization alone"""
+        spec = deploy.config_spec(nested_hv=False)
+
+        self.assertTrue(spec.nestedHVEnabled is None)
+        self.assertTrue(spec.annotation is None)
+
+    def test_config_spec_bad_meta(self):
+        """``config_spec`` raises ValueError for invalid meta data"""
+        with self.assertRaises(ValueError):
+            deploy.config_spec({'component': 'ESXi'})
+
+    @patch.object(deploy, 'nic_spec')
+    @patch.object(deploy, 'consume_task')
+    def test_clone_vm_config(self, fake_consume_task, fake_nic_spec):
+        """``clone_vm`` clones with the supplied settings, along with the NIC change"""
+        fake_nic_spec.return_value = deploy.vim.vm.device.VirtualDeviceSpec()
+        template = MagicMock()
+        template.snapshot.currentSnapshot = None
+        template.resourcePool = None
+        config = deploy.vim.vm.ConfigSpec(nestedHVEnabled=True, annotation='{}')
+
+        deploy.clone_vm(template, MagicMock(), 'myESXi', MagicMock(), MagicMock(), config=config)
+        spec = template.CloneVM_Task.call_args[1]['spec']
+
+        self.assertTrue(spec.config.nestedHVEnabled)
+        self.assertEqual(spec.config.annotation, '{}')
+        self.assertEqual(len(spec.config.deviceChange), 1)
+
+    @patch.object(deploy, 'nic_spec')
+    @patch.object(deploy, 'vim')
+    @patch.object(deploy, 'consume_task')
+    def test_clone_vm(self, fake_consume_task, fake_vim, fake_nic_spec):
+        """``clone_vm`` makes a linked clone of the base snapshot"""
+        template = MagicMock()
+        output = deploy.clone_vm(template, MagicMock(), 'myESXi', MagicMock(), MagicMock())
+
+        _, relocate_kwargs = fake_vim.vm.RelocateSpec.call_args
+        _, clone_kwargs = fake_vim.vm.CloneSpec.call_args
+
+        self.assertTrue(output is fake_consume_task.return_value)
+        self.assertEqual(relocate_kwargs['diskMoveType'], 'createNewChildDiskBacking')
+        self.assertTrue(clone_kwargs['snapshot'] is template.snapshot.currentSnapshot)
+
+    def test_check_name(self):
+        """``check_name`` accepts a valid hostname"""
+        deploy.check_name('my-ESXi.01')
+
+    def test_check_name_bad(self):
+        """``check_name`` raises ValueError for an invalid machine name"""
+        with self.assertRaises(ValueError):
+            deploy.check_name('my_ESXi!')
+
+    @patch.object(deploy, 'active_hosts')
+    @patch.object(deploy, 'candidate_datastores')
+    @patch.object(deploy, 'candidate_pools')
+    def test_get_placement(self, fake_candidate_pools, fake_candidate_datastores, fake_active_hosts):
+        """``get_placement`` returns every resource pool, datastore and host a VM can go to"""
+        placement = deploy.get_placement(MagicMock())
+
+        self.assertTrue(placement.resource_pools is fake_candidate_pools.return_value)
+        self.assertTrue(placement.datastores is fake_candidate_datastores.return_value)
+        self.assertTrue(placement.hosts is fake_active_hosts.return_value)
+
+    @patch.object(deploy, 'wait_for_lease')
+    @patch.object(deploy, 'PLACER')
+    def test_deploy_ova_placement(self, fake_PLACER, fake_wait_for_lease):
+        """``deploy_ova`` imports to the datastore and resource pool the placement engine picks"""
+        resource_pool, datastore, host = MagicMock(), MagicMock(), MagicMock()
+        fake_PLACER.choose.return_value = (resource_pool, datastore, host)
+        fake_vcenter = MagicMock()
+        fake_vcenter.ovf_manager.CreateImportSpec.return_value.error = []
+
+        deploy.deploy_ova(fake_vcenter, MagicMock(), [], MagicMock(), 'myESXi', MagicMock(), placement=MagicMock())
+        _, kwargs = fake_vcenter.ovf_manager.CreateImportSpec.call_args
+
+        self.assertTrue(kwargs['datastore'] is datastore)
+        self.assertTrue(resource_pool.ImportVApp.called)
+        fake_PLACER.deploying.assert_called_with(datastore, resource_pool)
+
+    @patch.object(deploy, 'consume_task')
+    @patch.object(deploy, 'wait_for_lease')
+    @patch.object(deploy, 'PLACER')
+    def test_deploy_ova_config(self, fake_PLACER, fake_wait_for_lease, fake_consume_task):
+        """``deploy_ova`` imports the VM with the supplied settings, instead of reconfiguring it afterwards"""
+        fake_PLACER.choose.return_value = (MagicMock(), MagicMock(), MagicMock())
+        fake_vcenter = MagicMock()
+        import_spec = fake_vcenter.ovf_manager.CreateImportSpec.return_value
+        import_spec.error = []
+        import_spec.importSpec.configSpec = deploy.vim.vm.ConfigSpec(name='myESXi', annotation='from the OVF')
+        config = deploy.vim.vm.ConfigSpec(nestedHVEnabled=True, annotation='{}')
+
+        the_vm = deploy.deploy_ova(fake_vcenter, MagicMock(), [], MagicMock(), 'myESXi', MagicMock(),
+                                   placement=MagicMock(), config=config)
+        spec = import_spec.importSpec.configSpec
+
+        self.assertTrue(spec.nestedHVEnabled)
+        self.assertEqual(spec.annotation, '{}')
+        self.assertEqual(spec.name, 'myESXi')
+        self.assertFalse(the_vm.ReconfigVM_Task.called)
+
+    @patch.object(deploy, 'consume_task')
+    @patch.object(deploy, 'wait_for_lease')
+    @patch.object(deploy, 'PLACER')
+    def test_deploy_ova_config_vapp(self, fake_PLACER, fake_wait_for_lease, fake_consume_task):
+        """``deploy_ova`` reconfigures the VM when the OVA imports as a vApp"""
+        fake_PLACER.choose.return_value = (MagicMock(), MagicMock(), MagicMock())
+        fake_vcenter = MagicMock()
+        import_spec = fake_vcenter.ovf_manager.CreateImportSpec.return_value
+        import_spec.error = []
+        import_spec.importSpec.configSpec = None
+        config = deploy.vim.vm.ConfigSpec(nestedHVEnabled=True)
+
+        the_vm = deploy.deploy_ova(fake_vcenter, MagicMock(), [], MagicMock(), 'myESXi', MagicMock(),
+                                   placement=MagicMock(), config=config)
+
+        the_vm.ReconfigVM_Task.assert_called_with(config)
+
+    def test_nic_spec(self):
+        """``nic_spec`` connects the NIC to the distributed port group"""
+        nic = deploy.vim.vm.device.VirtualVmxnet3()
+        nic.deviceInfo = deploy.vim.Description(label='Network adapter 1', summary='')
+        the_vm = MagicMock()
+        the_vm.config.hardware.device = [nic]
+        network = MagicMock()
+        network.key = 'dvportgroup-1'
+        network.config.distributedVirtualSwitch.uuid = 'some-uuid'
+
+        spec = deploy.nic_spec(the_vm, network)
+
+        self.assertEqual(spec.device.backing.port.portgroupKey, 'dvportgroup-1')
+        self.assertTrue(spec.device.connectable.connected)
+
+    def test_nic_spec_disconnected(self):
+        """``nic_spec`` can unplug the NIC"""
+        nic = deploy.vim.vm.device.VirtualVmxnet3()
+        nic.deviceInfo = deploy.vim.Description(label='Network adapter 1', summary='')
+        the_vm = MagicMock()
+        the_vm.config.hardware.device = [nic]
+        network = MagicMock()
+        network.key = 'dvportgroup-1'
+        network.config.distributedVirtualSwitch.uuid = 'some-uuid'
+
+        spec = deploy.nic_spec(the_vm, network, connected=False)
+
+        self.assertFalse(spec.device.connectable.connected)
+
+    def test_nic_spec_no_nic(self):
+        """``nic_spec`` raises RuntimeError if the VM has no such NIC"""
+        the_vm = MagicMock()
+        the_vm.config.hardware.device = []
+
+        with self.assertRaises(RuntimeError):
+            deploy.nic_spec(the_vm, MagicMock())
+
+    @patch.object(deploy.time, 'sleep')
+    def test_wait_for_lease_error(self, fake_sleep):
+        """``wait_for_lease`` raises RuntimeError if the lease fails"""
+        lease = MagicMock()
+        lease.error.msg = 'testing'
+
+        with self.assertRaises(RuntimeError):
+            deploy.wait_for_lease(lease)
+
+    @patch.object(deploy.time, 'sleep')
+    def test_wait_for_lease_timeout(self, fake_sleep):
+        """``wait_for_lease`` raises RuntimeError if the lease never becomes ready"""
+        lease = MagicMock()
+        lease.error = None
+        lease.state = 'initializing'
+
+        with self.assertRaises(RuntimeError):
+            deploy.wait_for_lease(lease, timeout=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,8 @@
 """
 A suite of tests for the esxi object
 """
+import shutil
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
@@ -33,6 +35,17 @@ class TestESXiView(unittest.TestCase):
         cls.fake_task = MagicMock()
         cls.fake_task.id = 'asdf-asdf-asdf'
         app.celery_app.send_task.return_value = cls.fake_task
+        cls.state_dir = tempfile.mkdtemp()
+        cls.singleflight_patcher = patch.object(esxi.singleflight, 'const')
+        fake_const = cls.singleflight_patcher.start()
+        fake_const.VLAB_ESXI_STATE_DIR = cls.state_dir
+        fake_const.VLAB_ESXI_SINGLEFLIGHT_FRESH = 5
+        fake_const.VLAB_ESXI_SINGLEFLIGHT_MAX_WAIT = 120
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.singleflight_patcher.stop()
+        shutil.rmtree(self.state_dir)
 
     def test_v1_deprecated(self):
         """ESXiView - GET on /api/1/inf/esxi returns an HTTP 404"""
@@ -64,6 +77,43 @@ class TestESXiView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    @patch.object(esxi.read_model, 'load')
+    def test_get_sync(self, fake_load):
+        """ESXiView - GET on /api/2/inf/esxi?sync=true returns the inventory inline"""
+        fake_load.return_value = ({'myESXi': {'worked': True}}, 3.2)
+        resp = self.app.get('/api/2/inf/esxi?sync=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'myESXi': {'worked': True}})
+        self.assertEqual(resp.headers['Age'], '3')
+
+    @patch.object(esxi.read_model, 'load')
+    def test_get_prefer_wait(self, fake_load):
+        """ESXiView - GET on /api/2/inf/esxi with 'Prefer: wait' returns the inventory inline"""
+        fake_load.return_value = ({'myESXi': {'worked': True}}, 3.2)
+        resp = self.app.get('/api/2/inf/esxi',
+                            headers={'X-Auth': self.token, 'Prefer': 'respond-async, wait=10'})
+
+        self.assertEqual(resp.status_code, 200)
+
+    @patch.object(esxi.read_model, 'load')
+    def test_get_sync_cold(self, fake_load):
+        """ESXiView - GET on /api/2/inf/esxi?sync=true falls back to a task when there's no recent inventory"""
+        fake_load.return_value = None
+        resp = self.app.get('/api/2/inf/esxi?sync=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['task-id'], 'asdf-asdf-asdf')
+
+    @patch.object(esxi.read_model, 'load')
+    def test_get_not_sync(self, fake_load):
+        """ESXiView - GET on /api/2/inf/esxi does not use the read-model unless asked to"""
+        self.app.get('/api/2/inf/esxi', headers={'X-Auth': self.token})
+
+        self.assertFalse(fake_load.called)
+
     def test_post_task(self):
         """ESXiView - POST on /api/2/inf/esxi returns a task-id"""
         resp = self.app.post('/api/2/inf/esxi',
@@ -133,5 +183,234 @@ class TestESXiView(unittest.TestCase):
         self.assertEqual(task_id, expected)
 
 
+    @patch.object(esxi.images, 'indexed')
+    def test_image_sync(self, fake_indexed):
+        """ESXiView - GET on ./image?sync=true returns the catalogue inline"""
+        fake_indexed.return_value = ([{'version': '6.7u1'}], True)
+        resp = self.app.get('/api/2/inf/esxi/image?sync=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'image': ['6.7u1'], 'catalogue': [{'version': '6.7u1'}]})
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(esxi.images, 'indexed')
+    def test_image_sync_incomplete(self, fake_indexed):
+        """ESXiView - GET on ./image?sync=true has the worker index images it has not described or hashed"""
+        fake_indexed.return_value = ([{'version': '6.7u1', 'checksum': None}], False)
+        resp = self.app.get('/api/2/inf/esxi/image?sync=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.app.application.celery_app.send_task.called)
+
+    @patch.object(esxi.images, 'indexed')
+    def test_image_sync_error(self, fake_indexed):
+        """ESXiView - GET on ./image?sync=true falls back to a task if the images cannot be read"""
+        fake_indexed.side_effect = OSError('testing')
+        resp = self.app.get('/api/2/inf/esxi/image?sync=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+
+    def test_task_progress(self):
+        """ESXiView - GET on ./task/<id> shows how far along an OVA upload is"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PROGRESS'
+        self.app.application.celery_app.AsyncResult.return_value.info = {'percent': 42}
+        resp = self.app.get('/api/2/inf/esxi/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['progress'], {'percent': 42})
+
+    def test_task_queued(self):
+        """ESXiView - GET on ./task/<id> shows a create's place in line"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'QUEUED'
+        self.app.application.celery_app.AsyncResult.return_value.info = {'position': 2, 'eta': 600}
+        resp = self.app.get('/api/2/inf/esxi/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['queue'], {'position': 2, 'eta': 600})
+
+    def test_task_success(self):
+        """ESXiView - GET on ./task/<id> returns the result of a finished task"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'SUCCESS'
+        self.app.application.celery_app.AsyncResult.return_value.result = {'content': {'worked': True}, 'error': None, 'params': {}}
+        resp = self.app.get('/api/2/inf/esxi/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'worked': True})
+
+    @patch.object(esxi.results, 'wait')
+    def test_task_wait(self, fake_wait):
+        """ESXiView - GET on ./task/<id>?wait=<seconds> holds the request until the task is done"""
+        fake_wait.return_value = 'SUCCESS'
+        self.app.application.celery_app.AsyncResult.return_value.status = 'SUCCESS'
+        self.app.application.celery_app.AsyncResult.return_value.result = {'content': {}, 'error': None, 'params': {}}
+        resp = self.app.get('/api/2/inf/esxi/task/asdf-asdf-asdf?wait=10',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(fake_wait.call_args[0][1], 10)
+
+    @patch.object(esxi.results, 'wait')
+    def test_task_wait_prefer(self, fake_wait):
+        """ESXiView - GET on ./task/<id> supports the header 'Prefer: wait=<seconds>'"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PENDING'
+        self.app.get('/api/2/inf/esxi/task/asdf-asdf-asdf',
+                     headers={'X-Auth': self.token, 'Prefer': 'wait=5'})
+
+        self.assertEqual(fake_wait.call_args[0][1], 5)
+
+    @patch.object(esxi.results, 'wait')
+    def test_task_wait_capped(self, fake_wait):
+        """ESXiView - GET on ./task/<id> does not hold a request longer than VLAB_ESXI_TASK_WAIT_MAX"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PENDING'
+        self.app.get('/api/2/inf/esxi/task/asdf-asdf-asdf?wait=9000',
+                     headers={'X-Auth': self.token})
+
+        self.assertEqual(fake_wait.call_args[0][1], esxi.const.VLAB_ESXI_TASK_WAIT_MAX)
+
+    @patch.object(esxi.results, 'wait')
+    def test_task_no_wait(self, fake_wait):
+        """ESXiView - GET on ./task/<id> returns right away by default"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PENDING'
+        self.app.get('/api/2/inf/esxi/task/asdf-asdf-asdf',
+                     headers={'X-Auth': self.token})
+
+        self.assertEqual(fake_wait.call_args[0][1], 0)
+
+    @patch.object(esxi.events, 'stream')
+    def test_events(self, fake_stream):
+        """ESXiView - GET on ./events streams Server-Sent Events for the user"""
+        fake_stream.return_value = iter(['retry: 3000\n\n'])
+        resp = self.app.get('/api/2/inf/esxi/events',
+                            headers={'X-Auth': self.token, 'Last-Event-ID': '1-2'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertEqual(resp.data, b'retry: 3000\n\n')
+        fake_stream.assert_called_with('bob', last_id='1-2')
+
+    def test_get_coalesced(self):
+        """ESXiView - GET on /api/2/inf/esxi reuses a listing task that's already in flight"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PENDING'
+        self.app.application.celery_app.AsyncResult.return_value.id = 'asdf-asdf-asdf'
+        self.app.get('/api/2/inf/esxi', headers={'X-Auth': self.token})
+        resp = self.app.get('/api/2/inf/esxi', headers={'X-Auth': self.token})
+
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+        self.assertEqual(resp.json['content']['task-id'], 'asdf-asdf-asdf')
+
+    def test_image_coalesced(self):
+        """ESXiView - GET on ./image reuses an image task that's already in flight"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'STARTED'
+        self.app.application.celery_app.AsyncResult.return_value.id = 'asdf-asdf-asdf'
+        self.app.get('/api/2/inf/esxi/image', headers={'X-Auth': self.token})
+        self.app.get('/api/2/inf/esxi/image', headers={'X-Auth': self.token})
+
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+
+    def test_post_forgets_listing(self):
+        """ESXiView - POST on /api/2/inf/esxi stops an in flight listing from being reused"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PENDING'
+        self.app.get('/api/2/inf/esxi', headers={'X-Auth': self.token})
+        self.app.post('/api/2/inf/esxi',
+                      headers={'X-Auth': self.token},
+                      json={'name': 'myESXi', 'image': '6.7u1', 'network': 'lab'})
+        self.app.get('/api/2/inf/esxi', headers={'X-Auth': self.token})
+
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 3)
+
+    def test_batch_create(self):
+        """ESXiView - POST on ./batch sends the esxi.batch_create task"""
+        resp = self.app.post('/api/2/inf/esxi/batch',
+                             headers={'X-Auth': self.token},
+                             json={'pattern': 'lab{}', 'count': 3, 'image': '6.7u1', 'network': 'lab'})
+
+        args, _ = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(args[0], 'esxi.batch_create')
+        self.assertEqual(args[1][1], ['lab1', 'lab2', 'lab3'])
+        self.assertEqual(args[1][3], 'bob_lab')
+
+    def test_batch_create_names(self):
+        """ESXiView - POST on ./batch accepts a list of names"""
+        resp = self.app.post('/api/2/inf/esxi/batch',
+                             headers={'X-Auth': self.token},
+                             json={'names': ['a', 'b'], 'image': '6.7u1', 'network': 'lab'})
+
+        args, _ = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(args[1][1], ['a', 'b'])
+
+    def test_batch_create_both(self):
+        """ESXiView - POST on ./batch returns HTTP 400 if given names and a pattern"""
+        resp = self.app.post('/api/2/inf/esxi/batch',
+                             headers={'X-Auth': self.token},
+                             json={'names': ['a'], 'pattern': 'lab{}', 'count': 1, 'image': '6.7u1', 'network': 'lab'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_batch_create_too_many(self):
+        """ESXiView - POST on ./batch returns HTTP 400 if asked to create too many instances"""
+        resp = self.app.post('/api/2/inf/esxi/batch',
+                             headers={'X-Auth': self.token},
+                             json={'pattern': 'lab{}', 'count': 9001, 'image': '6.7u1', 'network': 'lab'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    @patch.object(esxi, 'range', create=True)
+    def test_batch_create_huge_count(self, fake_range):
+        """ESXiView - POST on ./batch rejects a huge 'count' without making the names"""
+        resp = self.app.post('/api/2/inf/esxi/batch',
+                             headers={'X-Auth': self.token},
+                             json={'pattern': 'lab{}', 'count': 1000000000, 'image': '6.7u1', 'network': 'lab'})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(fake_range.called)
+
+    @patch.object(esxi, 'range', create=True)
+    def test_batch_names_too_many(self, fake_range):
+        """``batch_names`` checks the 'count' before making the names"""
+        with self.assertRaises(ValueError):
+            esxi.batch_names({'pattern': 'lab{}', 'count': 1000000000})
+
+        self.assertFalse(fake_range.called)
+
+    def test_batch_delete(self):
+        """ESXiView - DELETE on ./batch sends the esxi.batch_delete task"""
+        resp = self.app.delete('/api/2/inf/esxi/batch',
+                               headers={'X-Auth': self.token},
+                               json={'pattern': 'lab*'})
+
+        args, _ = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(args, ('esxi.batch_delete', ['bob', None, 'lab*', 'noId']))
+
+    def test_batch_delete_all(self):
+        """ESXiView - DELETE on ./batch can destroy everything"""
+        resp = self.app.delete('/api/2/inf/esxi/batch',
+                               headers={'X-Auth': self.token},
+                               json={'all': True})
+
+        args, _ = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(args, ('esxi.batch_delete', ['bob', None, None, 'noId']))
+
+    def test_batch_delete_ambiguous(self):
+        """ESXiView - DELETE on ./batch returns HTTP 400 unless exactly one option is supplied"""
+        resp = self.app.delete('/api/2/inf/esxi/batch',
+                               headers={'X-Auth': self.token},
+                               json={'all': True, 'names': ['a']})
+
+        self.assertEqual(resp.status_code, 400)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,207 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in events.py
+"""
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib import events
+
+
+class TestEvents(unittest.TestCase):
+    """A set of test cases for events.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(events, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESXI_STATE_DIR = self.state_dir
+        fake_const.VLAB_ESXI_EVENTS_MAX_BYTES = 1024 * 1024
+        self.fake_const = fake_const
+        self.hub = events.EventHub(poll_interval=1, max_queue=10)
+        # not starting the background thread; the tests call poll()
+        self.hub._pid = os.getpid()
+        self.hub._thread = MagicMock()
+        self.hub._thread.is_alive.return_value = True
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.state_dir)
+
+    def test_publish(self):
+        """``publish`` appends one event to the user's log"""
+        events.publish('bob', 'task', {'status': 'STARTED'})
+        events.publish('bob', 'task', {'status': 'SUCCESS'})
+        location = events._path('bob')
+
+        found, offset = events.read_events(location, os.stat(location).st_ino, 0)
+
+        self.assertEqual([x['data']['status'] for x in found], ['STARTED', 'SUCCESS'])
+        self.assertEqual(offset, os.stat(location).st_size)
+
+    def test_publish_rotates(self):
+        """``publish`` starts a new log once the current one is too big"""
+        self.fake_const.VLAB_ESXI_EVENTS_MAX_BYTES = 10
+        events.publish('bob', 'task', {'status': 'STARTED'})
+        before = os.stat(events._path('bob')).st_ino
+
+        events.publish('bob', 'task', {'status': 'SUCCESS'})
+        location = events._path('bob')
+        found, _ = events.read_events(location, 1, 0)
+
+        self.assertNotEqual(os.stat(location).st_ino, before)
+        self.assertEqual([x['data']['status'] for x in found], ['SUCCESS'])
+
+    def test_publish_concurrent(self):
+        """``publish`` never interleaves events published at the same time"""
+        threads = [threading.Thread(target=events.publish, args=('bob', 'task', {'status': x}))
+                   for x in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        location = events._path('bob')
+
+        found, _ = events.read_events(location, os.stat(location).st_ino, 0)
+
+        self.assertEqual(sorted(x['data']['status'] for x in found), list(range(16)))
+
+    @patch.object(events.filelock.time, 'sleep')
+    def test_publish_yields(self, fake_sleep):
+        """``publish`` sleeps, instead of blocking the process, while another holds the lock"""
+        holder = events.filelock.locked(events._path('bob', suffix='.lock'))
+        holder.__enter__()
+        fake_sleep.side_effect = lambda seconds: holder.__exit__(None, None, None)
+
+        events.publish('bob', 'task', {'status': 'STARTED'})
+
+        self.assertTrue(fake_sleep.called)
+
+    @patch.object(events.os, 'makedirs')
+    def test_publish_best_effort(self, fake_makedirs):
+        """``publish`` does not raise if the event cannot be written"""
+        fake_makedirs.side_effect = PermissionError('testing')
+
+        events.publish('bob', 'task', {})
+
+    def test_path_traversal(self):
+        """A username cannot escape the events directory"""
+        self.assertEqual(os.path.dirname(events._path('../../etc/passwd')),
+                         os.path.join(self.state_dir, 'events'))
+
+    def test_read_partial(self):
+        """``read_events`` leaves a partly written event for the next read"""
+        events.publish('bob', 'task', {'status': 'STARTED'})
+        location = events._path('bob')
+        size = os.stat(location).st_size
+        with open(location, 'ab') as the_file:
+            the_file.write(b'{"type": "task"')
+
+        found, offset = events.read_events(location, 1, 0)
+
+        self.assertEqual(len(found), 1)
+        self.assertEqual(offset, size)
+
+    def test_parse_id(self):
+        """``parse_id`` is the reverse of ``make_id``"""
+        self.assertEqual(events.parse_id(events.make_id(12, 34)), (12, 34))
+
+    def test_parse_id_invalid(self):
+        """``parse_id`` returns None for an id it did not make"""
+        self.assertTrue(events.parse_id('nope') is None)
+        self.assertTrue(events.parse_id(None) is None)
+
+    def test_to_sse(self):
+        """``to_sse`` formats an event per the Server-Sent Events spec"""
+        output = events.to_sse({'id': '1-2', 'type': 'task', 'data': {'a': 1}})
+
+        self.assertEqual(output, 'id: 1-2\nevent: task\ndata: {"a":1}\n\n')
+
+    def test_hub(self):
+        """``EventHub`` hands new events to every stream of the user"""
+        first = self.hub.subscribe('bob')
+        second = self.hub.subscribe('bob')
+        events.publish('bob', 'task', {'status': 'STARTED'})
+
+        self.hub.poll()
+
+        self.assertEqual(first.get(timeout=0)['data'], {'status': 'STARTED'})
+        self.assertEqual(second.get(timeout=0)['data'], {'status': 'STARTED'})
+
+    def test_hub_only_new(self):
+        """``EventHub`` does not replay old events to a new stream"""
+        events.publish('bob', 'task', {'status': 'STARTED'})
+        subscription = self.hub.subscribe('bob')
+
+        self.hub.poll()
+
+        with self.assertRaises(queue.Empty):
+            subscription.get(timeout=0)
+
+    def test_hub_other_user(self):
+        """``EventHub`` does not send a user's events to another user"""
+        subscription = self.hub.subscribe('alice')
+        events.publish('bob', 'task', {'status': 'STARTED'})
+
+        self.hub.poll()
+
+        with self.assertRaises(queue.Empty):
+            subscription.get(timeout=0)
+
+    def test_hub_resume(self):
+        """``EventHub`` replays the events after the client's last event id"""
+        events.publish('bob', 'task', {'status': 'STARTED'})
+        first = self.hub.subscribe('bob')
+        events.publish('bob', 'task', {'status': 'SUCCESS'})
+        self.hub.poll()
+        seen = first.get(timeout=0)
+        self.hub.unsubscribe(first)
+        events.publish('bob', 'task', {'status': 'woot'})
+
+        resumed = self.hub.subscribe('bob', last_id=seen['id'])
+
+        self.assertEqual(resumed.get(timeout=0)['data'], {'status': 'woot'})
+
+    def test_hub_unsubscribe(self):
+        """``EventHub`` stops watching a user's log once they have no streams"""
+        subscription = self.hub.subscribe('bob')
+
+        self.hub.unsubscribe(subscription)
+
+        self.assertEqual(self.hub._subscriptions, {})
+        self.assertEqual(self.hub._positions, {})
+
+    def test_subscription_overflow(self):
+        """A stream that falls too far behind is closed"""
+        subscription = events.Subscription('bob', max_size=1)
+        subscription.put({'id': '1-1'})
+        subscription.put({'id': '1-2'})
+
+        self.assertTrue(subscription.closed)
+        self.assertTrue(subscription.get(timeout=0) is None)
+
+    def test_stream(self):
+        """``stream`` yields events, and sends a comment when it's quiet"""
+        with patch.object(events, 'HUB', self.hub):
+            the_stream = events.stream('bob', heartbeat=0)
+            first = next(the_stream)
+            events.publish('bob', 'task', {'status': 'STARTED'})
+            self.hub.poll()
+            second = next(the_stream)
+            third = next(the_stream)
+            the_stream.close()
+
+        self.assertTrue(first.startswith('retry:'))
+        self.assertTrue(second.startswith('id: '))
+        self.assertEqual(third, ': keep-alive\n\n')
+        self.assertEqual(self.hub._subscriptions, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
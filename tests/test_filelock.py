@@ -0,0 +1,53 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in filelock.py
+"""
+import os
+import fcntl
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_esxi_api.lib import filelock
+
+
+class TestFileLock(unittest.TestCase):
+    """A set of test cases for filelock.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.location = os.path.join(self.tmp_dir, 'some', 'thing.lock')
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.tmp_dir)
+
+    def test_locked(self):
+        """``locked`` holds the lock until the block is done"""
+        with filelock.locked(self.location):
+            with open(self.location, 'a') as the_file:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with open(self.location, 'a') as the_file:
+            fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    @patch.object(filelock.time, 'sleep')
+    def test_locked_yields(self, fake_sleep):
+        """``locked`` sleeps, instead of blocking in ``flock``, while another holds the lock"""
+        os.makedirs(os.path.dirname(self.location))
+        holder = open(self.location, 'a')
+        fcntl.flock(holder, fcntl.LOCK_EX)
+        def release(seconds):
+            fcntl.flock(holder, fcntl.LOCK_UN)
+        fake_sleep.side_effect = release
+
+        with filelock.locked(self.location):
+            pass
+        holder.close()
+
+        fake_sleep.assert_called_once_with(filelock.POLL_SECONDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
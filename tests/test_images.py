@@ -0,0 +1,234 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in images.py
+"""
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib import images
+
+
+OVF = '<Envelope><NetworkSection><Network ovf:name="VM Network"></Network></NetworkSection></Envelope>'
+DISKS = """<DiskSection>
+  <Disk ovf:capacity="2" ovf:capacityAllocationUnits="byte * 2^30" ovf:diskId="vmdisk1"/>
+  <Disk ovf:capacity="1024" ovf:diskId="vmdisk2"/>
+</DiskSection>"""
+
+
+def make_ova(location, disk=b'some disk bytes'):
+    """Create a tiny OVA for testing"""
+    with tarfile.open(location, 'w') as the_tar:
+        for name, data in (('esxi.ovf', OVF.encode()), ('esxi-disk1.vmdk', disk)):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            the_tar.addfile(info, io.BytesIO(data))
+
+
+class TestImages(unittest.TestCase):
+    """A set of test cases for images.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.ova = os.path.join(self.state_dir, 'esxi-6.7u1.ova')
+        make_ova(self.ova)
+        self.patcher = patch.object(images, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESXI_STATE_DIR = self.state_dir
+        images._MEMO.clear()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.state_dir)
+
+    def test_scan(self):
+        """``scan`` records the OVF, networks, and where each disk is in the archive"""
+        entry = images.scan(self.ova)
+        disk = entry['disks'][0]
+        with open(self.ova, 'rb') as the_file:
+            the_file.seek(disk['offset'])
+            data = the_file.read(disk['size'])
+
+        self.assertEqual(entry['ovf'], OVF)
+        self.assertEqual(entry['networks'], ['VM Network'])
+        self.assertEqual(data, b'some disk bytes')
+
+    def test_describe(self):
+        """``describe`` saves the entry to the index file"""
+        images.describe(self.ova)
+
+        self.assertTrue('esxi-6.7u1.ova' in images._read_index())
+
+    @patch.object(images, 'scan')
+    def test_describe_cached(self, fake_scan):
+        """``describe`` does not rescan an OVA that has not changed"""
+        fake_scan.return_value = {'ovf': OVF, 'networks': [], 'disks': []}
+        images.describe(self.ova)
+        images._MEMO.clear()
+        images.describe(self.ova)
+
+        self.assertEqual(fake_scan.call_count, 1)
+
+    def test_describe_changed(self):
+        """``describe`` rescans an OVA that has been replaced"""
+        images.describe(self.ova)
+        make_ova(self.ova, disk=b'a much bigger disk than before')
+
+        entry = images.describe(self.ova)
+
+        self.assertEqual(entry['disks'][0]['size'], len(b'a much bigger disk than before'))
+
+    def test_describe_missing(self):
+        """``describe`` raises FileNotFoundError for an OVA that does not exist"""
+        with self.assertRaises(FileNotFoundError):
+            images.describe(os.path.join(self.state_dir, 'esxi-nope.ova'))
+
+    @patch.object(images.os, 'makedirs')
+    def test_describe_read_only(self, fake_makedirs):
+        """``describe`` still works if the index cannot be saved"""
+        fake_makedirs.side_effect = PermissionError('testing')
+
+        entry = images.describe(self.ova)
+
+        self.assertEqual(entry['networks'], ['VM Network'])
+
+
+    def test_disk_footprint(self):
+        """``disk_footprint`` adds up the capacity of every disk"""
+        self.assertEqual(images.disk_footprint(DISKS), 2 * 2**30 + 1024)
+
+    def test_convert_name(self):
+        """``convert_name`` pulls the version out of an OVA file name"""
+        self.assertEqual(images.convert_name('esxi-6.5u2.ova', to_version=True), '6.5u2')
+
+
+class TestCatalogue(unittest.TestCase):
+    """A set of test cases for the Catalogue object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.images_dir = tempfile.mkdtemp()
+        make_ova(os.path.join(self.images_dir, 'esxi-6.7u1.ova'))
+        self.patcher = patch.object(images, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESXI_STATE_DIR = self.state_dir
+        images._MEMO.clear()
+        self.catalogue = images.Catalogue(self.images_dir)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.state_dir)
+        shutil.rmtree(self.images_dir)
+
+    @patch.object(images.Catalogue, '_queue_checksum')
+    def test_entries(self, fake_queue_checksum):
+        """``Catalogue`` - ``entries`` describes every OVA in the images directory"""
+        entries = self.catalogue.entries()
+
+        self.assertEqual(entries[0]['version'], '6.7u1')
+        self.assertEqual(entries[0]['file'], 'esxi-6.7u1.ova')
+        self.assertTrue(entries[0]['checksum'] is None)
+        self.assertTrue(fake_queue_checksum.called)
+
+    @patch.object(images.Catalogue, '_queue_checksum')
+    @patch.object(images.os, 'listdir')
+    def test_entries_cached(self, fake_listdir, fake_queue_checksum):
+        """``Catalogue`` - ``entries`` does not list the images directory if it has not changed"""
+        fake_listdir.return_value = ['esxi-6.7u1.ova']
+        self.catalogue.entries()
+        self.catalogue.entries()
+
+        self.assertEqual(fake_listdir.call_count, 1)
+
+    @patch.object(images.Catalogue, '_queue_checksum')
+    def test_entries_ignores_junk(self, fake_queue_checksum):
+        """``Catalogue`` - ``entries`` skips files that are not usable OVAs"""
+        with open(os.path.join(self.images_dir, 'esxi-6.5.ova'), 'w') as the_file:
+            the_file.write('not a tar file')
+        with open(os.path.join(self.images_dir, 'README'), 'w') as the_file:
+            the_file.write('hello')
+
+        entries = self.catalogue.entries()
+
+        self.assertEqual([x['version'] for x in entries], ['6.7u1'])
+
+    @patch.object(images.Catalogue, '_queue_checksum')
+    def test_checksum(self, fake_queue_checksum):
+        """``Catalogue`` - ``checksum`` is recorded in the catalogue, and the index"""
+        self.catalogue.entries()
+        location = os.path.join(self.images_dir, 'esxi-6.7u1.ova')
+        checksum = self.catalogue.checksum(location)
+        images._MEMO.clear()
+
+        self.assertEqual(self.catalogue.entries()[0]['checksum'], checksum)
+        self.assertEqual(images.describe(location)['sha256'], checksum)
+
+
+class TestIndexed(unittest.TestCase):
+    """A set of test cases for the ``indexed`` function"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.images_dir = tempfile.mkdtemp()
+        self.ova = os.path.join(self.images_dir, 'esxi-6.7u1.ova')
+        make_ova(self.ova)
+        self.patcher = patch.object(images, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESXI_STATE_DIR = self.state_dir
+        fake_const.VLAB_ESXI_IMAGES_DIR = self.images_dir
+        images._MEMO.clear()
+        images._INDEXED['key'] = None
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.state_dir)
+        shutil.rmtree(self.images_dir)
+
+    @patch.object(images, 'scan')
+    def test_indexed_undescribed(self, fake_scan):
+        """``indexed`` skips an OVA the worker has not described, without opening it"""
+        entries, complete = images.indexed()
+
+        self.assertEqual(entries, [])
+        self.assertFalse(complete)
+        self.assertFalse(fake_scan.called)
+
+    def test_indexed_no_checksum(self):
+        """``indexed`` returns a null checksum for an OVA the worker has not hashed"""
+        images.describe(self.ova)
+
+        entries, complete = images.indexed()
+
+        self.assertEqual(entries[0]['version'], '6.7u1')
+        self.assertTrue(entries[0]['checksum'] is None)
+        self.assertFalse(complete)
+
+    def test_indexed_complete(self):
+        """``indexed`` is complete once the worker has described and hashed every OVA"""
+        images.describe(self.ova)
+        checksum = images.Catalogue(self.images_dir).checksum(self.ova)
+
+        entries, complete = images.indexed()
+
+        self.assertEqual(entries[0]['checksum'], checksum)
+        self.assertTrue(complete)
+
+    @patch.object(images, '_read_index')
+    def test_indexed_cached(self, fake_read_index):
+        """``indexed`` does not read the index again until it, or the images directory, changes"""
+        fake_read_index.return_value = {}
+        images.indexed()
+        images.indexed()
+
+        self.assertEqual(fake_read_index.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,282 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in inventory.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import inventory
+
+
+def make_content(obj, props):
+    """Create a stand-in for a vmodl.query.PropertyCollector.ObjectContent"""
+    prop_set = []
+    for name, val in props.items():
+        prop = MagicMock()
+        prop.name = name
+        prop.val = val
+        prop_set.append(prop)
+    content = MagicMock()
+    content.obj = obj
+    content.propSet = prop_set
+    return content
+
+
+def make_nic(ips):
+    """Create a stand-in for a vim.vm.GuestInfo.NicInfo"""
+    nic = MagicMock()
+    nic.ipAddress = ips
+    return nic
+
+
+class TestInventory(unittest.TestCase):
+    """A set of test cases for inventory.py"""
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        cls.object_specs = [inventory.folder_spec(inventory.vim.Folder('group-v1'))]
+        cls.property_specs = [inventory.vmodl.query.PropertyCollector.PropertySpec(type=inventory.vim.VirtualMachine,
+                                                                                   pathSet=['name'])]
+
+    def test_retrieve_pages(self):
+        """``retrieve`` follows the token until every page has been collected"""
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector
+        collector.RetrievePropertiesEx.return_value = MagicMock(objects=['a', 'b'], token='more')
+        collector.ContinueRetrievePropertiesEx.return_value = MagicMock(objects=['c'], token=None)
+
+        output = inventory.retrieve(fake_vcenter, self.object_specs, self.property_specs, page_size=2)
+        expected = ['a', 'b', 'c']
+
+        self.assertEqual(output, expected)
+
+    def test_retrieve_empty(self):
+        """``retrieve`` returns an empty list when nothing matches"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.propertyCollector.RetrievePropertiesEx.return_value = None
+
+        output = inventory.retrieve(fake_vcenter, self.object_specs, self.property_specs)
+
+        self.assertEqual(output, [])
+
+    @patch.object(inventory, 'retrieve')
+    def test_get_vm_records(self, fake_retrieve):
+        """``get_vm_records`` splits the collected objects into VMs and network names"""
+        the_vm = inventory.vim.VirtualMachine('vm-1')
+        fake_retrieve.return_value = [make_content(the_vm, {'name': 'myESXi'}),
+                                      make_content(inventory.vim.Network('network-1'), {'name': 'bob_lan'})]
+
+        vms, networks = inventory.get_vm_records(MagicMock(), inventory.vim.Folder('group-v1'))
+
+        self.assertEqual(vms, {'vm-1': (the_vm, {'name': 'myESXi'})})
+        self.assertEqual(networks, {'network-1': 'bob_lan'})
+
+    def test_parse_meta(self):
+        """``parse_meta`` loads the JSON notes of a VM"""
+        output = inventory.parse_meta('{"component": "ESXi"}')
+        expected = {'component': 'ESXi'}
+
+        self.assertEqual(output, expected)
+
+    def test_parse_meta_bad(self):
+        """``parse_meta`` returns the 'Unknown' meta data when the notes are not vLab meta data"""
+        for annotation in (None, '', 'some notes', '[]'):
+            output = inventory.parse_meta(annotation)
+
+            self.assertEqual(output, inventory.UNKNOWN_META)
+
+    def test_parse_ips(self):
+        """``parse_ips`` ignores IPv6 link local addresses"""
+        output = inventory.parse_ips([make_nic(['10.1.1.2', 'fe80::1']), make_nic(['192.168.1.1'])])
+        expected = ['10.1.1.2', '192.168.1.1']
+
+        self.assertEqual(output, expected)
+
+    def test_parse_ips_no_guest(self):
+        """``parse_ips`` returns an empty list when the VM has no guest info"""
+        self.assertEqual(inventory.parse_ips(None), [])
+
+    def test_parse_networks(self):
+        """``parse_networks`` only returns the user's networks, minus the username prefix"""
+        vm_networks = [inventory.vim.Network('network-1'), inventory.vim.Network('network-2')]
+        names = {'network-1': 'bob_lan', 'network-2': 'corporate'}
+
+        output = inventory.parse_networks(vm_networks, names, 'bob')
+        expected = ['lan']
+
+        self.assertEqual(output, expected)
+
+    @patch.object(inventory, 'INDEX')
+    @patch.object(inventory, 'ConsoleUrls')
+    @patch.object(inventory, 'get_vm_records')
+    def test_get_esxi_vms(self, fake_get_vm_records, fake_ConsoleUrls, fake_INDEX):
+        """``get_esxi_vms`` returns the same info as ``get_info``, but only for ESXi VMs"""
+        fake_ConsoleUrls.return_value.make.return_value = 'https://some-console'
+        esxi_props = {'name': 'myESXi',
+                      'runtime.powerState': 'poweredOn',
+                      'config.annotation': '{"component": "ESXi"}',
+                      'guest.net': [make_nic(['10.1.1.2'])],
+                      'network': [inventory.vim.Network('network-1')]}
+        other_props = {'name': 'myCentOS',
+                       'config.annotation': '{"component": "CentOS"}'}
+        fake_get_vm_records.return_value = ({'vm-1': (MagicMock(), esxi_props),
+                                             'vm-2': (MagicMock(), other_props)},
+                                            {'network-1': 'bob_lan'})
+
+        output = inventory.get_esxi_vms(MagicMock(), MagicMock(), 'bob')
+        expected = {'myESXi': {'state': 'poweredOn',
+                               'console': 'https://some-console',
+                               'ips': ['10.1.1.2'],
+                               'networks': ['lan'],
+                               'moid': 'vm-1',
+                               'meta': {'component': 'ESXi'}}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(inventory, 'OpenSSL')
+    @patch.object(inventory, 'ssl')
+    def test_console_urls(self, fake_ssl, fake_OpenSSL):
+        """``ConsoleUrls`` only looks up the vCenter details once"""
+        fake_vcenter = MagicMock()
+        consoles = inventory.ConsoleUrls(fake_vcenter)
+
+        consoles.make('vm-1', 'myESXi')
+        consoles.make('vm-2', 'myOtherESXi')
+
+        self.assertEqual(fake_ssl.get_server_certificate.call_count, 1)
+
+    @patch.object(inventory, 'OpenSSL')
+    @patch.object(inventory, 'ssl')
+    def test_console_urls_ticket(self, fake_ssl, fake_OpenSSL):
+        """``ConsoleUrls`` gets a new session ticket for every URL"""
+        fake_vcenter = MagicMock()
+        consoles = inventory.ConsoleUrls(fake_vcenter)
+
+        consoles.make('vm-1', 'myESXi')
+        consoles.make('vm-2', 'myOtherESXi')
+        session_manager = fake_vcenter.content.sessionManager
+
+        self.assertEqual(session_manager.AcquireCloneTicket.call_count, 2)
+
+
+class TestVMIndex(unittest.TestCase):
+    """A set of test cases for the VMIndex object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.index = inventory.VMIndex(max_size=2)
+        self.index._folders['bob'] = 'group-v2'
+        self.fake_vcenter = MagicMock()
+        self.fake_vcenter._conn._stub = None
+        self.esxi_props = {'name': 'myESXi',
+                           'parent': inventory.vim.Folder('group-v2'),
+                           'config.annotation': '{"component": "ESXi"}'}
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_esxi_hit(self, fake_retrieve):
+        """``VMIndex`` - a remembered VM is verified, not searched for"""
+        fake_retrieve.return_value = [make_content(inventory.vim.VirtualMachine('vm-9'), self.esxi_props)]
+        self.index.remember('bob', 'myESXi', 'vm-9')
+
+        the_vm = self.index.find_esxi(self.fake_vcenter, 'bob', 'myESXi')
+
+        self.assertEqual(the_vm._moId, 'vm-9')
+        self.assertFalse(self.fake_vcenter.content.searchIndex.FindChild.called)
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_esxi_miss(self, fake_retrieve):
+        """``VMIndex`` - an unknown VM is found via the SearchIndex, then remembered"""
+        fake_retrieve.return_value = [make_content(inventory.vim.VirtualMachine('vm-9'), self.esxi_props)]
+        self.fake_vcenter.content.searchIndex.FindChild.return_value = inventory.vim.VirtualMachine('vm-9')
+
+        the_vm = self.index.find_esxi(self.fake_vcenter, 'bob', 'myESXi')
+
+        self.assertEqual(the_vm._moId, 'vm-9')
+        self.assertEqual(self.index._vms[('bob', 'myESXi')], 'vm-9')
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_esxi_stale(self, fake_retrieve):
+        """``VMIndex`` - a remembered VM that was renamed is searched for again"""
+        renamed = dict(self.esxi_props)
+        renamed['name'] = 'someOtherName'
+        fake_retrieve.side_effect = [[make_content(inventory.vim.VirtualMachine('vm-9'), renamed)],
+                                     [make_content(inventory.vim.VirtualMachine('vm-10'), self.esxi_props)]]
+        self.fake_vcenter.content.searchIndex.FindChild.return_value = inventory.vim.VirtualMachine('vm-10')
+        self.index.remember('bob', 'myESXi', 'vm-9')
+
+        the_vm = self.index.find_esxi(self.fake_vcenter, 'bob', 'myESXi')
+
+        self.assertEqual(the_vm._moId, 'vm-10')
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_esxi_deleted(self, fake_retrieve):
+        """``VMIndex`` - a remembered VM that no longer exists is searched for again"""
+        fake_retrieve.side_effect = [inventory.vmodl.fault.ManagedObjectNotFound(),
+                                     [make_content(inventory.vim.VirtualMachine('vm-10'), self.esxi_props)]]
+        self.fake_vcenter.content.searchIndex.FindChild.return_value = inventory.vim.VirtualMachine('vm-10')
+        self.index.remember('bob', 'myESXi', 'vm-9')
+
+        the_vm = self.index.find_esxi(self.fake_vcenter, 'bob', 'myESXi')
+
+        self.assertEqual(the_vm._moId, 'vm-10')
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_esxi_not_found(self, fake_retrieve):
+        """``VMIndex`` - raises ValueError when the user has no VM by that name"""
+        self.fake_vcenter.content.searchIndex.FindChild.return_value = None
+
+        with self.assertRaises(ValueError):
+            self.index.find_esxi(self.fake_vcenter, 'bob', 'myESXi')
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_esxi_not_esxi(self, fake_retrieve):
+        """``VMIndex`` - raises ValueError when the VM by that name is not ESXi"""
+        not_esxi = dict(self.esxi_props)
+        not_esxi['config.annotation'] = '{"component": "CentOS"}'
+        fake_retrieve.return_value = [make_content(inventory.vim.VirtualMachine('vm-9'), not_esxi)]
+        self.fake_vcenter.content.searchIndex.FindChild.return_value = inventory.vim.VirtualMachine('vm-9')
+
+        with self.assertRaises(ValueError):
+            self.index.find_esxi(self.fake_vcenter, 'bob', 'myESXi')
+
+    @patch.object(inventory, 'retrieve')
+    def test_find_esxi_other_folder(self, fake_retrieve):
+        """``VMIndex`` - raises ValueError when the VM is not in the user's folder"""
+        moved = dict(self.esxi_props)
+        moved['parent'] = inventory.vim.Folder('group-v3')
+        fake_retrieve.return_value = [make_content(inventory.vim.VirtualMachine('vm-9'), moved)]
+        self.index.remember('bob', 'myESXi', 'vm-9')
+        self.fake_vcenter.content.searchIndex.FindChild.return_value = None
+
+        with self.assertRaises(ValueError):
+            self.index.find_esxi(self.fake_vcenter, 'bob', 'myESXi')
+
+    def test_folder_search(self):
+        """``VMIndex`` - a user's folder is found via the SearchIndex, then remembered"""
+        self.fake_vcenter.content.searchIndex.FindChild.return_value = inventory.vim.Folder('group-v7')
+
+        folder = self.index.folder(self.fake_vcenter, 'alice')
+        self.index.folder(self.fake_vcenter, 'alice')
+
+        self.assertEqual(folder._moId, 'group-v7')
+        self.assertEqual(self.fake_vcenter.content.searchIndex.FindChild.call_count, 1)
+
+    def test_folder_fallback(self):
+        """``VMIndex`` - falls back to a recursive search if the folder is not in the top level dir"""
+        self.fake_vcenter.content.searchIndex.FindChild.return_value = None
+        self.fake_vcenter.get_by_name.return_value = inventory.vim.Folder('group-v8')
+
+        folder = self.index.folder(self.fake_vcenter, 'alice')
+
+        self.assertEqual(folder._moId, 'group-v8')
+
+    def test_max_size(self):
+        """``VMIndex`` - forgets the least recently used VM when full"""
+        self.index.remember('bob', 'vm1', 'vm-1')
+        self.index.remember('bob', 'vm2', 'vm-2')
+        self.index.remember('bob', 'vm3', 'vm-3')
+
+        self.assertEqual(list(self.index._vms.keys()), [('bob', 'vm2'), ('bob', 'vm3')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in ipwatch.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import ipwatch
+
+
+def make_nic(*ips):
+    """Create a stand-in for a vim.vm.GuestInfo.NicInfo"""
+    nic = MagicMock()
+    nic.ipAddress = list(ips)
+    return nic
+
+
+def make_update(moid, kind='modify', guest_net=None):
+    """Create a stand-in for a vmodl.query.PropertyCollector.UpdateSet with one VM"""
+    object_update = MagicMock()
+    object_update.obj = ipwatch.vim.VirtualMachine(moid)
+    object_update.kind = kind
+    change = MagicMock()
+    change.name = 'guest.net'
+    change.val = guest_net
+    object_update.changeSet = [change]
+    update_set = MagicMock()
+    update_set.filterSet = [MagicMock(objectSet=[object_update])]
+    return update_set
+
+
+class TestIPWatcher(unittest.TestCase):
+    """A set of test cases for the IPWatcher object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(ipwatch, 'const')
+        self.patcher.start().VLAB_ESXI_STATE_DIR = self.state_dir
+        self.watcher = ipwatch.IPWatcher(factory=MagicMock(), timeout=600, wait_seconds=1, retry_seconds=1)
+        # pretend the update stream is running
+        self.watcher._pid = os.getpid()
+        self.watcher._thread = MagicMock()
+        self.watcher._thread.is_alive.return_value = True
+        self.watcher._vcenter = MagicMock()
+        self.watcher._collector = MagicMock()
+        self.info = {'ips': [], 'moid': 'vm-1', 'state': 'poweredOn', ipwatch.PENDING_KEY: True}
+
+    def tearDown(self):
+        """Runs after every test case"""
+        for record in self.watcher._pending.values():
+            if record.saved is not None:
+                record.saved.close()
+        self.patcher.stop()
+        shutil.rmtree(self.state_dir)
+
+    def _saved(self):
+        """The names of the saved pending VMs"""
+        return [x for x in os.listdir(os.path.join(self.state_dir, 'ipwatch')) if x.endswith('.json')]
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch(self, fake_read_model):
+        """``IPWatcher`` - the read-model is updated once a pending VM reports an IP"""
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.watcher.apply(make_update('vm-1', guest_net=[make_nic('fe80::1', '10.1.1.1')]))
+
+        fake_read_model.update.assert_called_with('bob', 'esxiBox', {'ips': ['10.1.1.1'],
+                                                                     'moid': 'vm-1',
+                                                                     'state': 'poweredOn'})
+        self.assertEqual(self.watcher.pending(), 0)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_destroys_filter(self, fake_read_model):
+        """``IPWatcher`` - the filter of a VM is removed once it has an IP"""
+        the_filter = self.watcher._collector.CreateFilter.return_value
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.watcher.apply(make_update('vm-1', guest_net=[make_nic('10.1.1.1')]))
+
+        self.assertTrue(the_filter.Destroy.called)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_ip_right_away(self, fake_read_model):
+        """``IPWatcher`` - a VM that has an IP as soon as its filter is made is not left pending"""
+        the_filter = MagicMock()
+        def create_filter(spec, partialUpdates):
+            self.watcher.apply(make_update('vm-1', guest_net=[make_nic('10.1.1.1')]))
+            return the_filter
+        self.watcher._collector.CreateFilter.side_effect = create_filter
+
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.assertTrue(fake_read_model.update.called)
+        self.assertTrue(the_filter.Destroy.called)
+        self.assertEqual(self.watcher.pending(), 0)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_link_local(self, fake_read_model):
+        """``IPWatcher`` - a link local IP does not count"""
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.watcher.apply(make_update('vm-1', guest_net=[make_nic('fe80::1')]))
+
+        self.assertFalse(fake_read_model.update.called)
+        self.assertEqual(self.watcher.pending(), 1)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_stale(self, fake_read_model):
+        """``IPWatcher`` - an IP the VM had on the standby network does not count"""
+        self.watcher.ignore('vm-1', ['192.168.1.5'])
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.watcher.apply(make_update('vm-1', guest_net=[make_nic('192.168.1.5')]))
+        self.assertFalse(fake_read_model.update.called)
+        self.watcher.apply(make_update('vm-1', guest_net=[make_nic('10.1.1.1')]))
+
+        self.assertEqual(fake_read_model.update.call_args[0][2]['ips'], ['10.1.1.1'])
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_deleted(self, fake_read_model):
+        """``IPWatcher`` - a VM that's deleted before it has an IP is forgotten"""
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.watcher.apply(make_update('vm-1', kind='leave'))
+
+        self.assertFalse(fake_read_model.update.called)
+        self.assertEqual(self.watcher.pending(), 0)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_not_ready(self, fake_read_model):
+        """``IPWatcher`` - a VM is watched once the update stream connects"""
+        collector = self.watcher._collector
+        self.watcher._collector = None
+
+        self.watcher.watch('bob', 'esxiBox', self.info)
+        self.assertFalse(collector.CreateFilter.called)
+        self.watcher._collector = collector
+        self.watcher._add_filter(self.watcher._pending['vm-1'])
+
+        self.assertEqual(collector.CreateFilter.call_count, 1)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_once(self, fake_read_model):
+        """``IPWatcher`` - a VM only ever has one filter"""
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.watcher._add_filter(self.watcher._pending['vm-1'])
+
+        self.assertEqual(self.watcher._collector.CreateFilter.call_count, 1)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_filter_fails(self, fake_read_model):
+        """``IPWatcher`` - a VM that cannot be watched is not left pending"""
+        self.watcher._collector.CreateFilter.side_effect = ipwatch.vmodl.fault.ManagedObjectNotFound()
+
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.assertEqual(self.watcher.pending(), 0)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_break(self, fake_read_model):
+        """``IPWatcher`` - VMs are watched again after the update stream reconnects"""
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.watcher._break()
+        self.watcher._collector = MagicMock()
+        self.watcher._add_filter(self.watcher._pending['vm-1'])
+
+        self.assertTrue(self.watcher._collector.CreateFilter.called)
+        self.assertEqual(self.watcher.pending(), 1)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_expire(self, fake_read_model):
+        """``IPWatcher`` - a VM that never reports an IP stops being pending"""
+        self.watcher._timeout = 0
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.watcher._expire()
+
+        fake_read_model.update.assert_called_with('bob', 'esxiBox', {'ips': [],
+                                                                     'moid': 'vm-1',
+                                                                     'state': 'poweredOn'})
+        self.assertEqual(self.watcher.pending(), 0)
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_saved(self, fake_read_model):
+        """``IPWatcher`` - a pending VM is saved until it has an IP"""
+        self.watcher.watch('bob', 'esxiBox', self.info)
+        self.assertEqual(self._saved(), ['vm-1.json'])
+
+        self.watcher.apply(make_update('vm-1', guest_net=[make_nic('10.1.1.1')]))
+
+        self.assertEqual(self._saved(), [])
+
+    @patch.object(ipwatch, 'read_model')
+    def test_watch_saved_expired(self, fake_read_model):
+        """``IPWatcher`` - a pending VM that times out is no longer saved"""
+        self.watcher._timeout = 0
+        self.watcher.watch('bob', 'esxiBox', self.info)
+
+        self.watcher._expire()
+
+        self.assertEqual(self._saved(), [])
+
+    @patch.object(ipwatch.threading, 'Thread')
+    @patch.object(ipwatch, 'read_model')
+    def test_resume(self, fake_read_model, fake_Thread):
+        """``IPWatcher`` - VMs left pending by a watcher that stopped are watched by the next one"""
+        self.watcher.ignore('vm-1', ['192.168.1.5'])
+        self.watcher.watch('bob', 'esxiBox', self.info)
+        other = ipwatch.IPWatcher(factory=MagicMock(), timeout=600, wait_seconds=1, retry_seconds=1)
+
+        other.resume()
+        # still being watched by the first watcher
+        self.assertEqual(other.pending(), 0)
+        self.watcher._pending['vm-1'].saved.close()
+        self.watcher._pending = {}
+        other._pid = None
+        other.resume()
+
+        record = other._pending['vm-1']
+        self.assertEqual((record.username, record.machine_name), ('bob', 'esxiBox'))
+        self.assertEqual(record.stale_ips, {'192.168.1.5'})
+        self.assertTrue(fake_Thread.return_value.start.called)
+        record.saved.close()
+
+    @patch.object(ipwatch.threading, 'Thread')
+    def test_resume_nothing(self, fake_Thread):
+        """``IPWatcher`` - ``resume`` does not start watching when nothing is pending"""
+        other = ipwatch.IPWatcher(factory=MagicMock(), timeout=600, wait_seconds=1, retry_seconds=1)
+
+        other.resume()
+
+        self.assertFalse(fake_Thread.called)
+
+    @patch.object(ipwatch.threading, 'Thread')
+    def test_start_after_fork(self, fake_Thread):
+        """``IPWatcher`` - a forked process does not inherit the pending VMs of its parent"""
+        self.watcher._pending['vm-1'] = MagicMock()
+        self.watcher._pid = -1
+
+        self.watcher.start()
+
+        self.assertEqual(self.watcher.pending(), 0)
+        self.assertTrue(fake_Thread.return_value.start.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,299 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in metrics.py
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib import metrics
+
+
+class TestHistogram(unittest.TestCase):
+    """A set of test cases for the Histogram object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.histogram = metrics.Histogram('testing_seconds', 'For testing', ('task',), (1, 5))
+
+    def test_observe(self):
+        """``observe`` counts a value in the first bucket it fits in"""
+        self.histogram.observe(0.5, 'esxi.show')
+        self.histogram.observe(1, 'esxi.show')
+        self.histogram.observe(3, 'esxi.show')
+        self.histogram.observe(100, 'esxi.show')
+
+        labels, counts, total = self.histogram.snapshot()[0]
+
+        self.assertEqual(labels, ['esxi.show'])
+        self.assertEqual(counts, [2, 1, 1])
+        self.assertEqual(total, 104.5)
+
+    def test_labels(self):
+        """Every combination of labels is its own series"""
+        self.histogram.observe(1, 'esxi.show')
+        self.histogram.observe(1, 'esxi.create')
+
+        self.assertEqual(len(self.histogram.snapshot()), 2)
+
+    def test_reset(self):
+        """``reset`` forgets every observation"""
+        self.histogram.observe(1, 'esxi.show')
+        self.histogram.reset()
+
+        self.assertEqual(self.histogram.snapshot(), [])
+
+
+class TestMetrics(unittest.TestCase):
+    """A set of test cases for metrics.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(metrics, 'const')
+        self.fake_const = self.patcher.start()
+        self.fake_const.VLAB_ESXI_STATE_DIR = self.state_dir
+        self.fake_const.VLAB_ESXI_METRICS_INTERVAL = 15
+        self.exporter_patcher = patch.object(metrics, 'EXPORTER')
+        self.exporter_patcher.start()
+        for histogram in metrics.HISTOGRAMS:
+            histogram.reset()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        metrics.end('ok')
+        for histogram in metrics.HISTOGRAMS:
+            histogram.reset()
+        self.exporter_patcher.stop()
+        self.patcher.stop()
+        shutil.rmtree(self.state_dir)
+
+    def test_begin_end(self):
+        """``end`` records how long the task took, labelled by ``begin``"""
+        metrics.begin('esxi.create', image='6.7.0')
+        metrics.end('ok')
+
+        labels, counts, _ = metrics.TASK_SECONDS.snapshot()[0]
+
+        self.assertEqual(labels, ['esxi.create', '6.7.0', 'ok'])
+        self.assertEqual(sum(counts), 1)
+        self.assertEqual(metrics.current(), ('', ''))
+
+    def test_end_without_begin(self):
+        """``end`` records nothing if no task began"""
+        metrics.end('ok')
+
+        self.assertEqual(metrics.TASK_SECONDS.snapshot(), [])
+
+    def test_phase(self):
+        """``phase`` records how long a block took, as part of the current task"""
+        metrics.begin('esxi.create', image='6.7.0')
+        with metrics.phase('upload'):
+            pass
+
+        labels, counts, _ = metrics.PHASE_SECONDS.snapshot()[0]
+
+        self.assertEqual(labels, ['esxi.create', '6.7.0', 'upload'])
+        self.assertEqual(sum(counts), 1)
+
+    def test_phase_error(self):
+        """``phase`` records the block even if it raises"""
+        with self.assertRaises(RuntimeError):
+            with metrics.phase('upload'):
+                raise RuntimeError('testing')
+
+        self.assertEqual(len(metrics.PHASE_SECONDS.snapshot()), 1)
+
+    def test_carry(self):
+        """``carry`` labels what a function records in another thread with the current task"""
+        metrics.begin('esxi.batch_create', image='6.7.0')
+        def work():
+            with metrics.phase('clone'):
+                pass
+        the_thread = threading.Thread(target=metrics.carry(work))
+        the_thread.start()
+        the_thread.join()
+
+        labels, _, _ = metrics.PHASE_SECONDS.snapshot()[0]
+
+        self.assertEqual(labels, ['esxi.batch_create', '6.7.0', 'clone'])
+
+    def test_instrument(self):
+        """``instrument`` times every method call and property read of a vCenter session"""
+        fake_vcenter = MagicMock()
+        stub = fake_vcenter._conn._stub
+        stub.InvokeMethod.return_value = 'some-result'
+        fake_mo = MagicMock()
+        fake_info = MagicMock()
+        fake_info.wsdlName = 'ReconfigVM_Task'
+        fake_info.name = 'runtime'
+        metrics.begin('esxi.create')
+
+        metrics.instrument(fake_vcenter)
+        output = stub.InvokeMethod(fake_mo, fake_info, ())
+        stub.InvokeAccessor(fake_mo, fake_info)
+
+        calls = sorted(x[0][1] for x in metrics.CALL_SECONDS.snapshot())
+        self.assertEqual(output, 'some-result')
+        self.assertEqual(calls, ['MagicMock.ReconfigVM_Task', 'MagicMock.runtime'])
+
+    def test_instrument_nested(self):
+        """``instrument`` counts a property read once, even when the stub reads it with a method call"""
+        fake_vcenter = MagicMock()
+        stub = fake_vcenter._conn._stub
+        fake_mo = MagicMock()
+        fake_info = MagicMock()
+        fake_info.name = 'runtime'
+        stub.InvokeAccessor.side_effect = lambda mo, info: stub.InvokeMethod(mo, info, ())
+
+        metrics.instrument(fake_vcenter)
+        stub.InvokeAccessor(fake_mo, fake_info)
+
+        labels, counts, _ = metrics.CALL_SECONDS.snapshot()[0]
+        self.assertEqual(labels, ['', 'MagicMock.runtime'])
+        self.assertEqual(sum(counts), 1)
+
+    def test_save_collect(self):
+        """``collect`` adds up the metrics saved by every worker process"""
+        metrics.begin('esxi.show')
+        metrics.end('ok')
+        metrics.save()
+        with patch.object(metrics.os, 'getpid', return_value=-1):
+            metrics.save()
+
+        totals = metrics.collect()
+        counts, _ = totals['vlab_esxi_task_seconds'][('esxi.show', '', 'ok')]
+
+        self.assertEqual(sum(counts), 2)
+
+    def _save_gone(self, pid):
+        """Save metrics as a worker process that's since stopped"""
+        with patch.object(metrics.os, 'getpid', return_value=pid):
+            metrics.save()
+        location = os.path.join(self.state_dir, 'metrics', '{}-{}.json'.format(metrics.socket.gethostname(), pid))
+        os.utime(location, (1, 1))
+        return location
+
+    def test_collect_prunes(self):
+        """``collect`` folds the files of gone worker processes into one, and keeps their counts"""
+        metrics.begin('esxi.show')
+        metrics.end('ok')
+        metrics.save()
+        location = self._save_gone(-1)
+
+        totals = metrics.collect()
+        counts, _ = totals['vlab_esxi_task_seconds'][('esxi.show', '', 'ok')]
+
+        self.assertEqual(sum(counts), 2)
+        self.assertFalse(os.path.exists(location))
+        self.assertTrue(os.path.exists(os.path.join(self.state_dir, 'metrics', metrics.RETIRED)))
+
+    def test_collect_prunes_monotonic(self):
+        """``collect`` adds to the counts already retired"""
+        metrics.begin('esxi.show')
+        metrics.end('ok')
+        self._save_gone(-1)
+        metrics.collect()
+        self._save_gone(-2)
+
+        totals = metrics.collect()
+        counts, _ = totals['vlab_esxi_task_seconds'][('esxi.show', '', 'ok')]
+
+        self.assertEqual(sum(counts), 2)
+        saved = [x for x in os.listdir(os.path.join(self.state_dir, 'metrics')) if x.endswith('.json')]
+        self.assertEqual(saved, [metrics.RETIRED])
+
+    def test_collect_concurrent(self):
+        """``collect`` never counts a retired file twice, or not at all, when called at the same time"""
+        metrics.begin('esxi.show')
+        metrics.end('ok')
+        for pid in range(-1, -6, -1):
+            self._save_gone(pid)
+        seen = []
+        def scrape():
+            counts, _ = metrics.collect()['vlab_esxi_task_seconds'][('esxi.show', '', 'ok')]
+            seen.append(sum(counts))
+        threads = [threading.Thread(target=scrape) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(seen, [5] * 8)
+
+    def test_save_error(self):
+        """``save`` logs, and does not raise, when it cannot write the metrics"""
+        self.fake_const.VLAB_ESXI_STATE_DIR = '/dev/null/nope'
+
+        metrics.save()
+
+    def test_collect_nothing(self):
+        """``collect`` works before any worker has saved metrics"""
+        totals = metrics.collect()
+
+        self.assertEqual(totals['vlab_esxi_task_seconds'], {})
+
+    def test_collect_bad_file(self):
+        """``collect`` skips files it cannot parse"""
+        os.makedirs(os.path.join(self.state_dir, 'metrics'))
+        with open(os.path.join(self.state_dir, 'metrics', 'bad.json'), 'w') as the_file:
+            the_file.write('not json')
+
+        totals = metrics.collect()
+
+        self.assertEqual(totals['vlab_esxi_task_seconds'], {})
+
+    def test_render(self):
+        """``render`` outputs cumulative buckets, a sum and a count for every series"""
+        totals = {'vlab_esxi_vcenter_call_seconds': {('esxi.show', 'Folder.name'): [[1] + [0] * 10 + [1], 20.0]}}
+
+        output = metrics.render(totals)
+
+        self.assertTrue('# TYPE vlab_esxi_vcenter_call_seconds histogram' in output)
+        self.assertTrue('vlab_esxi_vcenter_call_seconds_bucket{task="esxi.show",call="Folder.name",le="0.005"} 1' in output)
+        self.assertTrue('vlab_esxi_vcenter_call_seconds_bucket{task="esxi.show",call="Folder.name",le="10.0"} 1' in output)
+        self.assertTrue('vlab_esxi_vcenter_call_seconds_bucket{task="esxi.show",call="Folder.name",le="+Inf"} 2' in output)
+        self.assertTrue('vlab_esxi_vcenter_call_seconds_sum{task="esxi.show",call="Folder.name"} 20.0' in output)
+        self.assertTrue('vlab_esxi_vcenter_call_seconds_count{task="esxi.show",call="Folder.name"} 2' in output)
+
+    def test_render_escapes(self):
+        """``render`` escapes quotes in label values"""
+        totals = {'vlab_esxi_task_seconds': {('bad"task', '', 'ok'): [[1] + [0] * 12, 0.1]}}
+
+        output = metrics.render(totals)
+
+        self.assertTrue('task="bad\\"task"' in output)
+
+
+class TestExporter(unittest.TestCase):
+    """A set of test cases for the Exporter object"""
+    @patch.object(metrics.threading, 'Thread')
+    @patch.object(metrics, 'atexit')
+    def test_start_once(self, fake_atexit, fake_Thread):
+        """``start`` only starts one thread per process"""
+        exporter = metrics.Exporter(interval=15)
+
+        exporter.start()
+        exporter.start()
+
+        self.assertEqual(fake_Thread.call_count, 1)
+        fake_atexit.register.assert_called_once_with(metrics.save)
+
+    @patch.object(metrics.threading, 'Thread')
+    @patch.object(metrics, 'atexit')
+    def test_start_forked(self, fake_atexit, fake_Thread):
+        """A forked child starts counting from zero"""
+        exporter = metrics.Exporter(interval=15)
+        exporter.start()
+        metrics.TASK_SECONDS.observe(1, 'esxi.show', '', 'ok')
+
+        with patch.object(metrics.os, 'getpid', return_value=-1):
+            exporter.start()
+
+        self.assertEqual(metrics.TASK_SECONDS.snapshot(), [])
+        self.assertEqual(fake_Thread.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
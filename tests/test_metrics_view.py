@@ -0,0 +1,37 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the metrics API end point
+"""
+import unittest
+from unittest.mock import patch
+
+from flask import Flask
+
+from vlab_esxi_api.lib.views import metrics
+
+
+class TestMetricsView(unittest.TestCase):
+    """A set of test cases for the MetricsView object"""
+
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        app = Flask(__name__)
+        metrics.MetricsView.register(app)
+        app.config['TESTING'] = True
+        cls.app = app.test_client()
+
+    @patch.object(metrics.metrics, 'collect')
+    def test_metrics(self, fake_collect):
+        """The /api/1/inf/esxi/metrics end point serves the Prometheus text format"""
+        fake_collect.return_value = {}
+
+        resp = self.app.get('/api/1/inf/esxi/metrics')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertTrue(b'# TYPE vlab_esxi_task_seconds histogram' in resp.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in ova.py
+"""
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import ova
+
+
+class TestTarMember(unittest.TestCase):
+    """A set of test cases for the TarMember object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.member = ova.TarMember(io.BytesIO(b'xxxhello worldyyy'), offset=3, size=11)
+
+    def test_read(self):
+        """``TarMember`` only reads the bytes of the file"""
+        self.assertEqual(self.member.read(), b'hello world')
+
+    def test_read_chunks(self):
+        """``TarMember`` can be read in chunks"""
+        chunks = [self.member.read(4) for _ in range(4)]
+
+        self.assertEqual(chunks, [b'hell', b'o wo', b'rld', b''])
+
+    def test_seek(self):
+        """``TarMember`` supports seeking relative to the end of the file"""
+        self.member.seek(-5, 2)
+
+        self.assertEqual(self.member.read(), b'world')
+
+    def test_size(self):
+        """``TarMember`` has a size, so the upload knows the Content-Length"""
+        self.assertEqual(ova.Ova._get_tarfile_size(self.member), 11)
+
+
+class TestOpenOva(unittest.TestCase):
+    """A set of test cases for the open_ova function"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.location = os.path.join(self.tmp_dir, 'esxi-6.7u1.ova')
+        with open(self.location, 'wb') as the_file:
+            the_file.write(b'xxxxhello')
+
+    def tearDown(self):
+        """Runs after every test case"""
+        shutil.rmtree(self.tmp_dir)
+
+    @patch.object(ova.images, 'describe')
+    def test_open_ova(self, fake_describe):
+        """``open_ova`` uses the image index"""
+        fake_describe.return_value = {'ovf': '<xml/>',
+                                      'networks': ['VM Network'],
+                                      'disks': [{'name': 'disk1.vmdk', 'offset': 4, 'size': 5}]}
+
+        the_ova = ova.open_ova(self.location)
+        try:
+            self.assertEqual(the_ova.networks, ['VM Network'])
+            self.assertEqual(the_ova.vmdks, ['disk1.vmdk'])
+            self.assertEqual(the_ova._disks['disk1.vmdk'].read(), b'hello')
+        finally:
+            the_ova.close()
+
+    @patch.object(ova, 'Ova')
+    @patch.object(ova.images, 'describe')
+    def test_open_ova_fallback(self, fake_describe, fake_Ova):
+        """``open_ova`` falls back to scanning the OVA if it cannot be indexed"""
+        fake_describe.side_effect = ova.tarfile.ReadError('testing')
+
+        the_ova = ova.open_ova(self.location)
+
+        self.assertTrue(the_ova is fake_Ova.return_value)
+
+
+
+class TestIndexedOva(unittest.TestCase):
+    """A set of test cases for the IndexedOva object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.location = os.path.join(self.tmp_dir, 'esxi-6.7u1.ova')
+        with open(self.location, 'wb') as the_file:
+            the_file.write(b'xxxxhelloworld')
+        entry = {'ovf': '<xml/>',
+                 'networks': ['VM Network'],
+                 'disks': [{'name': 'disk1.vmdk', 'offset': 4, 'size': 5},
+                           {'name': 'disk2.vmdk', 'offset': 9, 'size': 5}]}
+        self.progress = MagicMock()
+        self.ova = ova.IndexedOva(self.location, entry, progress=self.progress)
+        self.spec = MagicMock()
+        self.spec.fileItem = [MagicMock(path='disk1.vmdk', deviceId='1'), MagicMock(path='disk2.vmdk', deviceId='2')]
+        self.lease = MagicMock()
+        self.lease.info.deviceUrl = [MagicMock(importKey='1', url='https://esx/1'),
+                                     MagicMock(importKey='2', url='https://esx/2')]
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.ova.close()
+        shutil.rmtree(self.tmp_dir)
+
+    @patch.object(ova, 'urlopen')
+    def test_deploy(self, fake_urlopen):
+        """``IndexedOva`` - ``deploy`` uploads every disk to its own device URL"""
+        uploaded = {}
+        def fake_upload(req, context):
+            uploaded[req.full_url] = req.data.read()
+            return MagicMock()
+        fake_urlopen.side_effect = fake_upload
+
+        self.ova.deploy(self.spec, self.lease, 'esx')
+
+        self.assertEqual(uploaded, {'https://esx/1': b'hello', 'https://esx/2': b'world'})
+        self.assertTrue(self.lease.Complete.called)
+
+    @patch.object(ova, 'urlopen')
+    def test_deploy_progress(self, fake_urlopen):
+        """``IndexedOva`` - ``deploy`` reports how many bytes were uploaded"""
+        fake_urlopen.side_effect = lambda req, context: req.data.read() and MagicMock()
+
+        self.ova.deploy(self.spec, self.lease, 'esx')
+
+        self.progress.assert_called_with(10, 10)
+
+    @patch.object(ova, 'urlopen')
+    def test_deploy_fails(self, fake_urlopen):
+        """``IndexedOva`` - ``deploy`` aborts the lease if an upload fails"""
+        fake_urlopen.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            self.ova.deploy(self.spec, self.lease, 'esx')
+
+        self.assertTrue(self.lease.Abort.called)
+        self.assertFalse(self.lease.Complete.called)
+
+    @patch.object(ova, 'const')
+    @patch.object(ova, 'urlopen')
+    def test_keep_alive(self, fake_urlopen, fake_const):
+        """``IndexedOva`` - the lease is kept alive while disks upload"""
+        fake_const.VLAB_ESXI_UPLOAD_WORKERS = 2
+        fake_const.VLAB_ESXI_LEASE_KEEPALIVE = 0.01
+        def slow_upload(req, context):
+            ova.threading.Event().wait(0.1)
+            return MagicMock()
+        fake_urlopen.side_effect = slow_upload
+
+        self.ova.deploy(self.spec, self.lease, 'esx')
+        percents = [x[0][0] for x in self.lease.Progress.call_args_list]
+
+        self.assertTrue(len(percents) > 1)
+        self.assertEqual(percents[-1], 100)
+
+if __name__ == '__main__':
+    unittest.main()
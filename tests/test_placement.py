@@ -0,0 +1,243 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in placement.py
+"""
+import os
+import unittest
+from contextlib import contextmanager
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import placement
+from vlab_esxi_api.lib.worker.deploy import Placement
+
+
+def make_datastore(moid, free, capacity=100, url='ds:///vmfs/volumes/{}/', hosts=('host-1',)):
+    """Create a stand-in for a vim.Datastore"""
+    datastore = MagicMock()
+    datastore._moId = moid
+    datastore.summary.freeSpace = free
+    datastore.summary.capacity = capacity
+    datastore.summary.accessible = True
+    datastore.summary.maintenanceMode = 'normal'
+    datastore.summary.url = url.format(moid)
+    mounts = []
+    for host_moid in hosts:
+        mount = MagicMock()
+        mount.key._moId = host_moid
+        mount.mountInfo.accessible = True
+        mounts.append(mount)
+    datastore.host = mounts
+    return datastore
+
+
+def make_entity(moid):
+    """Create a stand-in for a vim.ManagedEntity"""
+    entity = MagicMock()
+    entity._moId = moid
+    return entity
+
+
+class TestPlacementEngine(unittest.TestCase):
+    """A set of test cases for the PlacementEngine object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        @contextmanager
+        def factory():
+            yield self.vcenter
+        self.engine = placement.PlacementEngine(factory=factory, refresh_seconds=60, min_free=10)
+        # pretend the refresh thread is running
+        self.engine._pid = os.getpid()
+        self.engine._thread = MagicMock()
+        self.engine._thread.is_alive.return_value = True
+        self.pool = make_entity('resgroup-1')
+        self.host = make_entity('host-1')
+
+    def _placement(self, datastores, pools=None):
+        """Create a Placement"""
+        return Placement(pools or [self.pool], datastores, [self.host])
+
+    @patch.object(placement, 'datastore_latency')
+    @patch.object(placement, 'candidate_pools')
+    @patch.object(placement, 'candidate_datastores')
+    def test_refresh(self, fake_candidate_datastores, fake_candidate_pools, fake_datastore_latency):
+        """``PlacementEngine`` - ``refresh`` records the free space, latency and mounts of each datastore"""
+        fake_candidate_datastores.return_value = [make_datastore('ds-1', free=40)]
+        fake_candidate_pools.return_value = []
+        fake_datastore_latency.return_value = {'ds-1': 5}
+
+        self.engine.refresh()
+
+        self.assertEqual(self.engine._datastores['ds-1'], placement.DatastoreStats(40, 100, 5, ['host-1']))
+
+    @patch.object(placement, 'datastore_latency')
+    @patch.object(placement, 'candidate_pools')
+    @patch.object(placement, 'candidate_datastores')
+    def test_refresh_no_latency(self, fake_candidate_datastores, fake_candidate_pools, fake_datastore_latency):
+        """``PlacementEngine`` - ``refresh`` keeps the free space stats when latency can't be read"""
+        fake_candidate_datastores.return_value = [make_datastore('ds-1', free=40)]
+        fake_candidate_pools.return_value = []
+        fake_datastore_latency.side_effect = RuntimeError('testing')
+
+        self.engine.refresh()
+
+        self.assertEqual(self.engine._datastores['ds-1'].latency, 0)
+
+    @patch.object(placement, 'datastore_latency')
+    @patch.object(placement, 'candidate_pools')
+    @patch.object(placement, 'candidate_datastores')
+    def test_refresh_maintenance(self, fake_candidate_datastores, fake_candidate_pools, fake_datastore_latency):
+        """``PlacementEngine`` - ``refresh`` skips datastores in maintenance mode"""
+        datastore = make_datastore('ds-1', free=40)
+        datastore.summary.maintenanceMode = 'inMaintenance'
+        fake_candidate_datastores.return_value = [datastore]
+        fake_candidate_pools.return_value = []
+        fake_datastore_latency.return_value = {}
+
+        self.engine.refresh()
+
+        self.assertEqual(self.engine._datastores, {})
+
+    def test_choose_free_space(self):
+        """``PlacementEngine`` - ``choose`` prefers the datastore with the most free space"""
+        full, empty = make_entity('ds-1'), make_entity('ds-2')
+        self.engine._datastores = {'ds-1': placement.DatastoreStats(20, 100, 0, ['host-1']),
+                                   'ds-2': placement.DatastoreStats(80, 100, 0, ['host-1'])}
+
+        _, datastore, _ = self.engine.choose(self._placement([full, empty]))
+
+        self.assertTrue(datastore is empty)
+
+    def test_choose_latency(self):
+        """``PlacementEngine`` - ``choose`` avoids a slow datastore"""
+        slow, fast = make_entity('ds-1'), make_entity('ds-2')
+        self.engine._datastores = {'ds-1': placement.DatastoreStats(80, 100, 100, ['host-1']),
+                                   'ds-2': placement.DatastoreStats(60, 100, 1, ['host-1'])}
+
+        _, datastore, _ = self.engine.choose(self._placement([slow, fast]))
+
+        self.assertTrue(datastore is fast)
+
+    def test_choose_in_flight(self):
+        """``PlacementEngine`` - ``choose`` spreads deploys that are in flight at the same time"""
+        one, two = make_entity('ds-1'), make_entity('ds-2')
+
+        with self.engine.deploying(one):
+            _, datastore, _ = self.engine.choose(self._placement([one, two]))
+
+        self.assertTrue(datastore is two)
+
+    def test_choose_min_free(self):
+        """``PlacementEngine`` - ``choose`` avoids a datastore that's nearly full"""
+        tiny, busy = make_entity('ds-1'), make_entity('ds-2')
+        self.engine._datastores = {'ds-1': placement.DatastoreStats(5, 5, 0, ['host-1']),
+                                   'ds-2': placement.DatastoreStats(50, 100, 0, ['host-1'])}
+
+        with self.engine.deploying(busy), self.engine.deploying(busy):
+            _, datastore, _ = self.engine.choose(self._placement([tiny, busy]))
+
+        self.assertTrue(datastore is busy)
+
+    def test_choose_pool(self):
+        """``PlacementEngine`` - ``choose`` prefers the resource pool with the most headroom"""
+        busy, idle = make_entity('resgroup-1'), make_entity('resgroup-2')
+        self.engine._pools = {'resgroup-1': 0.1, 'resgroup-2': 0.9}
+
+        resource_pool, _, _ = self.engine.choose(self._placement([make_entity('ds-1')], pools=[busy, idle]))
+
+        self.assertTrue(resource_pool is idle)
+
+    def test_choose_host(self):
+        """``PlacementEngine`` - ``choose`` only picks a host that mounts the datastore"""
+        other = make_entity('host-2')
+        datastore = make_entity('ds-1')
+        self.engine._datastores = {'ds-1': placement.DatastoreStats(50, 100, 0, ['host-2'])}
+        the_placement = self._placement([datastore])._replace(hosts=[self.host, other])
+
+        _, _, host = self.engine.choose(the_placement)
+
+        self.assertTrue(host is other)
+
+    def test_deploying(self):
+        """``PlacementEngine`` - ``deploying`` stops counting a deploy once it's done"""
+        datastore = make_entity('ds-1')
+
+        with self.assertRaises(RuntimeError):
+            with self.engine.deploying(datastore):
+                raise RuntimeError('testing')
+
+        self.assertEqual(self.engine._in_flight['ds-1'], 0)
+
+
+class TestPlacementFunctions(unittest.TestCase):
+    """A set of test cases for the functions in placement.py"""
+    def test_url_uuid(self):
+        """``url_uuid`` returns the id of the datastore in its URL"""
+        self.assertEqual(placement.url_uuid('ds:///vmfs/volumes/5c4f-11e9/'), '5c4f-11e9')
+
+    def test_datastore_latency(self):
+        """``datastore_latency`` returns the worst latency any host sees"""
+        fake_vcenter = MagicMock()
+        counter = MagicMock()
+        counter.key = 1
+        counter.groupInfo.key = 'datastore'
+        counter.nameInfo.key = 'totalWriteLatency'
+        counter.rollupType = 'average'
+        fake_vcenter.content.perfManager.perfCounter = [counter]
+        series1 = MagicMock(value=[3])
+        series1.id.instance = 'abc'
+        series2 = MagicMock(value=[9])
+        series2.id.instance = 'abc'
+        fake_vcenter.content.perfManager.QueryPerf.return_value = [MagicMock(value=[series1]),
+                                                                   MagicMock(value=[series2])]
+        summary = MagicMock(url='ds:///vmfs/volumes/abc/')
+
+        latency = placement.datastore_latency(fake_vcenter, [placement.vim.HostSystem('host-1')], {'ds-1': summary})
+
+        self.assertEqual(latency, {'ds-1': 9})
+
+    def test_pool_headroom(self):
+        """``pool_headroom`` returns how much memory is unused"""
+        resource_pool = MagicMock()
+        resource_pool.runtime.memory.overallUsage = 25
+        resource_pool.runtime.memory.maxUsage = 100
+
+        self.assertEqual(placement.pool_headroom(resource_pool), 0.75)
+
+    @patch.object(placement, 'const')
+    def test_candidate_datastores(self, fake_const):
+        """``candidate_datastores`` expands datastore clusters"""
+        fake_const.VLAB_ESXI_DATASTORES = 'pod1, ds3'
+        fake_vcenter = MagicMock()
+        pod = placement.vim.StoragePod('group-p1')
+        fake_vcenter.datastores = {'pod1': pod, 'ds3': 'ds3'}
+
+        with patch.object(placement.vim.StoragePod, 'childEntity', ['ds1', 'ds2'], create=True):
+            datastores = placement.candidate_datastores(fake_vcenter)
+
+        self.assertEqual(datastores, ['ds1', 'ds2', 'ds3'])
+
+    @patch.object(placement, 'const')
+    def test_candidate_pools_default(self, fake_const):
+        """``candidate_pools`` uses INF_VCENTER_RESORUCE_POOL when no list is set"""
+        fake_const.VLAB_ESXI_RESOURCE_POOLS = ''
+        fake_const.INF_VCENTER_RESORUCE_POOL = 'Resources'
+        fake_vcenter = MagicMock()
+        fake_vcenter.resource_pools = {'Resources': 'the-pool'}
+
+        self.assertEqual(placement.candidate_pools(fake_vcenter), ['the-pool'])
+
+    def test_active_hosts(self):
+        """``active_hosts`` skips hosts in maintenance mode"""
+        fake_vcenter = MagicMock()
+        up = MagicMock()
+        up.runtime.inMaintenanceMode = False
+        down = MagicMock()
+        down.runtime.inMaintenanceMode = True
+        fake_vcenter.host_systems = {'up': up, 'down': down}
+
+        self.assertEqual(placement.active_hosts(fake_vcenter), [up])
+
+
+if __name__ == '__main__':
+    unittest.main()
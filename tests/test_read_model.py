@@ -0,0 +1,180 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in read_model.py
+"""
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib import read_model
+
+
+class TestReadModel(unittest.TestCase):
+    """A set of test cases for read_model.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(read_model, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESXI_STATE_DIR = self.state_dir
+        fake_const.VLAB_ESXI_READ_MODEL_MAX_AGE = 60
+        self.events_patcher = patch.object(read_model, 'events')
+        self.fake_events = self.events_patcher.start()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        self.events_patcher.stop()
+        shutil.rmtree(self.state_dir)
+
+    def test_save_load(self):
+        """``load`` returns what ``save`` recorded"""
+        read_model.save('bob', {'myESXi': {'state': 'poweredOn'}})
+
+        content, age = read_model.load('bob')
+
+        self.assertEqual(content, {'myESXi': {'state': 'poweredOn'}})
+        self.assertTrue(age < 60)
+
+    def test_save_publishes(self):
+        """``save`` publishes an inventory event when the listing changed"""
+        read_model.save('bob', {'myESXi': {'state': 'poweredOn'}})
+
+        self.fake_events.publish.assert_called_with('bob', 'inventory', {'action': 'refresh', 'content': {'myESXi': {'state': 'poweredOn'}}})
+
+    def test_save_unchanged(self):
+        """``save`` does not publish an event when nothing changed"""
+        read_model.save('bob', {'myESXi': {'state': 'poweredOn'}})
+        self.fake_events.publish.reset_mock()
+
+        read_model.save('bob', {'myESXi': {'state': 'poweredOn'}})
+
+        self.assertFalse(self.fake_events.publish.called)
+
+    def test_remove_publishes(self):
+        """``remove`` publishes an inventory event"""
+        read_model.save('bob', {'myESXi': {'state': 'poweredOn'}})
+
+        read_model.remove('bob', 'myESXi')
+
+        self.fake_events.publish.assert_called_with('bob', 'inventory', {'action': 'delete', 'name': 'myESXi'})
+
+    def test_load_missing(self):
+        """``load`` returns None when there's no listing for the user"""
+        self.assertTrue(read_model.load('alice') is None)
+
+    @patch.object(read_model.time, 'time')
+    def test_load_too_old(self, fake_time):
+        """``load`` returns None when the listing is older than the max age"""
+        fake_time.return_value = 100
+        read_model.save('bob', {})
+        fake_time.return_value = 200
+
+        self.assertTrue(read_model.load('bob') is None)
+
+    def test_update(self):
+        """``update`` adds an ESXi instance to an existing listing"""
+        read_model.save('bob', {'myESXi': {}})
+        read_model.update('bob', 'newESXi', {'state': 'poweredOn'})
+
+        content, _ = read_model.load('bob')
+
+        self.assertEqual(set(content.keys()), {'myESXi', 'newESXi'})
+
+    def test_update_concurrent(self):
+        """``update`` never loses a change made at the same time"""
+        read_model.save('bob', {})
+        threads = [threading.Thread(target=read_model.update, args=('bob', 'esxi{}'.format(x), {}))
+                   for x in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        content, _ = read_model.load('bob')
+
+        self.assertEqual(len(content), 16)
+
+    @patch.object(read_model.filelock.time, 'sleep')
+    def test_update_yields(self, fake_sleep):
+        """``update`` sleeps, instead of blocking the process, while another holds the lock"""
+        read_model.save('bob', {})
+        holder = read_model._locked('bob')
+        holder.__enter__()
+        fake_sleep.side_effect = lambda seconds: holder.__exit__(None, None, None)
+
+        read_model.update('bob', 'newESXi', {})
+
+        self.assertTrue(fake_sleep.called)
+        self.assertEqual(list(read_model.load('bob')[0].keys()), ['newESXi'])
+
+    def test_save_stale(self):
+        """``save`` discards a listing taken before a VM was deleted"""
+        read_model.save('bob', {'myESXi': {}, 'oldESXi': {}})
+        listed_at = read_model.generation('bob')
+        read_model.remove('bob', 'oldESXi')
+        self.fake_events.publish.reset_mock()
+
+        read_model.save('bob', {'myESXi': {}, 'oldESXi': {}}, listed_at=listed_at)
+        content, _ = read_model.load('bob')
+
+        self.assertEqual(list(content.keys()), ['myESXi'])
+        self.assertFalse(self.fake_events.publish.called)
+
+    def test_save_current(self):
+        """``save`` keeps a listing when nothing changed while it was taken"""
+        listed_at = read_model.generation('bob')
+
+        read_model.save('bob', {'myESXi': {}}, listed_at=listed_at)
+
+        self.assertEqual(list(read_model.load('bob')[0].keys()), ['myESXi'])
+
+    def test_generation(self):
+        """Every change to the inventory bumps the generation"""
+        read_model.update('bob', 'myESXi', {})
+        read_model.remove('bob', 'myESXi')
+        read_model.invalidate('bob')
+
+        self.assertEqual(read_model.generation('bob'), 3)
+
+    def test_update_no_listing(self):
+        """``update`` does not create a partial listing"""
+        read_model.update('bob', 'newESXi', {'state': 'poweredOn'})
+
+        self.assertTrue(read_model.load('bob') is None)
+
+    def test_remove(self):
+        """``remove`` drops an ESXi instance from the listing"""
+        read_model.save('bob', {'myESXi': {}, 'otherESXi': {}})
+        read_model.remove('bob', 'myESXi')
+
+        content, _ = read_model.load('bob')
+
+        self.assertEqual(list(content.keys()), ['otherESXi'])
+
+    def test_invalidate(self):
+        """``invalidate`` forgets the user's listing"""
+        read_model.save('bob', {'myESXi': {}})
+        read_model.invalidate('bob')
+
+        self.assertTrue(read_model.load('bob') is None)
+
+    def test_path_traversal(self):
+        """``save`` never writes outside of the state directory"""
+        location = read_model._path('../../etc/passwd')
+
+        self.assertTrue(location.startswith(self.state_dir))
+        self.assertFalse('/../' in location)
+
+    @patch.object(read_model, '_write')
+    def test_best_effort(self, fake_write):
+        """``save`` does not raise when the read-model cannot be written"""
+        fake_write.side_effect = PermissionError('testing')
+
+        read_model.save('bob', {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in results.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from celery import Celery
+
+from vlab_esxi_api.lib import results
+
+
+class TestResults(unittest.TestCase):
+    """A set of test cases for results.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(results, 'const')
+        self.fake_const = self.patcher.start()
+        self.fake_const.VLAB_ESXI_RESULT_BACKEND = 'file://{}/results'.format(self.state_dir)
+        self.fake_const.VLAB_ESXI_RESULT_EXPIRES = 60
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.state_dir)
+
+    def test_configure(self):
+        """``configure`` sets the result backend, and how long results are kept"""
+        app = Celery('testing')
+
+        results.configure(app)
+
+        self.assertEqual(app.conf.result_backend, self.fake_const.VLAB_ESXI_RESULT_BACKEND)
+        self.assertEqual(app.conf.result_expires, 60)
+
+    def test_configure_makes_dir(self):
+        """``configure`` creates the directory for the file system backend"""
+        results.configure(Celery('testing'))
+
+        self.assertTrue(os.path.isdir(os.path.join(self.state_dir, 'results')))
+
+    def test_durable(self):
+        """A result stored by one Celery app can be read by another, more than once"""
+        sender = Celery('testing')
+        results.configure(sender)
+        sender.backend.store_result('some-task', {'content': {}, 'error': None, 'params': {}}, 'SUCCESS')
+        reader = Celery('testing')
+        results.configure(reader)
+
+        first = reader.AsyncResult('some-task')
+        second = reader.AsyncResult('some-task')
+
+        self.assertEqual(first.status, 'SUCCESS')
+        self.assertEqual(second.result, {'content': {}, 'error': None, 'params': {}})
+
+    def test_configure_other_backend(self):
+        """``configure`` does not create directories for other backends"""
+        self.fake_const.VLAB_ESXI_RESULT_BACKEND = 'redis://localhost'
+        app = Celery('testing')
+
+        results.configure(app)
+
+        self.assertEqual(app.conf.result_backend, 'redis://localhost')
+        self.assertEqual(os.listdir(self.state_dir), [])
+
+    @patch.object(results.time, 'sleep')
+    def test_wait(self, fake_sleep):
+        """``wait`` returns as soon as the task is done"""
+        result = MagicMock()
+        type(result).status = unittest.mock.PropertyMock(side_effect=['PENDING', 'STARTED', 'SUCCESS'])
+
+        status = results.wait(result, timeout=30)
+
+        self.assertEqual(status, 'SUCCESS')
+        self.assertEqual(fake_sleep.call_count, 2)
+
+    def test_wait_timeout(self):
+        """``wait`` gives up once the timeout passes"""
+        result = MagicMock()
+        result.status = 'PENDING'
+
+        status = results.wait(result, timeout=0)
+
+        self.assertEqual(status, 'PENDING')
+
+    def test_cleanup(self):
+        """``cleanup`` deletes expired results"""
+        app = MagicMock()
+
+        results.cleanup(app)
+
+        self.assertTrue(app.backend.cleanup.called)
+
+    def test_cleanup_error(self):
+        """``cleanup`` does not raise if the backend cannot be cleaned up"""
+        app = MagicMock()
+        app.backend.cleanup.side_effect = OSError('testing')
+
+        results.cleanup(app)
+
+    @patch.object(results.threading, 'Thread')
+    def test_start_cleanup(self, fake_Thread):
+        """``start_cleanup`` runs the cleanup in a daemon thread"""
+        results.start_cleanup(MagicMock())
+
+        self.assertTrue(fake_Thread.return_value.start.called)
+        self.assertTrue(fake_Thread.call_args[1]['daemon'])
+        self.assertEqual(fake_Thread.call_args[1]['args'][1], 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
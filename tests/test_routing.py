@@ -0,0 +1,76 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in routing.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from celery import Celery
+
+from vlab_esxi_api.lib import routing
+
+
+class TestRouting(unittest.TestCase):
+    """A set of test cases for routing.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.patcher = patch.object(routing, 'const')
+        self.fake_const = self.patcher.start()
+        self.fake_const.VLAB_ESXI_READ_QUEUE = 'esxi-read'
+        self.fake_const.VLAB_ESXI_WRITE_QUEUE = 'celery'
+        self.fake_const.VLAB_ESXI_WORKER_QUEUES = 'esxi-read, celery'
+        self.fake_const.VLAB_ESXI_READ_CONCURRENCY = 16
+        self.fake_const.VLAB_ESXI_READ_PREFETCH = 4
+        self.fake_const.VLAB_ESXI_WORKER_CONCURRENCY = 32
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+
+    def test_task_routes(self):
+        """``task_routes`` sends reads and writes to different queues"""
+        routes = routing.task_routes()
+
+        self.assertEqual(routes['esxi.show'], {'queue': 'esxi-read'})
+        self.assertEqual(routes['esxi.image'], {'queue': 'esxi-read'})
+        self.assertEqual(routes['esxi.create'], {'queue': 'celery'})
+        self.assertEqual(routes['esxi.delete'], {'queue': 'celery'})
+
+    def test_configure(self):
+        """``configure`` makes the API send tasks to the right queue"""
+        app = Celery('testing')
+
+        routing.configure(app)
+        queue = app.amqp.router.route({}, 'esxi.show')['queue']
+
+        self.assertEqual(queue.name, 'esxi-read')
+
+    def test_configure_worker(self):
+        """``configure`` sets the queues a worker consumes"""
+        app = Celery('testing')
+
+        routing.configure(app, worker=True)
+
+        self.assertEqual([x.name for x in app.conf.task_queues], ['esxi-read', 'celery'])
+        self.assertEqual(app.conf.worker_concurrency, 32)
+        self.assertEqual(app.conf.worker_prefetch_multiplier, 1)
+
+    def test_read_worker(self):
+        """A worker that only consumes reads uses the read concurrency and prefetch"""
+        self.fake_const.VLAB_ESXI_WORKER_QUEUES = 'esxi-read'
+
+        settings = routing.worker_settings(routing.worker_queues())
+
+        self.assertEqual(settings, {'worker_concurrency': 16, 'worker_prefetch_multiplier': 4})
+
+    def test_write_worker(self):
+        """A worker that runs creates never prefetches more than one task per slot"""
+        self.fake_const.VLAB_ESXI_WORKER_QUEUES = 'celery'
+
+        settings = routing.worker_settings(routing.worker_queues())
+
+        self.assertEqual(settings['worker_prefetch_multiplier'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
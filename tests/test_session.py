@@ -0,0 +1,154 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in session.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import session
+
+
+class TestForgetNetworks(unittest.TestCase):
+    """Pins how vlab-inf-common caches networks, which ``forget_networks`` relies on"""
+
+    @patch.object(session.vCenter, 'get_by_type')
+    @patch('vlab_inf_common.vmware.vcenter.connect')
+    def test_forget_networks(self, fake_connect, fake_get_by_type):
+        """``forget_networks`` makes ``vCenter.networks`` look up the networks again"""
+        vcenter = session.vCenter(host='localhost', user='bob', password='IloveCats')
+        self.assertTrue(hasattr(vcenter, '_net_cache'))
+        fake_get_by_type.return_value = []
+        vcenter.networks
+        vcenter._net_cache = {'someLAN': MagicMock()}
+        self.assertEqual(list(vcenter.networks.keys()), ['someLAN'])
+
+        session.forget_networks(vcenter)
+        vcenter.networks
+
+        self.assertEqual(fake_get_by_type.call_count, 2)
+
+
+class TestSessionPool(unittest.TestCase):
+    """A set of test cases for the SessionPool object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.factory = MagicMock()
+        self.factory.side_effect = lambda: MagicMock()
+        self.pool = session.SessionPool(factory=self.factory, size=2, check_interval=60, timeout=0)
+
+    def test_reuses_session(self):
+        """``SessionPool`` - a returned session is handed out again instead of logging in"""
+        with self.pool.session() as first:
+            pass
+        with self.pool.session() as second:
+            pass
+
+        self.assertTrue(first is second)
+        self.assertEqual(self.factory.call_count, 1)
+
+    def test_max_size(self):
+        """``SessionPool`` - raises RuntimeError when every session is borrowed"""
+        self.pool.acquire()
+        self.pool.acquire()
+
+        with self.assertRaises(RuntimeError):
+            self.pool.acquire()
+
+    def test_max_size_release(self):
+        """``SessionPool`` - releasing a session frees up a slot in the pool"""
+        self.pool.acquire()
+        vcenter = self.pool.acquire()
+        self.pool.release(vcenter)
+
+        self.assertTrue(self.pool.acquire() is vcenter)
+
+    @patch.object(session.time, 'time')
+    def test_relogin(self, fake_time):
+        """``SessionPool`` - an idle session that's expired is replaced with a new login"""
+        fake_time.return_value = 100
+        with self.pool.session() as first:
+            first.content.sessionManager.currentSession = None
+        fake_time.return_value = 500
+        with self.pool.session() as second:
+            pass
+
+        self.assertFalse(first is second)
+        self.assertTrue(first.close.called)
+
+    @patch.object(session.time, 'time')
+    def test_health_check_ok(self, fake_time):
+        """``SessionPool`` - an idle session that's still logged in is reused"""
+        fake_time.return_value = 100
+        with self.pool.session() as first:
+            pass
+        fake_time.return_value = 500
+        with self.pool.session() as second:
+            pass
+
+        self.assertTrue(first is second)
+
+    def test_clears_network_cache(self):
+        """``SessionPool`` - a reused session does not return stale networks"""
+        with self.pool.session() as vcenter:
+            vcenter._net_cache = {'someLAN': MagicMock()}
+        with self.pool.session() as vcenter:
+            pass
+
+        self.assertTrue(vcenter._net_cache is None)
+
+    def test_discard_broken(self):
+        """``SessionPool`` - a session that raised a connection error is not reused"""
+        try:
+            with self.pool.session() as first:
+                raise ConnectionError('testing')
+        except ConnectionError:
+            pass
+        with self.pool.session() as second:
+            pass
+
+        self.assertFalse(first is second)
+        self.assertTrue(first.close.called)
+
+    def test_keeps_session_on_value_error(self):
+        """``SessionPool`` - bad user input does not cost the pool a session"""
+        try:
+            with self.pool.session() as first:
+                raise ValueError('testing')
+        except ValueError:
+            pass
+        with self.pool.session() as second:
+            pass
+
+        self.assertTrue(first is second)
+
+    @patch.object(session.os, 'getpid')
+    def test_fork(self, fake_getpid):
+        """``SessionPool`` - a forked process does not reuse the parent's sessions"""
+        fake_getpid.return_value = 1
+        pool = session.SessionPool(factory=self.factory, size=2, check_interval=60, timeout=0)
+        with pool.session() as first:
+            pass
+        fake_getpid.return_value = 2
+        with pool.session() as second:
+            pass
+
+        self.assertFalse(first is second)
+
+    def test_close(self):
+        """``SessionPool`` - ``close`` logs out of every idle session"""
+        with self.pool.session() as vcenter:
+            pass
+        self.pool.close()
+
+        self.assertTrue(vcenter.close.called)
+
+    def test_is_alive_error(self):
+        """``is_alive`` returns False if checking the session fails"""
+        vcenter = MagicMock()
+        type(vcenter).content = property(MagicMock(side_effect=ConnectionError('testing')))
+
+        self.assertFalse(session.is_alive(vcenter))
+
+
+if __name__ == '__main__':
+    unittest.main()
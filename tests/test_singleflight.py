@@ -0,0 +1,185 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in singleflight.py
+"""
+import os
+import fcntl
+import shutil
+import tempfile
+import unittest
+import threading
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib import singleflight
+
+
+class TestSingleFlight(unittest.TestCase):
+    """A set of test cases for singleflight.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.state_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(singleflight, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_ESXI_STATE_DIR = self.state_dir
+        fake_const.VLAB_ESXI_SINGLEFLIGHT_FRESH = 5
+        fake_const.VLAB_ESXI_SINGLEFLIGHT_MAX_WAIT = 120
+        self.celery_app = MagicMock()
+        self.celery_app.send_task.return_value.id = 'task-1'
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.state_dir)
+
+    def test_send_task(self):
+        """``send_task`` sends the task when there's nothing to reuse"""
+        task = singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        self.assertTrue(task is self.celery_app.send_task.return_value)
+        self.celery_app.send_task.assert_called_with('esxi.show', ['bob', 'txn'])
+
+    def test_send_task_in_flight(self):
+        """``send_task`` hands out the task already in flight"""
+        self.celery_app.AsyncResult.return_value.status = 'STARTED'
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        task = singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        self.assertTrue(task is self.celery_app.AsyncResult.return_value)
+        self.celery_app.AsyncResult.assert_called_with('task-1')
+        self.assertEqual(self.celery_app.send_task.call_count, 1)
+
+    def test_send_task_other_key(self):
+        """``send_task`` does not coalesce the tasks of different users"""
+        self.celery_app.AsyncResult.return_value.status = 'STARTED'
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        singleflight.send_task(self.celery_app, 'esxi.show', 'alice', ['alice', 'txn'])
+
+        self.assertEqual(self.celery_app.send_task.call_count, 2)
+
+    def test_send_task_failed(self):
+        """``send_task`` sends a new task if the last one failed"""
+        self.celery_app.AsyncResult.return_value.status = 'FAILURE'
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        self.assertEqual(self.celery_app.send_task.call_count, 2)
+
+    def test_send_task_fresh(self):
+        """``send_task`` hands out a task that just finished"""
+        self.celery_app.AsyncResult.return_value.status = 'SUCCESS'
+        self.celery_app.AsyncResult.return_value.date_done = datetime.now(timezone.utc) - timedelta(seconds=1)
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        self.assertEqual(self.celery_app.send_task.call_count, 1)
+
+    def test_send_task_stale(self):
+        """``send_task`` sends a new task if the last one finished a while ago"""
+        self.celery_app.AsyncResult.return_value.status = 'SUCCESS'
+        self.celery_app.AsyncResult.return_value.date_done = datetime.now(timezone.utc) - timedelta(seconds=60)
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        self.assertEqual(self.celery_app.send_task.call_count, 2)
+
+    @patch.object(singleflight.time, 'time')
+    def test_send_task_lost(self, fake_time):
+        """``send_task`` sends a new task if the last one has been pending too long"""
+        self.celery_app.AsyncResult.return_value.status = 'PENDING'
+        fake_time.return_value = 1000
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+        fake_time.return_value = 2000
+
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        self.assertEqual(self.celery_app.send_task.call_count, 2)
+
+    @patch.object(singleflight.os, 'makedirs')
+    def test_send_task_best_effort(self, fake_makedirs):
+        """``send_task`` still sends the task if it cannot be recorded"""
+        fake_makedirs.side_effect = PermissionError('testing')
+
+        task = singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        self.assertTrue(task is self.celery_app.send_task.return_value)
+
+    def test_send_task_concurrent(self):
+        """``send_task`` - a second request for the same key waits for the first one's task, and
+        neither holds the lock while talking to the broker"""
+        self.celery_app.AsyncResult.return_value.status = 'STARTED'
+        sending = threading.Event()
+        proceed = threading.Event()
+        lock_free = []
+        def send_task(name, args):
+            with open(singleflight._path(name, '', suffix='.lock'), 'a') as the_file:
+                try:
+                    fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(the_file, fcntl.LOCK_UN)
+                    lock_free.append(True)
+                except BlockingIOError:
+                    lock_free.append(False)
+            sending.set()
+            proceed.wait(5)
+            return MagicMock(id='task-1')
+        self.celery_app.send_task.side_effect = send_task
+        results = {}
+        def request(caller):
+            results[caller] = singleflight.send_task(self.celery_app, 'esxi.image', '', ['txn'])
+
+        first = threading.Thread(target=request, args=('first',))
+        first.start()
+        sending.wait(5)
+        second = threading.Thread(target=request, args=('second',))
+        second.start()
+        second.join(0.2)
+        # the second request is waiting, not blocked on the lock, and has not sent its own task
+        self.assertTrue(second.is_alive())
+        proceed.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual(lock_free, [True])
+        self.assertEqual(self.celery_app.send_task.call_count, 1)
+        self.assertTrue(results['second'] is self.celery_app.AsyncResult.return_value)
+        self.celery_app.AsyncResult.assert_called_with('task-1')
+
+    @patch.object(singleflight, 'SENDING_SECONDS', 0)
+    def test_send_task_sender_died(self):
+        """``send_task`` sends the task itself if another request never finished sending it"""
+        with singleflight._locked('esxi.show', 'bob'):
+            singleflight._write('esxi.show', 'bob', {'sending': 1, 'token': 'someone-else'})
+
+        task = singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        self.assertTrue(task is self.celery_app.send_task.return_value)
+        self.assertEqual(singleflight._read('esxi.show', 'bob')['task-id'], 'task-1')
+
+    def test_forget(self):
+        """``forget`` makes the next request send a new task"""
+        self.celery_app.AsyncResult.return_value.status = 'STARTED'
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        singleflight.forget('esxi.show', 'bob')
+        singleflight.send_task(self.celery_app, 'esxi.show', 'bob', ['bob', 'txn'])
+
+        self.assertEqual(self.celery_app.send_task.call_count, 2)
+
+    def test_forget_nothing(self):
+        """``forget`` is fine with there being nothing to forget"""
+        singleflight.forget('esxi.show', 'bob')
+
+    def test_path_traversal(self):
+        """A key cannot escape the singleflight directory"""
+        location = singleflight._path('esxi.show', '../../etc/passwd')
+
+        self.assertEqual(os.path.dirname(location), os.path.join(self.state_dir, 'singleflight'))
+
+
+if __name__ == '__main__':
+    unittest.main()
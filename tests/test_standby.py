@@ -0,0 +1,293 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in standby.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import standby
+
+
+READY = {'component': standby.COMPONENT, 'version': '6.7u1', 'configured': True}
+ON = standby.vim.VirtualMachinePowerState.poweredOn
+
+
+def make_content(obj, **props):
+    """Create a stand-in for a vmodl.query.PropertyCollector.ObjectContent"""
+    content = MagicMock()
+    content.obj = obj
+    content.propSet = []
+    for name, val in props.items():
+        prop = MagicMock()
+        prop.name = name.replace('__', '.')
+        prop.val = val
+        content.propSet.append(prop)
+    return content
+
+
+class TestStandby(unittest.TestCase):
+    """A set of test cases for standby.py"""
+
+    @patch.object(standby, 'const')
+    def test_pool_size(self, fake_const):
+        """``pool_size`` returns the size configured for a specific image"""
+        fake_const.VLAB_ESXI_STANDBY_SIZES = '*=1,6.7u1=3'
+
+        self.assertEqual(standby.pool_size('6.7u1'), 3)
+        self.assertEqual(standby.pool_size('6.5'), 1)
+
+    @patch.object(standby, 'const')
+    def test_pool_size_disabled(self, fake_const):
+        """``pool_size`` is zero by default"""
+        fake_const.VLAB_ESXI_STANDBY_SIZES = ''
+
+        self.assertEqual(standby.pool_size('6.7u1'), 0)
+
+    @patch.object(standby, 'const')
+    def test_pool_size_invalid(self, fake_const):
+        """``pool_size`` ignores sizes that are not numbers"""
+        fake_const.VLAB_ESXI_STANDBY_SIZES = '6.7u1=lots'
+
+        self.assertEqual(standby.pool_size('6.7u1'), 0)
+
+    @patch.object(standby.inventory, 'retrieve')
+    def test_get_members(self, fake_retrieve):
+        """``get_members`` returns the standby VMs, and which are claimed"""
+        fake_retrieve.return_value = [make_content(standby.vim.VirtualMachine('vm-1'),
+                                                   runtime__powerState=ON,
+                                                   config__annotation='{"component": "ESXi-standby"}'),
+                                      make_content(standby.vim.Folder('group-v2'), name='claim-vm-1')]
+
+        members, claimed = standby.get_members(MagicMock(), standby.vim.Folder('group-v1'))
+
+        self.assertEqual(members[0][1]['component'], standby.COMPONENT)
+        self.assertEqual(claimed, {'vm-1'})
+
+    @patch.object(standby, 'get_members')
+    @patch.object(standby.deploy, 'ensure_folder')
+    def test_claim(self, fake_ensure_folder, fake_get_members):
+        """``claim`` skips VMs that are already claimed"""
+        vm1 = standby.vim.VirtualMachine('vm-1')
+        vm2 = standby.vim.VirtualMachine('vm-2')
+        fake_get_members.return_value = ([(vm1, READY, ON), (vm2, READY, ON)], {'vm-1'})
+
+        the_vm, _ = standby.claim(MagicMock(), '6.7u1')
+
+        self.assertTrue(the_vm is vm2)
+        fake_ensure_folder.return_value.CreateFolder.assert_called_with('claim-vm-2')
+
+    @patch.object(standby, 'get_members')
+    @patch.object(standby.deploy, 'ensure_folder')
+    def test_claim_race(self, fake_ensure_folder, fake_get_members):
+        """``claim`` moves on to the next VM when another create wins the claim"""
+        vm1 = standby.vim.VirtualMachine('vm-1')
+        vm2 = standby.vim.VirtualMachine('vm-2')
+        fake_get_members.return_value = ([(vm1, READY, ON), (vm2, READY, ON)], set())
+        fake_ensure_folder.return_value.CreateFolder.side_effect = [standby.vim.fault.DuplicateName(), MagicMock()]
+
+        the_vm, _ = standby.claim(MagicMock(), '6.7u1')
+
+        self.assertTrue(the_vm is vm2)
+
+    @patch.object(standby, 'get_members')
+    @patch.object(standby.deploy, 'ensure_folder')
+    def test_claim_not_ready(self, fake_ensure_folder, fake_get_members):
+        """``claim`` returns None when no standby VM of that image is ready"""
+        not_booted = dict(READY, configured=False)
+        other_image = dict(READY, version='6.5')
+        fake_get_members.return_value = ([(standby.vim.VirtualMachine('vm-1'), not_booted, ON),
+                                          (standby.vim.VirtualMachine('vm-2'), other_image, ON)],
+                                         set())
+
+        self.assertTrue(standby.claim(MagicMock(), '6.7u1') is None)
+
+    @patch.object(standby.deploy, 'nic_spec')
+    @patch.object(standby, 'power')
+    @patch.object(standby, 'consume_task')
+    def test_adopt(self, fake_consume_task, fake_power, fake_nic_spec):
+        """``adopt`` renames and moves the VM, then releases the claim"""
+        fake_nic_spec.return_value = standby.vim.vm.device.VirtualDeviceSpec()
+        the_vm = MagicMock()
+        claim_folder = MagicMock()
+        folder = MagicMock()
+        meta_data = {'component': 'ESXi', 'created': 1, 'version': '6.7u1', 'configured': False, 'generation': 1}
+
+        standby.adopt(the_vm, claim_folder, folder, 'myESXi', MagicMock(), MagicMock(), meta_data=meta_data)
+        spec = the_vm.ReconfigVM_Task.call_args_list[0][0][0]
+
+        the_vm.Rename_Task.assert_called_with('myESXi')
+        folder.MoveIntoFolder_Task.assert_called_with([the_vm])
+        self.assertEqual(standby.deploy.ujson.loads(spec.annotation), meta_data)
+        self.assertEqual(len(spec.deviceChange), 1)
+        self.assertTrue(spec.nestedHVEnabled is None)
+        self.assertTrue(claim_folder.Destroy_Task.called)
+        self.assertFalse(the_vm.Destroy_Task.called)
+
+    @patch.object(standby.deploy, 'nic_spec')
+    @patch.object(standby, 'power')
+    @patch.object(standby, 'consume_task')
+    def test_adopt_replugs_nic(self, fake_consume_task, fake_power, fake_nic_spec):
+        """``adopt`` unplugs the NIC, then plugs it back in, so the guest gets a new IP"""
+        fake_nic_spec.return_value = standby.vim.vm.device.VirtualDeviceSpec()
+        the_vm = MagicMock()
+
+        standby.adopt(the_vm, MagicMock(), MagicMock(), 'myESXi', MagicMock(), MagicMock())
+        connected = [x[1].get('connected', True) for x in fake_nic_spec.call_args_list]
+
+        self.assertEqual(connected, [False, True])
+        self.assertEqual(the_vm.ReconfigVM_Task.call_count, 2)
+
+    @patch.object(standby.deploy, 'nic_spec')
+    @patch.object(standby, 'power')
+    @patch.object(standby, 'consume_task')
+    def test_adopt_stale_ips(self, fake_consume_task, fake_power, fake_nic_spec):
+        """``adopt`` returns the IPs the VM had on the standby network"""
+        fake_nic_spec.return_value = standby.vim.vm.device.VirtualDeviceSpec()
+        the_vm = MagicMock()
+        nic = MagicMock()
+        nic.ipAddress = ['fe80::1', '192.168.1.5']
+        the_vm.guest.net = [nic]
+
+        output = standby.adopt(the_vm, MagicMock(), MagicMock(), 'myESXi', MagicMock(), MagicMock())
+
+        self.assertEqual(output, ['192.168.1.5'])
+
+    @patch.object(standby.deploy, 'nic_spec')
+    @patch.object(standby, 'power')
+    @patch.object(standby, 'consume_task')
+    def test_adopt_fails(self, fake_consume_task, fake_power, fake_nic_spec):
+        """``adopt`` destroys the standby VM if it cannot be adopted"""
+        the_vm = standby.vim.VirtualMachine('vm-1')
+        claim_folder = MagicMock()
+        folder = MagicMock()
+        folder.MoveIntoFolder_Task.side_effect = standby.vim.fault.DuplicateName()
+
+        with patch.object(standby.vim.VirtualMachine, 'Rename_Task', create=True), \
+             patch.object(standby.vim.VirtualMachine, 'Destroy_Task', create=True) as fake_destroy:
+            with self.assertRaises(standby.vim.fault.DuplicateName):
+                standby.adopt(the_vm, claim_folder, folder, 'myESXi', MagicMock(), MagicMock())
+
+        self.assertTrue(fake_destroy.called)
+        self.assertTrue(claim_folder.Destroy_Task.called)
+
+    @patch.object(standby, 'make_member')
+    @patch.object(standby, 'get_members')
+    @patch.object(standby.deploy, 'ensure_folder')
+    @patch.object(standby, 'vcenter_session')
+    @patch.object(standby, '_refilling')
+    @patch.object(standby, 'pool_size')
+    def test_refill(self, fake_pool_size, fake_refilling, fake_vcenter_session, fake_ensure_folder,
+                    fake_get_members, fake_make_member):
+        """``refill`` only creates enough standby VMs to reach the target size"""
+        fake_pool_size.return_value = 3
+        fake_refilling.return_value.__enter__.return_value = True
+        fake_ensure_folder.return_value.childEntity = []
+        fake_get_members.return_value = ([(standby.vim.VirtualMachine('vm-1'), READY, ON),
+                                          (standby.vim.VirtualMachine('vm-2'), READY, ON)],
+                                         {'vm-2'})
+
+        output = standby.refill('6.7u1', MagicMock())
+
+        self.assertEqual(output, 2)
+        self.assertEqual(fake_make_member.call_count, 2)
+
+    @patch.object(standby, 'make_member')
+    @patch.object(standby, 'vcenter_session')
+    @patch.object(standby, '_refilling')
+    @patch.object(standby, 'pool_size')
+    def test_refill_busy(self, fake_pool_size, fake_refilling, fake_vcenter_session, fake_make_member):
+        """``refill`` does nothing if the pool is already being refilled"""
+        fake_pool_size.return_value = 3
+        fake_refilling.return_value.__enter__.return_value = False
+
+        output = standby.refill('6.7u1', MagicMock())
+
+        self.assertEqual(output, 0)
+        self.assertFalse(fake_vcenter_session.called)
+
+    @patch.object(standby, 'vcenter_session')
+    @patch.object(standby, 'pool_size')
+    def test_refill_disabled(self, fake_pool_size, fake_vcenter_session):
+        """``refill`` does nothing if the image has no standby pool"""
+        fake_pool_size.return_value = 0
+
+        output = standby.refill('6.7u1', MagicMock())
+
+        self.assertEqual(output, 0)
+        self.assertFalse(fake_vcenter_session.called)
+
+    @patch.object(standby, 'wait_for_boot')
+    @patch.object(standby, 'power')
+    @patch.object(standby.virtual_machine, 'set_meta')
+    @patch.object(standby, 'consume_task')
+    @patch.object(standby.deploy, 'clone_vm')
+    @patch.object(standby.deploy, 'get_template')
+    @patch.object(standby.deploy, 'deploy_mode')
+    def test_make_member(self, fake_deploy_mode, fake_get_template, fake_clone_vm, fake_consume_task,
+                         fake_set_meta, fake_power, fake_wait_for_boot):
+        """``make_member`` only marks a standby VM as ready once it's booted"""
+        fake_deploy_mode.return_value = 'clone'
+
+        standby.make_member(MagicMock(), '6.7u1', MagicMock(), MagicMock(), MagicMock())
+        _, last_meta = fake_set_meta.call_args[0]
+        config = fake_clone_vm.call_args[1]['config']
+
+        self.assertTrue(fake_wait_for_boot.called)
+        self.assertTrue(last_meta['configured'])
+        self.assertEqual(last_meta['component'], standby.COMPONENT)
+        self.assertTrue(config.nestedHVEnabled)
+        self.assertFalse(standby.deploy.ujson.loads(config.annotation)['configured'])
+        self.assertEqual(fake_set_meta.call_count, 1)
+        self.assertFalse(fake_clone_vm.return_value.ReconfigVM_Task.called)
+
+    @patch.object(standby, '_discard')
+    @patch.object(standby, 'wait_for_boot')
+    @patch.object(standby, 'power')
+    @patch.object(standby.virtual_machine, 'set_meta')
+    @patch.object(standby, 'consume_task')
+    @patch.object(standby.deploy, 'clone_vm')
+    @patch.object(standby.deploy, 'get_template')
+    @patch.object(standby.deploy, 'deploy_mode')
+    def test_make_member_fails(self, fake_deploy_mode, fake_get_template, fake_clone_vm, fake_consume_task,
+                               fake_set_meta, fake_power, fake_wait_for_boot, fake_discard):
+        """``make_member`` destroys a standby VM that never booted"""
+        fake_deploy_mode.return_value = 'clone'
+        fake_wait_for_boot.side_effect = RuntimeError('testing')
+
+        with self.assertRaises(RuntimeError):
+            standby.make_member(MagicMock(), '6.7u1', MagicMock(), MagicMock(), MagicMock())
+
+        fake_discard.assert_called_with(fake_clone_vm.return_value)
+
+    def test_wait_for_boot(self):
+        """``wait_for_boot`` returns once vCenter reports VMware Tools running"""
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        change = MagicMock()
+        change.val = 'guestToolsNotRunning'
+        booted = MagicMock()
+        booted.val = 'guestToolsRunning'
+        update_set = MagicMock()
+        update_set.filterSet = [MagicMock(objectSet=[MagicMock(changeSet=[change])])]
+        update_set_booted = MagicMock()
+        update_set_booted.filterSet = [MagicMock(objectSet=[MagicMock(changeSet=[booted])])]
+        collector.WaitForUpdatesEx.side_effect = [update_set, None, update_set_booted]
+
+        standby.wait_for_boot(fake_vcenter, standby.vim.VirtualMachine('vm-1'), timeout=60)
+
+        self.assertEqual(collector.WaitForUpdatesEx.call_count, 3)
+        self.assertTrue(collector.DestroyPropertyCollector.called)
+
+    def test_wait_for_boot_timeout(self):
+        """``wait_for_boot`` raises RuntimeError if the VM never boots"""
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+
+        with self.assertRaises(RuntimeError):
+            standby.wait_for_boot(fake_vcenter, standby.vim.VirtualMachine('vm-1'), timeout=0)
+
+        self.assertTrue(collector.DestroyPropertyCollector.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@
 A suite of tests for the functions in tasks.py
 """
 import unittest
+import threading
 from unittest.mock import patch, MagicMock
 
 from vlab_esxi_api.lib.worker import tasks
@@ -10,8 +11,19 @@ from vlab_esxi_api.lib.worker import tasks
 
 class TestTasks(unittest.TestCase):
     """A set of test cases for tasks.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        # Admit every create right away
+        self.admission_patcher = patch.object(tasks, 'admission')
+        self.fake_admission = self.admission_patcher.start()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.admission_patcher.stop()
+
+    @patch.object(tasks, 'read_model')
     @patch.object(tasks, 'vmware')
-    def test_show_ok(self, fake_vmware):
+    def test_show_ok(self, fake_vmware, fake_read_model):
         """``show`` returns a dictionary when everything works as expected"""
         fake_vmware.show_esxi.return_value = {'worked': True}
 
@@ -20,8 +32,20 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_show_read_model(self, fake_vmware, fake_read_model):
+        """``show`` saves the inventory to the read-model"""
+        fake_vmware.show_esxi.return_value = {'worked': True}
+        fake_read_model.generation.return_value = 3
+
+        tasks.show(username='bob', txn_id='myId')
+
+        fake_read_model.save.assert_called_with('bob', {'worked': True}, listed_at=3)
+
+    @patch.object(tasks, 'read_model')
     @patch.object(tasks, 'vmware')
-    def test_show_value_error(self, fake_vmware):
+    def test_show_value_error(self, fake_vmware, fake_read_model):
         """``show`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.show_esxi.side_effect = [ValueError("testing")]
 
@@ -30,22 +54,319 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'read_model')
     @patch.object(tasks, 'vmware')
-    def test_create_ok(self, fake_vmware):
+    def test_create_ok(self, fake_vmware, fake_read_model):
         """``create`` returns a dictionary when everything works as expected"""
-        fake_vmware.create_esxi.return_value = {'worked': True}
+        fake_vmware.create_esxi.return_value = {'esxiBox': {'worked': True}}
 
         output = tasks.create(username='bob',
                               machine_name='esxiBox',
                               image='0.0.1',
                               network='someLAN',
                               txn_id='myId')
-        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+        expected = {'content' : {'esxiBox': {'worked': True}}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks.ipwatch, 'WATCHER')
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_create_ip_pending(self, fake_vmware, fake_read_model, fake_WATCHER):
+        """``create`` has the IP watcher fill in a pending IP, after saving the new ESXi instance"""
+        info = {'ips': [], 'moid': 'vm-1', 'ip_pending': True}
+        fake_vmware.create_esxi.return_value = {'esxiBox': info}
+        calls = []
+        fake_read_model.update.side_effect = lambda *args: calls.append('update')
+        fake_WATCHER.watch.side_effect = lambda *args: calls.append('watch')
+
+        tasks.create(username='bob',
+                     machine_name='esxiBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     txn_id='myId')
+
+        fake_WATCHER.watch.assert_called_with('bob', 'esxiBox', info)
+        self.assertEqual(calls, ['update', 'watch'])
+
+    @patch.object(tasks.ipwatch, 'WATCHER')
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_create_ip_known(self, fake_vmware, fake_read_model, fake_WATCHER):
+        """``create`` does not watch an ESXi instance that already has an IP"""
+        fake_vmware.create_esxi.return_value = {'esxiBox': {'ips': ['10.1.1.1'], 'moid': 'vm-1'}}
+
+        tasks.create(username='bob',
+                     machine_name='esxiBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     txn_id='myId')
+
+        self.assertFalse(fake_WATCHER.watch.called)
+
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_create_read_model(self, fake_vmware, fake_read_model):
+        """``create`` adds the new ESXi instance to the read-model"""
+        fake_vmware.create_esxi.return_value = {'esxiBox': {'worked': True}}
+
+        tasks.create(username='bob',
+                     machine_name='esxiBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     txn_id='myId')
+
+        fake_read_model.update.assert_called_with('bob', 'esxiBox', {'worked': True})
+
+    @patch.object(tasks, 'refill_standby')
+    @patch.object(tasks, 'standby')
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_create_refill(self, fake_vmware, fake_read_model, fake_standby, fake_refill_standby):
+        """``create`` triggers a refill of the standby pool"""
+        fake_standby.pool_size.return_value = 2
+        fake_vmware.create_esxi.return_value = {'esxiBox': {'worked': True}}
+
+        tasks.create(username='bob',
+                     machine_name='esxiBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     txn_id='myId')
+
+        fake_refill_standby.delay.assert_called_with('0.0.1', 'myId')
+
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_batch_create(self, fake_vmware, fake_read_model):
+        """``batch_create`` returns what was created, and what failed"""
+        fake_vmware.create_esxi_batch.return_value = ({'esxi1': {'worked': True}}, {'esxi2': 'testing'})
+
+        output = tasks.batch_create(username='bob',
+                                    machine_names=['esxi1', 'esxi2'],
+                                    image='0.0.1',
+                                    network='someLAN',
+                                    txn_id='myId')
+        expected = {'content' : {'created': {'esxi1': {'worked': True}}, 'failed': {'esxi2': 'testing'}},
+                    'error': 'Failed to create 1 of 2 ESXi instances',
+                    'params': {}}
+
+        self.assertEqual(output, expected)
+        fake_read_model.update.assert_called_with('bob', 'esxi1', {'worked': True})
+
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_batch_create_value_error(self, fake_vmware, fake_read_model):
+        """``batch_create`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.create_esxi_batch.side_effect = ValueError('testing')
+
+        output = tasks.batch_create(username='bob',
+                                    machine_names=['esxi1', 'esxi2'],
+                                    image='0.0.1',
+                                    network='someLAN',
+                                    txn_id='myId')
+        expected = {'content' : {}, 'error': 'testing', 'params': {}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'read_model')
     @patch.object(tasks, 'vmware')
-    def test_create_value_error(self, fake_vmware):
+    def test_batch_delete(self, fake_vmware, fake_read_model):
+        """``batch_delete`` returns what was deleted, and what failed"""
+        fake_vmware.delete_esxi_batch.return_value = (['esxi1'], {'esxi2': 'testing'})
+
+        output = tasks.batch_delete(username='bob', machine_names=None, pattern='esxi*', txn_id='myId')
+        expected = {'content' : {'deleted': ['esxi1'], 'failed': {'esxi2': 'testing'}},
+                    'error': 'Failed to delete 1 of 2 ESXi instances',
+                    'params': {}}
+
+        self.assertEqual(output, expected)
+        fake_read_model.remove.assert_called_with('bob', 'esxi1')
+
+    def test_report_progress(self):
+        """``report_progress`` publishes the upload progress as the task state"""
+        fake_task = MagicMock()
+
+        tasks.report_progress(fake_task)(25, 100)
+
+        fake_task.update_state.assert_called_with(task_id=fake_task.request.id,
+                                                  state='PROGRESS',
+                                                  meta={'uploaded': 25, 'total': 100, 'percent': 25})
+
+    def test_report_progress_thread(self):
+        """``report_progress`` publishes to the right task when called from another thread"""
+        fake_task = MagicMock()
+        fake_task.request.id = 'some-task-id'
+        callback = tasks.report_progress(fake_task)
+        fake_task.request.id = None
+
+        the_thread = threading.Thread(target=callback, args=(25, 100))
+        the_thread.start()
+        the_thread.join()
+
+        self.assertEqual(fake_task.update_state.call_args[1]['task_id'], 'some-task-id')
+
+    @patch.object(tasks, 'events')
+    def test_report_progress_publishes(self, fake_events):
+        """``report_progress`` publishes the progress to the user's event stream"""
+        fake_task = MagicMock()
+
+        tasks.report_progress(fake_task, username='bob')(25, 100)
+
+        args, _ = fake_events.publish.call_args
+        self.assertEqual(args[0], 'bob')
+        self.assertEqual(args[2]['progress'], {'uploaded': 25, 'total': 100, 'percent': 25})
+
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_create_admission(self, fake_vmware, fake_read_model):
+        """``create`` waits for admission before deploying"""
+        fake_vmware.create_esxi.return_value = {}
+
+        tasks.create(username='bob',
+                     machine_name='esxiBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     txn_id='myId')
+
+        args, _ = self.fake_admission.admitted.call_args
+        self.assertEqual(args, ('bob',))
+
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_batch_create_admission(self, fake_vmware, fake_read_model):
+        """``batch_create`` takes a slot for every instance it deploys at once"""
+        fake_vmware.create_esxi_batch.return_value = ({}, {})
+
+        tasks.batch_create(username='bob', machine_names=['esxi1', 'esxi2'], image='0.0.1',
+                           network='someLAN', txn_id='myId')
+
+        _, kwargs = self.fake_admission.admitted.call_args
+        self.assertEqual(kwargs['slots'], 2)
+
+    @patch.object(tasks, 'events')
+    def test_report_queued(self, fake_events):
+        """``report_queued`` publishes a create's place in line as the task state"""
+        fake_task = MagicMock()
+
+        tasks.report_queued(fake_task, 'bob')(3, 600)
+
+        fake_task.update_state.assert_called_with(task_id=fake_task.request.id,
+                                                  state='QUEUED',
+                                                  meta={'position': 3, 'eta': 600})
+        args, _ = fake_events.publish.call_args
+        self.assertEqual(args[2]['queue'], {'position': 3, 'eta': 600})
+
+    @patch.object(tasks, 'events')
+    def test_publish_started(self, fake_events):
+        """``publish_started`` tells the user one of their tasks started"""
+        tasks.publish_started(task_id='some-task', task=tasks.create, args=['bob', 'myESXi'])
+
+        fake_events.publish.assert_called_with('bob', 'task', {'task-id': 'some-task', 'name': 'esxi.create', 'status': 'STARTED'})
+
+    @patch.object(tasks, 'events')
+    def test_publish_finished(self, fake_events):
+        """``publish_finished`` tells the user if their task worked"""
+        tasks.publish_finished(task_id='some-task', task=tasks.delete, args=['bob', 'myESXi'],
+                               retval={'content': {}, 'error': 'testing', 'params': {}}, state='SUCCESS')
+
+        args, _ = fake_events.publish.call_args
+        self.assertEqual(args[2]['status'], 'SUCCESS')
+        self.assertEqual(args[2]['error'], 'testing')
+
+    @patch.object(tasks, 'metrics')
+    def test_start_metrics(self, fake_metrics):
+        """``start_metrics`` labels a task's metrics with the image it's for"""
+        tasks.start_metrics(task_id='some-task', task=tasks.create, args=['bob', 'myESXi', '6.7.0', 'frontend', 'myId'])
+
+        fake_metrics.begin.assert_called_with('esxi.create', image='6.7.0')
+
+    @patch.object(tasks, 'metrics')
+    def test_start_metrics_no_image(self, fake_metrics):
+        """``start_metrics`` leaves the image blank for tasks not about an image"""
+        tasks.start_metrics(task_id='some-task', task=tasks.delete, args=['bob', 'myESXi', 'myId'])
+
+        fake_metrics.begin.assert_called_with('esxi.delete', image='')
+
+    @patch.object(tasks, 'metrics')
+    def test_finish_metrics(self, fake_metrics):
+        """``finish_metrics`` records a task that returned an error as an error"""
+        tasks.finish_metrics(task_id='some-task', task=tasks.delete,
+                             retval={'content': {}, 'error': 'testing', 'params': {}}, state='SUCCESS')
+
+        fake_metrics.end.assert_called_with('error')
+
+    @patch.object(tasks, 'metrics')
+    def test_finish_metrics_ok(self, fake_metrics):
+        """``finish_metrics`` records a task that worked"""
+        tasks.finish_metrics(task_id='some-task', task=tasks.delete,
+                             retval={'content': {}, 'error': None, 'params': {}}, state='SUCCESS')
+
+        fake_metrics.end.assert_called_with('ok')
+
+    @patch.object(tasks, 'tracing')
+    def test_start_trace(self, fake_tracing):
+        """``start_trace`` continues the trace a task was sent in"""
+        tasks.start_trace(task_id='some-task', task=tasks.delete, args=['bob', 'myESXi', 'myId'])
+
+        fake_tracing.begin_task.assert_called_with(tasks.delete)
+
+    @patch.object(tasks, 'tracing')
+    def test_finish_trace(self, fake_tracing):
+        """``finish_trace`` records the error a task returned"""
+        tasks.finish_trace(task_id='some-task', task=tasks.delete,
+                           retval={'content': {}, 'error': 'testing', 'params': {}}, state='SUCCESS')
+
+        fake_tracing.end_task.assert_called_with(error='testing')
+
+    @patch.object(tasks, 'tracing')
+    def test_finish_trace_exception(self, fake_tracing):
+        """``finish_trace`` records the exception a task raised"""
+        tasks.finish_trace(task_id='some-task', task=tasks.delete, retval=RuntimeError('testing'), state='FAILURE')
+
+        fake_tracing.end_task.assert_called_with(error='testing')
+
+    @patch.object(tasks, 'events')
+    def test_publish_not_user_task(self, fake_events):
+        """Tasks that do not change a user's inventory are not published"""
+        tasks.publish_started(task_id='some-task', task=tasks.image, args=['myTxnId'])
+
+        self.assertFalse(fake_events.publish.called)
+
+    def test_worker_pool(self):
+        """The worker runs tasks in the configured pool, one prefetched task at a time"""
+        self.assertEqual(tasks.app.conf.worker_pool, tasks.const.VLAB_ESXI_WORKER_POOL)
+        self.assertEqual(tasks.app.conf.worker_concurrency, tasks.const.VLAB_ESXI_WORKER_CONCURRENCY)
+        self.assertEqual(tasks.app.conf.worker_prefetch_multiplier, 1)
+
+    def test_worker_queues(self):
+        """By default, the worker consumes both the read and write queues"""
+        queues = [x.name for x in tasks.app.conf.task_queues]
+
+        self.assertEqual(queues, [tasks.const.VLAB_ESXI_READ_QUEUE, tasks.const.VLAB_ESXI_WRITE_QUEUE])
+
+    @patch.object(tasks, 'standby')
+    def test_refill_standby(self, fake_standby):
+        """``refill_standby`` returns how many standby VMs were created"""
+        fake_standby.refill.return_value = 2
+
+        output = tasks.refill_standby(image='0.0.1', txn_id='myId')
+        expected = {'content' : {'created': 2}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'standby')
+    def test_refill_standby_error(self, fake_standby):
+        """``refill_standby`` sets the error in the dictionary when the refill fails"""
+        fake_standby.refill.side_effect = RuntimeError('testing')
+
+        output = tasks.refill_standby(image='0.0.1', txn_id='myId')
+        expected = {'content' : {}, 'error': 'testing', 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_create_value_error(self, fake_vmware, fake_read_model):
         """``create`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.create_esxi.side_effect = [ValueError("testing")]
 
@@ -58,8 +379,9 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'read_model')
     @patch.object(tasks, 'vmware')
-    def test_delete_ok(self, fake_vmware):
+    def test_delete_ok(self, fake_vmware, fake_read_model):
         """``delete`` returns a dictionary when everything works as expected"""
         fake_vmware.delete_esxi.return_value = {'worked': True}
 
@@ -68,8 +390,17 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'vmware')
+    def test_delete_read_model(self, fake_vmware, fake_read_model):
+        """``delete`` removes the ESXi instance from the read-model"""
+        tasks.delete(username='bob', machine_name='esxiBox', txn_id='myId')
+
+        fake_read_model.remove.assert_called_with('bob', 'esxiBox')
+
+    @patch.object(tasks, 'read_model')
     @patch.object(tasks, 'vmware')
-    def test_delete_value_error(self, fake_vmware):
+    def test_delete_value_error(self, fake_vmware, fake_read_model):
         """``delete`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.delete_esxi.side_effect = [ValueError("testing")]
 
@@ -79,18 +410,21 @@ class TestTasks(unittest.TestCase):
         self.assertEqual(output, expected)
 
 
+    @patch.object(tasks, 'read_model')
+    @patch.object(tasks, 'images')
     @patch.object(tasks, 'vmware')
-    def test_image(self, fake_vmware):
+    def test_image(self, fake_vmware, fake_images, fake_read_model):
         """``image`` returns a dictionary when everything works as expected"""
-        fake_vmware.list_images.return_value = []
+        fake_images.catalogue.return_value = [{'version': '6.7u1'}]
 
         output = tasks.image(txn_id='myId')
-        expected = {'content' : {'image' : []}, 'error': None, 'params' : {}}
+        expected = {'content' : {'image' : ['6.7u1'], 'catalogue': [{'version': '6.7u1'}]}, 'error': None, 'params' : {}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'read_model')
     @patch.object(tasks, 'vmware')
-    def test_modify_network(self, fake_vmware):
+    def test_modify_network(self, fake_vmware, fake_read_model):
         """``modify_network`` returns an empty content dictionary upon success"""
         output = tasks.modify_network(username='pat',
                                       machine_name='myESXi',
@@ -100,8 +434,9 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'read_model')
     @patch.object(tasks, 'vmware')
-    def test_modify_network_error(self, fake_vmware):
+    def test_modify_network_error(self, fake_vmware, fake_read_model):
         """``modify_network`` Catches ValueError, and sets the response accordingly"""
         fake_vmware.update_network.side_effect = ValueError('some bad input')
 
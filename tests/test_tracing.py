@@ -0,0 +1,295 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in tracing.py
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+from flask import Flask
+
+from vlab_esxi_api.lib import tracing
+
+
+class TracingCase(unittest.TestCase):
+    """Turns tracing on, and collects finished spans instead of exporting them"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.patcher = patch.object(tracing, 'const')
+        self.fake_const = self.patcher.start()
+        self.fake_const.VLAB_ESXI_TRACE_OTLP_ENDPOINT = ''
+        self.fake_const.VLAB_ESXI_TRACE_FILE = '/tmp/spans.jsonl'
+        self.exporter_patcher = patch.object(tracing, 'EXPORTER')
+        self.fake_exporter = self.exporter_patcher.start()
+        tracing.activate(None)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        tracing.activate(None)
+        self.exporter_patcher.stop()
+        self.patcher.stop()
+
+    def finished(self):
+        """The spans that were exported, by name"""
+        return {x[0][0].name: x[0][0] for x in self.fake_exporter.export.call_args_list}
+
+
+class TestTracing(TracingCase):
+    """A set of test cases for tracing.py"""
+    def test_enabled(self):
+        """Tracing is off when spans are not exported anywhere"""
+        self.fake_const.VLAB_ESXI_TRACE_FILE = ''
+
+        self.assertFalse(tracing.enabled())
+        self.assertTrue(tracing.start_span('testing') is None)
+
+    def test_trace_id_for(self):
+        """A request id that's a UUID is the trace id"""
+        output = tracing.trace_id_for('b7bc2b1f-0a3e-4c6c-9d5e-7ac1f4e1b2a3')
+
+        self.assertEqual(output, 'b7bc2b1f0a3e4c6c9d5e7ac1f4e1b2a3')
+
+    def test_trace_id_for_other(self):
+        """A request id that's not a UUID gets a random trace id"""
+        output = tracing.trace_id_for('noId')
+
+        self.assertEqual(len(output), 32)
+
+    def test_parse_traceparent(self):
+        """``parse_traceparent`` obtains the trace and span ids"""
+        output = tracing.parse_traceparent('00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01')
+
+        self.assertEqual(output, ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331'))
+
+    def test_parse_traceparent_bad(self):
+        """``parse_traceparent`` returns None for an invalid value"""
+        self.assertTrue(tracing.parse_traceparent('garbage') is None)
+        self.assertTrue(tracing.parse_traceparent(None) is None)
+
+    def test_span(self):
+        """``span`` records the block as a child of the current span"""
+        root = tracing.start_span('root')
+        tracing.activate(root)
+
+        with tracing.span('child', phase='upload'):
+            pass
+
+        child = self.finished()['child']
+        self.assertEqual(child.trace_id, root.trace_id)
+        self.assertEqual(child.parent_id, root.span_id)
+        self.assertEqual(child.attributes, {'phase': 'upload'})
+        self.assertTrue(tracing.current() is root)
+
+    def test_span_no_trace(self):
+        """``span`` records nothing outside of a trace"""
+        with tracing.span('child') as output:
+            pass
+
+        self.assertTrue(output is None)
+        self.assertFalse(self.fake_exporter.export.called)
+
+    def test_span_error(self):
+        """``span`` marks the span failed if the block raises"""
+        tracing.activate(tracing.start_span('root'))
+
+        with self.assertRaises(RuntimeError):
+            with tracing.span('child'):
+                raise RuntimeError('testing')
+
+        self.assertEqual(self.finished()['child'].to_otlp()['status'], {'code': 2, 'message': 'testing'})
+
+    def test_carry(self):
+        """``carry`` continues the current span in another thread"""
+        root = tracing.start_span('root')
+        tracing.activate(root)
+        def work():
+            with tracing.span('child'):
+                pass
+        the_thread = threading.Thread(target=tracing.carry(work))
+        the_thread.start()
+        the_thread.join()
+
+        self.assertEqual(self.finished()['child'].parent_id, root.span_id)
+
+    def test_instrument(self):
+        """``instrument`` records a span for every vCenter call within a trace"""
+        fake_vcenter = MagicMock()
+        stub = fake_vcenter._conn._stub
+        stub.InvokeAccessor.side_effect = lambda mo, info: stub.InvokeMethod(mo, info, ())
+        fake_mo = MagicMock()
+        fake_mo._moId = 'vm-1'
+        fake_info = MagicMock()
+        fake_info.name = 'runtime'
+        tracing.activate(tracing.start_span('root'))
+
+        tracing.instrument(fake_vcenter)
+        stub.InvokeAccessor(fake_mo, fake_info)
+
+        self.assertEqual(list(self.finished().keys()), ['MagicMock.runtime'])
+        self.assertEqual(self.finished()['MagicMock.runtime'].attributes, {'vcenter.moid': 'vm-1'})
+
+    def test_instrument_no_trace(self):
+        """``instrument`` records nothing outside of a trace"""
+        fake_vcenter = MagicMock()
+        stub = fake_vcenter._conn._stub
+        stub.InvokeMethod.return_value = 'some-result'
+
+        tracing.instrument(fake_vcenter)
+        output = stub.InvokeMethod(MagicMock(), MagicMock(), ())
+
+        self.assertEqual(output, 'some-result')
+        self.assertFalse(self.fake_exporter.export.called)
+
+    def test_inject(self):
+        """``inject`` sends the current trace with a task"""
+        root = tracing.start_span('root')
+        tracing.activate(root)
+        headers = {}
+
+        tracing.inject(sender='esxi.show', headers=headers)
+
+        self.assertEqual(headers['traceparent'], root.traceparent())
+        self.assertTrue(tracing.ENQUEUED_HEADER in headers)
+
+    def test_inject_no_trace(self):
+        """``inject`` sends nothing outside of a trace"""
+        headers = {}
+
+        tracing.inject(sender='esxi.show', headers=headers)
+
+        self.assertEqual(headers, {})
+
+    def test_begin_end_task(self):
+        """A task continues the trace it was sent in, and records its time in the queue"""
+        fake_task = MagicMock()
+        fake_task.name = 'esxi.create'
+        fake_task.request.traceparent = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+        fake_task.request.vlab_enqueued = 1000.0
+
+        tracing.begin_task(fake_task)
+        tracing.end_task(error='testing')
+
+        spans = self.finished()
+        self.assertEqual(spans['queue'].start, 1000.0)
+        self.assertEqual(spans['queue'].parent_id, 'b7ad6b7169203331')
+        self.assertEqual(spans['esxi.create'].parent_id, 'b7ad6b7169203331')
+        self.assertEqual(spans['esxi.create'].error, 'testing')
+        self.assertTrue(tracing.current() is None)
+
+    def test_begin_task_untraced(self):
+        """A task sent outside of a trace records nothing"""
+        fake_task = MagicMock()
+        fake_task.request.traceparent = None
+
+        tracing.begin_task(fake_task)
+        tracing.end_task()
+
+        self.assertFalse(self.fake_exporter.export.called)
+
+
+class TestInitApp(TracingCase):
+    """A set of test cases for tracing the requests of the API"""
+    def setUp(self):
+        """Runs before every test case"""
+        super().setUp()
+        app = Flask(__name__)
+        tracing.init_app(app)
+
+        @app.route('/api/2/inf/esxi/<name>')
+        def handler(name):
+            return 'ok'
+
+        self.app = app.test_client()
+
+    def test_request_span(self):
+        """Every request is a span, with the request id as its trace id"""
+        self.app.get('/api/2/inf/esxi/foo', headers={'X-REQUEST-ID': 'b7bc2b1f-0a3e-4c6c-9d5e-7ac1f4e1b2a3'})
+
+        request_span = self.finished()['GET /api/2/inf/esxi/<name>']
+        self.assertEqual(request_span.trace_id, 'b7bc2b1f0a3e4c6c9d5e7ac1f4e1b2a3')
+        self.assertEqual(request_span.attributes['http.status_code'], 200)
+        self.assertEqual(request_span.attributes['vlab.request_id'], 'b7bc2b1f-0a3e-4c6c-9d5e-7ac1f4e1b2a3')
+
+    def test_request_traceparent(self):
+        """An incoming traceparent is continued"""
+        self.app.get('/api/2/inf/esxi/foo',
+                     headers={'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'})
+
+        request_span = self.finished()['GET /api/2/inf/esxi/<name>']
+        self.assertEqual(request_span.trace_id, '0af7651916cd43dd8448eb211c80319c')
+        self.assertEqual(request_span.parent_id, 'b7ad6b7169203331')
+
+
+class TestExporter(unittest.TestCase):
+    """A set of test cases for the Exporter object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(tracing, 'const')
+        self.fake_const = self.patcher.start()
+        self.fake_const.VLAB_ESXI_TRACE_OTLP_ENDPOINT = ''
+        self.fake_const.VLAB_ESXI_TRACE_FILE = os.path.join(self.tmp_dir, 'spans.jsonl')
+        self.exporter = tracing.Exporter(service='testing', interval=0, max_queue=1)
+        self.span = tracing.Span('testing', 'a' * 32)
+        self.span.end = self.span.start
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_send_file(self):
+        """``send`` appends an OTLP/JSON document to the file"""
+        self.exporter.send([self.span])
+        self.exporter.send([self.span])
+
+        with open(self.fake_const.VLAB_ESXI_TRACE_FILE) as the_file:
+            lines = the_file.readlines()
+        sent = ujson.loads(lines[0])['resourceSpans'][0]
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(sent['resource']['attributes'][0]['value'], {'stringValue': 'testing'})
+        self.assertEqual(sent['scopeSpans'][0]['spans'][0]['name'], 'testing')
+
+    @patch.object(tracing.urllib.request, 'urlopen')
+    def test_send_otlp(self, fake_urlopen):
+        """``send`` POSTs the spans to the collector"""
+        self.fake_const.VLAB_ESXI_TRACE_FILE = ''
+        self.fake_const.VLAB_ESXI_TRACE_OTLP_ENDPOINT = 'http://collector:4318/v1/traces'
+
+        self.exporter.send([self.span])
+
+        req = fake_urlopen.call_args[0][0]
+        self.assertEqual(req.full_url, 'http://collector:4318/v1/traces')
+        self.assertEqual(req.get_method(), 'POST')
+
+    @patch.object(tracing.urllib.request, 'urlopen')
+    def test_send_error(self, fake_urlopen):
+        """``send`` logs, and does not raise, when the collector is down"""
+        self.fake_const.VLAB_ESXI_TRACE_OTLP_ENDPOINT = 'http://collector:4318/v1/traces'
+        fake_urlopen.side_effect = OSError('testing')
+
+        self.exporter.send([self.span])
+
+    @patch.object(tracing.threading, 'Thread')
+    def test_export_full(self, fake_Thread):
+        """``export`` drops spans when the queue is full, instead of blocking"""
+        self.exporter.export(self.span)
+        self.exporter.export(self.span)
+
+        self.assertEqual(self.exporter.dropped, 1)
+
+    @patch.object(tracing.threading, 'Thread')
+    def test_next_batch(self, fake_Thread):
+        """``_next_batch`` returns what's queued once the interval is up"""
+        self.exporter.export(self.span)
+
+        self.assertEqual(self.exporter._next_batch(), [self.span])
+
+
+if __name__ == '__main__':
+    unittest.main()
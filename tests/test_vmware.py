@@ -5,27 +5,24 @@ A suite of tests for the functions in vmware.py
 import unittest
 from unittest.mock import patch, MagicMock
 
-from vlab_esxi_api.lib.worker import vmware
+from vlab_esxi_api.lib.worker import vmware, waiter
 
 
 class TestVMware(unittest.TestCase):
     """A set of test cases for the vmware.py module"""
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_show_esxi(self, fake_vCenter, fake_consume_task, fake_get_info):
+    @patch.object(vmware, 'cache')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware.inventory, 'get_esxi_vms')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_esxi(self, fake_vcenter_session, fake_get_esxi_vms, fake_INDEX, fake_cache):
         """``esxi`` returns a dictionary when everything works as expected"""
-        fake_vm = MagicMock()
-        fake_vm.name = 'ESXi'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'ESXi',
-                                               'created': 1234,
-                                               'version': '6.5',
-                                               'configured': False,
-                                               'generation': 1}}
+        fake_cache.CACHE.esxi_records.return_value = None
+        fake_get_esxi_vms.return_value = {'ESXi': {'meta': {'component': 'ESXi',
+                                                            'created': 1234,
+                                                            'version': '6.5',
+                                                            'configured': False,
+                                                            'generation': 1}}}
 
         output = vmware.show_esxi(username='alice')
         expected = {'ESXi': {'meta': {'component': 'ESXi',
@@ -36,63 +33,69 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware, 'cache')
+    @patch.object(vmware.inventory, 'esxi_info')
+    @patch.object(vmware.inventory, 'get_esxi_vms')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_esxi_cached(self, fake_vcenter_session, fake_get_esxi_vms, fake_esxi_info, fake_cache):
+        """``esxi`` answers from the inventory cache when it's fresh"""
+        fake_cache.CACHE.esxi_records.return_value = ({}, {})
+
+        vmware.show_esxi(username='alice')
+
+        self.assertTrue(fake_esxi_info.called)
+        self.assertFalse(fake_get_esxi_vms.called)
+
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware, 'power')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_esxi(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_esxi(self, fake_vcenter_session, fake_consume_task, fake_power, fake_INDEX):
         """``delete_esxi`` returns None when everything works as expected"""
         fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'ESXiBox'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'ESXi',
-                                               'created': 1234,
-                                               'version': '6.5',
-                                               'configured': False,
-                                               'generation': 1}}
 
         output = vmware.delete_esxi(username='bob', machine_name='ESXiBox', logger=fake_logger)
         expected = None
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware, 'power')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_esxi_value_error(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_esxi_forget(self, fake_vcenter_session, fake_consume_task, fake_power, fake_INDEX):
+        """``delete_esxi`` removes the deleted VM from the index"""
+        fake_logger = MagicMock()
+
+        vmware.delete_esxi(username='bob', machine_name='ESXiBox', logger=fake_logger)
+
+        fake_INDEX.forget.assert_called_with('bob', 'ESXiBox')
+
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware, 'power')
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_esxi_value_error(self, fake_vcenter_session, fake_consume_task, fake_power, fake_INDEX):
         """``delete_esxi`` raises ValueError when unable to find requested vm for deletion"""
         fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'win10'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'ESXi',
-                                               'created': 1234,
-                                               'version': '6.5',
-                                               'configured': False,
-                                               'generation': 1}}
+        fake_INDEX.find_esxi.side_effect = ValueError('testing')
 
         with self.assertRaises(ValueError):
             vmware.delete_esxi(username='bob', machine_name='myOtherESXiBox', logger=fake_logger)
 
     @patch.object(vmware.virtual_machine, 'set_meta')
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware, 'open_ova')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware.deploy, 'deploy_ova')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_esxi(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova, fake_set_meta):
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi(self, fake_vcenter_session, fake_consume_task, fake_deploy_ova, fake_get_info, fake_Ova, fake_set_meta):
         """``create_esxi`` returns a dictionary upon success"""
         fake_logger = MagicMock()
-        fake_deploy_from_ova.return_value.name = 'myESXi'
+        fake_deploy_ova.return_value.name = 'myESXi'
         fake_get_info.return_value = {'worked': True}
         fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
 
         output = vmware.create_esxi(username='alice',
                                        machine_name='ESXiBox',
@@ -103,17 +106,174 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, 'Ova')
+    @patch.object(vmware, 'standby')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, 'power')
     @patch.object(vmware.virtual_machine, 'get_info')
-    @patch.object(vmware.virtual_machine, 'deploy_from_ova')
+    @patch.object(vmware.deploy, 'deploy_ova')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_esxi_invalid_network(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova, fake_get_info, fake_Ova):
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_standby(self, fake_vcenter_session, fake_consume_task, fake_deploy_ova, fake_get_info,
+                                 fake_power, fake_set_meta, fake_INDEX, fake_standby):
+        """``create_esxi`` adopts an already booted standby VM when one is available"""
+        the_vm = MagicMock()
+        the_vm.name = 'ESXiBox'
+        fake_standby.claim.return_value = (the_vm, MagicMock())
+        fake_standby.adopt.return_value = []
+        fake_get_info.return_value = {'ips': ['10.1.1.1']}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        output = vmware.create_esxi(username='alice',
+                                    machine_name='ESXiBox',
+                                    image='1.0.0',
+                                    network='someLAN',
+                                    logger=MagicMock())
+
+        self.assertEqual(output, {'ESXiBox': {'ips': ['10.1.1.1']}})
+        meta_data = fake_standby.adopt.call_args[1]['meta_data']
+
+        self.assertEqual(meta_data['component'], 'ESXi')
+        self.assertFalse(fake_deploy_ova.called)
+        self.assertFalse(fake_set_meta.called)
+        self.assertFalse(fake_power.called)
+
+    @patch.object(vmware, 'const')
+    @patch.object(vmware, 'deploy')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware, 'power')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_no_wait_for_ip(self, fake_vcenter_session, fake_get_info, fake_power, fake_INDEX,
+                                        fake_deploy, fake_const):
+        """``create_esxi`` marks the IP pending instead of waiting for it, when configured to"""
+        fake_const.VLAB_ESXI_WAIT_FOR_IP = False
+        fake_const.VLAB_ESXI_STANDBY_SIZES = ''
+        fake_deploy.deploy_mode.return_value = 'clone'
+        fake_deploy.clone_vm.return_value.name = 'ESXiBox'
+        fake_get_info.return_value = {'ips': []}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        output = vmware.create_esxi(username='alice',
+                                    machine_name='ESXiBox',
+                                    image='1.0.0',
+                                    network='someLAN',
+                                    logger=MagicMock())
+        _, kwargs = fake_get_info.call_args
+
+        self.assertEqual(output, {'ESXiBox': {'ips': [], 'ip_pending': True}})
+        self.assertFalse(kwargs.get('ensure_ip', False))
+
+    @patch.object(vmware.ipwatch, 'WATCHER')
+    @patch.object(vmware, 'standby')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_standby_stale_ip(self, fake_vcenter_session, fake_get_info, fake_INDEX, fake_standby,
+                                          fake_WATCHER):
+        """``create_esxi`` does not report the IP a standby VM had on the standby network"""
+        the_vm = MagicMock()
+        the_vm.name = 'ESXiBox'
+        the_vm._moId = 'vm-1'
+        fake_standby.claim.return_value = (the_vm, MagicMock())
+        fake_standby.adopt.return_value = ['192.168.1.5']
+        fake_get_info.return_value = {'ips': ['192.168.1.5']}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        output = vmware.create_esxi(username='alice',
+                                    machine_name='ESXiBox',
+                                    image='1.0.0',
+                                    network='someLAN',
+                                    logger=MagicMock())
+
+        self.assertEqual(output, {'ESXiBox': {'ips': [], 'ip_pending': True}})
+        fake_WATCHER.ignore.assert_called_with('vm-1', ['192.168.1.5'])
+
+    @patch.object(vmware, 'standby')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_standby_bad_name(self, fake_vcenter_session, fake_standby):
+        """``create_esxi`` checks the machine name before claiming a standby VM"""
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        with self.assertRaises(ValueError):
+            vmware.create_esxi(username='alice',
+                               machine_name='ESXi_Box!',
+                               image='1.0.0',
+                               network='someLAN',
+                               logger=MagicMock())
+
+        self.assertFalse(fake_standby.claim.called)
+
+    @patch.object(vmware, 'deploy')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, 'power')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.deploy, 'deploy_ova')
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_clone(self, fake_vcenter_session, fake_consume_task, fake_deploy_ova, fake_get_info,
+                               fake_power, fake_set_meta, fake_INDEX, fake_deploy):
+        """``create_esxi`` makes a linked clone when the image is in clone mode"""
+        fake_deploy.deploy_mode.return_value = 'clone'
+        fake_deploy.clone_vm.return_value.name = 'ESXiBox'
+        fake_get_info.return_value = {'worked': True}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        output = vmware.create_esxi(username='alice',
+                                    machine_name='ESXiBox',
+                                    image='1.0.0',
+                                    network='someLAN',
+                                    logger=MagicMock())
+
+        meta_data = fake_deploy.config_spec.call_args[0][0]
+        _, clone_kwargs = fake_deploy.clone_vm.call_args
+
+        self.assertEqual(output, {'ESXiBox': {'worked': True}})
+        self.assertFalse(fake_deploy.deploy_ova.called)
+        self.assertEqual(meta_data['component'], 'ESXi')
+        self.assertTrue(clone_kwargs['config'] is fake_deploy.config_spec.return_value)
+        self.assertFalse(fake_set_meta.called)
+        self.assertFalse(fake_deploy.clone_vm.return_value.ReconfigVM_Task.called)
+        self.assertTrue(fake_power.called)
+
+    @patch.object(vmware, 'deploy')
+    @patch.object(vmware, 'open_ova')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, 'power')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.deploy, 'deploy_ova')
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_clone_fallback(self, fake_vcenter_session, fake_consume_task, fake_deploy_ova, fake_get_info,
+                                        fake_power, fake_set_meta, fake_INDEX, fake_Ova, fake_deploy):
+        """``create_esxi`` uploads the OVA when there's no base VM to clone"""
+        fake_deploy.deploy_mode.return_value = 'clone'
+        fake_deploy.get_template.return_value = None
+        fake_Ova.return_value.networks = ['someLAN']
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        vmware.create_esxi(username='alice',
+                           machine_name='ESXiBox',
+                           image='1.0.0',
+                           network='someLAN',
+                           logger=MagicMock())
+
+        self.assertTrue(fake_deploy.deploy_ova.called)
+        self.assertFalse(fake_deploy.clone_vm.called)
+
+    @patch.object(vmware, 'open_ova')
+    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.deploy, 'deploy_ova')
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_invalid_network(self, fake_vcenter_session, fake_consume_task, fake_deploy_ova, fake_get_info, fake_Ova):
         """``create_esxi`` raises ValueError if supplied with a non-existing network"""
         fake_logger = MagicMock()
         fake_get_info.return_value = {'worked': True}
         fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
 
         with self.assertRaises(ValueError):
             vmware.create_esxi(username='alice',
@@ -122,10 +282,138 @@ class TestVMware(unittest.TestCase):
                                   network='someOtherLAN',
                                   logger=fake_logger)
 
-    @patch.object(vmware.os, 'listdir')
-    def test_list_images(self, fake_listdir):
+    def _fake_records(self, fake_get_vm_records):
+        """Make a user own three ESXi instances, and one other VM"""
+        vms = {}
+        for idx, name in enumerate(['lab-1', 'lab-2', 'other', 'notESXi']):
+            the_vm = MagicMock()
+            the_vm.Destroy_Task.return_value.info.error = None
+            the_vm.PowerOffVM_Task.return_value.info.error = None
+            component = 'ESXi' if name != 'notESXi' else 'CentOS'
+            props = {'name': name,
+                     'runtime.powerState': 'poweredOn' if idx else 'poweredOff',
+                     'config.annotation': '{"component": "%s"}' % component}
+            vms['vm-{}'.format(idx)] = (the_vm, props)
+        fake_get_vm_records.return_value = (vms, {})
+        return {x[1]['name']: x[0] for x in vms.values()}
+
+    @patch.object(waiter.WAITER, '_enabled', False)
+    @patch.object(vmware.inventory, 'get_vm_records')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_esxi_batch_all(self, fake_vcenter_session, fake_INDEX, fake_get_vm_records):
+        """``delete_esxi_batch`` destroys every ESXi instance the user owns"""
+        vms = self._fake_records(fake_get_vm_records)
+
+        deleted, failed = vmware.delete_esxi_batch('bob', MagicMock())
+
+        self.assertEqual(set(deleted), {'lab-1', 'lab-2', 'other'})
+        self.assertEqual(failed, {})
+        self.assertFalse(vms['notESXi'].Destroy_Task.called)
+        self.assertFalse(vms['lab-1'].PowerOffVM_Task.called)
+        self.assertTrue(vms['lab-2'].PowerOffVM_Task.called)
+
+    @patch.object(waiter.WAITER, '_enabled', False)
+    @patch.object(vmware.inventory, 'get_vm_records')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_esxi_batch_pattern(self, fake_vcenter_session, fake_INDEX, fake_get_vm_records):
+        """``delete_esxi_batch`` destroys the ESXi instances that match a wildcard"""
+        self._fake_records(fake_get_vm_records)
+
+        deleted, _ = vmware.delete_esxi_batch('bob', MagicMock(), pattern='lab-*')
+
+        self.assertEqual(set(deleted), {'lab-1', 'lab-2'})
+
+    @patch.object(waiter.WAITER, '_enabled', False)
+    @patch.object(vmware.inventory, 'get_vm_records')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_esxi_batch_names(self, fake_vcenter_session, fake_INDEX, fake_get_vm_records):
+        """``delete_esxi_batch`` reports names that do not exist"""
+        self._fake_records(fake_get_vm_records)
+
+        deleted, failed = vmware.delete_esxi_batch('bob', MagicMock(), machine_names=['lab-1', 'nope'])
+
+        self.assertEqual(deleted, ['lab-1'])
+        self.assertEqual(failed, {'nope': 'No esxi named nope found'})
+
+    @patch.object(waiter.WAITER, '_enabled', False)
+    @patch.object(vmware.inventory, 'get_vm_records')
+    @patch.object(vmware.inventory, 'INDEX')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_esxi_batch_error(self, fake_vcenter_session, fake_INDEX, fake_get_vm_records):
+        """``delete_esxi_batch`` reports VMs that could not be destroyed, and keeps going"""
+        vms = self._fake_records(fake_get_vm_records)
+        vms['lab-2'].Destroy_Task.return_value.info.error = MagicMock(msg='testing')
+
+        deleted, failed = vmware.delete_esxi_batch('bob', MagicMock(), pattern='lab-*')
+
+        self.assertEqual(deleted, ['lab-1'])
+        self.assertEqual(failed, {'lab-2': 'testing'})
+        fake_INDEX.forget.assert_called_once_with('bob', 'lab-1')
+
+    @patch.object(vmware, '_create_one')
+    @patch.object(vmware.deploy, 'get_placement')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_batch(self, fake_vcenter_session, fake_get_placement, fake_create_one):
+        """``create_esxi_batch`` reports which instances were created, and which failed"""
+        def fake_create(vcenter, username, machine_name, *args, **kwargs):
+            if machine_name == 'esxi2':
+                raise RuntimeError('testing')
+            the_vm = MagicMock()
+            the_vm.name = machine_name
+            return the_vm, {'worked': True}
+        fake_create_one.side_effect = fake_create
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+        progress = MagicMock()
+
+        created, failed = vmware.create_esxi_batch(username='alice',
+                                                   machine_names=['esxi1', 'esxi2', 'esxi3'],
+                                                   image='1.0.0',
+                                                   network='someLAN',
+                                                   logger=MagicMock(),
+                                                   progress=progress)
+
+        self.assertEqual(created, {'esxi1': {'worked': True}, 'esxi3': {'worked': True}})
+        self.assertEqual(failed, {'esxi2': 'testing'})
+        progress.assert_called_with(3, 3)
+
+    @patch.object(vmware, '_create_one')
+    @patch.object(vmware.deploy, 'get_placement')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_batch_shared(self, fake_vcenter_session, fake_get_placement, fake_create_one):
+        """``create_esxi_batch`` makes every instance with the same session and placement"""
+        fake_create_one.return_value = (MagicMock(), {})
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+
+        vmware.create_esxi_batch(username='alice',
+                                 machine_names=['esxi1', 'esxi2'],
+                                 image='1.0.0',
+                                 network='someLAN',
+                                 logger=MagicMock())
+
+        self.assertEqual(fake_vcenter_session.call_count, 1)
+        self.assertEqual(fake_get_placement.call_count, 1)
+        for _, kwargs in fake_create_one.call_args_list:
+            self.assertTrue(kwargs['placement'] is fake_get_placement.return_value)
+
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_esxi_batch_invalid_network(self, fake_vcenter_session):
+        """``create_esxi_batch`` raises ValueError if supplied with a non-existing network"""
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {}
+
+        with self.assertRaises(ValueError):
+            vmware.create_esxi_batch(username='alice',
+                                     machine_names=['esxi1'],
+                                     image='1.0.0',
+                                     network='someLAN',
+                                     logger=MagicMock())
+
+    @patch.object(vmware.images, 'catalogue')
+    def test_list_images(self, fake_catalogue):
         """``list_images`` - Returns a list of available ESXi versions that can be deployed"""
-        fake_listdir.return_value = ['esxi-6.5u2.ova', 'esxi-6.5u1.ova', 'esxi-6.5.ova']
+        fake_catalogue.return_value = [{'version': '6.5u2'}, {'version': '6.5u1'}, {'version': '6.5'}]
 
         output = vmware.list_images()
         expected = ['6.5', '6.5u1', '6.5u2']
@@ -147,31 +435,13 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, 'consume_task')
-    def test_config_vm(self, fake_consume_task):
-        """``config_vm`` Enables hardware-assisted virtualization"""
-        fake_vm = MagicMock()
-        vmware.config_vm(fake_vm)
-
-        the_args, _ = fake_vm.ReconfigVM_Task.call_args
-        the_spec = the_args[0]
-
-        self.assertTrue(the_spec.nestedHVEnabled)
-
     @patch.object(vmware.virtual_machine, 'change_network')
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.inventory, 'INDEX')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_update_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    @patch.object(vmware, 'vcenter_session')
+    def test_update_network(self, fake_vcenter_session, fake_consume_task, fake_INDEX, fake_change_network):
         """``update_network`` Returns None upon success"""
-        fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'myESXi'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
-        fake_get_info.return_value = {'meta': {'component' : 'ESXi'}}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
 
         result = vmware.update_network(username='pat',
                                        machine_name='myESXi',
@@ -180,19 +450,13 @@ class TestVMware(unittest.TestCase):
         self.assertTrue(result is None)
 
     @patch.object(vmware.virtual_machine, 'change_network')
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.inventory, 'INDEX')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_update_network_no_vm(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    @patch.object(vmware, 'vcenter_session')
+    def test_update_network_no_vm(self, fake_vcenter_session, fake_consume_task, fake_INDEX, fake_change_network):
         """``update_network`` Raises ValueError if the supplied VM doesn't exist"""
-        fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'myESXi'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
-        fake_get_info.return_value = {'meta': {'component' : 'ESXi'}}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
+        fake_INDEX.find_esxi.side_effect = ValueError('testing')
 
         with self.assertRaises(ValueError):
             vmware.update_network(username='pat',
@@ -200,19 +464,12 @@ class TestVMware(unittest.TestCase):
                                   new_network='wootTown')
 
     @patch.object(vmware.virtual_machine, 'change_network')
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware.inventory, 'INDEX')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_update_network_no_network(self, fake_vCenter, fake_consume_task, fake_get_info, fake_change_network):
+    @patch.object(vmware, 'vcenter_session')
+    def test_update_network_no_network(self, fake_vcenter_session, fake_consume_task, fake_INDEX, fake_change_network):
         """``update_network`` Raises ValueError if the supplied new network doesn't exist"""
-        fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'myESXi'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_vCenter.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
-        fake_get_info.return_value = {'meta': {'component' : 'ESXi'}}
+        fake_vcenter_session.return_value.__enter__.return_value.networks = {'wootTown' : 'someNetworkObject'}
 
         with self.assertRaises(ValueError):
             vmware.update_network(username='pat',
@@ -0,0 +1,260 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in waiter.py
+"""
+import os
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_esxi_api.lib.worker import waiter
+
+
+def make_update(moid, **changes):
+    """Create a stand-in for a vmodl.query.PropertyCollector.UpdateSet with one task"""
+    object_update = MagicMock()
+    object_update.obj = waiter.vim.Task(moid)
+    object_update.changeSet = []
+    for name, val in changes.items():
+        change = MagicMock()
+        change.name = name.replace('__', '.')
+        change.val = val
+        object_update.changeSet.append(change)
+    update_set = MagicMock()
+    update_set.filterSet = [MagicMock(objectSet=[object_update])]
+    return update_set
+
+
+class TestTaskWaiter(unittest.TestCase):
+    """A set of test cases for the TaskWaiter object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.waiter = waiter.TaskWaiter(factory=MagicMock(), enabled=True, wait_seconds=1, retry_seconds=1)
+        # pretend the update stream is running
+        self.waiter._pid = os.getpid()
+        self.waiter._thread = MagicMock()
+        self.waiter._thread.is_alive.return_value = True
+        self.waiter._vcenter = MagicMock()
+        self.waiter._collector = MagicMock()
+
+    def _finish_on_filter(self, **changes):
+        """Make vCenter report every task as finished as soon as the filter is created"""
+        def create_filter(spec, partialUpdates):
+            for object_spec in spec.objectSet:
+                self.waiter.apply(make_update(object_spec.obj._moId, **changes))
+            return MagicMock()
+        self.waiter._collector.CreateFilter.side_effect = create_filter
+
+    def test_wait(self):
+        """``TaskWaiter`` - ``wait`` returns the result of every task"""
+        self._finish_on_filter(info__state='success', info__result='woot')
+        tasks = {'a': MagicMock(_moId='task-1'), 'b': MagicMock(_moId='task-2')}
+
+        outcome = self.waiter.wait(tasks, timeout=1)
+
+        self.assertEqual(outcome['a'], waiter.Outcome(None, 'woot'))
+        self.assertEqual(outcome['b'], waiter.Outcome(None, 'woot'))
+
+    def test_wait_error(self):
+        """``TaskWaiter`` - ``wait`` returns the error message of a failed task"""
+        self._finish_on_filter(info__state='error', info__error=MagicMock(msg='testing'))
+
+        outcome = self.waiter.wait({'a': MagicMock(_moId='task-1')}, timeout=1)
+
+        self.assertEqual(outcome['a'].error, 'testing')
+
+    def test_wait_no_polling(self):
+        """``TaskWaiter`` - ``wait`` does not read the task info when the stream is up"""
+        self._finish_on_filter(info__state='success', info__result=None)
+        # reading the_task.info would raise AttributeError
+        the_task = MagicMock(spec=['_moId'])
+        the_task._moId = 'task-1'
+
+        outcome = self.waiter.wait({'a': the_task}, timeout=1)
+
+        self.assertEqual(outcome['a'], waiter.Outcome(None, None))
+
+    def test_wait_destroys_filter(self):
+        """``TaskWaiter`` - ``wait`` removes its filter, and forgets its tasks"""
+        the_filter = MagicMock()
+        def create_filter(spec, partialUpdates):
+            self.waiter.apply(make_update('task-1', info__state='success'))
+            return the_filter
+        self.waiter._collector.CreateFilter.side_effect = create_filter
+
+        self.waiter.wait({'a': MagicMock(_moId='task-1')}, timeout=1)
+
+        self.assertTrue(the_filter.Destroy.called)
+        self.assertEqual(self.waiter._watches, {})
+
+    def test_wait_timeout(self):
+        """``TaskWaiter`` - ``wait`` reports tasks that did not finish in time"""
+        self._finish_on_filter(info__state='running')
+
+        outcome = self.waiter.wait({'a': MagicMock(_moId='task-1')}, timeout=0)
+
+        self.assertTrue(outcome['a'].error.startswith('Timeout'))
+
+    def test_wait_running(self):
+        """``TaskWaiter`` - a task that's still running does not wake the waiter"""
+        watch = waiter._Watch()
+        self.waiter._watches['task-1'] = [watch]
+
+        self.waiter.apply(make_update('task-1', info__state='running'))
+
+        self.assertFalse(watch.event.is_set())
+
+    @patch.object(waiter, 'poll')
+    def test_wait_not_ready(self, fake_poll):
+        """``TaskWaiter`` - ``wait`` polls when the update stream is down"""
+        self.waiter._collector = None
+        tasks = {'a': MagicMock(_moId='task-1')}
+
+        self.waiter.wait(tasks, timeout=1)
+
+        fake_poll.assert_called_with(tasks, 1)
+
+    @patch.object(waiter, 'poll')
+    def test_wait_disabled(self, fake_poll):
+        """``TaskWaiter`` - ``wait`` polls when the waiter is disabled"""
+        self.waiter._enabled = False
+
+        self.waiter.wait({'a': MagicMock(_moId='task-1')}, timeout=1)
+
+        self.assertTrue(fake_poll.called)
+        self.assertFalse(self.waiter._collector.CreateFilter.called)
+
+    @patch.object(waiter, 'poll')
+    def test_wait_broken(self, fake_poll):
+        """``TaskWaiter`` - tasks being waited on are polled if the stream breaks"""
+        fake_poll.return_value = {'a': waiter.Outcome(None, 'polled')}
+        def create_filter(spec, partialUpdates):
+            self.waiter._break()
+            return MagicMock()
+        self.waiter._collector.CreateFilter.side_effect = create_filter
+
+        outcome = self.waiter.wait({'a': MagicMock(_moId='task-1')}, timeout=5)
+
+        self.assertEqual(outcome['a'].result, 'polled')
+
+    @patch.object(waiter, 'poll')
+    def test_wait_filter_fails(self, fake_poll):
+        """``TaskWaiter`` - ``wait`` polls, and resets the stream, if the filter cannot be made"""
+        fake_poll.return_value = {'a': waiter.Outcome(None, 'polled')}
+        self.waiter._collector.CreateFilter.side_effect = ConnectionResetError('testing')
+
+        outcome = self.waiter.wait({'a': MagicMock(_moId='task-1')}, timeout=5)
+
+        self.assertEqual(outcome['a'].result, 'polled')
+        self.assertTrue(self.waiter._collector is None)
+
+    def test_wait_rebinds_result(self):
+        """``TaskWaiter`` - a managed object result is bound to the session of the task"""
+        self._finish_on_filter(info__state='success', info__result=waiter.vim.VirtualMachine('vm-1', 'waiter-stub'))
+        the_task = MagicMock(_moId='task-1', _stub='caller-stub')
+
+        outcome = self.waiter.wait({'a': the_task}, timeout=1)
+
+        self.assertEqual(outcome['a'].result._moId, 'vm-1')
+        self.assertEqual(outcome['a'].result._stub, 'caller-stub')
+
+    def test_watch_reconnects(self):
+        """``TaskWaiter`` - the update stream reconnects once a ``wait`` found it broken"""
+        collector = MagicMock()
+        vcenter = MagicMock()
+        vcenter.content.propertyCollector.CreatePropertyCollector.return_value = collector
+        collector.WaitForUpdatesEx.side_effect = lambda version, options: self.waiter._break()
+
+        self.waiter._watch(vcenter)
+
+        self.assertEqual(collector.WaitForUpdatesEx.call_count, 1)
+        self.assertTrue(collector.DestroyPropertyCollector.called)
+
+    def test_wait_nothing(self):
+        """``TaskWaiter`` - ``wait`` on no tasks returns immediately"""
+        self.assertEqual(self.waiter.wait({}), {})
+
+
+class TestWaiterFunctions(unittest.TestCase):
+    """A set of test cases for the functions in waiter.py"""
+
+    @patch.object(waiter.time, 'sleep')
+    def test_poll(self, fake_sleep):
+        """``poll`` returns the result or error of each task"""
+        worked = MagicMock()
+        worked.info.error = None
+        worked.info.result = 'woot'
+        failed = MagicMock()
+        failed.info.error.msg = 'testing'
+
+        outcome = waiter.poll({'a': worked, 'b': failed})
+
+        self.assertEqual(outcome, {'a': waiter.Outcome(None, 'woot'), 'b': waiter.Outcome('testing', None)})
+
+    @patch.object(waiter.time, 'sleep')
+    def test_poll_timeout(self, fake_sleep):
+        """``poll`` reports tasks that did not finish in time"""
+        the_task = MagicMock()
+        the_task.info.completeTime = None
+
+        outcome = waiter.poll({'a': the_task}, timeout=2)
+
+        self.assertTrue(outcome['a'].error.startswith('Timeout'))
+        self.assertEqual(fake_sleep.call_count, 2)
+
+    @patch.object(waiter, 'WAITER')
+    def test_consume_task(self, fake_WAITER):
+        """``consume_task`` returns the result of the task"""
+        fake_WAITER.wait.return_value = {'task': waiter.Outcome(None, 'woot')}
+
+        self.assertEqual(waiter.consume_task(MagicMock()), 'woot')
+
+    @patch.object(waiter, 'WAITER')
+    def test_consume_task_error(self, fake_WAITER):
+        """``consume_task`` raises RuntimeError if the task failed"""
+        fake_WAITER.wait.return_value = {'task': waiter.Outcome('testing', None)}
+
+        with self.assertRaises(RuntimeError):
+            waiter.consume_task(MagicMock())
+
+    @patch.object(waiter, 'WAITER')
+    def test_wait_for_tasks(self, fake_WAITER):
+        """``wait_for_tasks`` returns only the error message of each task"""
+        fake_WAITER.wait.return_value = {'a': waiter.Outcome(None, 'woot'), 'b': waiter.Outcome('testing', None)}
+
+        self.assertEqual(waiter.wait_for_tasks({}), {'a': None, 'b': 'testing'})
+
+    @patch.object(waiter, 'consume_task')
+    def test_power_on(self, fake_consume_task):
+        """``power`` starts a PowerOnVM_Task"""
+        the_vm = MagicMock()
+        the_vm.runtime.powerState = 'poweredOff'
+
+        self.assertTrue(waiter.power(the_vm, state='on'))
+        fake_consume_task.assert_called_with(the_vm.PowerOnVM_Task.return_value, timeout=600)
+
+    @patch.object(waiter, 'consume_task')
+    def test_power_noop(self, fake_consume_task):
+        """``power`` does nothing if the VM is already in the requested state"""
+        the_vm = MagicMock()
+        the_vm.runtime.powerState = 'poweredOff'
+
+        self.assertTrue(waiter.power(the_vm, state='off'))
+        self.assertFalse(fake_consume_task.called)
+
+    @patch.object(waiter, 'consume_task')
+    def test_power_fails(self, fake_consume_task):
+        """``power`` returns False if the task fails"""
+        fake_consume_task.side_effect = RuntimeError('testing')
+        the_vm = MagicMock()
+        the_vm.runtime.powerState = 'poweredOn'
+
+        self.assertFalse(waiter.power(the_vm, state='off'))
+
+    def test_power_bad_state(self):
+        """``power`` raises ValueError for an unknown power state"""
+        with self.assertRaises(ValueError):
+            waiter.power(MagicMock(), state='sideways')
+
+
+if __name__ == '__main__':
+    unittest.main()
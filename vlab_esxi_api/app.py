@@ -2,15 +2,19 @@
 from flask import Flask
 from celery import Celery
 
-from vlab_esxi_api.lib import const
-from vlab_esxi_api.lib.views import HealthView, ESXiView
+from vlab_esxi_api.lib import const, results, routing, tracing
+from vlab_esxi_api.lib.views import HealthView, ESXiView, MetricsView
 
 app = Flask(__name__)
-app.celery_app = Celery('esxi', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+app.celery_app = Celery('esxi', broker=const.VLAB_MESSAGE_BROKER)
+results.configure(app.celery_app)
+routing.configure(app.celery_app)
 app.celery_app.conf.broker_heartbeat = 0 #https://github.com/celery/celery/issues/4895
+tracing.init_app(app)
 
 HealthView.register(app)
 ESXiView.register(app)
+MetricsView.register(app)
 
 
 if __name__ == '__main__':
@@ -24,6 +24,63 @@ DEFINED = OrderedDict([
             ('VLAB_URL', environ.get('VLAB_URL', 'https://localhost')),
             ('VLAB_ESXI_IMAGES_DIR', environ.get('VLAB_ESXI_IMAGES_DIR', '/images')),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
+            # Sessions are only opened when needed, so the default is one per concurrent task
+            ('VLAB_ESXI_SESSION_POOL_SIZE', int(environ.get('VLAB_ESXI_SESSION_POOL_SIZE', environ.get('VLAB_ESXI_WORKER_CONCURRENCY', 32)))),
+            ('VLAB_ESXI_SESSION_CHECK_INTERVAL', int(environ.get('VLAB_ESXI_SESSION_CHECK_INTERVAL', 60))),
+            ('VLAB_ESXI_SESSION_WAIT_TIMEOUT', int(environ.get('VLAB_ESXI_SESSION_WAIT_TIMEOUT', 300))),
+            ('VLAB_ESXI_PROPERTY_PAGE_SIZE', int(environ.get('VLAB_ESXI_PROPERTY_PAGE_SIZE', 500))),
+            ('VLAB_ESXI_INDEX_SIZE', int(environ.get('VLAB_ESXI_INDEX_SIZE', 10000))),
+            ('VLAB_ESXI_INVENTORY_CACHE', environ.get('VLAB_ESXI_INVENTORY_CACHE', 'true').lower() == 'true'),
+            ('VLAB_ESXI_CACHE_MAX_OBJECTS', int(environ.get('VLAB_ESXI_CACHE_MAX_OBJECTS', 50000))),
+            ('VLAB_ESXI_CACHE_MAX_STALENESS', int(environ.get('VLAB_ESXI_CACHE_MAX_STALENESS', 90))),
+            ('VLAB_ESXI_CACHE_WAIT_SECONDS', int(environ.get('VLAB_ESXI_CACHE_WAIT_SECONDS', 30))),
+            ('VLAB_ESXI_CACHE_RETRY_SECONDS', int(environ.get('VLAB_ESXI_CACHE_RETRY_SECONDS', 30))),
+            ('VLAB_ESXI_STATE_DIR', environ.get('VLAB_ESXI_STATE_DIR', '/tmp/vlab_esxi')),
+            ('VLAB_ESXI_READ_MODEL_MAX_AGE', int(environ.get('VLAB_ESXI_READ_MODEL_MAX_AGE', 60))),
+            ('VLAB_ESXI_DEPLOY_MODES', environ.get('VLAB_ESXI_DEPLOY_MODES', '*=ova')),
+            ('VLAB_ESXI_TEMPLATE_DIR', environ.get('VLAB_ESXI_TEMPLATE_DIR', 'vlab/templates/esxi')),
+            ('VLAB_ESXI_STANDBY_SIZES', environ.get('VLAB_ESXI_STANDBY_SIZES', '')),
+            ('VLAB_ESXI_STANDBY_DIR', environ.get('VLAB_ESXI_STANDBY_DIR', 'vlab/standby/esxi')),
+            ('VLAB_ESXI_STANDBY_NETWORK', environ.get('VLAB_ESXI_STANDBY_NETWORK', 'frontend')),
+            ('VLAB_ESXI_STANDBY_BOOT_TIMEOUT', int(environ.get('VLAB_ESXI_STANDBY_BOOT_TIMEOUT', 600))),
+            ('VLAB_ESXI_WAIT_FOR_IP', environ.get('VLAB_ESXI_WAIT_FOR_IP', 'true').lower() == 'true'),
+            ('VLAB_ESXI_IP_TIMEOUT', int(environ.get('VLAB_ESXI_IP_TIMEOUT', 600))),
+            ('VLAB_ESXI_UPLOAD_WORKERS', int(environ.get('VLAB_ESXI_UPLOAD_WORKERS', 4))),
+            ('VLAB_ESXI_LEASE_KEEPALIVE', int(environ.get('VLAB_ESXI_LEASE_KEEPALIVE', 10))),
+            ('VLAB_ESXI_BATCH_WORKERS', int(environ.get('VLAB_ESXI_BATCH_WORKERS', 4))),
+            ('VLAB_ESXI_BATCH_MAX', int(environ.get('VLAB_ESXI_BATCH_MAX', 50))),
+            ('VLAB_ESXI_DATASTORES', environ.get('VLAB_ESXI_DATASTORES', '')),
+            ('VLAB_ESXI_RESOURCE_POOLS', environ.get('VLAB_ESXI_RESOURCE_POOLS', '')),
+            ('VLAB_ESXI_PLACEMENT_REFRESH', int(environ.get('VLAB_ESXI_PLACEMENT_REFRESH', 60))),
+            ('VLAB_ESXI_PLACEMENT_MIN_FREE_GB', int(environ.get('VLAB_ESXI_PLACEMENT_MIN_FREE_GB', 50))),
+            ('VLAB_ESXI_CREATE_MAX', int(environ.get('VLAB_ESXI_CREATE_MAX', 8))),
+            ('VLAB_ESXI_CREATE_MAX_PER_USER', int(environ.get('VLAB_ESXI_CREATE_MAX_PER_USER', 4))),
+            ('VLAB_ESXI_ADMISSION_POLL', float(environ.get('VLAB_ESXI_ADMISSION_POLL', 2))),
+            ('VLAB_ESXI_ADMISSION_LEASE', int(environ.get('VLAB_ESXI_ADMISSION_LEASE', 60))),
+            ('VLAB_ESXI_TASK_WAITER', environ.get('VLAB_ESXI_TASK_WAITER', 'true').lower() == 'true'),
+            ('VLAB_ESXI_TASK_WAIT_SECONDS', int(environ.get('VLAB_ESXI_TASK_WAIT_SECONDS', 30))),
+            ('VLAB_ESXI_WORKER_POOL', environ.get('VLAB_ESXI_WORKER_POOL', 'threads')),
+            ('VLAB_ESXI_WORKER_CONCURRENCY', int(environ.get('VLAB_ESXI_WORKER_CONCURRENCY', 32))),
+            ('VLAB_ESXI_READ_QUEUE', environ.get('VLAB_ESXI_READ_QUEUE', 'esxi-read')),
+            # 'celery' is the Celery default, so tasks queued before the split still run
+            ('VLAB_ESXI_WRITE_QUEUE', environ.get('VLAB_ESXI_WRITE_QUEUE', 'celery')),
+            ('VLAB_ESXI_WORKER_QUEUES', environ.get('VLAB_ESXI_WORKER_QUEUES', 'esxi-read,celery')),
+            ('VLAB_ESXI_READ_CONCURRENCY', int(environ.get('VLAB_ESXI_READ_CONCURRENCY', 16))),
+            ('VLAB_ESXI_READ_PREFETCH', int(environ.get('VLAB_ESXI_READ_PREFETCH', 4))),
+            ('VLAB_ESXI_RESULT_BACKEND', environ.get('VLAB_ESXI_RESULT_BACKEND', 'file://{}/results'.format(environ.get('VLAB_ESXI_STATE_DIR', '/tmp/vlab_esxi')))),
+            ('VLAB_ESXI_RESULT_EXPIRES', int(environ.get('VLAB_ESXI_RESULT_EXPIRES', 3600))),
+            ('VLAB_ESXI_TASK_WAIT_MAX', int(environ.get('VLAB_ESXI_TASK_WAIT_MAX', 30))),
+            ('VLAB_ESXI_SINGLEFLIGHT_FRESH', int(environ.get('VLAB_ESXI_SINGLEFLIGHT_FRESH', 5))),
+            ('VLAB_ESXI_SINGLEFLIGHT_MAX_WAIT', int(environ.get('VLAB_ESXI_SINGLEFLIGHT_MAX_WAIT', 120))),
+            ('VLAB_ESXI_EVENTS_POLL', float(environ.get('VLAB_ESXI_EVENTS_POLL', 0.5))),
+            ('VLAB_ESXI_EVENTS_HEARTBEAT', int(environ.get('VLAB_ESXI_EVENTS_HEARTBEAT', 15))),
+            ('VLAB_ESXI_EVENTS_QUEUE', int(environ.get('VLAB_ESXI_EVENTS_QUEUE', 1000))),
+            ('VLAB_ESXI_EVENTS_MAX_BYTES', int(environ.get('VLAB_ESXI_EVENTS_MAX_BYTES', 1024 * 1024))),
+            ('VLAB_ESXI_METRICS_INTERVAL', int(environ.get('VLAB_ESXI_METRICS_INTERVAL', 15))),
+            ('VLAB_ESXI_TRACE_OTLP_ENDPOINT', environ.get('VLAB_ESXI_TRACE_OTLP_ENDPOINT', '')),
+            ('VLAB_ESXI_TRACE_FILE', environ.get('VLAB_ESXI_TRACE_FILE', '')),
+            ('VLAB_ESXI_TRACE_INTERVAL', float(environ.get('VLAB_ESXI_TRACE_INTERVAL', 5))),
+            ('VLAB_ESXI_TRACE_QUEUE', int(environ.get('VLAB_ESXI_TRACE_QUEUE', 10000))),
           ])
 
 Constants = namedtuple('Constants', list(DEFINED.keys()))
@@ -0,0 +1,348 @@
+# -*- coding: UTF-8 -*-
+"""
+A per-user stream of task and inventory events, served as Server-Sent Events.
+
+Workers append events to a log file per user under ``VLAB_ESXI_STATE_DIR``,
+the same volume the read-model lives on. In the API, one ``EventHub`` thread
+per process watches the logs of users that have a stream open, reads each new
+event once, and hands it to every one of that user's streams. An idle stream
+costs a queue and a blocked (green) thread; it never touches the disk itself.
+
+The id of an event is where it ends in the log, so a client that reconnects
+with ``Last-Event-ID`` picks up where it left off.
+"""
+import os
+import time
+import queue
+import tempfile
+import threading
+from urllib.parse import quote
+
+import ujson
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const, filelock
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+# Tells an EventSource how long to wait before reconnecting, in milliseconds
+RETRY_MILLISECONDS = 3000
+
+
+def _path(username, suffix='.log'):
+    """Obtain the location of a user's event log
+
+    :Returns: String
+
+    :param username: The name of the user who owns the events
+    :type username: String
+
+    :param suffix: The file extension to use
+    :type suffix: String
+    """
+    # quote() so a username can never escape the events directory
+    return os.path.join(const.VLAB_ESXI_STATE_DIR, 'events', quote(username, safe='') + suffix)
+
+
+def publish(username, event_type, data):
+    """Add an event to a user's stream. Events are only a notification, so
+    failing to record one is logged, not raised.
+
+    :Returns: None
+
+    :param username: The name of the user the event is for
+    :type username: String
+
+    :param event_type: What the event is about, i.e. 'task' or 'inventory'
+    :type event_type: String
+
+    :param data: The details of the event
+    :type data: Dictionary
+    """
+    line = ujson.dumps({'type': event_type, 'time': time.time(), 'data': data}).encode() + b'\n'
+    location = _path(username)
+    try:
+        with filelock.locked(_path(username, suffix='.lock')):
+            try:
+                too_big = os.stat(location).st_size > const.VLAB_ESXI_EVENTS_MAX_BYTES
+            except FileNotFoundError:
+                too_big = False
+            if too_big:
+                # Start a new log; the new inode tells readers to start over
+                fd, tmp_location = tempfile.mkstemp(dir=os.path.dirname(location), suffix='.tmp')
+                os.close(fd)
+                os.replace(tmp_location, location)
+            with open(location, 'ab') as the_file:
+                the_file.write(line)
+    except OSError as doh:
+        logger.warning('Unable to publish event for {}: {}'.format(username, doh))
+
+
+def make_id(inode, offset):
+    """Create the id of an event
+
+    :Returns: String
+
+    :param inode: The inode of the log the event is in
+    :type inode: Integer
+
+    :param offset: Where the event ends in the log
+    :type offset: Integer
+    """
+    return '{}-{}'.format(inode, offset)
+
+
+def parse_id(event_id):
+    """Split an event id into the inode and offset, or None if it's not valid
+
+    :Returns: Tuple
+
+    :param event_id: The ``Last-Event-ID`` a client sent
+    :type event_id: String
+    """
+    try:
+        inode, offset = event_id.split('-')
+        return int(inode), int(offset)
+    except (AttributeError, ValueError):
+        return None
+
+
+def read_events(location, inode, offset):
+    """Read every complete event in a log after an offset
+
+    :Returns: Tuple - (List of events, the offset after the last complete event)
+
+    :param location: The path to the event log
+    :type location: String
+
+    :param inode: The inode of the log, for making the event ids
+    :type inode: Integer
+
+    :param offset: Where to start reading
+    :type offset: Integer
+    """
+    events = []
+    with open(location, 'rb') as the_file:
+        the_file.seek(offset)
+        data = the_file.read()
+    # a partly written line is picked up on the next read
+    for line in data.split(b'\n')[:-1]:
+        offset += len(line) + 1
+        try:
+            event = ujson.loads(line)
+        except ValueError:
+            continue
+        event['id'] = make_id(inode, offset)
+        events.append(event)
+    return events, offset
+
+
+def to_sse(event):
+    """Format an event as a Server-Sent Event
+
+    :Returns: String
+
+    :param event: An event from ``read_events``
+    :type event: Dictionary
+    """
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event['id'], event['type'], ujson.dumps(event['data']))
+
+
+class Subscription(object):
+    """The events waiting to be sent on one stream
+
+    :param username: The user the stream is for
+    :type username: String
+
+    :param max_size: The most events to hold before the stream is closed
+    :type max_size: Integer
+    """
+    def __init__(self, username, max_size):
+        self.username = username
+        self._queue = queue.Queue(maxsize=max_size)
+        self.closed = False
+
+    def put(self, event):
+        """Queue an event. A stream that can't keep up is closed; the client
+        reconnects and replays from its last event id.
+
+        :Returns: None
+        """
+        if self.closed:
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.closed = True
+            self._queue = queue.Queue(maxsize=1)
+            self._queue.put_nowait(None)
+
+    def get(self, timeout):
+        """Wait for the next event
+
+        :Returns: Dictionary, or None if the stream was closed
+
+        :Raises: queue.Empty if no event arrived within the timeout
+        """
+        return self._queue.get(timeout=timeout)
+
+
+class EventHub(object):
+    """Reads the event logs of every user with an open stream, and hands new
+    events to their streams.
+
+    :param poll_interval: How many seconds between checking the logs for new events
+    :type poll_interval: Float
+
+    :param max_queue: The most events a stream can fall behind by
+    :type max_queue: Integer
+    """
+    def __init__(self, poll_interval, max_queue):
+        self._poll_interval = poll_interval
+        self._max_queue = max_queue
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._subscriptions = {}
+        # username -> (inode, offset) of the last event read from their log
+        self._positions = {}
+
+    def start(self):
+        """Start watching event logs, if it's not already running in this process
+
+        :Returns: None
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._subscriptions = {}
+            self._positions = {}
+            self._thread = threading.Thread(target=self._run, name='esxi-event-hub', daemon=True)
+            self._thread.start()
+
+    def subscribe(self, username, last_id=None):
+        """Open a stream of a user's events
+
+        :Returns: Subscription
+
+        :param username: The user to stream events for
+        :type username: String
+
+        :param last_id: The id of the last event the client saw; replay everything after it
+        :type last_id: String
+        """
+        self.start()
+        subscription = Subscription(username, self._max_queue)
+        with self._lock:
+            if username not in self._positions:
+                self._positions[username] = self._end_of(username)
+            inode, offset = self._positions[username]
+            resume = parse_id(last_id)
+            if resume is not None and inode is not None:
+                start = resume[1] if resume[0] == inode and resume[1] <= offset else 0
+                try:
+                    backlog, _ = read_events(_path(username), inode, start)
+                except OSError:
+                    backlog = []
+                for event in backlog:
+                    if parse_id(event['id'])[1] <= offset:
+                        subscription.put(event)
+            self._subscriptions.setdefault(username, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Close a stream
+
+        :Returns: None
+
+        :param subscription: The stream to close
+        :type subscription: Subscription
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.username, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.username, None)
+                self._positions.pop(subscription.username, None)
+
+    def _end_of(self, username):
+        """The inode and size of a user's log; (None, 0) if there isn't one yet"""
+        try:
+            stat = os.stat(_path(username))
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def _run(self):
+        """Check for new events forever"""
+        while True:
+            time.sleep(self._poll_interval)
+            try:
+                self.poll()
+            except Exception as doh:
+                logger.error('Unable to read events: {}'.format(doh))
+
+    def poll(self):
+        """Read any new events, and hand them to the streams that want them
+
+        :Returns: None
+        """
+        with self._lock:
+            for username, subscriptions in self._subscriptions.items():
+                inode, offset = self._positions[username]
+                try:
+                    stat = os.stat(_path(username))
+                except FileNotFoundError:
+                    continue
+                if stat.st_ino != inode:
+                    # a new log
+                    inode, offset = stat.st_ino, 0
+                elif stat.st_size <= offset:
+                    continue
+                try:
+                    events, offset = read_events(_path(username), inode, offset)
+                except OSError as doh:
+                    logger.warning('Unable to read events for {}: {}'.format(username, doh))
+                    continue
+                self._positions[username] = (inode, offset)
+                for event in events:
+                    for subscription in subscriptions:
+                        subscription.put(event)
+
+
+HUB = EventHub(poll_interval=const.VLAB_ESXI_EVENTS_POLL,
+               max_queue=const.VLAB_ESXI_EVENTS_QUEUE)
+
+
+def stream(username, last_id=None, heartbeat=None):
+    """Generate the Server-Sent Events for a user, forever
+
+    :Returns: Generator of Strings
+
+    :param username: The user to stream events for
+    :type username: String
+
+    :param last_id: The id of the last event the client saw
+    :type last_id: String
+
+    :param heartbeat: How many seconds of quiet before sending a comment, so
+                      proxies don't close an idle connection
+    :type heartbeat: Integer
+    """
+    if heartbeat is None:
+        heartbeat = const.VLAB_ESXI_EVENTS_HEARTBEAT
+    subscription = HUB.subscribe(username, last_id=last_id)
+    try:
+        yield 'retry: {}\n\n'.format(RETRY_MILLISECONDS)
+        while True:
+            try:
+                event = subscription.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            if event is None:
+                break
+            yield to_sse(event)
+    finally:
+        HUB.unsubscribe(subscription)
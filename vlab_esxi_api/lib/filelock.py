@@ -0,0 +1,42 @@
+# -*- coding: UTF-8 -*-
+"""
+A file lock that's safe to take in the API.
+
+The API serves requests with gevent greenlets. A blocking ``flock`` is not
+cooperative; while one greenlet waits on it, no other greenlet in the process
+runs, including the one holding the lock. So the lock is taken with ``LOCK_NB``,
+and retried after a ``time.sleep``, which gevent turns into a yield.
+
+Locks should still only be held around reading and writing local files, never
+around a call to the broker, result backend or vCenter.
+"""
+import os
+import time
+import fcntl
+from contextlib import contextmanager
+
+
+POLL_SECONDS = 0.005
+
+
+@contextmanager
+def locked(location):
+    """Hold an exclusive lock on a file, creating it (and its directory) if needed
+
+    :Returns: None
+
+    :param location: The path to the lock file
+    :type location: String
+    """
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    with open(location, 'a') as the_file:
+        while True:
+            try:
+                fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(POLL_SECONDS)
+        try:
+            yield
+        finally:
+            fcntl.flock(the_file, fcntl.LOCK_UN)
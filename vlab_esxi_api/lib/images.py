@@ -0,0 +1,359 @@
+# -*- coding: UTF-8 -*-
+"""
+An on-disk index of what's inside each OVA in the images directory, and the
+catalogue of images built from it.
+
+Opening an OVA with ``tarfile`` reads every header in the archive, which on a
+large image (and an NFS mount) takes a while. The index records the OVF
+descriptor, network names and where each disk lives inside the archive, keyed
+by the inode, mtime and size of the OVA. A changed OVA is rescanned the next
+time it's used.
+
+Only the worker ever opens an OVA. Its ``Catalogue`` describes every OVA, and
+hashes them once in the background, because hashing a multi-GB OVA is slow. The
+API only reads what the worker recorded in the index, with ``indexed``; an
+image the worker has yet to describe is left out, and one it has yet to hash
+has no checksum.
+"""
+import os
+import re
+import queue
+import fcntl
+import hashlib
+import tarfile
+import tempfile
+import threading
+
+import ujson
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+NETWORK_REGEX = re.compile(r'<Network ovf:name="([^"]+)"')
+DISK_REGEX = re.compile(r'<(?:\w+:)?Disk\s[^>]*>')
+ATTRIBUTE_REGEX = re.compile(r'(?:\w+:)?(\w+)="([^"]*)"')
+UNITS_REGEX = re.compile(r'byte\s*\*\s*(\d+)\s*\^\s*(\d+)')
+CHUNK_SIZE = 1024 * 1024
+# Entries already read this process, so a hit doesn't even touch the index file
+_MEMO = {}
+_MEMO_LOCK = threading.Lock()
+
+
+def _index_location():
+    """The location of the index file"""
+    return os.path.join(const.VLAB_ESXI_STATE_DIR, 'images', 'index.json')
+
+
+def _fingerprint(stat):
+    """The parts of an OVA's stat that change when the file is replaced or modified"""
+    return [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+
+
+def scan(location):
+    """Read the OVF descriptor, and the position of every disk, out of an OVA
+
+    :Returns: Dictionary
+
+    :param location: The path to the OVA
+    :type location: String
+    """
+    ovf = ''
+    disks = []
+    with tarfile.open(location) as the_tar:
+        for member in the_tar.getmembers():
+            if member.name.endswith('.vmdk'):
+                disks.append({'name': member.name, 'offset': member.offset_data, 'size': member.size})
+            elif member.name.endswith('.ovf'):
+                ovf = the_tar.extractfile(member).read().decode()
+    return {'ovf': ovf,
+            'networks': NETWORK_REGEX.findall(ovf),
+            'disks': disks}
+
+
+def describe(location):
+    """Obtain the indexed contents of an OVA, rescanning it if it's changed
+
+    :Returns: Dictionary
+
+    :Raises: FileNotFoundError if the OVA does not exist
+
+    :param location: The path to the OVA
+    :type location: String
+    """
+    fingerprint = _fingerprint(os.stat(location))
+    name = os.path.basename(location)
+    with _MEMO_LOCK:
+        entry = _MEMO.get(name)
+    if entry is not None and entry['fingerprint'] == fingerprint:
+        return entry
+    index = _read_index()
+    entry = index.get(name)
+    if entry is None or entry['fingerprint'] != fingerprint:
+        logger.info('Indexing {}'.format(location))
+        entry = scan(location)
+        entry['fingerprint'] = fingerprint
+        _save_entry(name, entry)
+    with _MEMO_LOCK:
+        _MEMO[name] = entry
+    return entry
+
+
+def _read_index():
+    """Load the index file, or an empty index if there isn't a usable one"""
+    try:
+        with open(_index_location()) as the_file:
+            return ujson.load(the_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_entry(name, entry):
+    """Add one OVA to the index file. The index is only an optimization, so
+    failing to write it is logged, not raised."""
+    location = _index_location()
+    try:
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = _read_index()
+                index[name] = entry
+                fd, tmp_location = tempfile.mkstemp(dir=os.path.dirname(location), suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as the_file:
+                        ujson.dump(index, the_file)
+                    os.replace(tmp_location, location)
+                except Exception:
+                    os.unlink(tmp_location)
+                    raise
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    except OSError as doh:
+        logger.warning('Unable to update image index: {}'.format(doh))
+
+
+def set_checksum(location, fingerprint, checksum):
+    """Record the checksum of an OVA, unless the OVA changed while it was being hashed
+
+    :Returns: None
+
+    :param location: The path to the OVA
+    :type location: String
+
+    :param fingerprint: The fingerprint of the OVA when hashing started
+    :type fingerprint: List
+
+    :param checksum: The SHA-256 of the OVA
+    :type checksum: String
+    """
+    entry = describe(location)
+    if entry['fingerprint'] == fingerprint:
+        entry['sha256'] = checksum
+        _save_entry(os.path.basename(location), entry)
+
+
+def disk_footprint(ovf):
+    """Add up the provisioned size of every disk an OVF defines
+
+    :Returns: Integer - bytes
+
+    :param ovf: The OVF descriptor
+    :type ovf: String
+    """
+    total = 0
+    for disk in DISK_REGEX.findall(ovf):
+        attributes = dict(ATTRIBUTE_REGEX.findall(disk))
+        try:
+            capacity = int(attributes.get('capacity', 0))
+        except ValueError:
+            continue
+        units = UNITS_REGEX.search(attributes.get('capacityAllocationUnits', 'byte'))
+        if units:
+            capacity *= int(units.group(1)) ** int(units.group(2))
+        total += capacity
+    return total
+
+
+def convert_name(name, to_version=False):
+    """This function centralizes converting between the name of the OVA, and the
+    version of software it contains.
+
+    The naming convention of the ESXi OVAs is ``esxi-<version>.ova``; i.e. esxi-6.7u1.ova
+
+    :param name: The thing to covert
+    :type name: String
+
+    :param to_version: Set to True to covert the name of an OVA to the version
+    :type to_version: Boolean
+    """
+    if to_version:
+        return name.split('-')[-1].replace('.ova', '')
+    else:
+        return 'esxi-{}.ova'.format(name)
+
+
+def _item(file_name, entry):
+    """Convert the index entry of an OVA into its entry in the catalogue"""
+    return {'version': convert_name(file_name, to_version=True),
+            'file': file_name,
+            'size': entry['fingerprint'][2],
+            'disk_footprint': disk_footprint(entry['ovf']),
+            'checksum': entry.get('sha256', None)}
+
+
+class Catalogue(object):
+    """The images that can be deployed, cached until the images directory changes.
+    Reads, and hashes, the OVAs, so it's only for the worker.
+
+    :param images_dir: The directory that holds the OVAs
+    :type images_dir: String
+    """
+    def __init__(self, images_dir):
+        self._images_dir = images_dir
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._entries = []
+        self._pending = queue.Queue()
+        self._queued = set()
+        self._thread = None
+        self._pid = None
+
+    def entries(self):
+        """Obtain every image in the catalogue
+
+        :Returns: List of Dictionaries
+
+        :Raises: OSError if the images directory cannot be read
+        """
+        mtime = os.stat(self._images_dir).st_mtime_ns
+        with self._lock:
+            if mtime == self._mtime:
+                return [dict(x) for x in self._entries]
+        entries = []
+        to_hash = []
+        for file_name in sorted(os.listdir(self._images_dir)):
+            if not file_name.endswith('.ova'):
+                continue
+            location = os.path.join(self._images_dir, file_name)
+            try:
+                entry = describe(location)
+            except (OSError, ValueError, tarfile.TarError) as doh:
+                logger.error('Unable to read image {}: {}'.format(location, doh))
+                continue
+            entries.append(_item(file_name, entry))
+            if entry.get('sha256', None) is None:
+                to_hash.append(location)
+        with self._lock:
+            self._mtime = mtime
+            self._entries = entries
+            answer = [dict(x) for x in self._entries]
+        for location in to_hash:
+            self._queue_checksum(location)
+        return answer
+
+    def _queue_checksum(self, location):
+        """Hash an OVA in the background"""
+        with self._lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._pending = queue.Queue()
+                self._queued = set()
+                self._thread = threading.Thread(target=self._run, name='esxi-image-checksum', daemon=True)
+                self._thread.start()
+            if location not in self._queued:
+                self._queued.add(location)
+                self._pending.put(location)
+
+    def _run(self):
+        """Hash OVAs, one at a time, forever"""
+        while True:
+            location = self._pending.get()
+            try:
+                self.checksum(location)
+            except Exception as doh:
+                logger.error('Unable to checksum {}: {}'.format(location, doh))
+            finally:
+                with self._lock:
+                    self._queued.discard(location)
+
+    def checksum(self, location):
+        """Compute, and record, the SHA-256 of an OVA
+
+        :Returns: String
+
+        :param location: The path to the OVA
+        :type location: String
+        """
+        fingerprint = describe(location)['fingerprint']
+        digest = hashlib.sha256()
+        with open(location, 'rb') as the_file:
+            for chunk in iter(lambda: the_file.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        checksum = digest.hexdigest()
+        set_checksum(location, fingerprint, checksum)
+        file_name = os.path.basename(location)
+        with self._lock:
+            for item in self._entries:
+                if item['file'] == file_name:
+                    item['checksum'] = checksum
+        return checksum
+
+
+CATALOGUE = Catalogue(const.VLAB_ESXI_IMAGES_DIR)
+
+
+_INDEXED = {'key': None, 'entries': [], 'complete': True}
+_INDEXED_LOCK = threading.Lock()
+
+
+def catalogue():
+    """Obtain every image that can be deployed, describing and hashing any new
+    OVAs. Only for the worker.
+
+    :Returns: List of Dictionaries
+
+    :Raises: OSError if the images directory cannot be read
+    """
+    return CATALOGUE.entries()
+
+
+def indexed():
+    """Obtain the images the worker has described, without opening any OVA
+
+    :Returns: Tuple - (List of Dictionaries, Boolean - False if an image still
+              needs to be described or hashed by the worker)
+
+    :Raises: OSError if the images directory cannot be read
+    """
+    images_dir = const.VLAB_ESXI_IMAGES_DIR
+    try:
+        index_mtime = os.stat(_index_location()).st_mtime_ns
+    except FileNotFoundError:
+        index_mtime = None
+    key = (images_dir, os.stat(images_dir).st_mtime_ns, index_mtime)
+    with _INDEXED_LOCK:
+        if _INDEXED['key'] == key:
+            return [dict(x) for x in _INDEXED['entries']], _INDEXED['complete']
+    index = _read_index()
+    entries = []
+    complete = True
+    for file_name in sorted(os.listdir(images_dir)):
+        if not file_name.endswith('.ova'):
+            continue
+        entry = index.get(file_name, None)
+        try:
+            fingerprint = _fingerprint(os.stat(os.path.join(images_dir, file_name)))
+        except OSError:
+            continue
+        if entry is None or entry['fingerprint'] != fingerprint:
+            complete = False
+            continue
+        item = _item(file_name, entry)
+        if item['checksum'] is None:
+            complete = False
+        entries.append(item)
+    with _INDEXED_LOCK:
+        _INDEXED.update(key=key, entries=entries, complete=complete)
+    return [dict(x) for x in entries], complete
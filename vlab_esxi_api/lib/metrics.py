@@ -0,0 +1,429 @@
+# -*- coding: UTF-8 -*-
+"""
+Histograms of how long tasks, the phases of a task, and vCenter calls take,
+served in the Prometheus text format.
+
+A worker records, for every task, its total duration (``vlab_esxi_task_seconds``),
+the duration of each phase it goes through, i.e. waiting for admission, the OVA
+upload or waiting for an IP (``vlab_esxi_phase_seconds``), and every vCenter
+method call and property read it makes (``vlab_esxi_vcenter_call_seconds``).
+Each is labelled with the task name, and where it applies the image version.
+
+Every ``VLAB_ESXI_METRICS_INTERVAL`` seconds, each worker process writes its
+histograms to a file under ``VLAB_ESXI_STATE_DIR``. The API adds up the files of
+every worker, and serves the sum at ``/api/1/inf/esxi/metrics``. The file of a
+worker process that has stopped saving is folded into ``retired.json``, so the
+counters never go backwards, and the directory doesn't grow with every restart.
+"""
+import os
+import time
+import atexit
+import bisect
+import socket
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import ujson
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const, filelock, tracing
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Phases run from well under a second (a reconfigure) to many minutes (an upload)
+PHASE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+CALL_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RETIRED = 'retired.json'
+# How many missed saves before a worker process is considered gone
+STALE_INTERVALS = 4
+
+
+class Histogram(object):
+    """Counts observations into buckets, for every combination of labels
+
+    :param name: The name of the metric
+    :type name: String
+
+    :param documentation: What the metric measures, for the HELP line
+    :type documentation: String
+
+    :param labelnames: The labels every observation has
+    :type labelnames: Tuple
+
+    :param buckets: The upper bound of every bucket, in order; +Inf is implied
+    :type buckets: Tuple
+    """
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *labelvalues):
+        """Record one observation
+
+        :Returns: None
+
+        :param value: What was measured, i.e. seconds
+        :type value: Float
+
+        :param labelvalues: The value of each label, in the order of ``labelnames``
+        :type labelvalues: String
+        """
+        # A bucket counts everything less than or equal to its bound
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues, None)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def snapshot(self):
+        """Copy every series, to save or render
+
+        :Returns: List - [label values, bucket counts, sum] for every series
+        """
+        with self._lock:
+            return [[list(x), list(y[0]), y[1]] for x, y in self._series.items()]
+
+    def reset(self):
+        """Forget every observation
+
+        :Returns: None
+        """
+        with self._lock:
+            self._series = {}
+
+
+TASK_SECONDS = Histogram('vlab_esxi_task_seconds', 'How long a task ran, start to finish',
+                         ('task', 'image', 'outcome'), PHASE_BUCKETS)
+PHASE_SECONDS = Histogram('vlab_esxi_phase_seconds', 'How long one phase of a task took',
+                          ('task', 'image', 'phase'), PHASE_BUCKETS)
+CALL_SECONDS = Histogram('vlab_esxi_vcenter_call_seconds', 'How long a vCenter method call or property read took',
+                         ('task', 'call'), CALL_BUCKETS)
+HISTOGRAMS = (TASK_SECONDS, PHASE_SECONDS, CALL_SECONDS)
+_context = threading.local()
+
+
+def current():
+    """Obtain the task name and image version this thread is working on
+
+    :Returns: Tuple - (task name, image); both empty outside of a task
+    """
+    return getattr(_context, 'labels', ('', ''))
+
+
+def begin(task_name, image=''):
+    """Label everything this thread records with a task, until ``end`` is called
+
+    :Returns: None
+
+    :param task_name: The name of the task, i.e. 'esxi.create'
+    :type task_name: String
+
+    :param image: The image/version of ESXi the task is for, if any
+    :type image: String
+    """
+    EXPORTER.start()
+    _context.labels = (task_name, image or '')
+    _context.started = time.time()
+
+
+def end(outcome):
+    """Record how long the task this thread was working on took
+
+    :Returns: None
+
+    :param outcome: How the task went, i.e. 'ok' or 'error'
+    :type outcome: String
+    """
+    task_name, image = current()
+    started = getattr(_context, 'started', None)
+    if started is not None:
+        TASK_SECONDS.observe(time.time() - started, task_name, image, outcome)
+    _context.labels = ('', '')
+    _context.started = None
+
+
+@contextmanager
+def phase(name):
+    """Record how long the ``with`` block takes, as a phase of the current task.
+    Within a trace, the phase is also recorded as a span.
+
+    :Returns: None
+
+    :param name: The name of the phase, i.e. 'upload'
+    :type name: String
+    """
+    task_name, image = current()
+    start = time.time()
+    try:
+        with tracing.span(name):
+            yield
+    finally:
+        PHASE_SECONDS.observe(time.time() - start, task_name, image, name)
+
+
+def carry(func):
+    """Wrap a function so it records under the current task, even when it runs
+    in another thread, i.e. in a ThreadPoolExecutor
+
+    :Returns: Function
+
+    :param func: The function to wrap
+    :type func: Function
+    """
+    labels = current()
+    def wrapper(*args, **kwargs):
+        previous = current()
+        _context.labels = labels
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _context.labels = previous
+    return wrapper
+
+
+def _call_name(mo, name):
+    """i.e. ``VirtualMachine.ReconfigVM_Task``"""
+    return '{}.{}'.format(type(mo).__name__.split('.')[-1], name)
+
+
+def instrument(vcenter):
+    """Time every call a vCenter session makes. pyVmomi sends every method call
+    and property read through its stub, so wrapping the stub's two entry points
+    covers every object the session hands out.
+
+    :Returns: vlab_inf_common.vmware.vCenter - the same session
+
+    :param vcenter: A logged in vCenter session
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    stub = vcenter._conn._stub
+    invoke_method = stub.InvokeMethod
+    invoke_accessor = stub.InvokeAccessor
+    def timed(func, call_name, *args):
+        if getattr(_context, 'in_call', False):
+            # i.e. a SOAP stub reads a property with a call to InvokeMethod
+            return func(*args)
+        _context.in_call = True
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            _context.in_call = False
+            CALL_SECONDS.observe(time.time() - start, current()[0], call_name)
+    stub.InvokeMethod = lambda mo, info, args: timed(invoke_method, _call_name(mo, info.wsdlName), mo, info, args)
+    stub.InvokeAccessor = lambda mo, info: timed(invoke_accessor, _call_name(mo, info.name), mo, info)
+    return vcenter
+
+
+def snapshot():
+    """Copy every histogram this process has recorded
+
+    :Returns: Dictionary - metric name to a list of series
+    """
+    return {x.name: x.snapshot() for x in HISTOGRAMS}
+
+
+def _directory():
+    """Where every worker process saves its histograms"""
+    return os.path.join(const.VLAB_ESXI_STATE_DIR, 'metrics')
+
+
+def _write(location, data):
+    """Atomically replace a file with some JSON"""
+    directory = os.path.dirname(location)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_location = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as the_file:
+            ujson.dump(data, the_file)
+        os.replace(tmp_location, location)
+    except Exception:
+        os.unlink(tmp_location)
+        raise
+
+
+def save():
+    """Write this process's histograms where the API can read them. Metrics are
+    not worth failing a task over, so errors are logged, not raised.
+
+    :Returns: None
+    """
+    location = os.path.join(_directory(), '{}-{}.json'.format(socket.gethostname(), os.getpid()))
+    try:
+        _write(location, snapshot())
+    except OSError as doh:
+        logger.warning('Unable to save metrics: {}'.format(doh))
+
+
+def _load(name):
+    """Read the histograms saved in one file, or None if it cannot be read"""
+    try:
+        with open(os.path.join(_directory(), name)) as the_file:
+            return ujson.load(the_file)
+    except (OSError, ValueError) as doh:
+        logger.warning('Unable to read metrics {}: {}'.format(name, doh))
+        return None
+
+
+def _add(totals, saved):
+    """Add the histograms saved in one file to the running totals"""
+    sizes = {x.name: len(x.buckets) + 1 for x in HISTOGRAMS}
+    for metric, series in saved.items():
+        if metric not in totals:
+            continue
+        for labelvalues, counts, total in series:
+            if len(counts) != sizes[metric]:
+                # saved by a worker with different buckets, i.e. mid-upgrade
+                continue
+            key = tuple(labelvalues)
+            merged = totals[metric].setdefault(key, [[0] * sizes[metric], 0.0])
+            merged[0] = [x + y for x, y in zip(merged[0], counts)]
+            merged[1] += total
+
+
+def _prune(names):
+    """Fold the files of worker processes that stopped saving into ``RETIRED``.
+    The caller must hold the lock.
+
+    :Returns: List - the names of the files left
+
+    :param names: Every file in the metrics directory
+    :type names: List
+    """
+    cutoff = time.time() - STALE_INTERVALS * const.VLAB_ESXI_METRICS_INTERVAL
+    stale = []
+    for name in names:
+        if not name.endswith('.json') or name == RETIRED:
+            continue
+        try:
+            if os.stat(os.path.join(_directory(), name)).st_mtime < cutoff:
+                stale.append(name)
+        except FileNotFoundError:
+            continue
+    if not stale:
+        return names
+    retired = {x.name: {} for x in HISTOGRAMS}
+    for name in ([RETIRED] if RETIRED in names else []) + stale:
+        _add(retired, _load(name) or {})
+    # a crash between these steps counts a file twice, instead of losing it
+    _write(os.path.join(_directory(), RETIRED),
+           {x: [[list(y), z[0], z[1]] for y, z in series.items()] for x, series in retired.items()})
+    for name in stale:
+        try:
+            os.unlink(os.path.join(_directory(), name))
+        except FileNotFoundError:
+            pass
+    return sorted(set(names) - set(stale) | {RETIRED})
+
+
+def collect():
+    """Add up the histograms saved by every worker process, past and present
+
+    :Returns: Dictionary - metric name to {label values: [bucket counts, sum]}
+    """
+    totals = {x.name: {} for x in HISTOGRAMS}
+    if not os.path.isdir(_directory()):
+        return totals
+    try:
+        with filelock.locked(os.path.join(_directory(), 'retired.lock')):
+            # listed under the lock, so another process can't retire a file in between
+            names = sorted(os.listdir(_directory()))
+            try:
+                names = _prune(names)
+            except OSError as doh:
+                logger.warning('Unable to retire old metrics: {}'.format(doh))
+            for name in names:
+                if name.endswith('.json'):
+                    _add(totals, _load(name) or {})
+    except OSError as doh:
+        logger.warning('Unable to read metrics: {}'.format(doh))
+    return totals
+
+
+def _escape(value):
+    """Escape a label value for the text format"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    """Format the labels of one sample, i.e. ``{task="esxi.create",le="1"}``"""
+    pairs = list(zip(names, values)) + list(extra)
+    return '{' + ','.join('{}="{}"'.format(x, _escape(y)) for x, y in pairs) + '}'
+
+
+def _number(value):
+    """Format a bucket bound or sum the way Prometheus does"""
+    return repr(float(value))
+
+
+def render(totals):
+    """Format histograms in the Prometheus text exposition format
+
+    :Returns: String
+
+    :param totals: The output of ``collect``
+    :type totals: Dictionary
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.append('# HELP {} {}'.format(histogram.name, histogram.documentation))
+        lines.append('# TYPE {} histogram'.format(histogram.name))
+        for labelvalues, (counts, total) in sorted(totals.get(histogram.name, {}).items()):
+            cumulative = 0
+            bounds = [_number(x) for x in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = _labels(histogram.labelnames, labelvalues, extra=[('le', bound)])
+                lines.append('{}_bucket{} {}'.format(histogram.name, labels, cumulative))
+            labels = _labels(histogram.labelnames, labelvalues)
+            lines.append('{}_sum{} {}'.format(histogram.name, labels, _number(total)))
+            lines.append('{}_count{} {}'.format(histogram.name, labels, cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+class Exporter(object):
+    """Saves this process's histograms every so often, in a background thread
+
+    :param interval: How many seconds between saves
+    :type interval: Integer
+    """
+    def __init__(self, interval):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start saving, if it's not already running in this process
+
+        :Returns: None
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid is None:
+                atexit.register(save)
+            elif self._pid != os.getpid():
+                # A forked child starts counting from zero; its parent saves its own counts
+                for histogram in HISTOGRAMS:
+                    histogram.reset()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='esxi-metrics', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Save the histograms forever"""
+        while True:
+            time.sleep(self._interval)
+            save()
+
+
+EXPORTER = Exporter(interval=const.VLAB_ESXI_METRICS_INTERVAL)
@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+"""
+A read-model of every user's ESXi inventory, shared by the workers and the API.
+
+Workers save the result of every ``esxi.show`` (and patch it after a create,
+delete or network change) so the API can answer a listing inline, without a
+round-trip through Celery. The store is a directory of JSON files, one per user,
+so it can live on a volume shared by the API and worker containers.
+
+Every change to a user's inventory is also published to their event stream.
+
+Each change also bumps the user's generation. An ``esxi.show`` notes the
+generation before it lists the inventory, and its listing is thrown away if
+anything changed in the meantime; otherwise a listing taken just before a
+delete would bring the deleted VM back.
+"""
+import os
+import time
+import tempfile
+from functools import wraps
+from urllib.parse import quote
+
+import ujson
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const, events, filelock
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+
+
+def _best_effort(func):
+    """The read-model is only an optimization; failing to write it must not fail a task"""
+    @wraps(func)
+    def inner(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except OSError as doh:
+            logger.warning('Unable to update ESXi read-model: {}'.format(doh))
+    return inner
+
+
+def _path(username, suffix='.json'):
+    """Obtain the location of a user's inventory file
+
+    :Returns: String
+
+    :param username: The name of the user who owns the inventory
+    :type username: String
+
+    :param suffix: The file extension to use
+    :type suffix: String
+    """
+    # quote() so a username can never escape the store directory
+    return os.path.join(const.VLAB_ESXI_STATE_DIR, 'inventory', quote(username, safe='') + suffix)
+
+
+def _locked(username):
+    """Serialize read-modify-write updates of a user's inventory across processes"""
+    return filelock.locked(_path(username, suffix='.lock'))
+
+
+def _read(username, suffix='.json'):
+    """Load a user's inventory file, or None if there isn't a usable one"""
+    try:
+        with open(_path(username, suffix=suffix)) as the_file:
+            return ujson.load(the_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(username, record, suffix='.json'):
+    """Atomically replace a user's inventory file"""
+    location = _path(username, suffix=suffix)
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    fd, tmp_location = tempfile.mkstemp(dir=os.path.dirname(location), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as the_file:
+            ujson.dump(record, the_file)
+        os.replace(tmp_location, location)
+    except Exception:
+        os.unlink(tmp_location)
+        raise
+
+
+def generation(username):
+    """Obtain how many times a user's inventory has changed, to pass to ``save``
+
+    :Returns: Integer
+
+    :param username: The name of the user who owns the ESXi instances
+    :type username: String
+    """
+    return _read(username, suffix='.generation') or 0
+
+
+def _bump(username):
+    """Note a change to a user's inventory; the caller must hold the lock"""
+    _write(username, generation(username) + 1, suffix='.generation')
+
+
+@_best_effort
+def save(username, esxi_vms, listed_at=None):
+    """Record a complete listing of a user's ESXi instances
+
+    :Returns: None
+
+    :param username: The name of the user who owns the ESXi instances
+    :type username: String
+
+    :param esxi_vms: The output of ``vmware.show_esxi``
+    :type esxi_vms: Dictionary
+
+    :param listed_at: The ``generation`` from before the listing was taken. If
+                      the inventory has changed since, the listing is discarded.
+    :type listed_at: Integer
+    """
+    with _locked(username):
+        if listed_at is not None and listed_at != generation(username):
+            logger.debug('Discarding listing of {}; the inventory changed while listing it'.format(username))
+            return
+        record = _read(username)
+        _write(username, {'updated': time.time(), 'content': esxi_vms})
+    if record is None or record['content'] != esxi_vms:
+        events.publish(username, 'inventory', {'action': 'refresh', 'content': esxi_vms})
+
+
+def load(username, max_age=None):
+    """Obtain the last recorded listing of a user's ESXi instances
+
+    :Returns: Tuple - (Dictionary, age in seconds), or None if there is no recent enough listing
+
+    :param username: The name of the user who owns the ESXi instances
+    :type username: String
+
+    :param max_age: The oldest, in seconds, a listing can be. Defaults to ``VLAB_ESXI_READ_MODEL_MAX_AGE``
+    :type max_age: Integer
+    """
+    if max_age is None:
+        max_age = const.VLAB_ESXI_READ_MODEL_MAX_AGE
+    record = _read(username)
+    if record is None:
+        return None
+    age = max(0, time.time() - record.get('updated', 0))
+    if age > max_age:
+        return None
+    return record['content'], age
+
+
+@_best_effort
+def update(username, machine_name, info):
+    """Add or replace one ESXi instance in a user's recorded listing. Does nothing
+    if there is no listing to update.
+
+    :Returns: None
+
+    :param username: The name of the user who owns the ESXi instance
+    :type username: String
+
+    :param machine_name: The name of the ESXi instance
+    :type machine_name: String
+
+    :param info: The same info ``virtual_machine.get_info`` returns
+    :type info: Dictionary
+    """
+    with _locked(username):
+        _bump(username)
+        record = _read(username)
+        if record is not None:
+            record['content'][machine_name] = info
+            _write(username, record)
+    events.publish(username, 'inventory', {'action': 'update', 'name': machine_name, 'info': info})
+
+
+@_best_effort
+def remove(username, machine_name):
+    """Drop one ESXi instance from a user's recorded listing
+
+    :Returns: None
+
+    :param username: The name of the user who owned the ESXi instance
+    :type username: String
+
+    :param machine_name: The name of the ESXi instance
+    :type machine_name: String
+    """
+    with _locked(username):
+        _bump(username)
+        record = _read(username)
+        if record is not None and machine_name in record['content']:
+            record['content'].pop(machine_name)
+            _write(username, record)
+    events.publish(username, 'inventory', {'action': 'delete', 'name': machine_name})
+
+
+@_best_effort
+def invalidate(username):
+    """Forget a user's recorded listing, so the next read takes the slow path
+
+    :Returns: None
+
+    :param username: The name of the user who owns the ESXi instances
+    :type username: String
+    """
+    with _locked(username):
+        _bump(username)
+        try:
+            os.unlink(_path(username))
+        except FileNotFoundError:
+            pass
+    events.publish(username, 'inventory', {'action': 'invalidate'})
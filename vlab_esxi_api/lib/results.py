@@ -0,0 +1,99 @@
+# -*- coding: UTF-8 -*-
+"""
+Where task results are kept, and for how long.
+
+With the ``rpc://`` backend a result can only be read once, by the process that
+sent the task. Under uWSGI the next status check usually lands on a different
+process, and every result is lost when the API restarts. Any Celery result
+backend can be set with ``VLAB_ESXI_RESULT_BACKEND``; the default is a directory
+under ``VLAB_ESXI_STATE_DIR``, which the API and worker containers share.
+"""
+import os
+import time
+import threading
+
+from celery import states
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+FILE_SCHEME = 'file://'
+POLL_INTERVAL = 0.25
+
+
+def configure(celery_app):
+    """Point a Celery app at the configured result backend
+
+    :Returns: None
+
+    :param celery_app: The Celery app used by the API or the worker
+    :type celery_app: celery.Celery
+    """
+    backend = const.VLAB_ESXI_RESULT_BACKEND
+    if backend.startswith(FILE_SCHEME):
+        # The file system backend refuses to start if the directory is missing
+        os.makedirs(backend[len(FILE_SCHEME):], exist_ok=True)
+    celery_app.conf.update(result_backend=backend,
+                           result_expires=const.VLAB_ESXI_RESULT_EXPIRES)
+
+
+def wait(result, timeout):
+    """Block until a task is done, or the timeout passes
+
+    :Returns: String - the status of the task
+
+    :param result: The task to wait on
+    :type result: celery.result.AsyncResult
+
+    :param timeout: How many seconds to wait
+    :type timeout: Float
+    """
+    deadline = time.time() + timeout
+    while True:
+        status = result.status
+        if status in states.READY_STATES or time.time() >= deadline:
+            return status
+        time.sleep(min(POLL_INTERVAL, max(0, deadline - time.time())))
+
+
+def cleanup(celery_app):
+    """Delete expired results. Backends that expire results on their own
+    (i.e. Redis) treat this as a no-op.
+
+    :Returns: None
+
+    :param celery_app: The Celery app used by the worker
+    :type celery_app: celery.Celery
+    """
+    try:
+        celery_app.backend.cleanup()
+    except Exception as doh:
+        logger.error('Unable to delete expired task results: {}'.format(doh))
+
+
+def start_cleanup(celery_app, interval=None):
+    """Periodically delete expired results in a background thread
+
+    :Returns: threading.Thread
+
+    :param celery_app: The Celery app used by the worker
+    :type celery_app: celery.Celery
+
+    :param interval: How many seconds between cleanups. Defaults to ``VLAB_ESXI_RESULT_EXPIRES``
+    :type interval: Integer
+    """
+    if interval is None:
+        interval = const.VLAB_ESXI_RESULT_EXPIRES
+    the_thread = threading.Thread(target=_cleanup_forever, args=(celery_app, interval),
+                                  name='esxi-result-cleanup', daemon=True)
+    the_thread.start()
+    return the_thread
+
+
+def _cleanup_forever(celery_app, interval):
+    """Delete expired results every so often, forever"""
+    while True:
+        time.sleep(interval)
+        cleanup(celery_app)
@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+"""
+Which Celery queue each task goes to, and how workers consume them.
+
+Listings take well under a second, but a create can take minutes. On one queue,
+a burst of creates leaves every listing waiting behind them. Reads go to their
+own queue so a worker (or a dedicated read worker) always has a slot for them.
+
+The API and the worker both configure their Celery app with ``configure``, so
+the API sends each task to the right queue without naming it.
+"""
+from kombu import Queue
+
+from vlab_esxi_api.lib import const
+
+
+READ_TASKS = ('esxi.show', 'esxi.image')
+# MachineView.modify_network sends 'esxi.modify_network'
+WRITE_TASKS = ('esxi.create', 'esxi.batch_create', 'esxi.delete', 'esxi.batch_delete',
+               'esxi.network', 'esxi.modify_network', 'esxi.standby')
+
+
+def task_routes():
+    """Map every task to its queue
+
+    :Returns: Dictionary
+    """
+    routes = {x: {'queue': const.VLAB_ESXI_READ_QUEUE} for x in READ_TASKS}
+    routes.update({x: {'queue': const.VLAB_ESXI_WRITE_QUEUE} for x in WRITE_TASKS})
+    return routes
+
+
+def worker_queues():
+    """Obtain the queues this worker consumes, set with ``VLAB_ESXI_WORKER_QUEUES``
+
+    :Returns: List
+    """
+    return [x.strip() for x in const.VLAB_ESXI_WORKER_QUEUES.split(',') if x.strip()]
+
+
+def worker_settings(queues):
+    """Pick the concurrency and prefetch for a worker. A worker that only runs
+    reads uses the read settings; anything that runs creates uses the worker
+    settings, and never prefetches more than one task per slot.
+
+    :Returns: Dictionary
+
+    :param queues: The queues the worker consumes
+    :type queues: List
+    """
+    if queues == [const.VLAB_ESXI_READ_QUEUE]:
+        return {'worker_concurrency': const.VLAB_ESXI_READ_CONCURRENCY,
+                'worker_prefetch_multiplier': const.VLAB_ESXI_READ_PREFETCH}
+    return {'worker_concurrency': const.VLAB_ESXI_WORKER_CONCURRENCY,
+            'worker_prefetch_multiplier': 1}
+
+
+def configure(celery_app, worker=False):
+    """Route tasks to the read and write queues
+
+    :Returns: None
+
+    :param celery_app: The Celery app used by the API or the worker
+    :type celery_app: celery.Celery
+
+    :param worker: Set to True to also set which queues to consume, and how
+    :type worker: Boolean
+    """
+    celery_app.conf.update(task_routes=task_routes(),
+                           task_default_queue=const.VLAB_ESXI_WRITE_QUEUE)
+    if worker:
+        queues = worker_queues()
+        celery_app.conf.update(task_queues=[Queue(x) for x in queues],
+                               **worker_settings(queues))
@@ -0,0 +1,189 @@
+# -*- coding: UTF-8 -*-
+"""
+Only one of each read-only task in flight at a time.
+
+When a class opens the lab at once, every page load would queue its own,
+identical ``esxi.show`` or ``esxi.image`` task, and every one of them walks
+vCenter. Instead, the task id of the last one sent is recorded per task name and
+key (i.e. the username). A request that comes in while that task is still queued
+or running, or just after it finished, is handed the same task id.
+
+Records are files under ``VLAB_ESXI_STATE_DIR``, so every API process (and
+container, if they share the volume) coalesces onto the same task. The lock on a
+record is only held to read and change it. Talking to the broker and result
+backend happens without it, with a "sending" marker in the record telling
+other requests to wait for the task id.
+"""
+import os
+import time
+import uuid
+import tempfile
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+import ujson
+from celery import states
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const, filelock
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+# How long another request sending the same task is waited on, before sending it anyway
+SENDING_SECONDS = 10
+POLL_SECONDS = 0.05
+
+
+def _path(name, key, suffix='.json'):
+    """Obtain the location of the record for a task name and key
+
+    :Returns: String
+
+    :param name: The name of the task, i.e. 'esxi.show'
+    :type name: String
+
+    :param key: What makes two tasks of the same name identical, i.e. the username
+    :type key: String
+
+    :param suffix: The file extension to use
+    :type suffix: String
+    """
+    file_name = '{}-{}{}'.format(quote(name, safe=''), quote(key, safe=''), suffix)
+    return os.path.join(const.VLAB_ESXI_STATE_DIR, 'singleflight', file_name)
+
+
+def _locked(name, key):
+    """Only one process at a time changes the record of a task name and key"""
+    return filelock.locked(_path(name, key, suffix='.lock'))
+
+
+def _read(name, key):
+    """Load the record of the last task sent, or None"""
+    try:
+        with open(_path(name, key)) as the_file:
+            return ujson.load(the_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(name, key, record):
+    """Atomically replace the record of the last task sent"""
+    location = _path(name, key)
+    fd, tmp_location = tempfile.mkstemp(dir=os.path.dirname(location), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as the_file:
+            ujson.dump(record, the_file)
+        os.replace(tmp_location, location)
+    except Exception:
+        os.unlink(tmp_location)
+        raise
+
+
+def _finished_ago(result):
+    """How many seconds ago a task finished, or None if that's not known"""
+    date_done = result.date_done
+    if isinstance(date_done, str):
+        try:
+            date_done = datetime.fromisoformat(date_done)
+        except ValueError:
+            return None
+    if not isinstance(date_done, datetime):
+        return None
+    if date_done.tzinfo is None:
+        date_done = date_done.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - date_done).total_seconds()
+
+
+def reusable(result, sent):
+    """Test if a task can be handed out instead of sending a new one
+
+    :Returns: Boolean
+
+    :param result: The last task sent
+    :type result: celery.result.AsyncResult
+
+    :param sent: When the task was sent, as a UNIX timestamp
+    :type sent: Float
+    """
+    status = result.status
+    if status in states.UNREADY_STATES:
+        # A task that's been PENDING too long was probably lost
+        return time.time() - sent < const.VLAB_ESXI_SINGLEFLIGHT_MAX_WAIT
+    elif status == states.SUCCESS:
+        finished_ago = _finished_ago(result)
+        return finished_ago is not None and finished_ago < const.VLAB_ESXI_SINGLEFLIGHT_FRESH
+    return False
+
+
+def send_task(celery_app, name, key, args):
+    """Send a task, unless an identical one is in flight or just finished
+
+    :Returns: celery.result.AsyncResult
+
+    :param celery_app: The Celery app of the API
+    :type celery_app: celery.Celery
+
+    :param name: The name of the task, i.e. 'esxi.show'
+    :type name: String
+
+    :param key: What makes two tasks of the same name identical, i.e. the username
+    :type key: String
+
+    :param args: The arguments of the task, if a new one is sent
+    :type args: List
+    """
+    task = None
+    try:
+        token = uuid.uuid4().hex
+        while True:
+            # records are replaced atomically, so reading one needs no lock
+            record = _read(name, key)
+            if _sending(record):
+                time.sleep(POLL_SECONDS)
+                continue
+            if record is not None and 'task-id' in record:
+                result = celery_app.AsyncResult(record['task-id'])
+                if reusable(result, record['sent']):
+                    return result
+            with _locked(name, key):
+                if _read(name, key) == record:
+                    _write(name, key, {'sending': time.time(), 'token': token})
+                    break
+            # another request changed the record first; look again
+        task = celery_app.send_task(name, args)
+        with _locked(name, key):
+            current = _read(name, key)
+            # unless the record was forgotten, or taken over, while sending
+            if current is not None and current.get('token', None) == token:
+                _write(name, key, {'task-id': task.id, 'sent': time.time()})
+    except OSError as doh:
+        # coalescing is only an optimization
+        logger.warning('Unable to coalesce {} task: {}'.format(name, doh))
+        if task is None:
+            task = celery_app.send_task(name, args)
+    return task
+
+
+def _sending(record):
+    """Test if another request is sending the task right now"""
+    return record is not None and 'sending' in record and time.time() - record['sending'] < SENDING_SECONDS
+
+
+def forget(name, key):
+    """Stop handing out the last task sent, i.e. because it's now out of date
+
+    :Returns: None
+
+    :param name: The name of the task, i.e. 'esxi.show'
+    :type name: String
+
+    :param key: What makes two tasks of the same name identical, i.e. the username
+    :type key: String
+    """
+    try:
+        with _locked(name, key):
+            os.unlink(_path(name, key))
+    except FileNotFoundError:
+        pass
+    except OSError as doh:
+        logger.warning('Unable to forget {} task: {}'.format(name, doh))
@@ -0,0 +1,517 @@
+# -*- coding: UTF-8 -*-
+"""
+Span based tracing of a request, from the API, through the task queue, to every
+vCenter call the worker makes for it.
+
+The API starts a span for every request. Its trace id is the ``X-REQUEST-ID``
+of the request when that's a UUID, so a trace can be found by the same id as
+the log lines; an incoming W3C ``traceparent`` header takes precedence. Every
+task the API sends carries the ``traceparent`` and the time it was sent in its
+message headers. The worker records how long the task sat in the queue, a span
+for the task, a span for every phase of it (see ``metrics.phase``), and a span
+for every vCenter method call and property read.
+
+Finished spans are batched by a background thread, and sent as OTLP/JSON to
+``VLAB_ESXI_TRACE_OTLP_ENDPOINT`` (i.e. ``http://collector:4318/v1/traces``),
+and/or appended to ``VLAB_ESXI_TRACE_FILE``, one OTLP/JSON document per line.
+With neither set, tracing is off and costs nothing.
+"""
+import os
+import re
+import time
+import uuid
+import queue
+import random
+import threading
+import urllib.request
+from contextlib import contextmanager
+
+import ujson
+from celery.signals import before_task_publish
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+TRACEPARENT_REGEX = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+# The message header a task carries the time it was sent in
+ENQUEUED_HEADER = 'vlab_enqueued'
+# OTLP span kinds
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+KIND_CONSUMER = 5
+STATUS_OK = 1
+STATUS_ERROR = 2
+_context = threading.local()
+
+
+def enabled():
+    """Test if spans are exported anywhere
+
+    :Returns: Boolean
+    """
+    return bool(const.VLAB_ESXI_TRACE_OTLP_ENDPOINT or const.VLAB_ESXI_TRACE_FILE)
+
+
+def _new_id(size):
+    """Make a random, non-zero id of ``size`` bytes, as hex"""
+    return '{:0{}x}'.format(random.getrandbits(size * 8) or 1, size * 2)
+
+
+def trace_id_for(request_id):
+    """Obtain the trace id for a request; the request id itself when it's a UUID
+
+    :Returns: String
+
+    :param request_id: The ``X-REQUEST-ID`` of the request, or None
+    :type request_id: String
+    """
+    try:
+        return uuid.UUID(request_id).hex
+    except (TypeError, ValueError):
+        return _new_id(16)
+
+
+def parse_traceparent(value):
+    """Obtain the trace id and span id from a W3C ``traceparent``
+
+    :Returns: Tuple - (trace id, span id), or None if the value is not valid
+
+    :param value: The value of the ``traceparent`` header
+    :type value: String
+    """
+    match = TRACEPARENT_REGEX.match(value or '')
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+class Span(object):
+    """One timed operation within a trace
+
+    :param name: What the operation is, i.e. 'esxi.create'
+    :type name: String
+
+    :param trace_id: The trace the span is part of
+    :type trace_id: String
+
+    :param parent_id: The span id of the parent span, if any
+    :type parent_id: String
+
+    :param kind: The OTLP span kind
+    :type kind: Integer
+
+    :param attributes: Details about the operation
+    :type attributes: Dictionary
+
+    :param start: When the operation started, in seconds since the epoch. Defaults to now.
+    :type start: Float
+    """
+    def __init__(self, name, trace_id, parent_id=None, kind=KIND_INTERNAL, attributes=None, start=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.error = None
+
+    def set_error(self, error):
+        """Mark the operation as failed
+
+        :Returns: None
+
+        :param error: What went wrong
+        :type error: Object
+        """
+        self.error = '{}'.format(error)
+
+    def traceparent(self):
+        """Format this span as a W3C ``traceparent``, so a child can continue the trace
+
+        :Returns: String
+        """
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def finish(self, end=None):
+        """Record the end of the operation, and hand the span off to be exported
+
+        :Returns: None
+
+        :param end: When the operation ended, in seconds since the epoch. Defaults to now.
+        :type end: Float
+        """
+        self.end = time.time() if end is None else end
+        EXPORTER.export(self)
+
+    def to_otlp(self):
+        """Format the span as OTLP/JSON
+
+        :Returns: Dictionary
+        """
+        span = {'traceId': self.trace_id,
+                'spanId': self.span_id,
+                'name': self.name,
+                'kind': self.kind,
+                'startTimeUnixNano': str(int(self.start * 1e9)),
+                'endTimeUnixNano': str(int(self.end * 1e9)),
+                'attributes': _attributes(self.attributes),
+                'status': {'code': STATUS_OK}}
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.error is not None:
+            span['status'] = {'code': STATUS_ERROR, 'message': self.error}
+        return span
+
+
+def _attributes(values):
+    """Format attributes as OTLP/JSON key-values"""
+    formatted = []
+    for key, value in values.items():
+        if isinstance(value, bool):
+            typed = {'boolValue': value}
+        elif isinstance(value, int):
+            typed = {'intValue': str(value)}
+        elif isinstance(value, float):
+            typed = {'doubleValue': value}
+        else:
+            typed = {'stringValue': '{}'.format(value)}
+        formatted.append({'key': key, 'value': typed})
+    return formatted
+
+
+def current():
+    """Obtain the span this thread is working in
+
+    :Returns: Span, or None
+    """
+    return getattr(_context, 'span', None)
+
+
+def activate(span):
+    """Make a span the one this thread is working in
+
+    :Returns: Span - the one that was active before, to restore later
+
+    :param span: The span to work in, or None
+    :type span: Span
+    """
+    previous = current()
+    _context.span = span
+    return previous
+
+
+def start_span(name, parent=None, kind=KIND_INTERNAL, attributes=None, start=None):
+    """Begin a span, as a child of another. The caller must ``finish`` it.
+
+    :Returns: Span, or None if tracing is off
+
+    :param name: What the operation is
+    :type name: String
+
+    :param parent: The parent span, or its (trace id, span id). Defaults to the current span.
+    :type parent: Span or Tuple
+
+    :param kind: The OTLP span kind
+    :type kind: Integer
+
+    :param attributes: Details about the operation
+    :type attributes: Dictionary
+
+    :param start: When the operation started. Defaults to now.
+    :type start: Float
+    """
+    if not enabled():
+        return None
+    if parent is None:
+        parent = current()
+    if isinstance(parent, Span):
+        parent = (parent.trace_id, parent.span_id)
+    if parent is None:
+        parent = (_new_id(16), None)
+    return Span(name, parent[0], parent_id=parent[1], kind=kind, attributes=attributes, start=start)
+
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, **attributes):
+    """Record the ``with`` block as a child of the current span. Outside of a
+    trace, i.e. in a background thread, nothing is recorded.
+
+    :Returns: Span, or None
+
+    :param name: What the operation is
+    :type name: String
+
+    :param kind: The OTLP span kind
+    :type kind: Integer
+    """
+    parent = current()
+    if parent is None or not enabled():
+        yield None
+        return
+    child = start_span(name, parent=parent, kind=kind, attributes=attributes)
+    previous = activate(child)
+    try:
+        yield child
+    except Exception as doh:
+        child.set_error(doh)
+        raise
+    finally:
+        activate(previous)
+        child.finish()
+
+
+def carry(func):
+    """Wrap a function so its spans are children of the current span, even when
+    it runs in another thread, i.e. in a ThreadPoolExecutor
+
+    :Returns: Function
+
+    :param func: The function to wrap
+    :type func: Function
+    """
+    parent = current()
+    def wrapper(*args, **kwargs):
+        previous = activate(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            activate(previous)
+    return wrapper
+
+
+def instrument(vcenter):
+    """Record a span for every call a vCenter session makes within a trace
+
+    :Returns: vlab_inf_common.vmware.vCenter - the same session
+
+    :param vcenter: A logged in vCenter session
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    stub = vcenter._conn._stub
+    invoke_method = stub.InvokeMethod
+    invoke_accessor = stub.InvokeAccessor
+    def traced(func, mo, name, *args):
+        if current() is None or getattr(_context, 'in_call', False):
+            # Not in a trace, or a SOAP stub reading a property with InvokeMethod
+            return func(mo, *args)
+        _context.in_call = True
+        try:
+            call_name = '{}.{}'.format(type(mo).__name__.split('.')[-1], name)
+            with span(call_name, kind=KIND_CLIENT, **{'vcenter.moid': mo._moId}):
+                return func(mo, *args)
+        finally:
+            _context.in_call = False
+    stub.InvokeMethod = lambda mo, info, args: traced(invoke_method, mo, info.wsdlName, info, args)
+    stub.InvokeAccessor = lambda mo, info: traced(invoke_accessor, mo, info.name, info)
+    return vcenter
+
+
+@before_task_publish.connect
+def inject(sender=None, headers=None, **kwargs):
+    """Send the current trace, and the time, with every task"""
+    parent = current()
+    if parent is not None and headers is not None:
+        headers['traceparent'] = parent.traceparent()
+        headers[ENQUEUED_HEADER] = time.time()
+
+
+def begin_task(task):
+    """Continue the trace a task was sent in. Records how long the task waited
+    in the queue, and makes a span for the task the current span.
+
+    :Returns: None
+
+    :param task: The task that's about to run
+    :type task: celery.Task
+    """
+    parent = parse_traceparent(getattr(task.request, 'traceparent', None))
+    if parent is None or not enabled():
+        activate(None)
+        return
+    enqueued = getattr(task.request, ENQUEUED_HEADER, None)
+    if isinstance(enqueued, (int, float)):
+        start_span('queue', parent=parent, attributes={'celery.task_id': task.request.id}, start=enqueued).finish()
+    activate(start_span(task.name, parent=parent, kind=KIND_CONSUMER, attributes={'celery.task_id': task.request.id}))
+
+
+def end_task(error=None):
+    """Finish the span of the task this thread was running
+
+    :Returns: None
+
+    :param error: What went wrong, if the task failed
+    :type error: String
+    """
+    task_span = activate(None)
+    if task_span is not None:
+        if error:
+            task_span.set_error(error)
+        task_span.finish()
+
+
+def init_app(app):
+    """Record a span for every request the API serves
+
+    :Returns: None
+
+    :param app: The API
+    :type app: flask.Flask
+    """
+    from flask import request
+
+    @app.before_request
+    def start_request_span():
+        if not enabled():
+            return
+        request_id = request.headers.get('X-REQUEST-ID', None)
+        parent = parse_traceparent(request.headers.get('traceparent', None))
+        if parent is None:
+            parent = (trace_id_for(request_id), None)
+        route = request.url_rule.rule if request.url_rule is not None else request.path
+        attributes = {'http.method': request.method, 'http.route': route}
+        if request_id is not None:
+            attributes['vlab.request_id'] = request_id
+        activate(start_span('{} {}'.format(request.method, route), parent=parent, kind=KIND_SERVER,
+                            attributes=attributes))
+
+    @app.after_request
+    def record_status(response):
+        request_span = current()
+        if request_span is not None:
+            request_span.attributes['http.status_code'] = response.status_code
+            if response.status_code >= 500:
+                request_span.set_error('HTTP {}'.format(response.status_code))
+        return response
+
+    @app.teardown_request
+    def finish_request_span(error=None):
+        request_span = activate(None)
+        if request_span is not None:
+            if error is not None:
+                request_span.set_error(error)
+            request_span.finish()
+
+
+class Exporter(object):
+    """Batches finished spans, and sends them to the collector and/or file in a
+    background thread, so a request never waits on the collector
+
+    :param service: The name of the service the spans are from
+    :type service: String
+
+    :param interval: The most seconds a span waits to be sent
+    :type interval: Float
+
+    :param max_queue: The most spans to hold; beyond this, spans are dropped
+    :type max_queue: Integer
+
+    :param batch_size: The most spans to send at once
+    :type batch_size: Integer
+    """
+    def __init__(self, service, interval, max_queue, batch_size=512):
+        self.service = service
+        self._interval = interval
+        self._batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+
+    def start(self):
+        """Start sending spans, if it's not already running in this process
+
+        :Returns: None
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid is not None and self._pid != os.getpid():
+                # spans the parent finished are the parent's to send
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='esxi-tracing', daemon=True)
+            self._thread.start()
+
+    def export(self, finished):
+        """Queue a finished span to be sent
+
+        :Returns: None
+
+        :param finished: The span
+        :type finished: Span
+        """
+        self.start()
+        try:
+            self._queue.put_nowait(finished)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        """Send batches of spans forever"""
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self.send(batch)
+
+    def _next_batch(self):
+        """Wait for spans, up to the interval or batch size"""
+        batch = []
+        deadline = time.time() + self._interval
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def document(self, spans):
+        """Format spans as an OTLP/JSON export request
+
+        :Returns: Dictionary
+
+        :param spans: The finished spans
+        :type spans: List
+        """
+        resource = {'attributes': _attributes({'service.name': self.service})}
+        return {'resourceSpans': [{'resource': resource,
+                                   'scopeSpans': [{'scope': {'name': 'vlab_esxi_api'},
+                                                   'spans': [x.to_otlp() for x in spans]}]}]}
+
+    def send(self, spans):
+        """Send spans to the collector and/or file. Tracing is not worth failing
+        over, so errors are logged and the spans are dropped.
+
+        :Returns: None
+
+        :param spans: The finished spans
+        :type spans: List
+        """
+        payload = ujson.dumps(self.document(spans))
+        if const.VLAB_ESXI_TRACE_FILE:
+            try:
+                # One write of an O_APPEND file, so lines from many processes never interleave
+                fd = os.open(const.VLAB_ESXI_TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, (payload + '\n').encode())
+                finally:
+                    os.close(fd)
+            except OSError as doh:
+                logger.warning('Unable to write {} spans: {}'.format(len(spans), doh))
+        if const.VLAB_ESXI_TRACE_OTLP_ENDPOINT:
+            req = urllib.request.Request(const.VLAB_ESXI_TRACE_OTLP_ENDPOINT, data=payload.encode(),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+            try:
+                urllib.request.urlopen(req, timeout=10).close()
+            except Exception as doh:
+                logger.warning('Unable to send {} spans: {}'.format(len(spans), doh))
+
+
+EXPORTER = Exporter(service='vlab-esxi-api',
+                    interval=const.VLAB_ESXI_TRACE_INTERVAL,
+                    max_queue=const.VLAB_ESXI_TRACE_QUEUE)
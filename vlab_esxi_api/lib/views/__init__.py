@@ -1,3 +1,4 @@
 # -*- coding: UTF-8 -*-
 from .healthcheck import HealthView
 from .esxi import ESXiView
+from .metrics import MetricsView
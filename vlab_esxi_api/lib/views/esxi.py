@@ -3,17 +3,83 @@
 Defines the RESTful API for managing instance of ESXi
 """
 import ujson
-from flask import current_app
+from flask import current_app, stream_with_context
 from flask_classy import request, route, Response
 from vlab_inf_common.views import MachineView
 from vlab_inf_common.vmware import vCenter, vim
 from vlab_api_common import describe, get_logger, requires, validate_input
 
 
-from vlab_esxi_api.lib import const
+from vlab_esxi_api.lib import const, events, images, read_model, results, singleflight
 
 
 logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+# The custom states a worker sets on an unfinished task, and where in the task
+# status response their details go
+RUNNING_DETAILS = {'PROGRESS': 'progress', 'QUEUED': 'queue'}
+
+
+def wants_sync():
+    """Test if the client would rather wait for an answer than get a task link
+
+    Clients opt-in with either the ``sync=true`` query param, or the
+    ``Prefer: wait`` header (RFC 7240).
+
+    :Returns: Boolean
+    """
+    if request.args.get('sync', '').lower() in ('true', '1'):
+        return True
+    prefer = [x.strip().split('=')[0].lower() for x in request.headers.get('Prefer', '').split(',')]
+    return 'wait' in prefer
+
+
+def wait_seconds():
+    """How long the client is willing to wait on a task to finish
+
+    Set with either the ``wait=<seconds>`` query param, or the ``Prefer: wait=<seconds>``
+    header (RFC 7240). Capped at ``VLAB_ESXI_TASK_WAIT_MAX``.
+
+    :Returns: Float
+    """
+    wait = request.args.get('wait', None)
+    if wait is None:
+        for item in request.headers.get('Prefer', '').split(','):
+            name, _, value = item.strip().partition('=')
+            if name.lower() == 'wait' and value:
+                wait = value
+    try:
+        wait = float(wait or 0)
+    except ValueError:
+        return 0
+    return min(max(wait, 0), const.VLAB_ESXI_TASK_WAIT_MAX)
+
+
+def batch_names(body):
+    """Obtain the names of the ESXi instances to create in a batch
+
+    :Returns: List
+
+    :Raises: ValueError
+
+    :param body: The validated body of a batch create request
+    :type body: Dictionary
+    """
+    if 'names' in body and ('pattern' in body or 'count' in body):
+        raise ValueError("Supply either 'names', or 'pattern' and 'count', not both")
+    elif 'names' in body:
+        count = len(body['names'])
+    elif 'pattern' in body and 'count' in body:
+        if '{}' not in body['pattern']:
+            raise ValueError("The 'pattern' must contain '{}'")
+        count = body['count']
+    else:
+        raise ValueError("Supply either 'names', or 'pattern' and 'count'")
+    # Checked before making any names, so a huge 'count' costs nothing
+    if count > const.VLAB_ESXI_BATCH_MAX:
+        raise ValueError('Cannot create more than {} ESXi instances at once'.format(const.VLAB_ESXI_BATCH_MAX))
+    if 'names' in body:
+        return body['names']
+    return [body['pattern'].replace('{}', str(x)) for x in range(1, count + 1)]
 
 
 class ESXiView(MachineView):
@@ -50,22 +116,117 @@ class ESXiView(MachineView):
                      },
                      "required": ["name"]
                     }
+    BATCH_POST_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                         "type": "object",
+                         "description": "Create many ESXi instances. Supply either 'names', or 'pattern' and 'count'",
+                         "properties": {
+                             "names": {
+                                 "description": "The names to give your ESXi instances",
+                                 "type": "array",
+                                 "items": {"type": "string"},
+                                 "minItems": 1,
+                                 "uniqueItems": True
+                             },
+                             "pattern": {
+                                 "description": "A name containing '{}', which is replaced with 1 through 'count'; i.e. 'lab-esxi{}'",
+                                 "type": "string"
+                             },
+                             "count": {
+                                 "description": "How many ESXi instances to create from the 'pattern'",
+                                 "type": "integer",
+                                 "minimum": 1,
+                                 "maximum": const.VLAB_ESXI_BATCH_MAX
+                             },
+                             "image": {
+                                 "description": "The image/version of ESXi to create",
+                                 "type": "string"
+                             },
+                             "network": {
+                                 "description": "The network to hook the ESXi instances up to",
+                                 "type": "string"
+                             }
+                         },
+                         "required": ["image", "network"]
+                        }
+    BATCH_DELETE_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                           "type": "object",
+                           "description": "Destroy many ESXi instances. Supply one of 'names', 'pattern' or 'all'",
+                           "properties": {
+                               "names": {
+                                   "description": "The names of the ESXi instances to destroy",
+                                   "type": "array",
+                                   "items": {"type": "string"},
+                                   "minItems": 1
+                               },
+                               "pattern": {
+                                   "description": "A shell-style wildcard of ESXi instances to destroy; i.e. 'lab-*'",
+                                   "type": "string"
+                               },
+                               "all": {
+                                   "description": "Set to true to destroy every ESXi instance you own",
+                                   "type": "boolean"
+                               }
+                           }
+                          }
     GET_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                   "description": "Display the ESXi instances you own"
                  }
+    GET_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                       "type": "object",
+                       "properties": {
+                          "sync": {
+                              "description": "Set to true to get a recent listing inline (HTTP 200) instead of a task (HTTP 202). Same as sending the header 'Prefer: wait'",
+                              "type": "boolean"
+                          }
+                       }
+                      }
+    TASK_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                        "type": "object",
+                        "properties": {
+                           "task-id": {
+                               "description": "The Task Id. Optionally index the URL with the task id",
+                               "type": "string"
+                           },
+                           "wait": {
+                               "description": "Hold the request up to this many seconds for the task to finish. Same as sending the header 'Prefer: wait=<seconds>'",
+                               "type": "number"
+                           }
+                        }
+                       }
+    EVENTS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                     "description": "A Server-Sent Events stream of the state and progress of your tasks, and changes to your ESXi instances. Send the 'Last-Event-ID' header to resume a stream"
+                    }
     IMAGES_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                      "description": "View available versions of ESXi that can be created"
                     }
+    IMAGES_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                          "type": "object",
+                          "properties": {
+                             "sync": {
+                                 "description": "Set to true to get the image catalogue inline (HTTP 200) instead of a task (HTTP 202). Same as sending the header 'Prefer: wait'",
+                                 "type": "boolean"
+                             }
+                          }
+                         }
 
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
-    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA)
+    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA, get_args=GET_ARGS_SCHEMA)
     def get(self, *args, **kwargs):
         """Display the ESXi instances you own"""
         username = kwargs['token']['username']
         resp_data = {'user' : username}
+        if wants_sync():
+            found = read_model.load(username)
+            if found is not None:
+                resp_data['content'], age = found
+                resp_data['error'] = None
+                resp = Response(ujson.dumps(resp_data))
+                resp.status_code = 200
+                resp.headers['Age'] = int(age)
+                return resp
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
-        task = current_app.celery_app.send_task('esxi.show', [username, txn_id])
+        task = singleflight.send_task(current_app.celery_app, 'esxi.show', username, [username, txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
@@ -83,6 +244,8 @@ class ESXiView(MachineView):
         machine_name = body['name']
         image = body['image']
         network = '{}_{}'.format(username, body['network'])
+        # a listing that's already in flight won't include this change
+        singleflight.forget('esxi.show', username)
         task = current_app.celery_app.send_task('esxi.create', [username, machine_name, image, network, txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
@@ -98,6 +261,8 @@ class ESXiView(MachineView):
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
         machine_name = kwargs['body']['name']
+        # a listing that's already in flight won't include this change
+        singleflight.forget('esxi.show', username)
         task = current_app.celery_app.send_task('esxi.delete', [username, machine_name, txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
@@ -105,15 +270,116 @@ class ESXiView(MachineView):
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
 
+    @route('/batch', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=BATCH_POST_SCHEMA)
+    @describe(post=BATCH_POST_SCHEMA)
+    def batch_create(self, *args, **kwargs):
+        """Create many ESXi instances in one task"""
+        username = kwargs['token']['username']
+        resp_data = {'user' : username}
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        body = kwargs['body']
+        try:
+            machine_names = batch_names(body)
+        except ValueError as doh:
+            resp_data['error'] = '{}'.format(doh)
+            return ujson.dumps(resp_data), 400
+        image = body['image']
+        network = '{}_{}'.format(username, body['network'])
+        # a listing that's already in flight won't include this change
+        singleflight.forget('esxi.show', username)
+        task = current_app.celery_app.send_task('esxi.batch_create', [username, machine_names, image, network, txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/batch', methods=["DELETE"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=BATCH_DELETE_SCHEMA)
+    @describe(delete=BATCH_DELETE_SCHEMA)
+    def batch_delete(self, *args, **kwargs):
+        """Destroy many ESXi instances in one task"""
+        username = kwargs['token']['username']
+        resp_data = {'user' : username}
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        body = kwargs['body']
+        chosen = [x for x in ('names', 'pattern', 'all') if body.get(x, None) not in (None, False)]
+        if len(chosen) != 1:
+            resp_data['error'] = "Supply exactly one of 'names', 'pattern' or 'all'"
+            return ujson.dumps(resp_data), 400
+        # a listing that's already in flight won't include this change
+        singleflight.forget('esxi.show', username)
+        task = current_app.celery_app.send_task('esxi.batch_delete', [username, body.get('names', None),
+                                                                      body.get('pattern', None), txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/task', methods=["GET"])
+    @route('/task/<tid>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get_args=TASK_ARGS_SCHEMA)
+    def handle_task(self, *args, **kwargs):
+        """End point for checking the status of Celery tasks. While an OVA is
+        uploading, the response includes how far along the upload is. While a
+        create waits its turn, the response includes its place in line.
+
+        Supply ``wait`` to have the request held until the task is done (or the
+        wait is over), instead of polling over and over.
+        """
+        task_id = request.args.get('task-id', kwargs.get('tid', None))
+        if task_id is not None and not (request.args.get('task-id', None) and kwargs.get('tid', None)):
+            result = current_app.celery_app.AsyncResult(task_id)
+            status = results.wait(result, wait_seconds())
+            if status in RUNNING_DETAILS:
+                resp = {'user': kwargs['token']['username'],
+                        'content' : {'status': status, RUNNING_DETAILS[status]: result.info}}
+                return ujson.dumps(resp), 202
+        return super().handle_task(*args, **kwargs)
+
+    @route('/events', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get=EVENTS_SCHEMA)
+    def events(self, *args, **kwargs):
+        """Stream the events of your tasks and ESXi instances, instead of polling for them"""
+        username = kwargs['token']['username']
+        last_id = request.headers.get('Last-Event-ID', None)
+        resp = Response(stream_with_context(events.stream(username, last_id=last_id)),
+                        mimetype='text/event-stream')
+        resp.headers['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the stream
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp
+
     @route('/image', methods=["GET"])
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
-    @describe(get=IMAGES_SCHEMA)
+    @describe(get=IMAGES_SCHEMA, get_args=IMAGES_ARGS_SCHEMA)
     def image(self, *args, **kwargs):
         """Show available versions of ESXi that can be deployed"""
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
-        task = current_app.celery_app.send_task('esxi.image', [txn_id])
+        if wants_sync():
+            try:
+                catalogue, complete = images.indexed()
+            except OSError as doh:
+                logger.error('Unable to read image catalogue: {}'.format(doh))
+            else:
+                if not complete:
+                    # the worker describes and hashes new images
+                    singleflight.send_task(current_app.celery_app, 'esxi.image', '', [txn_id])
+                resp_data['content'] = {'image': [x['version'] for x in catalogue], 'catalogue': catalogue}
+                resp_data['error'] = None
+                resp = Response(ujson.dumps(resp_data))
+                resp.status_code = 200
+                return resp
+        # every user sees the same images
+        task = singleflight.send_task(current_app.celery_app, 'esxi.image', '', [txn_id])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
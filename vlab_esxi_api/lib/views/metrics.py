@@ -0,0 +1,22 @@
+# -*- coding: UTF-8 -*-
+"""
+Serves the worker metrics in the Prometheus text format
+"""
+from flask_classy import FlaskView, Response
+
+from vlab_esxi_api.lib import metrics
+
+
+class MetricsView(FlaskView):
+    """
+    End point for Prometheus to scrape
+    """
+    route_base = '/api/1/inf/esxi/metrics'
+    trailing_slash = False
+
+    def get(self):
+        """The histograms of every worker, added up"""
+        response = Response(metrics.render(metrics.collect()))
+        response.status_code = 200
+        response.headers['Content-Type'] = metrics.CONTENT_TYPE
+        return response
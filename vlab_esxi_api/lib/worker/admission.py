@@ -0,0 +1,303 @@
+# -*- coding: UTF-8 -*-
+"""
+Admission control for deploying ESXi instances.
+
+Every create uploads a few GB to the same datastore. Past a handful at once,
+the datastore saturates and every deploy slows down, or times out. So a create
+first takes a ticket, and waits until there's a free slot under both the global
+cap (``VLAB_ESXI_CREATE_MAX``) and the cap for its user
+(``VLAB_ESXI_CREATE_MAX_PER_USER``).
+
+Waiting tickets are admitted fairly: each user's first waiting ticket goes
+before anyone's second, so one user queuing 50 creates can't starve everyone
+else. While it waits, a ticket learns its position in line and a rough estimate
+of how long until it's admitted, from how long recent creates held a slot.
+
+Tickets are kept in one file under ``VLAB_ESXI_STATE_DIR``, so every worker
+process (and container, if they share the volume) shares the same caps. A
+ticket is renewed while its worker is alive; the ticket of a worker that died
+expires after ``VLAB_ESXI_ADMISSION_LEASE`` seconds.
+"""
+import os
+import time
+import uuid
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import ujson
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const, metrics
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+# How much the latest hold time counts toward the average; the rest is history
+AVERAGE_WEIGHT = 0.2
+
+
+def _path(suffix='.json'):
+    """Obtain the location of the admission state
+
+    :Returns: String
+
+    :param suffix: The file extension to use
+    :type suffix: String
+    """
+    return os.path.join(const.VLAB_ESXI_STATE_DIR, 'admission', 'tickets' + suffix)
+
+
+@contextmanager
+def _locked():
+    """Only one process at a time reads and changes the tickets"""
+    lock_file = _path(suffix='.lock')
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with open(lock_file, 'a') as the_file:
+        fcntl.flock(the_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(the_file, fcntl.LOCK_UN)
+
+
+def _read():
+    """Load the tickets, and the average hold time"""
+    try:
+        with open(_path()) as the_file:
+            return ujson.load(the_file)
+    except (OSError, ValueError):
+        return {'tickets': {}, 'average': None}
+
+
+def _write(state):
+    """Atomically replace the tickets"""
+    location = _path()
+    fd, tmp_location = tempfile.mkstemp(dir=os.path.dirname(location), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as the_file:
+            ujson.dump(state, the_file)
+        os.replace(tmp_location, location)
+    except Exception:
+        os.unlink(tmp_location)
+        raise
+
+
+def schedule(tickets, global_max, user_max):
+    """Decide which waiting tickets can start now, and the order of the rest.
+
+    A user's n-th waiting ticket is ranked as if they already had n more
+    creates running, so users take turns; ties go to the oldest ticket.
+
+    :Returns: Tuple - (List of ticket ids to start, List of ticket ids still waiting in order)
+
+    :param tickets: Every ticket, keyed by id
+    :type tickets: Dictionary
+
+    :param global_max: The most slots in use at once. Zero means no limit.
+    :type global_max: Integer
+
+    :param user_max: The most slots one user can have in use at once. Zero means no limit.
+    :type user_max: Integer
+    """
+    running = 0
+    user_running = {}
+    waiting = []
+    for ticket_id, ticket in tickets.items():
+        if ticket['started']:
+            running += ticket['slots']
+            user_running[ticket['username']] = user_running.get(ticket['username'], 0) + ticket['slots']
+        else:
+            waiting.append(ticket_id)
+    waiting.sort(key=lambda x: tickets[x]['queued'])
+    turns = {}
+    ranks = {}
+    for ticket_id in waiting:
+        username = tickets[ticket_id]['username']
+        ranks[ticket_id] = (user_running.get(username, 0) + turns.get(username, 0), tickets[ticket_id]['queued'])
+        turns[username] = turns.get(username, 0) + 1
+    waiting.sort(key=lambda x: ranks[x])
+
+    start = []
+    still_waiting = []
+    full = False
+    for ticket_id in waiting:
+        ticket = tickets[ticket_id]
+        in_use = user_running.get(ticket['username'], 0)
+        # A ticket bigger than a cap is admitted only once nothing else is running
+        fits = not global_max or running == 0 or running + ticket['slots'] <= global_max
+        user_fits = not user_max or in_use == 0 or in_use + ticket['slots'] <= user_max
+        if full or not fits:
+            # nobody jumps ahead of a ticket that's waiting on the global cap
+            full = True
+            still_waiting.append(ticket_id)
+        elif not user_fits:
+            still_waiting.append(ticket_id)
+        else:
+            start.append(ticket_id)
+            running += ticket['slots']
+            user_running[ticket['username']] = in_use + ticket['slots']
+    return start, still_waiting
+
+
+def estimate_wait(tickets, waiting, ticket_id, global_max, average):
+    """Roughly how many seconds until a waiting ticket is admitted
+
+    :Returns: Integer, or None if there's nothing to base an estimate on
+
+    :param tickets: Every ticket, keyed by id
+    :type tickets: Dictionary
+
+    :param waiting: The ids of the waiting tickets, in order
+    :type waiting: List
+
+    :param ticket_id: The ticket to estimate
+    :type ticket_id: String
+
+    :param global_max: The most slots in use at once
+    :type global_max: Integer
+
+    :param average: How many seconds a ticket holds its slots, on average
+    :type average: Float
+    """
+    if average is None or not global_max:
+        return None
+    ahead = sum(tickets[x]['slots'] for x in waiting[:waiting.index(ticket_id)])
+    # Every slot ahead has to free up, plus one for this ticket
+    return int(average * (ahead // global_max + 1))
+
+
+class Ticket(object):
+    """One create's place in line
+
+    :param username: The user who wants to create ESXi instances
+    :type username: String
+
+    :param slots: How many slots the create will use, i.e. instances deployed at once
+    :type slots: Integer
+    """
+    def __init__(self, username, slots=1):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.slots = slots
+        self.started = None
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def _update(self, state, now):
+        """Renew this ticket, and drop the tickets of workers that died"""
+        tickets = state['tickets']
+        expired = [x for x, y in tickets.items() if now - y['renewed'] > const.VLAB_ESXI_ADMISSION_LEASE]
+        for ticket_id in expired:
+            logger.warning('Dropping expired create ticket {} of {}'.format(ticket_id, tickets[ticket_id]['username']))
+            tickets.pop(ticket_id)
+        if self.id not in tickets:
+            tickets[self.id] = {'username': self.username, 'slots': self.slots,
+                                'queued': now, 'started': self.started}
+        tickets[self.id]['renewed'] = now
+
+    def check(self):
+        """Start this ticket if there's room, or find its place in line
+
+        :Returns: Tuple - (position in line, estimated seconds to wait); (0, 0) once started
+        """
+        with _locked():
+            state = _read()
+            now = time.time()
+            self._update(state, now)
+            tickets = state['tickets']
+            start, waiting = schedule(tickets, const.VLAB_ESXI_CREATE_MAX, const.VLAB_ESXI_CREATE_MAX_PER_USER)
+            for ticket_id in start:
+                # Start every ticket that fits, so a slow poller doesn't hold a slot back
+                tickets[ticket_id]['started'] = now
+            _write(state)
+        if self.id in start or tickets[self.id]['started']:
+            self.started = tickets[self.id]['started']
+            return 0, 0
+        position = waiting.index(self.id) + 1
+        return position, estimate_wait(tickets, waiting, self.id, const.VLAB_ESXI_CREATE_MAX, state['average'])
+
+    def renew(self):
+        """Keep this ticket from expiring
+
+        :Returns: None
+        """
+        with _locked():
+            state = _read()
+            self._update(state, time.time())
+            _write(state)
+
+    def release(self):
+        """Give up this ticket, and the slots it holds
+
+        :Returns: None
+        """
+        self._stop.set()
+        with _locked():
+            state = _read()
+            ticket = state['tickets'].pop(self.id, None)
+            if ticket is not None and ticket['started']:
+                held = time.time() - ticket['started']
+                if state['average'] is None:
+                    state['average'] = held
+                else:
+                    state['average'] = AVERAGE_WEIGHT * held + (1 - AVERAGE_WEIGHT) * state['average']
+            _write(state)
+
+    def start_renewing(self):
+        """Renew this ticket in a background thread until it's released
+
+        :Returns: None
+        """
+        self._renewer = threading.Thread(target=self._renew_forever, name='esxi-admission-{}'.format(self.id),
+                                         daemon=True)
+        self._renewer.start()
+
+    def _renew_forever(self):
+        """Renew this ticket every third of a lease"""
+        while not self._stop.wait(const.VLAB_ESXI_ADMISSION_LEASE / 3):
+            try:
+                self.renew()
+            except OSError as doh:
+                logger.warning('Unable to renew create ticket {}: {}'.format(self.id, doh))
+
+
+@contextmanager
+def admitted(username, slots=1, on_wait=None):
+    """Block until a create is allowed to run, and hold its slots until the
+    ``with`` block exits. Admission protects the datastore, but is not worth
+    failing a create over; if the tickets can't be read, the create runs anyway.
+
+    :Returns: None
+
+    :param username: The user who wants to create ESXi instances
+    :type username: String
+
+    :param slots: How many slots the create will use, i.e. instances deployed at once
+    :type slots: Integer
+
+    :param on_wait: Called with (position in line, estimated seconds to wait) when either changes
+    :type on_wait: Function
+    """
+    ticket = Ticket(username, slots=slots)
+    try:
+        try:
+            last = None
+            with metrics.phase('admission'):
+                while True:
+                    position, eta = ticket.check()
+                    if not position:
+                        break
+                    if on_wait is not None and (position, eta) != last:
+                        on_wait(position, eta)
+                    last = (position, eta)
+                    time.sleep(const.VLAB_ESXI_ADMISSION_POLL)
+            ticket.start_renewing()
+        except OSError as doh:
+            logger.warning('Unable to queue create for {}, running it now: {}'.format(username, doh))
+        yield
+    finally:
+        try:
+            ticket.release()
+        except OSError as doh:
+            logger.warning('Unable to release create ticket {}: {}'.format(ticket.id, doh))
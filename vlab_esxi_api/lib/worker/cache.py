@@ -0,0 +1,248 @@
+# -*- coding: UTF-8 -*-
+"""
+An in-memory copy of every VM under the vLab folder tree.
+
+Instead of collecting a user's inventory on every ``esxi.show``, a background
+thread subscribes to changes in the vLab folder tree with ``WaitForUpdatesEx``
+and applies them as they happen. Reads are answered from memory as long as the
+update stream is healthy; otherwise the caller falls back to a full collection.
+A vLab too big to hold in memory turns the cache off until the worker restarts.
+"""
+import os
+import time
+import threading
+
+from pyVmomi import vim, vmodl
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const
+from vlab_esxi_api.lib.worker import inventory
+from vlab_esxi_api.lib.worker.session import new_vcenter
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+VM_PROPERTIES = inventory.VM_PROPERTIES + ['parent']
+FOLDER_PROPERTIES = ['name', 'parent']
+
+
+def tree_spec(top_folder):
+    """Select every folder and VM below the top level folder, and the networks
+    of those VMs.
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param top_folder: The root of the vLab folder tree
+    :type top_folder: vim.Folder
+    """
+    vm_to_network = vmodl.query.PropertyCollector.TraversalSpec(name='vmToNetwork',
+                                                                type=vim.VirtualMachine,
+                                                                path='network',
+                                                                skip=False)
+    folder_to_child = vmodl.query.PropertyCollector.TraversalSpec(name='folderToChild',
+                                                                  type=vim.Folder,
+                                                                  path='childEntity',
+                                                                  skip=False)
+    folder_to_child.selectSet = [vmodl.query.PropertyCollector.SelectionSpec(name='folderToChild'),
+                                 vm_to_network]
+    object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=top_folder, skip=False,
+                                                           selectSet=[folder_to_child])
+    property_specs = [vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=VM_PROPERTIES),
+                      vmodl.query.PropertyCollector.PropertySpec(type=vim.Folder, pathSet=FOLDER_PROPERTIES),
+                      vmodl.query.PropertyCollector.PropertySpec(type=vim.Network, pathSet=['name'])]
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=[object_spec], propSet=property_specs)
+
+
+def _moid(managed_object):
+    """The moid of a managed object, or None"""
+    return getattr(managed_object, '_moId', None)
+
+
+class InventoryCache(object):
+    """Keeps a copy of the VMs, folders and networks in the vLab folder tree
+    current by consuming a ``WaitForUpdatesEx`` change stream.
+
+    The cache has its own vCenter session because ``WaitForUpdatesEx`` blocks.
+    If the stream breaks, the cache empties itself and reconnects after a delay;
+    reads made in the meantime return None so the caller can do a full collection.
+    If the tree grows beyond ``max_objects``, the cache empties itself and stays
+    off until the process restarts, instead of loading the whole tree over and
+    over again.
+
+    :param factory: A callable that returns a new, logged in vCenter object
+    :type factory: Function
+
+    :param max_objects: The most VMs, folders and networks to hold in memory
+    :type max_objects: Integer
+
+    :param max_staleness: How many seconds old the last confirmation from vCenter
+                          can be before the cache is not trusted
+    :type max_staleness: Integer
+
+    :param wait_seconds: How long a single ``WaitForUpdatesEx`` call blocks
+    :type wait_seconds: Integer
+
+    :param retry_seconds: How long to wait before reconnecting a broken stream
+    :type retry_seconds: Integer
+    """
+    def __init__(self, factory, max_objects, max_staleness, wait_seconds, retry_seconds):
+        self._factory = factory
+        self._max_objects = max_objects
+        self._max_staleness = max_staleness
+        self._wait_seconds = wait_seconds
+        self._retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._disabled = False
+        self._reset()
+
+    def _reset(self):
+        """Forget everything; the next read falls back to a full collection"""
+        with self._lock:
+            self._objects = {vim.VirtualMachine: {}, vim.Folder: {}, vim.Network: {}}
+            self._count = 0
+            self._top_folder = None
+            self._ready = False
+            self._last_sync = 0
+
+    def start(self):
+        """Start consuming the change stream, if it's not already running in this process
+
+        :Returns: None
+        """
+        with self._lock:
+            if self._disabled or (self._pid == os.getpid() and self._thread.is_alive()):
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='esxi-inventory-cache', daemon=True)
+            self._thread.start()
+
+    def fresh(self):
+        """Test if the cache can be trusted right now
+
+        :Returns: Boolean
+        """
+        with self._lock:
+            return self._ready and (time.time() - self._last_sync) <= self._max_staleness
+
+    def _run(self):
+        """Consume the change stream forever, reconnecting when it breaks"""
+        while True:
+            try:
+                vcenter = self._factory()
+                try:
+                    self._watch(vcenter)
+                finally:
+                    vcenter.close()
+            except Exception as doh:
+                logger.error('Inventory cache update stream broke: {}'.format(doh))
+            self._reset()
+            if self._disabled:
+                logger.error('Inventory cache disabled; listings will collect the inventory instead')
+                return
+            time.sleep(self._retry_seconds)
+
+    def _watch(self, vcenter):
+        """Load the vLab folder tree, then apply changes as vCenter reports them"""
+        top_folder = vcenter.get_vm_folder(path=const.INF_VCENTER_TOP_LVL_DIR)
+        with self._lock:
+            self._top_folder = top_folder._moId
+        collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+        try:
+            collector.CreateFilter(tree_spec(top_folder), partialUpdates=False)
+            # load the tree in batches, so a tree that's too big is noticed before
+            # all of it is in memory
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self._wait_seconds,
+                                                                maxObjectUpdates=self._max_objects)
+            version = ''
+            while True:
+                update_set = collector.WaitForUpdatesEx(version, options)
+                if update_set is not None:
+                    self.apply(update_set)
+                    version = update_set.version
+                    if update_set.truncated:
+                        # more changes pending; don't claim to be in sync yet
+                        continue
+                with self._lock:
+                    self._ready = True
+                    self._last_sync = time.time()
+        finally:
+            collector.DestroyPropertyCollector()
+
+    def apply(self, update_set):
+        """Apply a set of changes reported by vCenter
+
+        :Returns: None
+
+        :Raises: RuntimeError if the tree has grown too large to cache, which
+                 disables the cache
+
+        :param update_set: The changes returned by ``WaitForUpdatesEx``
+        :type update_set: vmodl.query.PropertyCollector.UpdateSet
+        """
+        with self._lock:
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    self._apply_object(object_update)
+                    if self._count > self._max_objects:
+                        self._disabled = True
+                        self._objects = {vim.VirtualMachine: {}, vim.Folder: {}, vim.Network: {}}
+                        self._count = 0
+                        self._ready = False
+                        error = 'vLab folder tree has more than the max of {} objects'.format(self._max_objects)
+                        raise RuntimeError(error)
+
+    def _apply_object(self, object_update):
+        """Apply the changes to a single object; the caller must hold the lock"""
+        for vimtype, bucket in self._objects.items():
+            if isinstance(object_update.obj, vimtype):
+                break
+        else:
+            return
+        moid = object_update.obj._moId
+        if object_update.kind == 'leave':
+            if bucket.pop(moid, None) is not None:
+                self._count -= 1
+            return
+        if moid not in bucket:
+            bucket[moid] = {}
+            self._count += 1
+        props = bucket[moid]
+        for change in object_update.changeSet:
+            if change.op in ('remove', 'indirectRemove'):
+                props.pop(change.name, None)
+            else:
+                props[change.name] = change.val
+
+    def esxi_records(self, username):
+        """Obtain the cached properties of every VM in a user's folder
+
+        :Returns: Tuple - (Dictionary of VM moid to (None, properties), Dictionary of network moid to name),
+                  or None if the cache can't be trusted right now
+
+        :param username: The name of the user who owns the VMs
+        :type username: String
+        """
+        if not self.fresh():
+            return None
+        with self._lock:
+            # only the user's folder directly under the vLab root, not any other
+            # folder that happens to share the name
+            folders = {moid for moid, props in self._objects[vim.Folder].items()
+                       if props.get('name') == username and _moid(props.get('parent', None)) == self._top_folder}
+            if not folders:
+                return None
+            vms = {}
+            for moid, props in self._objects[vim.VirtualMachine].items():
+                parent = props.get('parent', None)
+                if parent is not None and parent._moId in folders:
+                    vms[moid] = (None, dict(props))
+            networks = {moid: props.get('name', '') for moid, props in self._objects[vim.Network].items()}
+        return vms, networks
+
+
+CACHE = InventoryCache(factory=new_vcenter,
+                       max_objects=const.VLAB_ESXI_CACHE_MAX_OBJECTS,
+                       max_staleness=const.VLAB_ESXI_CACHE_MAX_STALENESS,
+                       wait_seconds=const.VLAB_ESXI_CACHE_WAIT_SECONDS,
+                       retry_seconds=const.VLAB_ESXI_CACHE_RETRY_SECONDS)
@@ -0,0 +1,408 @@
+# -*- coding: UTF-8 -*-
+"""
+Different ways to make the VM for a new instance of ESXi.
+
+Uploading the OVA copies every byte of the disk on every create. When an image
+is set to ``clone`` mode, the OVA is instead imported once into a base VM with
+a snapshot, and new instances are linked clones of that snapshot. Creating a
+linked clone takes seconds, and uses almost no datastore space.
+"""
+import re
+import time
+import os.path
+import threading
+from collections import namedtuple
+
+import ujson
+from vlab_inf_common.vmware import vim
+
+from vlab_esxi_api.lib import const
+from vlab_esxi_api.lib.worker.ova import open_ova
+from vlab_esxi_api.lib.worker.placement import PLACER, active_hosts, candidate_datastores, candidate_pools
+from vlab_esxi_api.lib.worker.waiter import consume_task
+
+
+BASE_SNAPSHOT = 'vlab-base'
+META_KEYS = {'component', 'created', 'version', 'generation', 'configured'}
+HOSTNAME_REGEX = r'^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$'
+_IMPORT_LOCK = threading.Lock()
+Placement = namedtuple('Placement', ['resource_pools', 'datastores', 'hosts'])
+
+
+def deploy_mode(image):
+    """Obtain how new instances of an image/version of ESXi should be created
+
+    Set with ``VLAB_ESXI_DEPLOY_MODES``, a comma separated list of ``<version>=<mode>``.
+    The version ``*`` sets the default mode. Valid modes are ``ova`` and ``clone``.
+
+    :Returns: String
+
+    :param image: The image/version of ESXi
+    :type image: String
+    """
+    modes = {}
+    for item in const.VLAB_ESXI_DEPLOY_MODES.split(','):
+        if '=' in item:
+            version, mode = item.split('=', 1)
+            modes[version.strip()] = mode.strip().lower()
+    return modes.get(image, modes.get('*', 'ova'))
+
+
+def template_name(image):
+    """The name of the base VM that linked clones of an image are made from
+
+    :Returns: String
+
+    :param image: The image/version of ESXi
+    :type image: String
+    """
+    return 'esxi-{}-base'.format(image)
+
+
+def check_name(machine_name):
+    """Make sure a machine name is also a valid hostname
+
+    :Returns: None
+
+    :Raises: ValueError
+
+    :param machine_name: The name to give the new VM
+    :type machine_name: String
+    """
+    if not re.match(HOSTNAME_REGEX, machine_name):
+        error = 'Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name)
+        raise ValueError(error)
+
+
+def get_placement(vcenter):
+    """Find where new VMs can go; the resource pools, datastores and hosts
+
+    :Returns: Placement
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return Placement(candidate_pools(vcenter), candidate_datastores(vcenter), active_hosts(vcenter))
+
+
+def config_spec(meta_data=None, nested_hv=True):
+    """Make the settings a new ESXi VM needs, so they can be part of the clone
+    or import, instead of a reconfigure afterwards.
+
+    :Returns: vim.vm.ConfigSpec
+
+    :Raises: ValueError - when invalid meta data supplied
+
+    :param meta_data: The vlab meta data to store in the notes of the VM
+    :type meta_data: Dictionary
+
+    :param nested_hv: Enable hardware-assisted virtualization, so 64-bit OSes can
+                      run on the virtual ESXi host. Can only change while the VM
+                      is powered off.
+    :type nested_hv: Boolean
+    """
+    spec = vim.vm.ConfigSpec()
+    if nested_hv:
+        spec.nestedHVEnabled = True
+    if meta_data is not None:
+        provided = set(meta_data.keys())
+        if not META_KEYS.issubset(provided):
+            error = "Invalid meta data schema. Supplied: {}, Required: {}".format(provided, META_KEYS)
+            raise ValueError(error)
+        spec.annotation = ujson.dumps(meta_data)
+    return spec
+
+
+def _merge(spec, config):
+    """Copy the settings that are set in ``config`` onto ``spec``"""
+    for prop in config._GetPropertyList():
+        value = getattr(config, prop.name)
+        if value is not None and not (isinstance(value, list) and not value):
+            setattr(spec, prop.name, value)
+
+
+def deploy_ova(vcenter, ova, network_map, folder, machine_name, logger, placement=None, config=None):
+    """Upload an OVA to create a new, powered off, VM in any folder
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param ova: The Ova object
+    :type ova: vlab_inf_common.vmware.Ova
+
+    :param network_map: The mapping of networks defined in the OVA with what's
+                        available in vCenter.
+    :type network_map: List of vim.OvfManager.NetworkMapping
+
+    :param folder: The folder to create the VM in
+    :type folder: vim.Folder
+
+    :param machine_name: The name to give the new VM
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param placement: Where the VM can go. Looked up if not supplied.
+    :type placement: Placement
+
+    :param config: Settings to import the VM with, like from ``config_spec``
+    :type config: vim.vm.ConfigSpec
+    """
+    if placement is None:
+        placement = get_placement(vcenter)
+    resource_pool, datastore, host = PLACER.choose(placement)
+    logger.debug('Deploying to datastore {} in resource pool {}'.format(datastore.name, resource_pool.name))
+    spec_params = vim.OvfManager.CreateImportSpecParams(entityName=machine_name,
+                                                        diskProvisioning='thin',
+                                                        networkMapping=network_map)
+    with PLACER.deploying(datastore, resource_pool):
+        spec = vcenter.ovf_manager.CreateImportSpec(ovfDescriptor=ova.ovf,
+                                                    resourcePool=resource_pool,
+                                                    datastore=datastore,
+                                                    cisp=spec_params)
+        if spec.error:
+            raise RuntimeError(spec.error[0].msg)
+        imported_config = getattr(spec.importSpec, 'configSpec', None)
+        if config is not None and imported_config is not None:
+            _merge(imported_config, config)
+        lease = resource_pool.ImportVApp(spec.importSpec, folder=folder, host=host)
+        wait_for_lease(lease)
+        logger.debug('Uploading OVA')
+        ova.deploy(spec, lease, host.name)
+        logger.debug('OVA deployed successfully')
+    the_vm = vcenter.content.searchIndex.FindChild(entity=folder, name=machine_name)
+    if the_vm is None:
+        error = 'Unable to find newly created VM by name {}'.format(machine_name)
+        raise RuntimeError(error)
+    if config is not None and imported_config is None:
+        # A vApp import has no spec for the VM itself
+        consume_task(the_vm.ReconfigVM_Task(config))
+    return the_vm
+
+
+def wait_for_lease(lease, timeout=300):
+    """Block until an OVA deploy lease is ready to be used
+
+    :Returns: None
+
+    :Raises: RuntimeError
+
+    :param lease: The lease returned by ``ImportVApp``
+    :type lease: vim.HttpNfcLease
+
+    :param timeout: How many seconds to wait
+    :type timeout: Integer
+    """
+    for _ in range(timeout):
+        if lease.error:
+            raise RuntimeError(lease.error.msg)
+        elif lease.state == vim.HttpNfcLease.State.ready:
+            return
+        time.sleep(1)
+    raise RuntimeError('Deploy lease not usable after {} seconds'.format(timeout))
+
+
+def nic_spec(the_vm, network, adapter_label='Network adapter 1', connected=True):
+    """Make the spec that connects a VM's NIC to a distributed port group
+
+    :Returns: vim.vm.device.VirtualDeviceSpec
+
+    :param the_vm: The VM that owns the NIC
+    :type the_vm: vim.VirtualMachine
+
+    :param network: The network to connect to
+    :type network: vim.dvs.DistributedVirtualPortgroup
+
+    :param adapter_label: The name of the virtual NIC to connect
+    :type adapter_label: String
+
+    :param connected: Set to False to unplug the NIC from the network, as far as
+                      the guest can tell
+    :type connected: Boolean
+    """
+    devices = [x for x in the_vm.config.hardware.device if x.deviceInfo.label == adapter_label]
+    if not devices:
+        error = "VM has no network adapter named {}".format(adapter_label)
+        raise RuntimeError(error)
+    spec = vim.vm.device.VirtualDeviceSpec()
+    spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+    spec.device = devices[0]
+    spec.device.wakeOnLanEnabled = True
+    port = vim.dvs.PortConnection()
+    port.portgroupKey = network.key
+    port.switchUuid = network.config.distributedVirtualSwitch.uuid
+    spec.device.backing = vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo()
+    spec.device.backing.port = port
+    spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+    spec.device.connectable.startConnected = True
+    spec.device.connectable.allowGuestControl = True
+    spec.device.connectable.connected = connected
+    return spec
+
+
+def ensure_folder(vcenter, path):
+    """Obtain a VM folder, creating it if needed
+
+    :Returns: vim.Folder
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param path: The absolute path to the folder
+    :type path: String
+    """
+    try:
+        return vcenter.get_vm_folder(path=path)
+    except FileNotFoundError:
+        vcenter.create_vm_folder(path=path)
+        return vcenter.get_vm_folder(path=path)
+
+
+def template_folder(vcenter):
+    """Obtain the folder that holds the base VMs, creating it if needed
+
+    :Returns: vim.Folder
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return ensure_folder(vcenter, const.VLAB_ESXI_TEMPLATE_DIR)
+
+
+def import_template(vcenter, image, network, folder, logger):
+    """Make the base VM, and snapshot, that linked clones of an image are created from
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ESXi
+    :type image: String
+
+    :param network: Any network; linked clones connect to their own network
+    :type network: vim.Network
+
+    :param folder: The folder that holds the base VMs
+    :type folder: vim.Folder
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    ova = open_ova(os.path.join(const.VLAB_ESXI_IMAGES_DIR, 'esxi-{}.ova'.format(image)))
+    try:
+        network_map = vim.OvfManager.NetworkMapping(name=ova.networks[0], network=network)
+        base_vm = deploy_ova(vcenter, ova, [network_map], folder, template_name(image), logger,
+                             config=config_spec())
+    finally:
+        ova.close()
+    take_snapshot(base_vm, image)
+    return base_vm
+
+
+def take_snapshot(base_vm, image):
+    """Make the snapshot that linked clones of an image are created from
+
+    :Returns: None
+
+    :param base_vm: The base VM for the image
+    :type base_vm: vim.VirtualMachine
+
+    :param image: The image/version of ESXi
+    :type image: String
+    """
+    consume_task(base_vm.CreateSnapshot_Task(name=BASE_SNAPSHOT,
+                                             description='Linked clones of ESXi {} are made from this snapshot'.format(image),
+                                             memory=False,
+                                             quiesce=False))
+
+
+def get_template(vcenter, image, network, logger):
+    """Obtain the base VM for an image, importing it the first time it's needed
+
+    :Returns: vim.VirtualMachine, or None if the base VM is not usable right now
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ESXi
+    :type image: String
+
+    :param network: Any network; only used if the base VM has to be imported
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    folder = template_folder(vcenter)
+    base_vm = vcenter.content.searchIndex.FindChild(entity=folder, name=template_name(image))
+    if base_vm is None:
+        # Only one import per process; another worker importing the same image
+        # at the same time fails on the duplicate name, and uploads the OVA instead.
+        if not _IMPORT_LOCK.acquire(blocking=False):
+            return None
+        try:
+            logger.info('Importing base VM for ESXi {}'.format(image))
+            base_vm = import_template(vcenter, image, network, folder, logger)
+        except Exception as doh:
+            logger.error('Unable to import base VM for ESXi {}: {}'.format(image, doh))
+            return None
+        finally:
+            _IMPORT_LOCK.release()
+    if base_vm.snapshot is None:
+        # vCenter disables the methods of a VM while its OVA is being uploaded
+        if 'CreateSnapshot_Task' in (base_vm.disabledMethod or []):
+            return None
+        if not _IMPORT_LOCK.acquire(blocking=False):
+            return None
+        # The import stopped between the upload and the snapshot, i.e. the
+        # worker was restarted. Without a snapshot, no clone can ever be made.
+        try:
+            logger.warning('Base VM for ESXi {} has no snapshot; taking it now'.format(image))
+            take_snapshot(base_vm, image)
+        except Exception as doh:
+            logger.error('Unable to snapshot base VM for ESXi {}: {}'.format(image, doh))
+            return None
+        finally:
+            _IMPORT_LOCK.release()
+    return base_vm
+
+
+def clone_vm(template, folder, machine_name, network, logger, config=None):
+    """Create a new VM as a linked clone of a base VM's snapshot
+
+    :Returns: vim.VirtualMachine
+
+    :param template: The base VM
+    :type template: vim.VirtualMachine
+
+    :param folder: The folder to create the new VM in
+    :type folder: vim.Folder
+
+    :param machine_name: The name to give the new VM
+    :type machine_name: String
+
+    :param network: The network to connect the new VM to
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param config: Settings to clone the VM with, like from ``config_spec``
+    :type config: vim.vm.ConfigSpec
+    """
+    if config is None:
+        config = vim.vm.ConfigSpec()
+    config.deviceChange = [nic_spec(template, network)]
+    relocate = vim.vm.RelocateSpec(diskMoveType='createNewChildDiskBacking',
+                                   pool=template.resourcePool)
+    spec = vim.vm.CloneSpec(location=relocate,
+                            powerOn=False,
+                            template=False,
+                            snapshot=template.snapshot.currentSnapshot,
+                            config=config)
+    logger.debug('Creating linked clone of {}'.format(template.name))
+    return consume_task(template.CloneVM_Task(folder=folder, name=machine_name, spec=spec))
@@ -0,0 +1,464 @@
+# -*- coding: UTF-8 -*-
+"""
+Bulk lookups of a user's virtual machines.
+
+Walking ``folder.childEntity`` and calling ``virtual_machine.get_info`` costs
+several round-trips to vCenter *per VM*. The functions in this module get the
+same information for every VM in a folder with one ``RetrievePropertiesEx`` call
+(or a few paged calls), via the PropertyCollector.
+"""
+import ssl
+import textwrap
+import threading
+from collections import OrderedDict
+
+import ujson
+import OpenSSL
+from pyVmomi import vim, vmodl
+
+from vlab_esxi_api.lib import const
+
+
+VM_PROPERTIES = ['name', 'runtime.powerState', 'config.annotation', 'guest.net', 'network']
+UNKNOWN_META = {'component': 'Unknown',
+                'created': 0,
+                'version': "Unknown",
+                'generation': 0,
+                'configured': False
+               }
+
+
+def retrieve(vcenter, object_specs, property_specs, page_size=None):
+    """Obtain properties for many objects with as few calls to vCenter as possible
+
+    :Returns: List of vmodl.query.PropertyCollector.ObjectContent
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param object_specs: Where to start looking, and how to traverse from there
+    :type object_specs: List of vmodl.query.PropertyCollector.ObjectSpec
+
+    :param property_specs: The properties to collect for each type of object
+    :type property_specs: List of vmodl.query.PropertyCollector.PropertySpec
+
+    :param page_size: The max number of objects vCenter returns per call
+    :type page_size: Integer
+    """
+    if page_size is None:
+        page_size = const.VLAB_ESXI_PROPERTY_PAGE_SIZE
+    collector = vcenter.content.propertyCollector
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=object_specs,
+                                                           propSet=property_specs)
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    objects = []
+    result = collector.RetrievePropertiesEx([filter_spec], options)
+    while result:
+        objects.extend(result.objects)
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(result.token)
+    return objects
+
+
+def to_dict(object_content):
+    """Convert the propSet of an ObjectContent into a dictionary
+
+    :Returns: Dictionary
+
+    :param object_content: One object returned by the PropertyCollector
+    :type object_content: vmodl.query.PropertyCollector.ObjectContent
+    """
+    return {x.name: x.val for x in object_content.propSet}
+
+
+def folder_spec(folder):
+    """Select the direct children of a folder, and the networks of any VM in it
+
+    :Returns: vmodl.query.PropertyCollector.ObjectSpec
+
+    :param folder: The folder to look in
+    :type folder: vim.Folder
+    """
+    vm_to_network = vmodl.query.PropertyCollector.TraversalSpec(name='vmToNetwork',
+                                                                type=vim.VirtualMachine,
+                                                                path='network',
+                                                                skip=False)
+    folder_to_child = vmodl.query.PropertyCollector.TraversalSpec(name='folderToChild',
+                                                                  type=vim.Folder,
+                                                                  path='childEntity',
+                                                                  skip=False,
+                                                                  selectSet=[vm_to_network])
+    return vmodl.query.PropertyCollector.ObjectSpec(obj=folder, skip=True, selectSet=[folder_to_child])
+
+
+def get_vm_records(vcenter, folder):
+    """Obtain the raw properties of every VM in a folder in one pass
+
+    :Returns: Tuple - (Dictionary of VM moid to (vim.VirtualMachine, properties), Dictionary of network moid to name)
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The user's folder
+    :type folder: vim.Folder
+    """
+    property_specs = [vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=VM_PROPERTIES),
+                      vmodl.query.PropertyCollector.PropertySpec(type=vim.Network, pathSet=['name'])]
+    vms = {}
+    networks = {}
+    for item in retrieve(vcenter, [folder_spec(folder)], property_specs):
+        props = to_dict(item)
+        if isinstance(item.obj, vim.VirtualMachine):
+            vms[item.obj._moId] = (item.obj, props)
+        else:
+            networks[item.obj._moId] = props.get('name', '')
+    return vms, networks
+
+
+def parse_meta(annotation):
+    """Convert the notes of a VM into the vLab meta data
+
+    :Returns: Dictionary
+
+    :param annotation: The notes on a VM
+    :type annotation: String
+    """
+    try:
+        meta_data = ujson.loads(annotation)
+    except (ValueError, TypeError):
+        # ValueError -> VM created, but notes not updated
+        # TypeError  -> VM failed to be created; notes are None
+        meta_data = None
+    if not isinstance(meta_data, dict):
+        meta_data = dict(UNKNOWN_META)
+    return meta_data
+
+
+def parse_ips(guest_nics):
+    """Pull the IPs out of the guest NIC info, minus the link local ones
+
+    :Returns: List
+
+    :param guest_nics: The ``guest.net`` property of a VM
+    :type guest_nics: List of vim.vm.GuestInfo.NicInfo
+    """
+    ips = []
+    for nic in guest_nics or []:
+        ips += nic.ipAddress
+    # No point is showing the IPv6 link local addrs if a firewall wont forward them
+    # https://en.wikipedia.org/wiki/Link-local_address
+    return [x for x in ips if not x.startswith('fe80::')]
+
+
+def parse_networks(vm_networks, network_names, username):
+    """Map the networks a VM is connected to, to the names a user knows them by
+
+    :Returns: List
+
+    :param vm_networks: The ``network`` property of a VM
+    :type vm_networks: List of vim.Network
+
+    :param network_names: A mapping of network moid to network name
+    :type network_names: Dictionary
+
+    :param username: The name of the user who owns the VM
+    :type username: String
+    """
+    networks = []
+    for network in vm_networks or []:
+        name = network_names.get(network._moId, '')
+        if name.startswith(username):
+            networks.append(name.replace('{}_'.format(username), ''))
+    return networks
+
+
+class ConsoleUrls(object):
+    """Makes the HTML5 console URL for VMs, looking up the vCenter details only once.
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    def __init__(self, vcenter):
+        self._vcenter = vcenter
+        self._session_manager = None
+        self._server_guid = None
+        self._thumbprint = None
+
+    def _lookup(self):
+        """Obtain the details that are the same for every console URL"""
+        content = self._vcenter.content
+        vcenter_cert = ssl.get_server_certificate((const.INF_VCENTER_SERVER, const.INF_VCENTER_PORT))
+        cert = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, vcenter_cert)
+        self._thumbprint = cert.digest('sha1').decode()
+        self._server_guid = content.about.instanceUuid
+        self._session_manager = content.sessionManager
+
+    def make(self, vm_moid, vm_name):
+        """Obtain the console URL for one VM
+
+        Every URL has a single-use session ticket, so this costs one call to vCenter.
+
+        :Returns: String
+
+        :param vm_moid: The managed object id of the VM
+        :type vm_moid: String
+
+        :param vm_name: The name of the VM
+        :type vm_name: String
+        """
+        if self._session_manager is None:
+            self._lookup()
+        url = """\
+        https://{0}/ui/webconsole.html?vmId={1}&vmName={2}&serverGuid={3}&
+        locale=en_US&host={0}&sessionTicket={4}&thumbprint={5}
+        """.format(const.INF_VCENTER_SERVER,
+                   vm_moid,
+                   vm_name,
+                   self._server_guid,
+                   self._session_manager.AcquireCloneTicket(),
+                   self._thumbprint)
+        return textwrap.dedent(url).replace('\n', '')
+
+
+def make_info(moid, props, network_names, username, console_url):
+    """Build the same dictionary ``virtual_machine.get_info`` returns, from collected properties
+
+    :Returns: Dictionary
+
+    :param moid: The managed object id of the VM
+    :type moid: String
+
+    :param props: The collected properties of the VM
+    :type props: Dictionary
+
+    :param network_names: A mapping of network moid to network name
+    :type network_names: Dictionary
+
+    :param username: The name of the user who owns the VM
+    :type username: String
+
+    :param console_url: The HTML5 console URL for the VM
+    :type console_url: String
+    """
+    info = {}
+    info['state'] = props.get('runtime.powerState')
+    info['console'] = console_url
+    info['ips'] = parse_ips(props.get('guest.net'))
+    info['networks'] = parse_networks(props.get('network'), network_names, username)
+    info['moid'] = moid
+    info['meta'] = parse_meta(props.get('config.annotation'))
+    return info
+
+
+def get_esxi_vms(vcenter, folder, username):
+    """Obtain info about every ESXi instance in a user's folder
+
+    :Returns: Dictionary - VM name to the same info ``virtual_machine.get_info`` returns
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The user's folder
+    :type folder: vim.Folder
+
+    :param username: The name of the user who owns the folder
+    :type username: String
+    """
+    vms, network_names = get_vm_records(vcenter, folder)
+    return esxi_info(vcenter, vms, network_names, username)
+
+
+def esxi_info(vcenter, vms, network_names, username):
+    """Convert the collected properties of a user's VMs into info about their ESXi instances
+
+    :Returns: Dictionary - VM name to the same info ``virtual_machine.get_info`` returns
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param vms: A mapping of VM moid to (vim.VirtualMachine, properties)
+    :type vms: Dictionary
+
+    :param network_names: A mapping of network moid to network name
+    :type network_names: Dictionary
+
+    :param username: The name of the user who owns the VMs
+    :type username: String
+    """
+    consoles = ConsoleUrls(vcenter)
+    esxi_vms = {}
+    for moid, (_, props) in vms.items():
+        if parse_meta(props.get('config.annotation')).get('component') != 'ESXi':
+            continue
+        name = props.get('name')
+        INDEX.remember(username, name, moid)
+        console_url = consoles.make(moid, name)
+        esxi_vms[name] = make_info(moid, props, network_names, username, console_url)
+    return esxi_vms
+
+
+class VMIndex(object):
+    """Finds a user's ESXi instance by name without scanning their whole folder.
+
+    The index remembers the managed object id of every (username, machine_name)
+    it has seen, and the id of every user's folder. A remembered VM is verified
+    with a single property lookup (name, parent folder and meta data), so stale
+    entries are never returned. On a miss, vCenter's SearchIndex finds the VM by
+    name. Either way, a lookup costs a constant number of calls to vCenter no
+    matter how many VMs are in the folder.
+
+    :param max_size: The most VMs (and user folders) to remember
+    :type max_size: Integer
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._vms = OrderedDict()
+        self._folders = OrderedDict()
+        self._top_folder = None
+
+    def _get(self, bucket, key):
+        with self._lock:
+            value = bucket.get(key, None)
+            if value is not None:
+                bucket.move_to_end(key)
+            return value
+
+    def _put(self, bucket, key, value):
+        with self._lock:
+            bucket[key] = value
+            bucket.move_to_end(key)
+            while len(bucket) > self._max_size:
+                bucket.popitem(last=False)
+
+    def remember(self, username, machine_name, moid):
+        """Record where a user's ESXi instance is
+
+        :Returns: None
+
+        :param username: The name of the user who owns the VM
+        :type username: String
+
+        :param machine_name: The name of the VM
+        :type machine_name: String
+
+        :param moid: The managed object id of the VM
+        :type moid: String
+        """
+        self._put(self._vms, (username, machine_name), moid)
+
+    def forget(self, username, machine_name):
+        """Drop a VM from the index, like after it's been destroyed
+
+        :Returns: None
+
+        :param username: The name of the user who owned the VM
+        :type username: String
+
+        :param machine_name: The name of the VM
+        :type machine_name: String
+        """
+        with self._lock:
+            self._vms.pop((username, machine_name), None)
+
+    def folder(self, vcenter, username):
+        """Obtain a user's folder
+
+        :Returns: vim.Folder
+
+        :Raises: ValueError if the user has no folder
+
+        :param vcenter: An established connection to vCenter
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param username: The name of the user who owns the folder
+        :type username: String
+        """
+        stub = vcenter._conn._stub
+        moid = self._get(self._folders, username)
+        if moid is not None:
+            return vim.Folder(moid, stub)
+        if self._top_folder is None:
+            self._top_folder = vcenter.get_vm_folder(path=const.INF_VCENTER_TOP_LVL_DIR)._moId
+        found = vcenter.content.searchIndex.FindChild(entity=vim.Folder(self._top_folder, stub), name=username)
+        if not isinstance(found, vim.Folder):
+            # not a direct child of the top level dir; fall back to the slow, recursive search
+            found = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+        self._put(self._folders, username, found._moId)
+        return found
+
+    def find_esxi(self, vcenter, username, machine_name):
+        """Obtain a user's ESXi instance by name
+
+        :Returns: vim.VirtualMachine
+
+        :Raises: ValueError if the user owns no ESXi instance by that name
+
+        :param vcenter: An established connection to vCenter
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param username: The name of the user who owns the VM
+        :type username: String
+
+        :param machine_name: The name of the VM
+        :type machine_name: String
+        """
+        folder = self.folder(vcenter, username)
+        moid = self._get(self._vms, (username, machine_name))
+        if moid is not None:
+            the_vm = vim.VirtualMachine(moid, vcenter._conn._stub)
+            if _is_esxi_in(vcenter, the_vm, machine_name, folder):
+                return the_vm
+            self.forget(username, machine_name)
+        try:
+            the_vm = vcenter.content.searchIndex.FindChild(entity=folder, name=machine_name)
+        except vmodl.fault.ManagedObjectNotFound:
+            # the user's folder was deleted, and maybe recreated
+            with self._lock:
+                self._folders.pop(username, None)
+            folder = self.folder(vcenter, username)
+            the_vm = vcenter.content.searchIndex.FindChild(entity=folder, name=machine_name)
+        if isinstance(the_vm, vim.VirtualMachine) and _is_esxi_in(vcenter, the_vm, machine_name, folder):
+            self.remember(username, machine_name, the_vm._moId)
+            return the_vm
+        raise ValueError('No {} named {} found'.format('esxi', machine_name))
+
+
+def _is_esxi_in(vcenter, the_vm, machine_name, folder):
+    """Check, with one call to vCenter, that a VM is an ESXi instance with the
+    expected name, and that it lives in the expected folder.
+
+    :Returns: Boolean
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The VM to check
+    :type the_vm: vim.VirtualMachine
+
+    :param machine_name: The name the VM should have
+    :type machine_name: String
+
+    :param folder: The folder the VM should be in
+    :type folder: vim.Folder
+    """
+    object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=the_vm, skip=False)
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                               pathSet=['name', 'parent', 'config.annotation'])
+    try:
+        found = retrieve(vcenter, [object_spec], [property_spec])
+    except vmodl.fault.ManagedObjectNotFound:
+        return False
+    if not found:
+        return False
+    props = to_dict(found[0])
+    parent = props.get('parent', None)
+    if props.get('name') != machine_name:
+        return False
+    elif parent is None or parent._moId != folder._moId:
+        return False
+    return parse_meta(props.get('config.annotation')).get('component') == 'ESXi'
+
+
+INDEX = VMIndex(max_size=const.VLAB_ESXI_INDEX_SIZE)
@@ -0,0 +1,392 @@
+# -*- coding: UTF-8 -*-
+"""
+Fill in the IPs of new ESXi instances once they boot.
+
+A nested ESXi host takes minutes to boot and report an IP through VMware Tools.
+When ``VLAB_ESXI_WAIT_FOR_IP`` is false, a create doesn't spend that time
+holding a worker slot; it returns once the VM is powered on, with its IP marked
+pending. The ``IPWatcher`` in this module then adds a PropertyCollector filter
+on ``guest.net`` for each pending VM, and a single background thread consumes
+the changes with ``WaitForUpdatesEx``. When a VM reports an IP, its entry in the
+read-model is updated, which also tells the user over their event stream.
+
+Each pending VM is also saved to a file under ``VLAB_ESXI_STATE_DIR``, locked by
+the process watching it. If that process stops, the lock goes with it, and the
+next watcher to start picks the VM up; otherwise it would be pending forever.
+"""
+import os
+import time
+import fcntl
+import tempfile
+import threading
+
+import ujson
+from pyVmomi import vim, vmodl
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const, read_model
+from vlab_esxi_api.lib.worker import inventory
+from vlab_esxi_api.lib.worker.session import new_vcenter
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+PENDING_KEY = 'ip_pending'
+
+
+class _Pending(object):
+    """One new ESXi instance that has no IP yet"""
+    def __init__(self, username, machine_name, info, deadline, stale_ips=()):
+        self.username = username
+        self.machine_name = machine_name
+        self.info = info
+        self.deadline = deadline
+        # IPs the VM had before it was created, i.e. on the standby network
+        self.stale_ips = set(stale_ips)
+        # the saved copy of this record, locked while this process watches it
+        self.saved = None
+        # True once a filter is being, or has been, created for the VM
+        self.watched = False
+        self.filter = None
+
+
+class IPWatcher(object):
+    """Watches the guest NICs of new VMs on behalf of every thread in the process.
+
+    The watcher has its own vCenter session because ``WaitForUpdatesEx`` blocks.
+    If the stream breaks, the VMs being watched are kept, and watched again once
+    it reconnects. A VM that has no IP after ``timeout`` seconds stops being
+    pending, and is left with no IPs.
+
+    :param factory: A callable that returns a new, logged in vCenter object
+    :type factory: Function
+
+    :param timeout: How many seconds a new VM has to report an IP
+    :type timeout: Integer
+
+    :param wait_seconds: How long a single ``WaitForUpdatesEx`` call blocks
+    :type wait_seconds: Integer
+
+    :param retry_seconds: How long to wait before reconnecting a broken stream
+    :type retry_seconds: Integer
+    """
+    def __init__(self, factory, timeout, wait_seconds, retry_seconds):
+        self._factory = factory
+        self._timeout = timeout
+        self._wait_seconds = wait_seconds
+        self._retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._vcenter = None
+        self._collector = None
+        self._pending = {}
+        self._stale = {}
+
+    def start(self):
+        """Start consuming guest NIC updates, if it's not already running in this process
+
+        :Returns: None
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._pending = {}
+                self._stale = {}
+                for record in _resume():
+                    self._pending[record.info['moid']] = record
+            self._pid = os.getpid()
+            self._collector = None
+            self._thread = threading.Thread(target=self._run, name='esxi-ip-watcher', daemon=True)
+            self._thread.start()
+
+    def watch(self, username, machine_name, info):
+        """Fill in the IPs of a new ESXi instance once it has some
+
+        :Returns: None
+
+        :param username: The name of the user who owns the ESXi instance
+        :type username: String
+
+        :param machine_name: The name of the ESXi instance
+        :type machine_name: String
+
+        :param info: The info returned by the create, with the IP marked pending
+        :type info: Dictionary
+        """
+        self.start()
+        with self._lock:
+            stale_ips = self._stale.pop(info['moid'], ())
+        record = _Pending(username, machine_name, info, time.time() + self._timeout, stale_ips)
+        _save(record)
+        with self._lock:
+            self._pending[info['moid']] = record
+        self._add_filter(record)
+
+    def resume(self):
+        """Watch the VMs a watcher that stopped left pending, if there are any
+
+        :Returns: None
+        """
+        try:
+            names = os.listdir(_directory())
+        except OSError:
+            return
+        if any(x.endswith('.json') for x in names):
+            self.start()
+
+    def ignore(self, moid, ips):
+        """Have the next ``watch`` of a VM skip IPs it no longer has, but the guest
+        might still report for a while
+
+        :Returns: None
+
+        :param moid: The managed object id of the VM
+        :type moid: String
+
+        :param ips: The IPs to skip
+        :type ips: List
+        """
+        with self._lock:
+            self._stale[moid] = set(ips)
+
+    def pending(self):
+        """The number of VMs that have no IP yet
+
+        :Returns: Integer
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        """Consume guest NIC updates forever, reconnecting when the stream breaks"""
+        while True:
+            try:
+                vcenter = self._factory()
+                try:
+                    self._watch(vcenter)
+                finally:
+                    vcenter.close()
+            except Exception as doh:
+                logger.error('IP watcher update stream broke: {}'.format(doh))
+            self._break()
+            self._expire()
+            time.sleep(self._retry_seconds)
+
+    def _watch(self, vcenter):
+        """Watch every pending VM, then block on guest NIC updates"""
+        collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+        try:
+            with self._lock:
+                self._vcenter = vcenter
+                self._collector = collector
+                records = list(self._pending.values())
+            for record in records:
+                self._add_filter(record)
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self._wait_seconds)
+            version = ''
+            while True:
+                update_set = collector.WaitForUpdatesEx(version, options)
+                if update_set is not None:
+                    self.apply(update_set)
+                    version = update_set.version
+                self._expire()
+        finally:
+            with self._lock:
+                self._collector = None
+            collector.DestroyPropertyCollector()
+
+    def _break(self):
+        """Forget the filters of the broken stream; they went with its collector"""
+        with self._lock:
+            self._collector = None
+            for record in self._pending.values():
+                record.watched = False
+                record.filter = None
+
+    def _add_filter(self, record):
+        """Start receiving guest NIC updates for a pending VM, if the stream is up"""
+        with self._lock:
+            vcenter, collector = self._vcenter, self._collector
+            if collector is None or record.watched:
+                return
+            record.watched = True
+        moid = record.info['moid']
+        # the same VM, as seen by the watcher's session
+        the_vm = vim.VirtualMachine(moid, vcenter._conn._stub)
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=the_vm)
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=['guest.net'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[object_spec], propSet=[property_spec])
+        try:
+            the_filter = collector.CreateFilter(filter_spec, partialUpdates=False)
+        except vmodl.MethodFault as doh:
+            logger.warning('Unable to watch for the IP of {}: {}'.format(moid, doh))
+            with self._lock:
+                self._pending.pop(moid, None)
+            _forget(record)
+            return
+        with self._lock:
+            if self._pending.get(moid, None) is record:
+                record.filter = the_filter
+                return
+        # the VM got an IP (or was deleted) as soon as the filter was made
+        _destroy(the_filter)
+
+    def apply(self, update_set):
+        """Fill in the IPs of every pending VM that now has some
+
+        :Returns: None
+
+        :param update_set: The changes returned by ``WaitForUpdatesEx``
+        :type update_set: vmodl.query.PropertyCollector.UpdateSet
+        """
+        done = []
+        with self._lock:
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    moid = object_update.obj._moId
+                    record = self._pending.get(moid, None)
+                    if record is None:
+                        continue
+                    if object_update.kind == 'leave':
+                        # the VM was deleted
+                        done.append((self._pending.pop(moid), None))
+                        continue
+                    for change in object_update.changeSet:
+                        if change.name != 'guest.net':
+                            continue
+                        ips = [x for x in inventory.parse_ips(change.val) if x not in record.stale_ips]
+                        if ips:
+                            done.append((self._pending.pop(moid), ips))
+                            break
+        for record, ips in done:
+            self._finish(record, ips)
+
+    def _expire(self):
+        """Stop waiting on VMs that took too long to report an IP"""
+        now = time.time()
+        with self._lock:
+            expired = [moid for moid, record in self._pending.items() if record.deadline <= now]
+            records = [self._pending.pop(moid) for moid in expired]
+        for record in records:
+            logger.warning('No IP for {} after {} seconds'.format(record.machine_name, self._timeout))
+            self._finish(record, [])
+
+    def _finish(self, record, ips):
+        """Stop watching a VM, and record the IPs it reported
+
+        :param record: The VM that's no longer pending
+        :type record: _Pending
+
+        :param ips: The IPs of the VM, or None if it was deleted
+        :type ips: List
+        """
+        if record.filter is not None:
+            _destroy(record.filter)
+        _forget(record)
+        if ips is None:
+            return
+        info = dict(record.info)
+        info.pop(PENDING_KEY, None)
+        info['ips'] = ips
+        read_model.update(record.username, record.machine_name, info)
+
+
+def _directory():
+    """Where the pending VMs are saved"""
+    return os.path.join(const.VLAB_ESXI_STATE_DIR, 'ipwatch')
+
+
+def _save(record):
+    """Save a pending VM, and hold the lock on it for as long as this process
+    watches it. Errors are logged; the VM is still watched, just not saved.
+    """
+    directory = _directory()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_location = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        the_file = os.fdopen(fd, 'w')
+        try:
+            fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            ujson.dump({'username': record.username,
+                        'machine_name': record.machine_name,
+                        'info': record.info,
+                        'deadline': record.deadline,
+                        'stale_ips': sorted(record.stale_ips)}, the_file)
+            the_file.flush()
+            # the lock is on the file itself, so it moves with the rename
+            os.replace(tmp_location, os.path.join(directory, '{}.json'.format(record.info['moid'])))
+        except Exception:
+            the_file.close()
+            os.unlink(tmp_location)
+            raise
+    except OSError as doh:
+        logger.warning('Unable to save pending IP of {}: {}'.format(record.machine_name, doh))
+        return
+    record.saved = the_file
+
+
+def _forget(record):
+    """Delete the saved copy of a VM that's no longer pending"""
+    if record.saved is None:
+        return
+    try:
+        os.unlink(os.path.join(_directory(), '{}.json'.format(record.info['moid'])))
+    except OSError as doh:
+        logger.warning('Unable to forget pending IP of {}: {}'.format(record.machine_name, doh))
+    record.saved.close()
+    record.saved = None
+
+
+def _resume():
+    """Load every saved VM that no running process is watching
+
+    :Returns: List of _Pending
+    """
+    directory = _directory()
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    records = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            the_file = open(os.path.join(directory, name))
+        except OSError:
+            continue
+        try:
+            fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.fstat(the_file.fileno()).st_nlink == 0:
+                # forgotten while we waited to open it
+                the_file.close()
+                continue
+            saved = ujson.load(the_file)
+            record = _Pending(saved['username'], saved['machine_name'], saved['info'],
+                              saved['deadline'], saved['stale_ips'])
+        except BlockingIOError:
+            # another process is watching it
+            the_file.close()
+            continue
+        except (OSError, ValueError, KeyError) as doh:
+            logger.warning('Unable to load pending IP {}: {}'.format(name, doh))
+            the_file.close()
+            continue
+        record.saved = the_file
+        records.append(record)
+    return records
+
+
+def _destroy(the_filter):
+    """Remove a filter, ignoring errors because its collector might already be gone"""
+    try:
+        the_filter.Destroy()
+    except Exception as doh:
+        logger.debug('Unable to destroy IP filter: {}'.format(doh))
+
+
+WATCHER = IPWatcher(factory=new_vcenter,
+                    timeout=const.VLAB_ESXI_IP_TIMEOUT,
+                    wait_seconds=const.VLAB_ESXI_TASK_WAIT_SECONDS,
+                    retry_seconds=const.VLAB_ESXI_CACHE_RETRY_SECONDS)
@@ -0,0 +1,239 @@
+# -*- coding: UTF-8 -*-
+"""
+Open an OVA from the images directory without rescanning the archive.
+
+``IndexedOva`` behaves like ``vlab_inf_common.vmware.Ova`` but gets the OVF
+descriptor and the location of each disk from ``lib.images``; uploading a disk
+seeks straight to its bytes in the archive. The disks of an OVA are uploaded
+concurrently, each streamed from its own file handle, while a background thread
+keeps the HttpNfcLease alive and reports how many bytes have been sent.
+"""
+import io
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen, Request
+
+from pyVmomi import vmodl
+from vlab_api_common import get_logger
+from vlab_inf_common.vmware import Ova
+from vlab_inf_common.ssl_context import get_context
+from vlab_inf_common.vmware.ova import FileHandle
+
+from vlab_esxi_api.lib import const, images
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+
+
+class TarMember(io.RawIOBase):
+    """A read-only, seekable window onto one file stored in a tar archive
+
+    :param handle: The open OVA file
+    :type handle: vlab_inf_common.vmware.ova.FileHandle
+
+    :param offset: Where the file's data starts in the archive
+    :type offset: Integer
+
+    :param size: How many bytes the file is
+    :type size: Integer
+
+    :param on_read: Called with the number of bytes every time the file is read
+    :type on_read: Function
+    """
+    def __init__(self, handle, offset, size, on_read=None):
+        super().__init__()
+        self._handle = handle
+        self._offset = offset
+        self.size = size
+        self._position = 0
+        self._on_read = on_read
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self._position = offset
+        elif whence == 1:
+            self._position += offset
+        elif whence == 2:
+            self._position = self.size + offset
+        self._position = min(max(self._position, 0), self.size)
+        return self._position
+
+    def read(self, amount=-1):
+        remaining = self.size - self._position
+        if amount is None or amount < 0 or amount > remaining:
+            amount = remaining
+        if amount == 0:
+            return b''
+        self._handle.seek(self._offset + self._position)
+        data = self._handle.read(amount)
+        self._position += len(data)
+        if self._on_read is not None:
+            self._on_read(len(data))
+        return data
+
+
+class IndexedOva(Ova):
+    """An OVA whose contents come from the image index instead of a tar scan
+
+    :param ovafile: The path to an OVA in the images directory
+    :type ovafile: String
+
+    :param entry: The output of ``images.describe`` for the OVA
+    :type entry: Dictionary
+
+    :param progress: Called with (bytes uploaded, total bytes) while deploying
+    :type progress: Function
+    """
+    def __init__(self, ovafile, entry, progress=None):
+        # Not calling Ova.__init__ on purpose; it scans the whole archive
+        self._spec = None
+        self._lease = None
+        self._host = None
+        self._prog = None
+        self._tar = None
+        self._location = ovafile
+        self._handle = FileHandle(ovafile)
+        self._ovf = entry['ovf']
+        self._networks = entry['networks']
+        self._entries = {x['name']: x for x in entry['disks']}
+        self._disks = {x['name']: TarMember(self._handle, x['offset'], x['size']) for x in entry['disks']}
+        self._progress = progress
+        self._uploaded = 0
+        self._total = 0
+        self._counter_lock = threading.Lock()
+
+    @property
+    def networks(self):
+        """Return a list of network names that a VM has configured"""
+        return list(self._networks)
+
+    def deploy(self, deploy_spec, lease, host):
+        """Create a new VM based off the OVA, uploading the disks in parallel
+
+        :param deploy_spec: **Required** The OVA deployment spec
+        :type deploy_spec: vim.OvfManager.CreateImportSpecResult
+
+        :param lease: **Required** The vSphere lease that enables VM/vApp creation
+        :type lease: vim.HttpNfcLease
+
+        :param host: **Required** The FQDN for vSphere
+        :type host: String
+        """
+        self._spec = deploy_spec
+        self._lease = lease
+        self._host = host
+        file_items = [x for x in deploy_spec.fileItem if x.path in self._entries]
+        self._uploaded = 0
+        self._total = sum(self._entries[x.path]['size'] for x in file_items)
+        done = threading.Event()
+        keep_alive = threading.Thread(target=self._keep_alive, args=(lease, done), daemon=True)
+        keep_alive.start()
+        try:
+            workers = max(1, min(const.VLAB_ESXI_UPLOAD_WORKERS, len(file_items)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # list() so the first failed upload is raised here
+                list(executor.map(self._upload_disk, file_items))
+            done.set()
+            keep_alive.join()
+            self._report()
+            lease.Progress(100)
+            lease.Complete()
+        except vmodl.MethodFault as doh:
+            lease.Abort(doh)
+            raise
+        except Exception as doh:
+            lease.Abort(vmodl.fault.SystemError(reason=str(doh)))
+            raise
+        finally:
+            done.set()
+            self._reset()
+
+    def _upload_disk(self, file_item):
+        """Stream one disk straight out of the archive to its lease device URL
+
+        :param file_item: The disk to upload
+        :type file_item: vim.OvfManager.FileItem
+        """
+        disk = self._entries[file_item.path]
+        url = self._get_device_url(file_item)
+        # Each upload gets its own handle so concurrent seeks don't collide
+        with open(self._location, 'rb') as handle:
+            vmdk = TarMember(handle, disk['offset'], disk['size'], on_read=self._count)
+            headers = {'Content-length': vmdk.size,
+                       'Content-Type': 'application/x-vnd.vmware-streamVmdk'}
+            req = Request(url, method='POST', data=vmdk, headers=headers)
+            urlopen(req, context=get_context()).close()
+
+    def _count(self, amount):
+        """Track how many bytes have been uploaded across all disks"""
+        with self._counter_lock:
+            self._uploaded += amount
+
+    def _percent(self):
+        """How much of the upload is done, from 0 to 100"""
+        with self._counter_lock:
+            if not self._total:
+                return 100
+            return min(100, int(100 * self._uploaded / self._total))
+
+    def _report(self):
+        """Pass the upload progress to whoever asked for it"""
+        if self._progress is None:
+            return
+        with self._counter_lock:
+            uploaded, total = self._uploaded, self._total
+        try:
+            self._progress(uploaded, total)
+        except Exception as doh:
+            logger.warning('Unable to report upload progress: {}'.format(doh))
+
+    def _keep_alive(self, lease, done):
+        """Periodically tell vCenter the upload is progressing, so the lease
+        does not time out, and report progress"""
+        while not done.wait(const.VLAB_ESXI_LEASE_KEEPALIVE):
+            self._prog = self._percent()
+            try:
+                lease.Progress(self._prog)
+            except vmodl.fault.ManagedObjectNotFound:
+                # race between the upload completing, and the keep alive
+                return
+            except Exception as doh:
+                logger.warning('Unable to update lease progress: {}'.format(doh))
+            self._report()
+
+    def _reset(self):
+        """Reset after deployment"""
+        super()._reset()
+        self._uploaded = 0
+        self._total = 0
+
+
+def open_ova(location, progress=None):
+    """Open an OVA, using the image index when possible
+
+    :Returns: vlab_inf_common.vmware.Ova
+
+    :param location: The path to the OVA
+    :type location: String
+
+    :param progress: Called with (bytes uploaded, total bytes) while deploying.
+                     Only supported for OVAs that can be indexed.
+    :type progress: Function
+    """
+    try:
+        entry = images.describe(location)
+    except (OSError, ValueError, tarfile.TarError) as doh:
+        # i.e. tarfile.ReadError; let Ova raise a meaningful error
+        logger.warning('Unable to index {}: {}'.format(location, doh))
+        return Ova(location)
+    return IndexedOva(location, entry, progress=progress)
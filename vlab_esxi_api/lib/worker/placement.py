@@ -0,0 +1,276 @@
+# -*- coding: UTF-8 -*-
+"""
+Pick the datastore and resource pool for a new VM, by how loaded each one is.
+
+Sending every deploy to the same datastore makes it the I/O hotspot, while the
+rest of the storage sits idle. When ``VLAB_ESXI_DATASTORES`` and
+``VLAB_ESXI_RESOURCE_POOLS`` list more than one, each deploy goes to the one
+with the most room to spare: free space and latency for datastores, memory
+headroom for resource pools, and how many deploys this process already has
+going to each.
+
+Free space, latency and headroom are refreshed by a background thread every
+``VLAB_ESXI_PLACEMENT_REFRESH`` seconds, so picking a spot never waits on
+vCenter. Until the first refresh, deploys are only spread by how many are in
+flight.
+"""
+import os
+import time
+import random
+import threading
+from contextlib import contextmanager
+from collections import namedtuple
+
+from pyVmomi import vim
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const
+from vlab_esxi_api.lib.worker.session import vcenter_session
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+# A datastore with this much latency, in milliseconds, counts as half as good
+LATENCY_SCALE = 20.0
+LATENCY_COUNTERS = ('totalReadLatency', 'totalWriteLatency')
+DatastoreStats = namedtuple('DatastoreStats', ['free', 'capacity', 'latency', 'hosts'])
+
+
+def url_uuid(url):
+    """Obtain the id vCenter uses for a datastore in performance counters,
+    i.e. ``ds:///vmfs/volumes/5c4f-11e9/`` -> ``5c4f-11e9``
+
+    :Returns: String
+
+    :param url: The URL of the datastore
+    :type url: String
+    """
+    return url.rstrip('/').split('/')[-1]
+
+
+def datastore_latency(vcenter, hosts, datastores):
+    """Obtain the worst recent read or write latency of every datastore, as seen
+    by any of the hosts
+
+    :Returns: Dictionary - datastore moid to milliseconds
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param hosts: The hosts to ask about
+    :type hosts: List of vim.HostSystem
+
+    :param datastores: Datastore moid to the datastore summary
+    :type datastores: Dictionary
+    """
+    perf = vcenter.content.perfManager
+    counter_ids = [x.key for x in perf.perfCounter
+                   if x.groupInfo.key == 'datastore' and x.nameInfo.key in LATENCY_COUNTERS
+                   and x.rollupType == 'average']
+    if not (counter_ids and hosts):
+        return {}
+    by_uuid = {url_uuid(summary.url): moid for moid, summary in datastores.items()}
+    metric_ids = [vim.PerformanceManager.MetricId(counterId=x, instance='*') for x in counter_ids]
+    # the latest real-time (20 second) sample
+    specs = [vim.PerformanceManager.QuerySpec(entity=x, metricId=metric_ids, intervalId=20, maxSample=1)
+             for x in hosts]
+    latency = {}
+    for entity_metric in perf.QueryPerf(querySpec=specs):
+        for series in entity_metric.value:
+            moid = by_uuid.get(series.id.instance, None)
+            if moid is not None and series.value:
+                latency[moid] = max(latency.get(moid, 0), series.value[-1])
+    return latency
+
+
+def pool_headroom(resource_pool):
+    """Obtain how much of a resource pool's memory is unused, from 0 to 1
+
+    :Returns: Float
+
+    :param resource_pool: The resource pool
+    :type resource_pool: vim.ResourcePool
+    """
+    memory = resource_pool.runtime.memory
+    if not memory.maxUsage:
+        return 1.0
+    return max(0.0, 1.0 - memory.overallUsage / memory.maxUsage)
+
+
+def _names(setting, default):
+    """Split a comma separated setting, or use the default name"""
+    return [x.strip() for x in setting.split(',') if x.strip()] or [default]
+
+
+def candidate_datastores(vcenter):
+    """Obtain every datastore new VMs can go on; datastore clusters are expanded
+
+    :Returns: List of vim.Datastore
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    datastores = []
+    for name in _names(const.VLAB_ESXI_DATASTORES, const.INF_VCENTER_DATASTORE):
+        datastore = vcenter.datastores[name]
+        if isinstance(datastore, vim.StoragePod):
+            datastores.extend(datastore.childEntity)
+        else:
+            datastores.append(datastore)
+    return datastores
+
+
+def candidate_pools(vcenter):
+    """Obtain every resource pool new VMs can go in
+
+    :Returns: List of vim.ResourcePool
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return [vcenter.resource_pools[x] for x in _names(const.VLAB_ESXI_RESOURCE_POOLS, const.INF_VCENTER_RESORUCE_POOL)]
+
+
+def active_hosts(vcenter):
+    """Obtain every host that's not in maintenance mode
+
+    :Returns: List of vim.HostSystem
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    return [x for x in vcenter.host_systems.values() if not x.runtime.inMaintenanceMode]
+
+
+class PlacementEngine(object):
+    """Keeps load stats for datastores and resource pools, and picks the least
+    loaded ones for new VMs.
+
+    :param factory: Returns a context manager that lends out a vCenter session
+    :type factory: Function
+
+    :param refresh_seconds: How often to refresh the stats
+    :type refresh_seconds: Integer
+
+    :param min_free: The fewest free bytes a datastore needs to be picked ahead of a full one
+    :type min_free: Integer
+    """
+    def __init__(self, factory, refresh_seconds, min_free):
+        self._factory = factory
+        self._refresh_seconds = refresh_seconds
+        self._min_free = min_free
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._datastores = {}
+        self._pools = {}
+        self._in_flight = {}
+
+    def start(self):
+        """Start refreshing the stats, if it's not already running in this process
+
+        :Returns: None
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._in_flight = {}
+            self._thread = threading.Thread(target=self._run, name='esxi-placement', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Refresh the stats forever"""
+        while True:
+            try:
+                self.refresh()
+            except Exception as doh:
+                logger.error('Unable to refresh placement stats: {}'.format(doh))
+            time.sleep(self._refresh_seconds)
+
+    def refresh(self):
+        """Look up the free space, latency and headroom of every datastore and resource pool
+
+        :Returns: None
+        """
+        with self._factory() as vcenter:
+            summaries = {}
+            hosts = {}
+            for datastore in candidate_datastores(vcenter):
+                summaries[datastore._moId] = datastore.summary
+                hosts[datastore._moId] = [x.key._moId for x in datastore.host if x.mountInfo.accessible]
+            try:
+                latency = datastore_latency(vcenter, active_hosts(vcenter), summaries)
+            except Exception as doh:
+                # Stale or missing latency is better than no free space stats at all
+                logger.warning('Unable to read datastore latency: {}'.format(doh))
+                latency = {}
+            stats = {}
+            for moid, summary in summaries.items():
+                if not summary.accessible or summary.maintenanceMode not in (None, 'normal'):
+                    continue
+                stats[moid] = DatastoreStats(summary.freeSpace, summary.capacity, latency.get(moid, 0), hosts[moid])
+            pools = {x._moId: pool_headroom(x) for x in candidate_pools(vcenter)}
+        with self._lock:
+            self._datastores = stats
+            self._pools = pools
+
+    def _datastore_score(self, datastore):
+        """Rank a datastore; higher is better. The caller must hold the lock"""
+        in_flight = self._in_flight.get(datastore._moId, 0)
+        stats = self._datastores.get(datastore._moId, None)
+        if stats is None:
+            # not measured yet; only spread by in-flight deploys
+            return 1.0 / (1 + in_flight)
+        if stats.free < self._min_free or not stats.capacity:
+            return -1.0 / (1 + in_flight)
+        return (stats.free / stats.capacity) / ((1 + in_flight) * (1 + stats.latency / LATENCY_SCALE))
+
+    def _pool_score(self, resource_pool):
+        """Rank a resource pool; higher is better. The caller must hold the lock"""
+        in_flight = self._in_flight.get(resource_pool._moId, 0)
+        return self._pools.get(resource_pool._moId, 1.0) / (1 + in_flight)
+
+    def choose(self, placement):
+        """Pick where a new VM goes
+
+        :Returns: Tuple - (vim.ResourcePool, vim.Datastore, vim.HostSystem)
+
+        :param placement: Everywhere the VM can go
+        :type placement: deploy.Placement
+        """
+        self.start()
+        with self._lock:
+            # random() breaks ties, so equally loaded spots share the work
+            datastore = max(placement.datastores, key=lambda x: (self._datastore_score(x), random.random()))
+            resource_pool = max(placement.resource_pools, key=lambda x: (self._pool_score(x), random.random()))
+            stats = self._datastores.get(datastore._moId, None)
+        hosts = placement.hosts
+        if stats is not None:
+            # only hosts that mount the datastore can write to it
+            hosts = [x for x in placement.hosts if x._moId in stats.hosts] or placement.hosts
+        return resource_pool, datastore, random.choice(hosts)
+
+    @contextmanager
+    def deploying(self, *places):
+        """Count a deploy as in flight to a datastore and resource pool until
+        the ``with`` block exits
+
+        :Returns: None
+
+        :param places: The datastore, resource pool, etc. the VM is going to
+        :type places: vim.ManagedEntity
+        """
+        with self._lock:
+            for place in places:
+                self._in_flight[place._moId] = self._in_flight.get(place._moId, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for place in places:
+                    self._in_flight[place._moId] = max(0, self._in_flight.get(place._moId, 0) - 1)
+
+
+PLACER = PlacementEngine(factory=vcenter_session,
+                         refresh_seconds=const.VLAB_ESXI_PLACEMENT_REFRESH,
+                         min_free=const.VLAB_ESXI_PLACEMENT_MIN_FREE_GB * 1024 ** 3)
@@ -0,0 +1,207 @@
+# -*- coding: UTF-8 -*-
+"""
+A per-process pool of logged in vCenter sessions.
+
+Logging into vCenter means a TLS handshake, authentication and session setup.
+Instead of paying that on every task, the worker keeps a few sessions alive and
+lends them out.
+"""
+import os
+import time
+import atexit
+import threading
+from http.client import HTTPException
+from contextlib import contextmanager
+
+from vlab_api_common import get_logger
+from vlab_inf_common.vmware import vCenter, vim
+
+from vlab_esxi_api.lib import const, metrics, tracing
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+# Errors that mean the session is no good, and should not go back into the pool
+BROKEN_SESSION_ERRORS = (vim.fault.NotAuthenticated, ConnectionError, TimeoutError, HTTPException)
+
+
+def new_vcenter():
+    """Log into vCenter with the configured credentials
+
+    :Returns: vlab_inf_common.vmware.vCenter
+    """
+    vcenter = vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                      password=const.INF_VCENTER_PASSWORD)
+    return tracing.instrument(metrics.instrument(vcenter))
+
+
+def is_alive(vcenter):
+    """Test if a vCenter session is still logged in
+
+    :Returns: Boolean
+
+    :param vcenter: The session to test
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    try:
+        return vcenter.content.sessionManager.currentSession is not None
+    except Exception:
+        return False
+
+
+def forget_networks(vcenter):
+    """Make a session look up its networks again the next time they're used.
+
+    ``vCenter.networks`` keeps what it finds in the private ``_net_cache``
+    attribute, and only looks again while that's empty; there's no public way to
+    clear it. This is the one place we rely on that, and ``test_session`` checks
+    the installed vlab-inf-common still works this way.
+
+    :Returns: None
+
+    :param vcenter: The session to reset
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    vcenter._net_cache = None
+
+
+def _close(vcenter):
+    """Logout of vCenter, ignoring any errors because the session might already be dead"""
+    try:
+        vcenter.close()
+    except Exception as doh:
+        logger.debug('Error closing vCenter session: {}'.format(doh))
+
+
+class SessionPool(object):
+    """Lends out logged in vCenter sessions, and keeps them alive between uses.
+
+    Idle sessions are health checked before being handed out, and a session that
+    has expired is transparently replaced with a new login. The pool is safe to
+    use from multiple threads, and resets itself if the process forks.
+
+    :param factory: A callable that returns a new, logged in vCenter object
+    :type factory: Function
+
+    :param size: The max number of sessions (idle and borrowed) the pool will have open
+    :type size: Integer
+
+    :param check_interval: How many seconds a session can sit idle before it's
+                           health checked when borrowed
+    :type check_interval: Integer
+
+    :param timeout: How many seconds to block waiting on a session when all of
+                    them are already borrowed
+    :type timeout: Integer
+    """
+    def __init__(self, factory, size, check_interval, timeout):
+        self._factory = factory
+        self._size = size
+        self._check_interval = check_interval
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """Forget about every session; used at init and after a fork"""
+        self._pid = os.getpid()
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(self._size)
+
+    def _check_pid(self):
+        """A forked child must not share the sockets of its parent process"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+
+    def acquire(self):
+        """Borrow a session. Prefer ``session()`` so it's always given back.
+
+        :Returns: vlab_inf_common.vmware.vCenter
+
+        :Raises: RuntimeError if no session is available within the timeout
+        """
+        self._check_pid()
+        if not self._slots.acquire(timeout=self._timeout):
+            error = 'No vCenter session available after {} seconds'.format(self._timeout)
+            raise RuntimeError(error)
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    vcenter, last_used = self._idle.pop()
+                if time.time() - last_used < self._check_interval or is_alive(vcenter):
+                    # The vCenter object caches networks, and users make new ones all the time
+                    forget_networks(vcenter)
+                    return vcenter
+                logger.info('Replacing expired vCenter session')
+                _close(vcenter)
+            return self._factory()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, vcenter, discard=False):
+        """Give a borrowed session back to the pool
+
+        :Returns: None
+
+        :param vcenter: The session that was borrowed
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param discard: Set to True to logout of the session instead of reusing it
+        :type discard: Boolean
+        """
+        if discard:
+            _close(vcenter)
+        else:
+            with self._lock:
+                self._idle.append((vcenter, time.time()))
+        self._slots.release()
+
+    @contextmanager
+    def session(self):
+        """Borrow a session for the duration of a ``with`` block
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        with metrics.phase('session'):
+            vcenter = self.acquire()
+        discard = False
+        try:
+            yield vcenter
+        except BROKEN_SESSION_ERRORS:
+            discard = True
+            raise
+        finally:
+            self.release(vcenter, discard=discard)
+
+    def close(self):
+        """Logout of every idle session
+
+        :Returns: None
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for vcenter, _ in idle:
+            _close(vcenter)
+
+
+POOL = SessionPool(factory=new_vcenter,
+                   size=const.VLAB_ESXI_SESSION_POOL_SIZE,
+                   check_interval=const.VLAB_ESXI_SESSION_CHECK_INTERVAL,
+                   timeout=const.VLAB_ESXI_SESSION_WAIT_TIMEOUT)
+atexit.register(POOL.close)
+
+
+def vcenter_session():
+    """Borrow a logged in vCenter session from this process's pool
+
+    Usage::
+
+        with vcenter_session() as vcenter:
+            vcenter.get_by_name(name='bob', vimtype=vim.Folder)
+
+    :Returns: contextlib.GeneratorContextManager
+    """
+    return POOL.session()
@@ -0,0 +1,348 @@
+# -*- coding: UTF-8 -*-
+"""
+A pool of already deployed, configured and booted ESXi VMs, per image/version.
+
+Even a linked clone has to be reconfigured, powered on and booted before the
+user can do anything with it. Pool members have already done all of that, so a
+create that claims one only has to rename it, move it into the user's folder and
+connect it to the user's network.
+
+A member is claimed by creating a folder named ``claim-<moid>`` next to it.
+vCenter refuses to create two folders with the same name in the same parent, so
+only one create can ever win a given member.
+"""
+import os
+import time
+import uuid
+import fcntl
+import os.path
+from contextlib import contextmanager
+
+from pyVmomi import vmodl
+from vlab_api_common import get_logger
+from vlab_inf_common.vmware import vim, virtual_machine
+
+from vlab_esxi_api.lib import const
+from vlab_esxi_api.lib.worker import deploy, inventory
+from vlab_esxi_api.lib.worker.ova import open_ova
+from vlab_esxi_api.lib.worker.session import vcenter_session
+from vlab_esxi_api.lib.worker.waiter import consume_task, power
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+COMPONENT = 'ESXi-standby'
+CLAIM_PREFIX = 'claim-'
+
+
+def pool_size(image):
+    """Obtain how many standby VMs to keep for an image/version of ESXi
+
+    Set with ``VLAB_ESXI_STANDBY_SIZES``, a comma separated list of ``<version>=<count>``.
+    The version ``*`` sets the default size. The pool is disabled by default.
+
+    :Returns: Integer
+
+    :param image: The image/version of ESXi
+    :type image: String
+    """
+    sizes = {}
+    for item in const.VLAB_ESXI_STANDBY_SIZES.split(','):
+        if '=' in item:
+            version, count = item.split('=', 1)
+            try:
+                sizes[version.strip()] = max(0, int(count))
+            except ValueError:
+                logger.error('Invalid standby pool size for {}: {}'.format(version, count))
+    return sizes.get(image, sizes.get('*', 0))
+
+
+def claim_name(moid):
+    """The name of the folder that marks a standby VM as taken
+
+    :Returns: String
+
+    :param moid: The managed object id of the standby VM
+    :type moid: String
+    """
+    return '{}{}'.format(CLAIM_PREFIX, moid)
+
+
+def get_members(vcenter, folder):
+    """Obtain every VM in the standby pool, and which of them are claimed
+
+    :Returns: Tuple - (List of (vim.VirtualMachine, meta data, power state), Set of claimed moids)
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The folder that holds the standby pool
+    :type folder: vim.Folder
+    """
+    property_specs = [vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                                 pathSet=['runtime.powerState', 'config.annotation']),
+                      vmodl.query.PropertyCollector.PropertySpec(type=vim.Folder, pathSet=['name'])]
+    members = []
+    claimed = set()
+    for item in inventory.retrieve(vcenter, [inventory.folder_spec(folder)], property_specs):
+        props = inventory.to_dict(item)
+        if isinstance(item.obj, vim.VirtualMachine):
+            meta = inventory.parse_meta(props.get('config.annotation', ''))
+            members.append((item.obj, meta, props.get('runtime.powerState', '')))
+        elif isinstance(item.obj, vim.Folder) and props.get('name', '').startswith(CLAIM_PREFIX):
+            claimed.add(props['name'][len(CLAIM_PREFIX):])
+    return members, claimed
+
+
+def claim(vcenter, image):
+    """Take a ready standby VM out of the pool
+
+    :Returns: Tuple - (vim.VirtualMachine, the claim folder), or None if the pool is empty
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ESXi
+    :type image: String
+    """
+    folder = deploy.ensure_folder(vcenter, const.VLAB_ESXI_STANDBY_DIR)
+    members, claimed = get_members(vcenter, folder)
+    for the_vm, meta, power_state in members:
+        if not _is_ready(meta, power_state, image) or the_vm._moId in claimed:
+            continue
+        try:
+            claim_folder = folder.CreateFolder(claim_name(the_vm._moId))
+        except vim.fault.DuplicateName:
+            # lost the race for this one; try the next
+            continue
+        return the_vm, claim_folder
+    return None
+
+
+def _is_ready(meta, power_state, image):
+    """Test if a pool member can be handed out"""
+    return meta.get('component') == COMPONENT and \
+           meta.get('version') == image and \
+           meta.get('configured') is True and \
+           power_state == vim.VirtualMachinePowerState.poweredOn
+
+
+def adopt(the_vm, claim_folder, folder, machine_name, network, logger, meta_data=None):
+    """Turn a claimed standby VM into a user's ESXi instance. If that fails, the
+    standby VM is destroyed so it's never handed out half renamed or moved.
+
+    The NIC is unplugged while it's moved to the user's network, then plugged
+    back in, so the guest sees the link drop and asks for a new IP.
+
+    :Returns: List - the IPs the VM had on the standby network, which it's giving up
+
+    :param the_vm: The claimed standby VM
+    :type the_vm: vim.VirtualMachine
+
+    :param claim_folder: The folder returned by ``claim``
+    :type claim_folder: vim.Folder
+
+    :param folder: The user's folder
+    :type folder: vim.Folder
+
+    :param machine_name: The name to give the new ESXi instance
+    :type machine_name: String
+
+    :param network: The network to connect the new ESXi instance to
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param meta_data: The vlab meta data of the new ESXi instance; set along with the network
+    :type meta_data: Dictionary
+    """
+    try:
+        logger.debug('Adopting standby VM {}'.format(the_vm._moId))
+        consume_task(the_vm.Rename_Task(machine_name))
+        consume_task(folder.MoveIntoFolder_Task([the_vm]))
+        stale_ips = inventory.parse_ips(the_vm.guest.net)
+        # already powered on, so nestedHVEnabled cannot be touched
+        spec = deploy.config_spec(meta_data, nested_hv=False)
+        spec.deviceChange = [deploy.nic_spec(the_vm, network, connected=False)]
+        consume_task(the_vm.ReconfigVM_Task(spec))
+        reconnect = vim.vm.ConfigSpec(deviceChange=[deploy.nic_spec(the_vm, network)])
+        consume_task(the_vm.ReconfigVM_Task(reconnect))
+        return stale_ips
+    except Exception:
+        _discard(the_vm)
+        raise
+    finally:
+        _discard(claim_folder)
+
+
+def _discard(entity):
+    """Best effort destroy of a VM or folder"""
+    try:
+        if isinstance(entity, vim.VirtualMachine):
+            power(entity, state='off')
+        consume_task(entity.Destroy_Task())
+    except Exception as doh:
+        logger.error('Unable to destroy {}: {}'.format(entity, doh))
+
+
+@contextmanager
+def _refilling(image):
+    """Only one refill of an image's pool at a time; yields False if one is already running"""
+    lock_file = os.path.join(const.VLAB_ESXI_STATE_DIR, 'standby', '{}.lock'.format(image))
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with open(lock_file, 'a') as the_file:
+        try:
+            fcntl.flock(the_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(the_file, fcntl.LOCK_UN)
+
+
+def refill(image, logger):
+    """Create standby VMs until the pool for an image is back at its target size
+
+    :Returns: Integer - the number of standby VMs created
+
+    :param image: The image/version of ESXi
+    :type image: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    target = pool_size(image)
+    if not target:
+        return 0
+    created = 0
+    with _refilling(image) as refilling:
+        if not refilling:
+            logger.info('Standby pool for ESXi {} is already being refilled'.format(image))
+            return 0
+        with vcenter_session() as vcenter:
+            folder = deploy.ensure_folder(vcenter, const.VLAB_ESXI_STANDBY_DIR)
+            members, claimed = get_members(vcenter, folder)
+            _reap_claims(folder, members, claimed)
+            available = [x for x in members if x[1].get('version') == image and x[0]._moId not in claimed]
+            try:
+                network = vcenter.networks[const.VLAB_ESXI_STANDBY_NETWORK]
+            except KeyError:
+                logger.error('No standby network named {}'.format(const.VLAB_ESXI_STANDBY_NETWORK))
+                return 0
+            for _ in range(target - len(available)):
+                make_member(vcenter, image, folder, network, logger)
+                created += 1
+    return created
+
+
+def _reap_claims(folder, members, claimed):
+    """Destroy claim folders left behind after their VM left the pool"""
+    in_pool = {x[0]._moId for x in members}
+    for child in folder.childEntity:
+        if isinstance(child, vim.Folder) and child.name.startswith(CLAIM_PREFIX):
+            if child.name[len(CLAIM_PREFIX):] not in in_pool:
+                _discard(child)
+
+
+def make_member(vcenter, image, folder, network, logger):
+    """Deploy, configure and boot one standby VM
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of ESXi
+    :type image: String
+
+    :param folder: The folder that holds the standby pool
+    :type folder: vim.Folder
+
+    :param network: The network standby VMs are connected to
+    :type network: vim.Network
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    machine_name = 'standby-{}-{}'.format(image, uuid.uuid4().hex[:8])
+    logger.info('Creating standby VM {}'.format(machine_name))
+    meta_data = {'component' : COMPONENT,
+                 'created': time.time(),
+                 'version': image,
+                 'configured': False,
+                 'generation': 1,
+                }
+    the_vm = None
+    if deploy.deploy_mode(image) == 'clone':
+        template = deploy.get_template(vcenter, image, network, logger)
+        if template is not None:
+            the_vm = deploy.clone_vm(template, folder, machine_name, network, logger,
+                                     config=deploy.config_spec(meta_data))
+    if the_vm is None:
+        ova = open_ova(os.path.join(const.VLAB_ESXI_IMAGES_DIR, 'esxi-{}.ova'.format(image)))
+        try:
+            network_map = vim.OvfManager.NetworkMapping(name=ova.networks[0], network=network)
+            the_vm = deploy.deploy_ova(vcenter, ova, [network_map], folder, machine_name, logger,
+                                       config=deploy.config_spec(meta_data))
+        finally:
+            ova.close()
+    try:
+        power(the_vm, state='on')
+        wait_for_boot(vcenter, the_vm)
+        # only now can it be claimed
+        meta_data['configured'] = True
+        virtual_machine.set_meta(the_vm, meta_data)
+    except Exception:
+        _discard(the_vm)
+        raise
+    return the_vm
+
+
+def wait_for_boot(vcenter, the_vm, timeout=None):
+    """Block until VMware Tools reports the guest is running. Instead of reading
+    the status once a second, vCenter tells us when it changes.
+
+    :Returns: None
+
+    :Raises: RuntimeError
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The standby VM
+    :type the_vm: vim.VirtualMachine
+
+    :param timeout: How many seconds to wait. Defaults to ``VLAB_ESXI_STANDBY_BOOT_TIMEOUT``
+    :type timeout: Integer
+    """
+    if timeout is None:
+        timeout = const.VLAB_ESXI_STANDBY_BOOT_TIMEOUT
+    deadline = time.time() + timeout
+    object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=the_vm)
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                               pathSet=['guest.toolsRunningStatus'])
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[object_spec], propSet=[property_spec])
+    # the filter goes away with its collector
+    collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+    try:
+        collector.CreateFilter(filter_spec, partialUpdates=False)
+        version = ''
+        while True:
+            remaining = int(deadline - time.time())
+            if remaining <= 0:
+                break
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=remaining)
+            update_set = collector.WaitForUpdatesEx(version, options)
+            if update_set is None:
+                continue
+            version = update_set.version
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    for change in object_update.changeSet:
+                        if change.val == vim.vm.GuestInfo.ToolsRunningStatus.guestToolsRunning:
+                            return
+    finally:
+        collector.DestroyPropertyCollector()
+    raise RuntimeError('Standby VM did not boot within {} seconds'.format(timeout))
@@ -3,12 +3,146 @@
 Entry point logic for available backend worker tasks
 """
 from celery import Celery
+from celery.signals import worker_ready, task_prerun, task_postrun
 from vlab_api_common import get_task_logger
 
-from vlab_esxi_api.lib import const
-from vlab_esxi_api.lib.worker import vmware
+from vlab_esxi_api.lib import const, events, images, metrics, read_model, results, routing, tracing
+from vlab_esxi_api.lib.worker import admission, ipwatch, standby, vmware
 
-app = Celery('esxi', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+app = Celery('esxi', broker=const.VLAB_MESSAGE_BROKER)
+results.configure(app)
+# Tasks spend nearly all their time waiting on vCenter, so by default one worker
+# process runs many of them in threads. The concurrency and prefetch depend on
+# which queues the worker consumes; see lib/routing.py
+app.conf.update(worker_pool=const.VLAB_ESXI_WORKER_POOL)
+routing.configure(app, worker=True)
+tracing.EXPORTER.service = 'vlab-esxi-worker'
+# Tasks that change a user's inventory, and take the username as the first arg.
+# Their state changes are published to the user's event stream.
+USER_TASKS = {'esxi.create', 'esxi.batch_create', 'esxi.delete', 'esxi.batch_delete', 'esxi.network'}
+# Which arg of a task is the image/version of ESXi, to label its metrics with
+IMAGE_ARGS = {'esxi.create': 2, 'esxi.batch_create': 2, 'esxi.standby': 0}
+
+
+def report_progress(task, unit='uploaded', username=None):
+    """Make a callback that publishes how far along a task is as the state of
+    the task, so the task status end point can show it.
+
+    :Returns: Function
+
+    :param task: The running task
+    :type task: celery.Task
+
+    :param unit: What's being counted, i.e. bytes 'uploaded' or instances 'finished'
+    :type unit: String
+
+    :param username: Also publish the progress to this user's event stream
+    :type username: String
+    """
+    # The request is thread local, and the callback can run in an upload thread
+    task_id = task.request.id
+    def callback(done, total):
+        percent = int(100 * done / total) if total else 100
+        meta = {unit: done, 'total': total, 'percent': percent}
+        task.update_state(task_id=task_id, state='PROGRESS', meta=meta)
+        if username is not None:
+            events.publish(username, 'task', {'task-id': task_id, 'name': task.name, 'status': 'PROGRESS', 'progress': meta})
+    return callback
+
+
+def report_queued(task, username):
+    """Make a callback that publishes a create's place in line as the state of
+    the task, while it waits for admission.
+
+    :Returns: Function
+
+    :param task: The running task
+    :type task: celery.Task
+
+    :param username: Also publish the place in line to this user's event stream
+    :type username: String
+    """
+    task_id = task.request.id
+    def callback(position, eta):
+        meta = {'position': position, 'eta': eta}
+        task.update_state(task_id=task_id, state='QUEUED', meta=meta)
+        events.publish(username, 'task', {'task-id': task_id, 'name': task.name, 'status': 'QUEUED', 'queue': meta})
+    return callback
+
+
+def record_created(username, machine_name, info):
+    """Add a new ESXi instance to the read-model, and if its IP is pending, have
+    the IP watcher fill it in later. Watching only starts once the pending info
+    is saved, so it can never overwrite the IP.
+
+    :Returns: None
+
+    :param username: The name of the user who owns the ESXi instance
+    :type username: String
+
+    :param machine_name: The name of the ESXi instance
+    :type machine_name: String
+
+    :param info: The info about the new ESXi instance
+    :type info: Dictionary
+    """
+    read_model.update(username, machine_name, info)
+    if info.get(ipwatch.PENDING_KEY, False):
+        ipwatch.WATCHER.watch(username, machine_name, info)
+
+
+@task_prerun.connect
+def publish_started(sender=None, task_id=None, task=None, args=None, **kwargs):
+    """Tell the user a task of theirs started running"""
+    if task is not None and task.name in USER_TASKS and args:
+        events.publish(args[0], 'task', {'task-id': task_id, 'name': task.name, 'status': 'STARTED'})
+
+
+@task_postrun.connect
+def publish_finished(sender=None, task_id=None, task=None, args=None, retval=None, state=None, **kwargs):
+    """Tell the user a task of theirs is done, and if it worked"""
+    if task is not None and task.name in USER_TASKS and args:
+        if isinstance(retval, dict):
+            error = retval.get('error', None)
+        else:
+            # i.e. the exception the task raised
+            error = None if retval is None else '{}'.format(retval)
+        events.publish(args[0], 'task', {'task-id': task_id, 'name': task.name, 'status': state, 'error': error})
+
+
+@task_prerun.connect
+def start_metrics(sender=None, task_id=None, task=None, args=None, **kwargs):
+    """Label the metrics recorded while a task runs with its name and image"""
+    if task is not None:
+        index = IMAGE_ARGS.get(task.name, None)
+        image = args[index] if index is not None and args and len(args) > index else ''
+        metrics.begin(task.name, image=image)
+
+
+@task_postrun.connect
+def finish_metrics(sender=None, task_id=None, task=None, retval=None, state=None, **kwargs):
+    """Record how long a task took, and if it worked"""
+    if task is not None:
+        failed = state != 'SUCCESS' or (isinstance(retval, dict) and retval.get('error', None))
+        metrics.end('error' if failed else 'ok')
+
+
+@task_prerun.connect
+def start_trace(sender=None, task_id=None, task=None, **kwargs):
+    """Continue the trace of the request that sent a task"""
+    if task is not None:
+        tracing.begin_task(task)
+
+
+@task_postrun.connect
+def finish_trace(sender=None, task_id=None, task=None, retval=None, state=None, **kwargs):
+    """Finish the span of a task"""
+    if task is not None:
+        if isinstance(retval, dict):
+            error = retval.get('error', None)
+        else:
+            error = None if state == 'SUCCESS' else '{}'.format(retval)
+        tracing.end_task(error=error)
 
 
 @app.task(name='esxi.show', bind=True)
@@ -26,6 +160,7 @@ def show(self, username, txn_id):
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESXI_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
+    listed_at = read_model.generation(username)
     try:
         info = vmware.show_esxi(username)
     except ValueError as doh:
@@ -34,6 +169,7 @@ def show(self, username, txn_id):
     else:
         logger.info('Task complete')
         resp['content'] = info
+        read_model.save(username, info, listed_at=listed_at)
     return resp
 
 
@@ -62,14 +198,110 @@ def create(self, username, machine_name, image, network, txn_id):
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        resp['content'] = vmware.create_esxi(username, machine_name, image, network, logger)
+        with admission.admitted(username, on_wait=report_queued(self, username)):
+            resp['content'] = vmware.create_esxi(username, machine_name, image, network, logger,
+                                                 progress=report_progress(self, username=username))
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        for name, info in resp['content'].items():
+            record_created(username, name, info)
+    if standby.pool_size(image):
+        refill_standby.delay(image, txn_id)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='esxi.batch_create', bind=True)
+def batch_create(self, username, machine_names, image, network, txn_id):
+    """Deploy many new instances of ESXi
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to create new ESXi instances
+    :type username: String
+
+    :param machine_names: The names of the new instances of ESXi
+    :type machine_names: List
+
+    :param image: The image/version of ESXi to create
+    :type image: String
+
+    :param network: The name of the network to connect the new ESXi instances up to
+    :type network: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESXI_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    # a batch deploys up to VLAB_ESXI_BATCH_WORKERS instances at once
+    slots = max(1, min(const.VLAB_ESXI_BATCH_WORKERS, len(machine_names)))
+    try:
+        with admission.admitted(username, slots=slots, on_wait=report_queued(self, username)):
+            created, failed = vmware.create_esxi_batch(username, machine_names, image, network, logger,
+                                                       progress=report_progress(self, unit='finished', username=username))
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+    else:
+        resp['content'] = {'created': created, 'failed': failed}
+        if failed:
+            resp['error'] = 'Failed to create {} of {} ESXi instances'.format(len(failed), len(machine_names))
+        for name, info in created.items():
+            record_created(username, name, info)
+    if standby.pool_size(image):
+        refill_standby.delay(image, txn_id)
+    logger.info('Task complete')
+    return resp
+
+
+@app.task(name='esxi.standby', bind=True)
+def refill_standby(self, image, txn_id):
+    """Top up the pool of standby VMs for an image/version of ESXi
+
+    :Returns: Dictionary
+
+    :param image: The image/version of ESXi
+    :type image: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESXI_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = {'created': standby.refill(image, logger)}
+    except Exception as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
     logger.info('Task complete')
     return resp
 
 
+@worker_ready.connect
+def clean_results(sender, **kwargs):
+    """Delete expired task results while the worker runs"""
+    results.start_cleanup(app)
+
+
+@worker_ready.connect
+def resume_ip_watch(sender, **kwargs):
+    """Fill in the IPs a worker that stopped was still waiting on"""
+    ipwatch.WATCHER.resume()
+
+
+@worker_ready.connect
+def fill_standby_pools(sender, **kwargs):
+    """Fill every configured standby pool when a worker starts"""
+    for version in vmware.list_images():
+        if standby.pool_size(version):
+            refill_standby.delay(version, 'worker-startup')
+
+
 @app.task(name='esxi.delete', bind=True)
 def delete(self, username, machine_name, txn_id):
     """Destroy an instance of ESXi
@@ -94,10 +326,49 @@ def delete(self, username, machine_name, txn_id):
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
     else:
+        read_model.remove(username, machine_name)
         logger.info('Task complete')
     return resp
 
 
+@app.task(name='esxi.batch_delete', bind=True)
+def batch_delete(self, username, machine_names, pattern, txn_id):
+    """Destroy many instances of ESXi
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to delete ESXi instances
+    :type username: String
+
+    :param machine_names: The names of the instances of ESXi, or None
+    :type machine_names: List
+
+    :param pattern: A shell-style wildcard of instances to destroy, or None.
+                    When both this and ``machine_names`` are None, every ESXi
+                    instance the user owns is destroyed.
+    :type pattern: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESXI_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        deleted, failed = vmware.delete_esxi_batch(username, logger, machine_names=machine_names, pattern=pattern)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        resp['content'] = {'deleted': deleted, 'failed': failed}
+        if failed:
+            resp['error'] = 'Failed to delete {} of {} ESXi instances'.format(len(failed), len(deleted) + len(failed))
+        for machine_name in deleted:
+            read_model.remove(username, machine_name)
+    logger.info('Task complete')
+    return resp
+
+
 @app.task(name='esxi.image', bind=True)
 def image(self, txn_id):
     """Obtain a list of available images/versions of ESXi that can be created
@@ -110,7 +381,8 @@ def image(self, txn_id):
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_ESXI_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
-    resp['content'] = {'image': vmware.list_images()}
+    catalogue = images.catalogue()
+    resp['content'] = {'image': [x['version'] for x in catalogue], 'catalogue': catalogue}
     logger.info('Task complete')
     return resp
 
@@ -126,5 +398,7 @@ def modify_network(self, username, machine_name, new_network, txn_id):
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+    else:
+        read_model.invalidate(username)
     logger.info('Task complete')
     return resp
@@ -1,11 +1,19 @@
 # -*- coding: UTF-8 -*-
 """Business logic for backend worker tasks"""
 import time
+import fnmatch
 import random
 import os.path
-from vlab_inf_common.vmware import vCenter, Ova, vim, virtual_machine, consume_task
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from vlab_esxi_api.lib import const
+from vlab_inf_common.vmware import vim, virtual_machine
+
+from vlab_esxi_api.lib import const, images, metrics, tracing
+from vlab_esxi_api.lib.images import convert_name
+from vlab_esxi_api.lib.worker import cache, deploy, inventory, ipwatch, standby
+from vlab_esxi_api.lib.worker.ova import open_ova
+from vlab_esxi_api.lib.worker.session import vcenter_session
+from vlab_esxi_api.lib.worker.waiter import consume_task, power, wait_for_tasks
 
 
 def show_esxi(username):
@@ -16,15 +24,17 @@ def show_esxi(username):
     :param username: The user requesting info about their ESXi
     :type username: String
     """
-    info = {}
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        esxi_vms = {}
-        for vm in folder.childEntity:
-            info = virtual_machine.get_info(vcenter, vm, username)
-            if info['meta']['component'] == 'ESXi':
-                esxi_vms[vm.name] = info
+    records = None
+    if const.VLAB_ESXI_INVENTORY_CACHE:
+        cache.CACHE.start()
+        records = cache.CACHE.esxi_records(username)
+    with vcenter_session() as vcenter, metrics.phase('inventory'):
+        if records is None:
+            folder = inventory.INDEX.folder(vcenter, username)
+            esxi_vms = inventory.get_esxi_vms(vcenter, folder, username)
+        else:
+            vms, network_names = records
+            esxi_vms = inventory.esxi_info(vcenter, vms, network_names, username)
     return esxi_vms
 
 
@@ -42,24 +52,93 @@ def delete_esxi(username, machine_name, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'ESXi':
-                    logger.debug('powering off VM')
-                    virtual_machine.power(entity, state='off')
-                    delete_task = entity.Destroy_Task()
-                    logger.debug('blocking while VM is being destroyed')
-                    consume_task(delete_task)
-                    break
+    with vcenter_session() as vcenter:
+        the_vm = inventory.INDEX.find_esxi(vcenter, username, machine_name)
+        logger.debug('powering off VM')
+        with metrics.phase('power_off'):
+            power(the_vm, state='off')
+        with metrics.phase('destroy'):
+            delete_task = the_vm.Destroy_Task()
+            logger.debug('blocking while VM is being destroyed')
+            consume_task(delete_task)
+        inventory.INDEX.forget(username, machine_name)
+
+
+def delete_esxi_batch(username, logger, machine_names=None, pattern=None):
+    """Destroy many of a user's ESXi instances at once. Every power off is
+    issued before waiting on any of them, then every destroy.
+
+    Supply ``machine_names`` or ``pattern``; supply neither to destroy all of
+    the user's ESXi instances.
+
+    :Returns: Tuple - (List of deleted instance names, Dictionary of instance name to error)
+
+    :param username: The user who wants to delete their ESXi instances
+    :type username: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param machine_names: The names of the instances to destroy
+    :type machine_names: List
+
+    :param pattern: A shell-style wildcard, i.e. ``lab-*``, of instances to destroy
+    :type pattern: String
+    """
+    failed = {}
+    with vcenter_session() as vcenter:
+        folder = inventory.INDEX.folder(vcenter, username)
+        vms, _ = inventory.get_vm_records(vcenter, folder)
+        owned = {}
+        for the_vm, props in vms.values():
+            if inventory.parse_meta(props.get('config.annotation', '')).get('component') == 'ESXi':
+                owned[props.get('name', '')] = (the_vm, props)
+        if machine_names is not None:
+            targets = {x: owned[x] for x in machine_names if x in owned}
+            failed.update({x: 'No esxi named {} found'.format(x) for x in machine_names if x not in owned})
+        elif pattern is not None:
+            targets = {x: y for x, y in owned.items() if fnmatch.fnmatchcase(x, pattern)}
         else:
-            raise ValueError('No {} named {} found'.format('esxi', machine_name))
+            targets = owned
+        logger.debug('powering off {} VMs'.format(len(targets)))
+        powered_on = {x: y[0] for x, y in targets.items() if y[1].get('runtime.powerState') == vim.VirtualMachinePowerState.poweredOn}
+        with metrics.phase('power_off'):
+            _run_all(powered_on, 'PowerOffVM_Task', failed)
+        logger.debug('destroying {} VMs'.format(len(targets)))
+        with metrics.phase('destroy'):
+            _run_all({x: y[0] for x, y in targets.items() if x not in failed}, 'Destroy_Task', failed)
+        deleted = [x for x in targets.keys() if x not in failed]
+        for machine_name in deleted:
+            inventory.INDEX.forget(username, machine_name)
+    return deleted, failed
+
+
+def _run_all(vms, method, failed):
+    """Start the same task on many VMs, then wait for all of them to finish
 
+    :Returns: None
 
-def create_esxi(username, machine_name, image, network, logger):
+    :param vms: The VMs to run the task on, by name
+    :type vms: Dictionary
+
+    :param method: The name of the task method, i.e. ``Destroy_Task``
+    :type method: String
+
+    :param failed: Updated with the error for every VM the task failed on
+    :type failed: Dictionary
+    """
+    tasks = {}
+    for machine_name, the_vm in vms.items():
+        try:
+            tasks[machine_name] = getattr(the_vm, method)()
+        except Exception as doh:
+            failed[machine_name] = '{}'.format(getattr(doh, 'msg', doh))
+    for machine_name, error in wait_for_tasks(tasks).items():
+        if error is not None:
+            failed[machine_name] = error
+
+
+def create_esxi(username, machine_name, image, network, logger, progress=None):
     """Deploy a new instance of ESXi
 
     :Returns: Dictionary
@@ -78,82 +157,187 @@ def create_esxi(username, machine_name, image, network, logger):
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
+
+    :param progress: Called with (bytes uploaded, total bytes) while the OVA uploads
+    :type progress: Function
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        image_name = convert_name(image)
-        logger.info(image_name)
-        ova = Ova(os.path.join(const.VLAB_ESXI_IMAGES_DIR, image_name))
-        try:
-            network_map = vim.OvfManager.NetworkMapping()
-            network_map.name = ova.networks[0]
-            try:
-                network_map.network = vcenter.networks[network]
-            except KeyError:
-                raise ValueError('No such network named {}'.format(network))
-            the_vm = virtual_machine.deploy_from_ova(vcenter=vcenter,
-                                                     ova=ova,
-                                                     network_map=[network_map],
-                                                     username=username,
-                                                     machine_name=machine_name,
-                                                     logger=logger,
-                                                     power_on=False)
-        finally:
-            ova.close()
-        config_vm(the_vm)
-        virtual_machine.power(the_vm, state='on')
-        meta_data = {'component' : "ESXi",
-                     'created': time.time(),
-                     'version': image,
-                     'configured': False,
-                     'generation': 1,
-                    }
-        virtual_machine.set_meta(the_vm, meta_data)
-        info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
+    with vcenter_session() as vcenter:
+        the_network = _get_network(vcenter, network)
+        template = _get_template(vcenter, image, the_network, logger)
+        the_vm, info = _create_one(vcenter, username, machine_name, image, the_network, template, logger,
+                                   progress=progress)
         return {the_vm.name: info}
 
 
-def list_images():
-    """Obtain a list of available versions of ESXi that can be created
+def create_esxi_batch(username, machine_names, image, network, logger, progress=None):
+    """Deploy many instances of ESXi at once. The vCenter session, image, and
+    placement are shared, and up to ``VLAB_ESXI_BATCH_WORKERS`` instances are
+    deployed at the same time.
 
-    :Returns: List
+    :Returns: Tuple - (Dictionary of created instances, Dictionary of instance name to error)
+
+    :Raises: ValueError if nothing could be created at all, i.e. the network does not exist
+
+    :param username: The name of the user who wants to create new ESXi instances
+    :type username: String
+
+    :param machine_names: The names of the new instances of ESXi
+    :type machine_names: List
+
+    :param image: The image/version of ESXi to create
+    :type image: String
+
+    :param network: The name of the network to connect the new ESXi instances up to
+    :type network: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param progress: Called with (instances finished, total instances)
+    :type progress: Function
     """
-    images = os.listdir(const.VLAB_ESXI_IMAGES_DIR)
-    images = [convert_name(x, to_version=True) for x in images]
-    return images
+    created = {}
+    failed = {}
+    with vcenter_session() as vcenter:
+        the_network = _get_network(vcenter, network)
+        template = _get_template(vcenter, image, the_network, logger)
+        placement = deploy.get_placement(vcenter)
+        workers = max(1, min(const.VLAB_ESXI_BATCH_WORKERS, len(machine_names)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(metrics.carry(tracing.carry(_create_one)), vcenter, username, machine_name, image, the_network,
+                                       template, logger, placement=placement): machine_name
+                       for machine_name in machine_names}
+            for future in as_completed(futures):
+                machine_name = futures[future]
+                try:
+                    the_vm, info = future.result()
+                except Exception as doh:
+                    logger.error('Failed to create {}: {}'.format(machine_name, doh))
+                    failed[machine_name] = '{}'.format(doh)
+                else:
+                    created[the_vm.name] = info
+                if progress is not None:
+                    progress(len(created) + len(failed), len(machine_names))
+    return created, failed
+
+
+def _get_network(vcenter, network):
+    """Look up a network by name, or raise ValueError"""
+    try:
+        return vcenter.networks[network]
+    except KeyError:
+        raise ValueError('No such network named {}'.format(network))
+
+
+def _get_template(vcenter, image, network, logger):
+    """Obtain the base VM to clone, or None if the image is deployed from the OVA"""
+    if deploy.deploy_mode(image) != 'clone':
+        return None
+    with metrics.phase('template'):
+        template = deploy.get_template(vcenter, image, network, logger)
+    if template is None:
+        logger.info('No base VM for ESXi {}, uploading OVA instead'.format(image))
+    return template
+
+
+def _create_one(vcenter, username, machine_name, image, the_network, template, logger, progress=None, placement=None):
+    """Create, configure and power on one instance of ESXi
+
+    :Returns: Tuple - (vim.VirtualMachine, Dictionary of info about the VM)
+
+    :param vcenter: An established connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param username: The name of the user who wants to create a new ESXi
+    :type username: String
 
+    :param machine_name: The name of the new instance of ESXi
+    :type machine_name: String
 
-def convert_name(name, to_version=False):
-    """This function centralizes converting between the name of the OVA, and the
-    version of software it contains.
+    :param image: The image/version of ESXi to create
+    :type image: String
+
+    :param the_network: The network to connect the new ESXi instance up to
+    :type the_network: vim.Network
 
-    The naming convention of the ESXi OVAs is ``esxi-<version>.ova``; i.e. esxi-6.7u1.ova
+    :param template: The base VM to make a linked clone of, or None to upload the OVA
+    :type template: vim.VirtualMachine
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
 
-    :param name: The thing to covert
-    :type name: String
+    :param progress: Called with (bytes uploaded, total bytes) while the OVA uploads
+    :type progress: Function
 
-    :param to_version: Set to True to covert the name of an OVA to the version
-    :type to_version: Boolean
+    :param placement: Where the VM can go. Looked up if not supplied.
+    :type placement: deploy.Placement
     """
-    if to_version:
-        return name.split('-')[-1].replace('.ova', '')
+    deploy.check_name(machine_name)
+    folder = inventory.INDEX.folder(vcenter, username)
+    meta_data = {'component' : "ESXi",
+                 'created': time.time(),
+                 'version': image,
+                 'configured': False,
+                 'generation': 1,
+                }
+    claimed = None
+    if standby.pool_size(image):
+        with metrics.phase('standby_claim'):
+            claimed = standby.claim(vcenter, image)
+    if claimed is not None:
+        the_vm, claim_folder = claimed
+        with metrics.phase('standby_adopt'):
+            stale_ips = standby.adopt(the_vm, claim_folder, folder, machine_name, the_network, logger,
+                                      meta_data=meta_data)
+    elif template is not None:
+        with metrics.phase('clone'):
+            the_vm = deploy.clone_vm(template, folder, machine_name, the_network, logger,
+                                     config=deploy.config_spec(meta_data))
     else:
-        return 'esxi-{}.ova'.format(name)
-
+        image_name = convert_name(image)
+        logger.info(image_name)
+        with metrics.phase('ova_open'):
+            ova = open_ova(os.path.join(const.VLAB_ESXI_IMAGES_DIR, image_name), progress=progress)
+        try:
+            network_map = vim.OvfManager.NetworkMapping()
+            network_map.name = ova.networks[0]
+            network_map.network = the_network
+            with metrics.phase('upload'):
+                the_vm = deploy.deploy_ova(vcenter, ova, [network_map], folder, machine_name, logger,
+                                           placement=placement, config=deploy.config_spec(meta_data))
+        finally:
+            ova.close()
+    inventory.INDEX.remember(username, machine_name, the_vm._moId)
+    if claimed is None:
+        # nestedHVEnabled and the meta data were set by the clone/import
+        with metrics.phase('power_on'):
+            power(the_vm, state='on')
+    with metrics.phase('get_info'):
+        if claimed is not None:
+            # The guest may still report the IP it had on the standby network.
+            # Instead of waiting for the new one, the IP watcher fills it in.
+            info = virtual_machine.get_info(vcenter, the_vm, username)
+            info['ips'] = [x for x in info['ips'] if x not in stale_ips]
+            if not info['ips']:
+                info[ipwatch.PENDING_KEY] = True
+                ipwatch.WATCHER.ignore(the_vm._moId, stale_ips)
+        elif const.VLAB_ESXI_WAIT_FOR_IP:
+            info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True,
+                                            ensure_timeout=const.VLAB_ESXI_IP_TIMEOUT)
+        else:
+            # the caller hands the VM to ipwatch.WATCHER once the info is saved
+            info = virtual_machine.get_info(vcenter, the_vm, username)
+            if not info['ips']:
+                info[ipwatch.PENDING_KEY] = True
+    return the_vm, info
 
-def config_vm(the_vm):
-    """Enable hardware-assisted virtualization so 64-bit OSes can run on the
-    virtual ESXi host.
 
-    :Returns: None
+def list_images():
+    """Obtain a list of available versions of ESXi that can be created
 
-    :param the_vm: The new ESXi virtual machine object
-    :type the_vm: vim.VirtualMachine
+    :Returns: List
     """
-    spec = vim.vm.ConfigSpec()
-    spec.nestedHVEnabled = True
-    task = the_vm.ReconfigVM_Task(spec)
-    consume_task(task)
+    return [x['version'] for x in images.catalogue()]
 
 
 def update_network(username, machine_name, new_network):
@@ -168,23 +352,13 @@ def update_network(username, machine_name, new_network):
     :param new_network: The name of the new network to connect the VM to
     :type new_network: String
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'ESXi':
-                    the_vm = entity
-                    break
-        else:
-            error = 'No VM named {} found'.format(machine_name)
-            raise ValueError(error)
-
+    with vcenter_session() as vcenter:
+        the_vm = inventory.INDEX.find_esxi(vcenter, username, machine_name)
         try:
             network = vcenter.networks[new_network]
         except KeyError:
             error = 'No VM named {} found'.format(machine_name)
             raise ValueError(error)
         else:
-            virtual_machine.change_network(the_vm, network)
+            with metrics.phase('change_network'):
+                virtual_machine.change_network(the_vm, network)
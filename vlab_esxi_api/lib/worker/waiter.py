@@ -0,0 +1,362 @@
+# -*- coding: UTF-8 -*-
+"""
+Wait on many vCenter tasks over one connection.
+
+``consume_task`` from ``vlab_inf_common`` reads ``task.info`` once a second, per
+task, per thread. Under load that's dozens of threads polling vCenter. The
+``TaskWaiter`` in this module instead adds a PropertyCollector filter for the
+tasks being waited on, and a single background thread consumes the changes with
+``WaitForUpdatesEx``. Callers block on an event until vCenter reports the task
+finished.
+
+If the update stream is down (or disabled), waiting falls back to polling, so
+callers never need to care which one they got.
+"""
+import os
+import time
+import threading
+from collections import namedtuple
+
+from pyVmomi import vim, vmodl
+from vlab_api_common import get_logger
+
+from vlab_esxi_api.lib import const
+from vlab_esxi_api.lib.worker.session import new_vcenter
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_ESXI_LOG_LEVEL)
+TASK_PROPERTIES = ['info.state', 'info.error', 'info.result']
+DONE_STATES = (vim.TaskInfo.State.success, vim.TaskInfo.State.error)
+Outcome = namedtuple('Outcome', ['error', 'result'])
+
+
+class _Watch(object):
+    """The latest state of one task, and an event that's set when it's finished"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.props = {}
+        self.broken = False
+
+    def outcome(self, the_task):
+        """Convert what vCenter reported into an Outcome
+
+        :param the_task: The task, as the caller sees it
+        :type the_task: vim.Task
+        """
+        error = self.props.get('info.error', None)
+        if error is not None:
+            return Outcome('{}'.format(getattr(error, 'msg', error)), None)
+        return Outcome(None, _rebind(self.props.get('info.result', None), the_task))
+
+
+def _rebind(result, the_task):
+    """A managed object reported by the waiter is bound to the waiter's own session,
+    so hand the caller the same object bound to the session of its task instead.
+    """
+    if isinstance(result, vim.ManagedObject):
+        return type(result)(result._moId, the_task._stub)
+    return result
+
+
+def _timeout_error(timeout, the_task):
+    """The error message for a task that did not finish in time"""
+    return 'Timeout of {} seconds exceeded for task {}'.format(timeout, the_task)
+
+
+def poll(tasks, timeout=600):
+    """Wait for many vCenter tasks by reading each one's info once a second
+
+    :Returns: Dictionary - the same keys as ``tasks``, and an Outcome
+
+    :param tasks: The tasks to wait on
+    :type tasks: Dictionary
+
+    :param timeout: How many seconds to wait for all the tasks to finish
+    :type timeout: Integer
+    """
+    outcome = {}
+    pending = dict(tasks)
+    for _ in range(timeout):
+        for key, the_task in list(pending.items()):
+            info = the_task.info
+            if info.completeTime:
+                if info.error:
+                    outcome[key] = Outcome(info.error.msg, None)
+                else:
+                    outcome[key] = Outcome(None, info.result)
+                pending.pop(key)
+        if not pending:
+            break
+        time.sleep(1)
+    for key, the_task in pending.items():
+        outcome[key] = Outcome(_timeout_error(timeout, the_task), None)
+    return outcome
+
+
+class TaskWaiter(object):
+    """Watches vCenter tasks on behalf of every thread in the process.
+
+    The waiter has its own vCenter session because ``WaitForUpdatesEx`` blocks.
+    Each call to ``wait`` adds one filter for its tasks, and removes it once
+    they're all done. If the stream breaks, any thread currently waiting is
+    woken up and polls for the rest of its tasks.
+
+    :param factory: A callable that returns a new, logged in vCenter object
+    :type factory: Function
+
+    :param enabled: Set to False to always poll
+    :type enabled: Boolean
+
+    :param wait_seconds: How long a single ``WaitForUpdatesEx`` call blocks
+    :type wait_seconds: Integer
+
+    :param retry_seconds: How long to wait before reconnecting a broken stream
+    :type retry_seconds: Integer
+    """
+    def __init__(self, factory, enabled, wait_seconds, retry_seconds):
+        self._factory = factory
+        self._enabled = enabled
+        self._wait_seconds = wait_seconds
+        self._retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._vcenter = None
+        self._collector = None
+        self._watches = {}
+
+    def start(self):
+        """Start consuming task updates, if it's not already running in this process
+
+        :Returns: None
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._collector = None
+            self._watches = {}
+            self._thread = threading.Thread(target=self._run, name='esxi-task-waiter', daemon=True)
+            self._thread.start()
+
+    def ready(self):
+        """Test if task updates are being received right now
+
+        :Returns: Boolean
+        """
+        with self._lock:
+            return self._pid == os.getpid() and self._collector is not None
+
+    def _run(self):
+        """Consume task updates forever, reconnecting when the stream breaks"""
+        while True:
+            try:
+                vcenter = self._factory()
+                try:
+                    self._watch(vcenter)
+                finally:
+                    vcenter.close()
+            except Exception as doh:
+                logger.error('Task waiter update stream broke: {}'.format(doh))
+            self._break()
+            time.sleep(self._retry_seconds)
+
+    def _watch(self, vcenter):
+        """Block on task updates, and wake up whoever is waiting on a finished task"""
+        collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+        try:
+            with self._lock:
+                self._vcenter = vcenter
+                self._collector = collector
+            options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self._wait_seconds)
+            version = ''
+            while True:
+                update_set = collector.WaitForUpdatesEx(version, options)
+                with self._lock:
+                    if self._collector is not collector:
+                        # a ``wait`` found the stream broken; reconnect
+                        return
+                if update_set is not None:
+                    self.apply(update_set)
+                    version = update_set.version
+        finally:
+            with self._lock:
+                self._collector = None
+            collector.DestroyPropertyCollector()
+
+    def _break(self):
+        """Wake every waiting thread, so they poll instead"""
+        with self._lock:
+            self._collector = None
+            watches, self._watches = self._watches, {}
+        for records in watches.values():
+            for record in records:
+                record.broken = True
+                record.event.set()
+
+    def apply(self, update_set):
+        """Record the changes vCenter reported, and wake up the threads whose task finished
+
+        :Returns: None
+
+        :param update_set: The changes returned by ``WaitForUpdatesEx``
+        :type update_set: vmodl.query.PropertyCollector.UpdateSet
+        """
+        with self._lock:
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    records = self._watches.get(object_update.obj._moId, ())
+                    for record in records:
+                        for change in object_update.changeSet:
+                            record.props[change.name] = change.val
+                        if record.props.get('info.state', None) in DONE_STATES:
+                            record.event.set()
+
+    def wait(self, tasks, timeout=600):
+        """Block until every task is finished, or the timeout is hit
+
+        :Returns: Dictionary - the same keys as ``tasks``, and an Outcome
+
+        :param tasks: The tasks to wait on
+        :type tasks: Dictionary
+
+        :param timeout: How many seconds to wait for all the tasks to finish
+        :type timeout: Integer
+        """
+        if not tasks:
+            return {}
+        if not self._enabled:
+            return poll(tasks, timeout)
+        self.start()
+        with self._lock:
+            vcenter, collector = self._vcenter, self._collector
+        if collector is None or self._pid != os.getpid():
+            return poll(tasks, timeout)
+        watches = {key: _Watch() for key in tasks.keys()}
+        stub = vcenter._conn._stub
+        object_specs = []
+        with self._lock:
+            for key, the_task in tasks.items():
+                self._watches.setdefault(the_task._moId, []).append(watches[key])
+                # the same task, as seen by the waiter's session
+                object_specs.append(vmodl.query.PropertyCollector.ObjectSpec(obj=vim.Task(the_task._moId, stub)))
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=TASK_PROPERTIES)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=object_specs, propSet=[property_spec])
+        the_filter = None
+        try:
+            try:
+                the_filter = collector.CreateFilter(filter_spec, partialUpdates=False)
+            except Exception as doh:
+                # i.e. the waiter's session expired; every waiting thread polls
+                # until the stream reconnects
+                logger.warning('Unable to watch tasks, polling instead: {}'.format(doh))
+                self._break()
+                return poll(tasks, timeout)
+            return self._collect(tasks, watches, timeout)
+        finally:
+            self._forget(tasks, watches)
+            if the_filter is not None:
+                try:
+                    the_filter.Destroy()
+                except Exception as doh:
+                    logger.debug('Unable to destroy task filter: {}'.format(doh))
+
+    def _collect(self, tasks, watches, timeout):
+        """Block on the events of the watched tasks"""
+        outcome = {}
+        leftover = {}
+        deadline = time.time() + timeout
+        for key, record in watches.items():
+            if not record.event.wait(max(0, deadline - time.time())):
+                outcome[key] = Outcome(_timeout_error(timeout, tasks[key]), None)
+            elif record.broken:
+                leftover[key] = tasks[key]
+            else:
+                outcome[key] = record.outcome(tasks[key])
+        if leftover:
+            outcome.update(poll(leftover, max(1, int(deadline - time.time()))))
+        return outcome
+
+    def _forget(self, tasks, watches):
+        """Stop routing updates to the events of a finished ``wait``"""
+        with self._lock:
+            for key, the_task in tasks.items():
+                records = self._watches.get(the_task._moId, [])
+                if watches[key] in records:
+                    records.remove(watches[key])
+                if not records:
+                    self._watches.pop(the_task._moId, None)
+
+
+WAITER = TaskWaiter(factory=new_vcenter,
+                    enabled=const.VLAB_ESXI_TASK_WAITER,
+                    wait_seconds=const.VLAB_ESXI_TASK_WAIT_SECONDS,
+                    retry_seconds=const.VLAB_ESXI_CACHE_RETRY_SECONDS)
+
+
+def consume_task(the_task, timeout=600):
+    """Wait for a task to complete; a drop in for ``vlab_inf_common.vmware.consume_task``
+
+    :Returns: vim.TaskInfo.result
+
+    :Raises: RuntimeError
+
+    :param the_task: The pyVmomi task that you're waiting on
+    :type the_task: vim.Task
+
+    :param timeout: How many seconds to wait for a task to complete
+    :type timeout: Integer
+    """
+    outcome = WAITER.wait({'task': the_task}, timeout=timeout)['task']
+    if outcome.error is not None:
+        raise RuntimeError(outcome.error)
+    return outcome.result
+
+
+def wait_for_tasks(tasks, timeout=600):
+    """Wait for many vCenter tasks to finish
+
+    :Returns: Dictionary - the same keys as ``tasks``, and the error message, or None if the task worked
+
+    :param tasks: The tasks to wait on
+    :type tasks: Dictionary
+
+    :param timeout: How many seconds to wait for all the tasks to finish
+    :type timeout: Integer
+    """
+    return {key: outcome.error for key, outcome in WAITER.wait(tasks, timeout=timeout).items()}
+
+
+def power(the_vm, state, timeout=600):
+    """Turn a VM on or off, like ``vlab_inf_common.vmware.virtual_machine.power``,
+    but waiting on the task with the ``TaskWaiter``
+
+    :Returns: Boolean
+
+    :param the_vm: The pyVmomi Virtual machine object
+    :type the_vm: vim.VirtualMachine
+
+    :param state: The power state to put the VM into. Valid values are "on" "off" and "restart"
+    :type state: String
+
+    :param timeout: How many seconds to wait on the power state change
+    :type timeout: Integer
+    """
+    valid_states = {'on', 'off', 'restart'}
+    if state not in valid_states:
+        error = 'state must be one of {}, supplied {}'.format(valid_states, state)
+        raise ValueError(error)
+    vm_power_state = the_vm.runtime.powerState.lower().replace('powered', '')
+    if vm_power_state == state:
+        return True
+    elif state == 'on' or (vm_power_state == 'off' and state == 'restart'):
+        task = the_vm.PowerOnVM_Task()
+    elif state == 'off':
+        task = the_vm.PowerOffVM_Task()
+    else:
+        task = the_vm.ResetVM_Task()
+    try:
+        consume_task(task, timeout=timeout)
+    except RuntimeError:
+        return False
+    return True